@@ -1,8 +1,15 @@
-import copy
 import re
+from types import MappingProxyType
 
 import numpy as np
 from scipy.optimize import curve_fit
+from scipy.spatial import cKDTree
+
+
+def unit_vectors(ra, dec):
+    """Returns the unit vectors (..., 3) of positions on the celestial sphere (in rad)"""
+    ra, dec = np.asarray(ra, dtype=float), np.asarray(dec, dtype=float)
+    return np.stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)], axis=-1)
 
 
 class catalog_parser:
@@ -13,6 +20,10 @@ class catalog_parser:
         """
         cls = self.__class__
         self._cat = cls.read_caltable(filename)
+        # read-only view of the sources, and a spatial index of their positions (in the order of the file)
+        self._view = MappingProxyType({name: MappingProxyType(src) for name, src in self._cat.items()})
+        self._names = list(self._cat)
+        self._tree = cKDTree(unit_vectors([src["ra"] for src in self._cat.values()], [src["decl"] for src in self._cat.values()]).reshape(-1, 3))
 
     # Comment by Josh: @property is a means to protect private
     # Variables
@@ -22,8 +33,35 @@ class catalog_parser:
     # a.db = XXX is then impossible.
     @property
     def db(self):
-        """Returns a copy of divine sky knowledge"""
-        return copy.deepcopy(self._cat)
+        """Returns a read-only view of divine sky knowledge"""
+        return self._view
+
+    def crossmatch(self, ra, dec, tol=2.9e-3):
+        """
+        Finds the calibrators at the given positions, in a single query of the spatial index
+        (so that all fields of all MSs can be matched at once)
+
+        :ra, dec: positions in rad (scalars or arrays)
+        :tol: tolerance in rad (default: 10 arcmin)
+        :returns: for every position, the name of the first calibrator in the database
+                  that is closer than tol (None if there is none), and its angular distance
+                  in rad (NaN if there is no match)
+        """
+        xyz = unit_vectors(ra, dec).reshape(-1, 3)
+        names, dists = [None] * len(xyz), np.full(len(xyz), np.nan)
+        if not self._names:
+            return names, dists
+        # the chord length of the tolerance, with some margin for rounding
+        chord = 2 * np.sin(min(tol, np.pi) / 2) * (1 + 1e-9)
+        for ii, candidates in enumerate(self._tree.query_ball_point(xyz, chord)):
+            if not candidates:
+                continue
+            candidates = np.sort(candidates)
+            dist = 2 * np.arcsin(np.clip(np.linalg.norm(self._tree.data[candidates] - xyz[ii], axis=1) / 2, 0, 1))
+            matched = np.nonzero(dist < tol)[0]
+            if len(matched):
+                names[ii], dists[ii] = self._names[candidates[matched[0]]], dist[matched[0]]
+        return names, dists
 
     def __str__(self):
         """Return multiline string describing the calibrator database"""
@@ -0,0 +1,277 @@
+import json
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import psutil
+from astropy.io import fits
+from astropy.wcs import WCS
+from scipy import stats
+
+from caracal import log
+from caracal.dispatch_crew import step_cache
+
+# rows of an image plane read at a time
+CHUNK_ROWS = 512
+# pixels of an image kept (systematically subsampled) for the median, MAD and normality test
+SAMPLE_SIZE = 2**20
+# the Shapiro-Wilk p-value is only accurate for up to this many samples
+SHAPIRO_SIZE = 5000
+
+# process-wide cache: image path -> (fingerprint of image, ImageStats)
+_CACHE = {}
+_CACHE_LOCK = threading.Lock()
+# serializes updates of results files, which targets processed concurrently share
+_RESULTS_LOCK = threading.Lock()
+
+
+class ImageStats(object):
+    def __init__(self, path, header, shape):
+        """
+        Pixel statistics of the first plane of a FITS image, accumulated over chunks of rows: the central moments
+        (combined as in Chan et al. 1979), the extrema and their positions, and a systematic subsample of the pixels.
+        Blanked (NaN) pixels are left out.
+        """
+        self.path, self.header, self.shape = path, header, shape
+        self.n, self.mean, self.m2, self.m3, self.m4, self.sumsq = 0, 0.0, 0.0, 0.0, 0.0, 0.0
+        self.min, self.max, self.argmin, self.argmax = np.inf, -np.inf, None, None
+        self.sample = np.zeros(0)
+
+    @classmethod
+    def from_chunk(cls, path, header, shape, chunk, row0, stride):
+        """Returns the statistics of rows row0 onwards of the image plane"""
+        st = cls(path, header, shape)
+        good = np.isfinite(chunk)
+        values = chunk[good].astype(np.float64)
+        st.sample = chunk.ravel()[(-row0 * shape[1]) % stride :: stride]
+        st.sample = st.sample[np.isfinite(st.sample)].astype(np.float64)
+        if not len(values):
+            return st
+        st.n, st.mean = len(values), values.mean()
+        dev = values - st.mean
+        dev2 = dev**2
+        st.m2, st.m3, st.m4, st.sumsq = dev2.sum(), (dev2 * dev).sum(), (dev2**2).sum(), (values**2).sum()
+        masked = np.where(good, chunk, np.nan)
+        imin, imax = np.nanargmin(masked), np.nanargmax(masked)
+        st.min, st.max = float(masked.flat[imin]), float(masked.flat[imax])
+        st.argmin = (row0 + imin // shape[1], imin % shape[1])
+        st.argmax = (row0 + imax // shape[1], imax % shape[1])
+        return st
+
+    def combine(self, other):
+        """Adds the statistics of other (of a different set of pixels) to these"""
+        na, nb = self.n, other.n
+        n = na + nb
+        if nb:
+            delta = other.mean - self.mean
+            m2, m3 = self.m2, self.m3
+            self.m4 += (
+                other.m4 + delta**4 * na * nb * (na**2 - na * nb + nb**2) / n**3 + 6 * delta**2 * (na**2 * other.m2 + nb**2 * m2) / n**2 + 4 * delta * (na * other.m3 - nb * m3) / n
+            )
+            self.m3 += other.m3 + delta**3 * na * nb * (na - nb) / n**2 + 3 * delta * (na * other.m2 - nb * m2) / n
+            self.m2 += other.m2 + delta**2 * na * nb / n
+            self.mean += delta * nb / n
+            self.n, self.sumsq = n, self.sumsq + other.sumsq
+            if other.min < self.min:
+                self.min, self.argmin = other.min, other.argmin
+            if other.max > self.max:
+                self.max, self.argmax = other.max, other.argmax
+        self.sample = np.concatenate([self.sample, other.sample])
+        return self
+
+    @property
+    def rms(self):
+        return math.sqrt(self.sumsq / self.n) if self.n else np.nan
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / self.n) if self.n else np.nan
+
+    @property
+    def skew(self):
+        return math.sqrt(self.n) * self.m3 / self.m2**1.5 if self.m2 else np.nan
+
+    @property
+    def kurt(self):
+        """Pearson kurtosis (3 for a normal distribution)"""
+        return self.n * self.m4 / self.m2**2 if self.m2 else np.nan
+
+    @property
+    def mad(self):
+        """Median absolute deviation from the median (of the subsample)"""
+        return float(np.median(np.abs(self.sample - np.median(self.sample)))) if len(self.sample) else np.nan
+
+    def normality(self, test="normaltest"):
+        """Returns the [statistic, p-value] of a normality test ('normaltest' or 'shapiro') of the subsample"""
+        if test == "shapiro":
+            sample = self.sample[:: max(1, -(-len(self.sample) // SHAPIRO_SIZE))]
+            result = stats.shapiro(sample)
+        elif test == "normaltest":
+            result = stats.normaltest(self.sample)
+        else:
+            raise ValueError(f"unknown normality test '{test}'")
+        return [float(result[0]), float(result[1])]
+
+
+def _plane(data):
+    """Returns the first plane (y, x) of FITS image data"""
+    return data[(0,) * (data.ndim - 2)]
+
+
+def compute(path, chunk_rows=CHUNK_ROWS, nthreads=0):
+    """Computes the statistics of the first plane of a FITS image in one pass, over chunks of chunk_rows rows of the
+    memory-mapped image, in up to nthreads threads (0: one per CPU)"""
+    with fits.open(path, memmap=True) as hdul:
+        header, plane = hdul[0].header, _plane(hdul[0].data)
+        ny, nx = plane.shape
+        stride = max(1, -(-ny * nx // SAMPLE_SIZE))
+
+        def _chunk(row0):
+            return ImageStats.from_chunk(path, header, plane.shape, np.asarray(plane[row0 : row0 + chunk_rows]), row0, stride)
+
+        rows = range(0, ny, chunk_rows)
+        nthreads = max(1, min(nthreads or psutil.cpu_count() or 1, len(rows)))
+        with ThreadPoolExecutor(nthreads) as pool:
+            chunks = list(pool.map(_chunk, rows))
+    result = ImageStats(path, header, (ny, nx))
+    for chunk in chunks:
+        result.combine(chunk)
+    return result
+
+
+def get(path, chunk_rows=CHUNK_ROWS, nthreads=0):
+    """Returns the statistics of a FITS image, computing them only if the image has changed since they were last
+    computed in this process (so that successive convergence checks share a single pass over each image)"""
+    key = os.path.abspath(path)
+    fingerprint = step_cache.fingerprint(key)
+    with _CACHE_LOCK:
+        cached = _CACHE.get(key)
+    if cached and cached[0] == fingerprint:
+        return cached[1]
+    result = compute(path, chunk_rows=chunk_rows, nthreads=nthreads)
+    with _CACHE_LOCK:
+        _CACHE[key] = fingerprint, result
+    return result
+
+
+def _local_box(residual, centre, area_factor):
+    """Returns the (finite) pixels of the residual image in a box of area_factor beams (BMAJ of the header) across,
+    around centre (y, x), or None if the box is outside the image"""
+    res = get(residual)
+    cdelt = abs(res.header.get("CDELT2", 0)) or 1
+    beam = res.header.get("BMAJ", cdelt) / cdelt
+    half = max(1, int(round(area_factor * beam / 2)))
+    y, x = int(round(centre[0])), int(round(centre[1]))
+    ny, nx = res.shape
+    if not (0 <= y < ny and 0 <= x < nx):
+        return None
+    with fits.open(residual, memmap=True) as hdul:
+        box = np.asarray(_plane(hdul[0].data)[max(0, y - half) : y + half + 1, max(0, x - half) : x + half + 1], dtype=np.float64)
+    box = box[np.isfinite(box)]
+    return box if len(box) else None
+
+
+def _dynamic_range(peak, residual, centre, area_factor):
+    """
+    Returns the dynamic range of a peak at centre (y, x), as aimfast defines it: over the standard deviation of the
+    residual image ('DR' and 'DR_global_rms'), over that of the residual in a box of area_factor beams around the peak
+    ('DR_local_rms'), and over the deepest negative of the residual in that box ('DR_deepest_negative'). The local
+    ones fall back to the whole residual image if the box is outside it.
+    """
+    res = get(residual)
+    box = _local_box(residual, centre, area_factor) if centre is not None else None
+    local_std = box.std() if box is not None else res.std
+    deepest = box.min() if box is not None else res.min
+    global_dr = float(peak / res.std)
+    return {
+        "DR": global_dr,
+        "DR_deepest_negative": float(peak / abs(deepest)) if deepest else np.inf,
+        "DR_global_rms": global_dr,
+        "DR_local_rms": float(peak / local_std) if local_std else np.inf,
+    }
+
+
+def residual_stats(residual, normality="normaltest"):
+    """Returns the statistics of a residual image, as aimfast reports them"""
+    res = get(residual)
+    return {
+        "RMS": res.rms,
+        "STDDev": res.std,
+        "MEAN": res.mean,
+        "MAD": res.mad,
+        "SKEW": res.skew,
+        "KURT": res.kurt,
+        "NORM": res.normality(normality),
+    }
+
+
+def image_dynamic_range(restored, residual, area_factor=6):
+    """Returns the dynamic range of a restored image: its peak over the residual noise (see _dynamic_range())"""
+    img = get(restored)
+    return _dynamic_range(img.max, residual, img.argmax, area_factor)
+
+
+def read_gaul(path):
+    """Returns the RA, Dec (deg) and peak flux of the components of a PyBDSF Gaussian list (ascii format)"""
+    names = None
+    with open(path) as stdr:
+        for line in stdr:
+            if line.startswith("#") and "Peak_flux" in line:
+                names = line.lstrip("#").split()
+            elif line.startswith("#"):
+                continue
+            else:
+                break
+    if names is None:
+        raise ValueError(f"{path} is not a PyBDSF Gaussian list")
+    data = np.loadtxt(path, comments="#", ndmin=2, usecols=[names.index(col) for col in ("RA", "DEC", "Peak_flux")])
+    return data[:, 0], data[:, 1], data[:, 2]
+
+
+def model_dynamic_range(gauls, residual, area_factor=6):
+    """Returns the dynamic range of a sky model (PyBDSF Gaussian lists): its brightest peak over the residual noise
+    (see _dynamic_range())"""
+    ra, dec, peak = (np.concatenate(cols) for cols in zip(*map(read_gaul, gauls)))
+    if not len(peak):
+        return {"DR": 0.0, "DR_deepest_negative": 0.0, "DR_global_rms": 0.0, "DR_local_rms": 0.0}
+    brightest = np.argmax(peak)
+    try:
+        x, y = WCS(get(residual).header).celestial.all_world2pix(ra[brightest], dec[brightest], 0)
+        centre = (float(y), float(x))
+    except Exception:
+        centre = None
+    return _dynamic_range(peak[brightest], residual, centre, area_factor)
+
+
+def fidelity_results(label, residual, restored=None, gauls=None, area_factor=6, normality="normaltest"):
+    """
+    Returns the fidelity metrics of a selfcal iteration, in the layout of aimfast's fidelity_results.json:
+    the residual statistics under '<label>-residual' (with the dynamic range of the sky model, if gauls are given,
+    under its '<label>-model' entry), and the dynamic range of the restored image, if given, under '<label>-restored'
+    """
+    results = {f"{label}-residual": residual_stats(residual, normality)}
+    if gauls:
+        results[f"{label}-residual"][f"{label}-model"] = model_dynamic_range(gauls, residual, area_factor)
+    if restored:
+        results[f"{label}-restored"] = image_dynamic_range(restored, residual, area_factor)
+    return results
+
+
+def save_fidelity_results(outfile, label, residual, restored=None, gauls=None, area_factor=6, normality="normaltest"):
+    """Adds the fidelity metrics of a selfcal iteration (see fidelity_results()) to the JSON file outfile"""
+    new = fidelity_results(label, residual, restored=restored, gauls=gauls, area_factor=area_factor, normality=normality)
+    with _RESULTS_LOCK:
+        results = {}
+        if os.path.exists(outfile):
+            with open(outfile) as stdr:
+                results = json.load(stdr)
+        results.update(new)
+        # write via a temporary file, so that readers never see a partial file
+        tmp_file = f"{outfile}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as stdw:
+            json.dump(results, stdw, indent=4)
+        os.replace(tmp_file, outfile)
+    res = new[f"{label}-residual"]
+    log.info(f"{label}: residual RMS {res['RMS']:.3g}, skewness {res['SKEW']:.3g}, kurtosis {res['KURT']:.3g}")
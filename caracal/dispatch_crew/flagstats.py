@@ -0,0 +1,264 @@
+import base64
+import io
+import json
+import os
+import threading
+
+import numpy as np
+from casacore.tables import table
+from matplotlib.figure import Figure
+
+from caracal import log
+from caracal.dispatch_crew import step_cache
+from caracal.dispatch_crew.flagversions import CHUNK_SIZE, row_ranges
+
+# names of the POLARIZATION::CORR_TYPE values (casacore's Stokes enum)
+STOKES_TYPES = {1: "I", 2: "Q", 3: "U", 4: "V", 5: "RR", 6: "RL", 7: "LR", 8: "LL", 9: "XX", 10: "XY", 11: "YX", 12: "YY"}
+
+# process-wide cache: MS path -> (fingerprint of MS, FlagStats)
+_CACHE = {}
+_CACHE_LOCK = threading.Lock()
+
+
+class FlagStats(object):
+    def __init__(self, ms, antenna_names, antenna_positions, field_names, chan_freqs, corr_types):
+        """
+        Flag statistics of an MS, as numbers of flagged and total visibilities (one visibility being one
+        channel of one correlation of one row) per antenna, baseline, scan, field, channel (of each SPW) and
+        correlation. Rows with FLAG_ROW set count as fully flagged.
+
+        Args:
+        @ms: path of the MS
+        @antenna_names, antenna_positions: ANTENNA subtable NAME and POSITION (ITRF, m)
+        @field_names: FIELD subtable NAME
+        @chan_freqs: CHAN_FREQ of each SPW
+        @corr_types: names of the correlations of each polarisation setup
+        """
+        self.ms = ms
+        self.antenna_names = list(antenna_names)
+        self.antenna_positions = np.asarray(antenna_positions, dtype=float).reshape(len(self.antenna_names), 3)
+        self.field_names = list(field_names)
+        self.chan_freqs = [np.asarray(ff, dtype=float) for ff in chan_freqs]
+        self.corr_types = [list(cc) for cc in corr_types]
+        # correlations of all setups, in order of appearance
+        self.corr_names = list(dict.fromkeys(sum(self.corr_types, [])))
+
+        nant = len(self.antenna_names)
+        self.flagged = dict(
+            antenna=np.zeros(nant, np.int64),
+            baseline=np.zeros((nant, nant), np.int64),
+            scan=np.zeros(0, np.int64),
+            field=np.zeros(len(self.field_names), np.int64),
+            channel=[np.zeros(len(ff), np.int64) for ff in self.chan_freqs],
+            correlation=np.zeros(len(self.corr_names), np.int64),
+        )
+        self.total = {key: [np.zeros_like(cc) for cc in val] if isinstance(val, list) else np.zeros_like(val) for key, val in self.flagged.items()}
+
+    def _add(self, key, idx, flagged, total):
+        """Adds per-row counts to the bins idx of a 1D statistic, growing it if needed (scan numbers are not known up front)"""
+        size = max(len(self.flagged[key]), int(idx.max()) + 1 if len(idx) else 0)
+        for counts, weights in (self.flagged, flagged), (self.total, total):
+            if len(counts[key]) < size:
+                counts[key] = np.concatenate([counts[key], np.zeros(size - len(counts[key]), np.int64)])
+            counts[key] += np.bincount(idx, weights=weights, minlength=size).astype(np.int64)
+
+    def add_chunk(self, ant1, ant2, scans, fields, spws, pols, flag):
+        """Accumulates a chunk of rows of one FLAG shape. spws and pols are the per-row SPW and polarisation IDs"""
+        nrow, nchan, ncorr = flag.shape
+        rowFlagged = flag.sum(axis=(1, 2))
+        rowTotal = np.full(nrow, nchan * ncorr)
+        nant = len(self.antenna_names)
+
+        cross = ant1 != ant2
+        self._add("antenna", np.concatenate([ant1, ant2[cross]]), np.concatenate([rowFlagged, rowFlagged[cross]]), np.concatenate([rowTotal, rowTotal[cross]]))
+        bl = np.bincount(ant1 * nant + ant2, weights=rowFlagged, minlength=nant * nant).astype(np.int64)
+        self.flagged["baseline"] += bl.reshape(nant, nant)
+        self.total["baseline"] += (np.bincount(ant1 * nant + ant2, minlength=nant * nant) * nchan * ncorr).reshape(nant, nant)
+        self._add("scan", scans, rowFlagged, rowTotal)
+        self._add("field", fields, rowFlagged, rowTotal)
+
+        # rows of one FLAG shape may still belong to different SPWs or polarisation setups
+        setups, inverse = np.unique(np.stack([spws, pols]), axis=1, return_inverse=True)
+        for ii, (spw, pol) in enumerate(setups.T):
+            sel = flag[inverse.ravel() == ii]
+            self.flagged["channel"][spw] += sel.sum(axis=(0, 2))
+            self.total["channel"][spw] += len(sel) * ncorr
+            corrs = [self.corr_names.index(cc) for cc in self.corr_types[pol]]
+            self.flagged["correlation"][corrs] += sel.sum(axis=(0, 1))
+            self.total["correlation"][corrs] += len(sel) * nchan
+
+    def fraction(self, key):
+        """Flagged fraction of a statistic (NaN where there is no data). Channel fractions are a list, one array per SPW"""
+        if key == "channel":
+            return [_fraction(ff, tt) for ff, tt in zip(self.flagged[key], self.total[key])]
+        return _fraction(self.flagged[key], self.total[key])
+
+    @property
+    def scan_numbers(self):
+        """Scan numbers with data"""
+        return np.nonzero(self.total["scan"])[0]
+
+    @property
+    def total_fraction(self):
+        """Flagged fraction of the whole MS"""
+        return float(_fraction(self.flagged["field"].sum(), self.total["field"].sum()))
+
+    @property
+    def array_centre_dist(self):
+        """Distance (m) of each antenna from the array centre, taken as the median antenna position"""
+        if not len(self.antenna_names):
+            return np.zeros(0)
+        return np.linalg.norm(self.antenna_positions - np.median(self.antenna_positions, axis=0), axis=1)
+
+    def to_json(self):
+        """
+        Returns the statistics as a JSON-serialisable dict, in the layout of MSUtils' flag_stats (so "Flag stats" entry 1
+        holds the antennas), with the baseline and channel statistics appended. Fractions without data are None.
+        """
+
+        def frac(value):
+            return None if np.isnan(value) else float(value)
+
+        antfrac, dist = self.fraction("antenna"), self.array_centre_dist
+        blfrac = self.fraction("baseline")
+        scanfrac, fieldfrac, corrfrac = self.fraction("scan"), self.fraction("field"), self.fraction("correlation")
+        return {
+            "ms": self.ms,
+            "total": frac(self.total_fraction),
+            "Flag stats": [
+                {"fields": {str(ii): {"name": name, "frac": frac(fieldfrac[ii])} for ii, name in enumerate(self.field_names)}},
+                {
+                    "antennas": {
+                        str(ii): {
+                            "name": name,
+                            "frac": frac(antfrac[ii]),
+                            "array_centre_dist": float(dist[ii]),
+                            "position": self.antenna_positions[ii].tolist(),
+                        }
+                        for ii, name in enumerate(self.antenna_names)
+                    }
+                },
+                {"scans": {str(scan): {"frac": frac(scanfrac[scan])} for scan in self.scan_numbers}},
+                {"correlations": {name: {"frac": frac(corrfrac[ii])} for ii, name in enumerate(self.corr_names)}},
+                {"baselines": {f"{self.antenna_names[a1]}&{self.antenna_names[a2]}": {"frac": frac(blfrac[a1, a2])} for a1, a2 in zip(*np.nonzero(self.total["baseline"]))}},
+                {
+                    "channels": {
+                        str(spw): {"freq": ff.tolist(), "frac": [frac(vv) for vv in chfrac]} for spw, (ff, chfrac) in enumerate(zip(self.chan_freqs, self.fraction("channel")))
+                    }
+                },
+            ],
+        }
+
+
+def _fraction(flagged, total):
+    flagged, total = np.asarray(flagged, dtype=float), np.asarray(total, dtype=float)
+    return np.divide(flagged, total, out=np.full(flagged.shape, np.nan), where=total > 0)
+
+
+def compute(ms, chunkSize=CHUNK_SIZE):
+    """Computes the flag statistics of an MS in one pass over FLAG, reading chunkSize MB of flags at a time"""
+    with table(f"{ms}::ANTENNA", ack=False) as st:
+        antenna_names, antenna_positions = st.getcol("NAME"), st.getcol("POSITION") if st.nrows() else np.zeros((0, 3))
+    with table(f"{ms}::FIELD", ack=False) as st:
+        field_names = st.getcol("NAME") if st.nrows() else []
+    with table(f"{ms}::SPECTRAL_WINDOW", ack=False) as st:
+        chan_freqs = [st.getcell("CHAN_FREQ", ii) if st.iscelldefined("CHAN_FREQ", ii) else np.zeros(nchan) for ii, nchan in enumerate(st.getcol("NUM_CHAN"))]
+    with table(f"{ms}::POLARIZATION", ack=False) as st:
+        corr_types = [
+            [STOKES_TYPES.get(int(cc), str(cc)) for cc in st.getcell("CORR_TYPE", ii)] if st.iscelldefined("CORR_TYPE", ii) else [str(cc) for cc in range(ncorr)]
+            for ii, ncorr in enumerate(st.getcol("NUM_CORR"))
+        ]
+    with table(f"{ms}::DATA_DESCRIPTION", ack=False) as st:
+        ddid_spw, ddid_pol = st.getcol("SPECTRAL_WINDOW_ID"), st.getcol("POLARIZATION_ID")
+
+    stats = FlagStats(ms, antenna_names, antenna_positions, field_names, chan_freqs, corr_types)
+    with table(ms, ack=False) as t:
+        for start, nchunk in row_ranges(t, chunkSize):
+            flag = t.getcol("FLAG", start, nchunk) | t.getcol("FLAG_ROW", start, nchunk)[:, None, None]
+            ddids = t.getcol("DATA_DESC_ID", start, nchunk)
+            stats.add_chunk(
+                t.getcol("ANTENNA1", start, nchunk),
+                t.getcol("ANTENNA2", start, nchunk),
+                t.getcol("SCAN_NUMBER", start, nchunk),
+                t.getcol("FIELD_ID", start, nchunk),
+                ddid_spw[ddids],
+                ddid_pol[ddids],
+                flag,
+            )
+    return stats
+
+
+def get(ms, chunkSize=CHUNK_SIZE):
+    """
+    Returns the flag statistics of an MS, computing them only if the MS has changed since they were last computed
+    in this process (so that, e.g., the reference antenna selection and the flagging summary share a single pass)
+    """
+    key = os.path.abspath(ms)
+    fingerprint = step_cache.fingerprint(key)
+    with _CACHE_LOCK:
+        cached = _CACHE.get(key)
+    if cached and cached[0] == fingerprint:
+        return cached[1]
+    stats = compute(ms, chunkSize=chunkSize)
+    with _CACHE_LOCK:
+        _CACHE[key] = fingerprint, stats
+    return stats
+
+
+def _png(fig):
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", bbox_inches="tight", dpi=100)
+    return base64.b64encode(buf.getvalue()).decode()
+
+
+def _plots(stats):
+    """Yields (title, base64 PNG) plots of the statistics"""
+    bars = [
+        ("Antennas", stats.antenna_names, stats.fraction("antenna")),
+        ("Fields", stats.field_names, stats.fraction("field")),
+        ("Scans", [str(ss) for ss in stats.scan_numbers], stats.fraction("scan")[stats.scan_numbers]),
+        ("Correlations", stats.corr_names, stats.fraction("correlation")),
+    ]
+    for title, labels, fracs in bars:
+        fig = Figure(figsize=(max(4, 0.25 * len(labels)), 3))
+        ax = fig.add_subplot()
+        ax.bar(np.arange(len(labels)), 100 * np.nan_to_num(fracs))
+        ax.set_xticks(np.arange(len(labels)), labels, rotation=90, fontsize="small")
+        ax.set_ylim(0, 100)
+        ax.set_ylabel("Flagged (%)")
+        ax.set_title(title)
+        yield title, _png(fig)
+
+    fig = Figure(figsize=(8, 3))
+    ax = fig.add_subplot()
+    for spw, (freqs, fracs) in enumerate(zip(stats.chan_freqs, stats.fraction("channel"))):
+        ax.plot(freqs / 1e6, 100 * fracs, label=f"SPW {spw}")
+    ax.set_ylim(0, 100)
+    ax.set_xlabel("Frequency (MHz)")
+    ax.set_ylabel("Flagged (%)")
+    ax.set_title("Channels")
+    yield "Channels", _png(fig)
+
+    fig = Figure(figsize=(6, 5))
+    ax = fig.add_subplot()
+    blfrac = stats.fraction("baseline")
+    blfrac = np.where(np.isnan(blfrac), blfrac.T, blfrac)
+    im = ax.imshow(100 * blfrac, vmin=0, vmax=100, origin="lower", interpolation="nearest")
+    fig.colorbar(im, ax=ax, label="Flagged (%)")
+    ax.set_xlabel("Antenna")
+    ax.set_ylabel("Antenna")
+    ax.set_title("Baselines")
+    yield "Baselines", _png(fig)
+
+
+def save_statistics(msname, outfile, htmlfile=None, chunkSize=CHUNK_SIZE):
+    """Writes the flag statistics of an MS as a JSON file and, if htmlfile is given, as an HTML page of plots"""
+    stats = get(msname, chunkSize=chunkSize)
+    with open(outfile, "w") as stdw:
+        json.dump(stats.to_json(), stdw, indent=1)
+    log.info(f"{os.path.basename(msname)}: {100 * stats.total_fraction:.1f}% of the data is flagged")
+    if htmlfile:
+        title = f"Flagging summary of {os.path.basename(msname)}"
+        images = "\n".join(f'<h2>{name}</h2>\n<img src="data:image/png;base64,{png}"/>' for name, png in _plots(stats))
+        with open(htmlfile, "w") as stdw:
+            stdw.write(f"<html>\n<head><title>{title}</title></head>\n<body>\n<h1>{title}</h1>\n{images}\n</body>\n</html>\n")
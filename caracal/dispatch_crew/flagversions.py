@@ -0,0 +1,206 @@
+import os
+import shutil
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from casacore.tables import table
+
+import caracal
+from caracal import log
+
+# Default size (MB) of the FLAG chunks read at a time
+CHUNK_SIZE = 256
+# Versions are stored as <ms>.flagversions/flags.<name> (CASA tables, from CASA's flagmanager) or
+# <ms>.flagversions/flags.<name>.bits (compressed bitmaps, from this module)
+BITS_SUFFIX = ".bits"
+FORMAT_VERSION = 1
+
+# serialises updates of FLAG_VERSION_LIST files within this process
+_list_lock = threading.Lock()
+
+
+def flagversions_dir(ms):
+    return f"{ms.rstrip('/')}.flagversions"
+
+
+def _list_file(ms):
+    return os.path.join(flagversions_dir(ms), "FLAG_VERSION_LIST")
+
+
+def _bits_file(ms, name):
+    return os.path.join(flagversions_dir(ms), f"flags.{name}{BITS_SUFFIX}")
+
+
+def _table_dir(ms, name):
+    return os.path.join(flagversions_dir(ms), f"flags.{name}")
+
+
+def list_versions(ms):
+    """Returns the flag versions of an MS, from the oldest to the most recent, as a list of (name, comment) tuples"""
+    if not os.path.exists(_list_file(ms)):
+        return []
+    versions = []
+    with open(_list_file(ms)) as stdr:
+        for line in stdr:
+            if line.strip():
+                name, _, comment = line.strip().partition(" : ")
+                versions.append((name.split()[0], comment))
+    return versions
+
+
+def _write_list(ms, versions):
+    tmp_file = f"{_list_file(ms)}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as stdw:
+        for name, comment in versions:
+            stdw.write(f"{name} : {comment}\n")
+    os.replace(tmp_file, _list_file(ms))
+
+
+def row_ranges(t, chunkSize):
+    """
+    Yields (startrow, nrow) ranges covering an MS, of about chunkSize MB of flags each. Where the data descriptions
+    have different FLAG shapes, ranges are also split where DATA_DESC_ID changes, so that each range has one shape.
+    """
+    ddesc = table(f"{t.name()}::DATA_DESCRIPTION", ack=False)
+    spw = table(f"{t.name()}::SPECTRAL_WINDOW", ack=False)
+    pol = table(f"{t.name()}::POLARIZATION", ack=False)
+    nchans = spw.getcol("NUM_CHAN")
+    ncorrs = pol.getcol("NUM_CORR")
+    shapes = {(nchans[ss], ncorrs[pp]) for ss, pp in zip(ddesc.getcol("SPECTRAL_WINDOW_ID"), ddesc.getcol("POLARIZATION_ID"))}
+    for subtable in ddesc, spw, pol:
+        subtable.close()
+
+    nrow = t.nrows()
+    ncell = max([nchan * ncorr for nchan, ncorr in shapes] + [1])
+    chunkRows = max(1, int(chunkSize * 2**20) // ncell) if chunkSize > 0 else max(nrow, 1)
+    for start in range(0, nrow, chunkRows):
+        nchunk = min(chunkRows, nrow - start)
+        if len(shapes) <= 1:
+            yield start, nchunk
+            continue
+        ddids = t.getcol("DATA_DESC_ID", start, nchunk)
+        edges = np.concatenate([[0], np.nonzero(np.diff(ddids))[0] + 1, [nchunk]])
+        for lo, hi in zip(edges[:-1], edges[1:]):
+            yield start + lo, hi - lo
+
+
+def _write_bits(fh, start, flag, flagRow):
+    np.save(fh, np.array([start, *flag.shape], dtype=np.int64))
+    np.save(fh, np.frombuffer(zlib.compress(np.packbits(flag).tobytes(), 1), dtype=np.uint8))
+    np.save(fh, np.packbits(flagRow))
+
+
+def _read_bits(path):
+    """Yields (startrow, FLAG, FLAG_ROW) chunks of a bitmap flag version"""
+    with open(path, "rb") as fh:
+        version, nrow = np.load(fh)
+        if version != FORMAT_VERSION:
+            raise caracal.BadDataError(f"flag version {path} has unsupported format {version}")
+        while True:
+            header = np.load(fh)
+            if header[0] < 0:
+                return
+            start, shape = int(header[0]), tuple(header[1:])
+            size = int(np.prod(shape))
+            flag = np.unpackbits(np.frombuffer(zlib.decompress(np.load(fh).tobytes()), dtype=np.uint8), count=size)
+            flagRow = np.unpackbits(np.load(fh), count=shape[0])
+            yield start, flag.reshape(shape).astype(bool), flagRow.astype(bool)
+
+
+def _read_version(ms, name, t, chunkSize):
+    """Yields (startrow, FLAG, FLAG_ROW) chunks of a flag version, stored as a bitmap or a CASA table"""
+    if os.path.exists(_bits_file(ms, name)):
+        yield from _read_bits(_bits_file(ms, name))
+    elif os.path.exists(_table_dir(ms, name)):
+        with table(_table_dir(ms, name), ack=False) as ft:
+            if ft.nrows() != t.nrows():
+                raise caracal.BadDataError(f"flag version {name} of {ms} has {ft.nrows()} rows, but the MS has {t.nrows()}")
+            for start, nchunk in row_ranges(t, chunkSize):
+                yield start, ft.getcol("FLAG", start, nchunk), ft.getcol("FLAG_ROW", start, nchunk)
+    else:
+        raise caracal.BadDataError(f"flag version {name} of {ms} does not exist")
+
+
+def _remove(ms, name):
+    for path in _bits_file(ms, name), _table_dir(ms, name):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def save(ms, name, comment="", chunkSize=CHUNK_SIZE):
+    """
+    Saves the FLAG and FLAG_ROW columns of an MS as a flag version, reading chunkSize MB of flags at a time.
+    The version is added to the end of FLAG_VERSION_LIST. An existing version of the same name is replaced,
+    and moved to the end of the list.
+    """
+    os.makedirs(flagversions_dir(ms), exist_ok=True)
+    path = _bits_file(ms, name)
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    with table(ms, ack=False) as t, open(tmp_file, "wb") as fh:
+        np.save(fh, np.array([FORMAT_VERSION, t.nrows()], dtype=np.int64))
+        for start, nchunk in row_ranges(t, chunkSize):
+            _write_bits(fh, start, t.getcol("FLAG", start, nchunk), t.getcol("FLAG_ROW", start, nchunk))
+        np.save(fh, np.array([-1], dtype=np.int64))
+    with _list_lock:
+        _remove(ms, name)
+        os.replace(tmp_file, path)
+        _write_list(ms, [vv for vv in list_versions(ms) if vv[0] != name] + [(name, comment)])
+    log.info(f"Saved flag version {name} of {ms}")
+
+
+def restore(ms, name, chunkSize=CHUNK_SIZE):
+    """Restores the FLAG and FLAG_ROW columns of an MS from a flag version (replacing the current flags)"""
+    with table(ms, readonly=False, ack=False) as t:
+        for start, flag, flagRow in _read_version(ms, name, t, chunkSize):
+            t.putcol("FLAG", flag, start, len(flagRow))
+            t.putcol("FLAG_ROW", flagRow, start, len(flagRow))
+    log.info(f"Restored flag version {name} of {ms}")
+
+
+def delete(ms, name):
+    """Deletes a flag version of an MS"""
+    with _list_lock:
+        _remove(ms, name)
+        versions = list_versions(ms)
+        if name in [vv[0] for vv in versions]:
+            _write_list(ms, [vv for vv in versions if vv[0] != name])
+    log.info(f"Deleted flag version {name} of {ms}")
+
+
+def diff(ms, name, chunkSize=CHUNK_SIZE):
+    """
+    Compares a flag version to the current flags of an MS. Returns a dict with the number of visibilities
+    flagged in the version, flagged now, flagged since the version was saved, and unflagged since.
+    """
+    counts = dict(version=0, current=0, added=0, removed=0)
+    with table(ms, ack=False) as t:
+        for start, flag, flagRow in _read_version(ms, name, t, chunkSize):
+            current = t.getcol("FLAG", start, len(flagRow))
+            counts["version"] += int(flag.sum())
+            counts["current"] += int(current.sum())
+            counts["added"] += int((current & ~flag).sum())
+            counts["removed"] += int((flag & ~current).sum())
+    return counts
+
+
+def _call(args):
+    function, ms, kw = args
+    return function(ms, **kw)
+
+
+def for_each_ms(function, mslist, nproc=1, **kw):
+    """Calls function(ms, **kw) (e.g. save, restore) for each MS, in up to nproc processes. Returns the results"""
+    args = [(function, ms, kw) for ms in mslist]
+    if nproc > 1 and len(mslist) > 1:
+        with ProcessPoolExecutor(min(nproc, len(mslist))) as executor:
+            return list(executor.map(_call, args))
+    return list(map(_call, args))
+
+
+def save_all(mslist, name, comment="", nproc=1, chunkSize=CHUNK_SIZE):
+    """Saves a flag version of each MS in mslist, in up to nproc processes"""
+    for_each_ms(save, mslist, nproc=nproc, name=name, comment=comment, chunkSize=chunkSize)
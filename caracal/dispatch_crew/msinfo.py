@@ -0,0 +1,168 @@
+import json
+import os
+import pickle
+import threading
+from typing import Dict, List, Union
+
+import numpy as np
+
+from caracal import log
+
+# bump whenever the layout of MSInfo changes, so that stale index files are rebuilt
+INDEX_VERSION = 1
+INDEX_SUFFIX = ".pkl"
+
+# process-wide index: summary file -> (fingerprint of summary file, MSInfo)
+_INDEX = {}
+_INDEX_LOCK = threading.Lock()
+
+
+class MSInfo(object):
+    def __init__(self, summary: Dict):
+        """
+        MS metadata, built once from an MSUtils.summary() dictionary (the *-summary.json file that the obsconf
+        and transform workers write next to each MS). Fields, scans, SPWs, antennas and correlations are held as
+        arrays, with O(1) lookups of fields and antennas by name or ID.
+
+        The instance can also be indexed like the summary dict itself (e.g. msinfo["FIELD"]["NAME"]), which
+        returns the original entries. These are shared by all users of the index, so treat them as read-only.
+
+        Args:
+        @summary: summary dict
+        """
+        self.summary = summary
+
+        field = summary["FIELD"]
+        self.field_names: List[str] = list(field["NAME"])
+        self.nfields = len(self.field_names)
+        # SOURCE_ID is what the summary uses to key scans by (see field_observation_length())
+        self.source_ids = np.array(field["SOURCE_ID"], dtype=int)
+        self.reference_dirs = np.array([dd[0] for dd in field["REFERENCE_DIR"]], dtype=float).reshape(self.nfields, 2)
+        self.delay_dirs = np.array([dd[0] for dd in field.get("DELAY_DIR", field["REFERENCE_DIR"])], dtype=float).reshape(self.nfields, 2)
+        intents = field.get("INTENTS") or []
+        self.field_intents: List[List[str]] = [intents[sid].split(",") if intents else [] for sid in field.get("STATE_ID", [0] * self.nfields)]
+        # on duplicates, the first field wins (as with list.index())
+        self._field_by_name = {}
+        self._field_by_id = {}
+        for idx, (name, sid) in enumerate(zip(self.field_names, self.source_ids.tolist())):
+            self._field_by_name.setdefault(name, idx)
+            self._field_by_id.setdefault(sid, idx)
+
+        # scans of each field (by index), as arrays of scan numbers and scan lengths
+        scans = summary.get("SCAN", {})
+        self.scan_numbers: List[np.ndarray] = []
+        self.scan_lengths: List[np.ndarray] = []
+        for sid in self.source_ids.tolist():
+            field_scans = scans.get(str(sid), {})
+            self.scan_numbers.append(np.array([int(scan) for scan in field_scans], dtype=int))
+            self.scan_lengths.append(np.array(list(field_scans.values()), dtype=float))
+
+        spw = summary.get("SPW", {})
+        self.chan_freqs: List[np.ndarray] = [np.array(ff, dtype=float) for ff in spw.get("CHAN_FREQ", [])]
+        self.num_chans = np.array(spw.get("NUM_CHAN", []), dtype=int)
+        self.ref_frequencies = np.array(spw.get("REF_FREQUENCY", []), dtype=float)
+        self.total_bandwidths = np.array(spw.get("TOTAL_BANDWIDTH", []), dtype=float)
+
+        ant = summary.get("ANT", {})
+        self.antenna_names: List[str] = list(ant.get("NAME", []))
+        self.antenna_positions = np.array(ant.get("POSITION", []), dtype=float).reshape(len(self.antenna_names), 3)
+        self.dish_diameters = np.array(ant.get("DISH_DIAMETER", []), dtype=float)
+        self._antenna_by_name = {name: idx for idx, name in enumerate(self.antenna_names)}
+
+        self.corr_types: List[str] = list(summary.get("CORR", {}).get("CORR_TYPE", []))
+
+    # dict-like access to the original summary, for code that expects the summary dict
+
+    def __getitem__(self, key):
+        return self.summary[key]
+
+    def __contains__(self, key):
+        return key in self.summary
+
+    def get(self, key, default=None):
+        return self.summary.get(key, default)
+
+    def keys(self):
+        return self.summary.keys()
+
+    def field_index(self, field: Union[str, int]) -> int:
+        """Returns the index of a field given by name or (source) ID. Raises ValueError if there is no such field"""
+        lookup = self._field_by_name if isinstance(field, str) else self._field_by_id
+        try:
+            return lookup[field]
+        except (KeyError, TypeError):
+            raise ValueError(f"Could not find field '{field}' in the field list {self.field_names}")
+
+    def field_name(self, field: Union[str, int]) -> str:
+        return self.field_names[self.field_index(field)]
+
+    def field_scans(self, field: Union[str, int]):
+        """Returns (scan numbers, scan lengths) of a field given by name or ID"""
+        idx = self.field_index(field)
+        return self.scan_numbers[idx], self.scan_lengths[idx]
+
+    def antenna_index(self, name: str) -> int:
+        return self._antenna_by_name[name]
+
+    @property
+    def nants(self) -> int:
+        return len(self.antenna_names)
+
+
+def _index_file(summary_file):
+    return os.path.splitext(summary_file)[0] + INDEX_SUFFIX
+
+
+def _fingerprint(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def load(summary_file: str) -> MSInfo:
+    """
+    Returns the MSInfo for a *-summary.json file. The index is built once per process, and persisted
+    next to the summary file, so that later runs load it without parsing the JSON. It is rebuilt whenever the
+    summary file changes.
+    """
+    summary_file = os.path.abspath(summary_file)
+    fp = _fingerprint(summary_file)
+    with _INDEX_LOCK:
+        cached_fp, info = _INDEX.get(summary_file, (None, None))
+        if cached_fp == fp:
+            return info
+
+        index_file = _index_file(summary_file)
+        info = None
+        if os.path.exists(index_file):
+            try:
+                with open(index_file, "rb") as stdr:
+                    version, index_fp, info = pickle.load(stdr)
+                if version != INDEX_VERSION or index_fp != fp:
+                    info = None
+            except Exception as exc:
+                log.warning(f"ignoring unreadable MS metadata index {index_file}: {exc}")
+                info = None
+
+        if info is None:
+            with open(summary_file) as stdr:
+                info = MSInfo(json.load(stdr))
+            # write to a temporary file first, so that a concurrent reader never sees a partial index
+            tmp_file = f"{index_file}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_file, "wb") as stdw:
+                    pickle.dump((INDEX_VERSION, fp, info), stdw, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_file, index_file)
+            except OSError as exc:
+                log.warning(f"could not write MS metadata index {index_file}: {exc}")
+
+        _INDEX[summary_file] = fp, info
+        return info
+
+
+def as_msinfo(info: Union[str, Dict, MSInfo]) -> MSInfo:
+    """Returns an MSInfo given a summary file, a summary dict, or an MSInfo"""
+    if isinstance(info, MSInfo):
+        return info
+    if isinstance(info, str):
+        return load(info)
+    return MSInfo(info)
@@ -4,13 +4,16 @@
 
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pyrap.tables as tables
-from matplotlib.pyplot import flag
 
 import caracal
 
+# Default size (MB) of the FLAG chunks read at a time
+CHUNK_SIZE = 256
+
 ########################
 ### DEFINE FUNCTIONS ###
 ########################
@@ -44,22 +47,19 @@ def InterpolateTsyseff(tsyseff, chans):
     return np.interp(np.ravel(chans), tsyseff[:, 0], tsyseff[:, 1])
 
 
-# Get single-MS flags, intervals, channel widths, channel frequencies and calculate natural rms (ignoring flags)
+# Get single-MS unflagged integration per channel, channel widths, channel frequencies and calculate natural rms (ignoring flags)
+# The MS is read in chunks of rows, so that memory use does not depend on the number of rows
 
 
-def ProcessSingleMS(ms, kB, tsyseff, tsyseffFile, Aant, selectFieldName, verbose=0):
+def ProcessSingleMS(ms, kB, tsyseff, tsyseffFile, Aant, selectFieldName, verbose=0, chunkSize=CHUNK_SIZE):
     if verbose > 1:
         caracal.log.info("    Processing MS file {0:s}".format(ms))
     t = tables.table(ms, ack=False)
-    fieldIDs = t.getcol("FIELD_ID")
-    ant1 = t.getcol("ANTENNA1")
-    ant2 = t.getcol("ANTENNA2")
     fieldNames = tables.table(ms + "/FIELD", ack=False).getcol("NAME")
     spw = tables.table(ms + "/SPECTRAL_WINDOW", ack=False)
     channelWidths = spw.getcol("CHAN_WIDTH")
     channelFreqs = spw.getcol("CHAN_FREQ")
-    stokesdef = "Undefined,I,Q,U,V,RR,RL,LR,LL,XX,XY,YX,YY,RX,RY,"
-    "LX,LY,XR,XL,YR,YL,PP,PQ,QP,QQ,RCircular,LCircular,Linear,Ptotal,Plinear,PFtotal,PFlinear,Pangle".split(",")
+    stokesdef = "Undefined,I,Q,U,V,RR,RL,LR,LL,XX,XY,YX,YY,RX,RY,LX,LY,XR,XL,YR,YL,PP,PQ,QP,QQ,RCircular,LCircular,Linear,Ptotal,Plinear,PFtotal,PFlinear,Pangle".split(",")
     corrs = [stokesdef[cc] for cc in tables.table(ms + "/POLARIZATION", ack=False).getcol("CORR_TYPE")[0]]  # taking the correlations of the first SPW
 
     if selectFieldName:
@@ -73,22 +73,66 @@ def ProcessSingleMS(ms, kB, tsyseff, tsyseffFile, Aant, selectFieldName, verbose
             sys.exit()
         if verbose > 1:
             caracal.log.info("      Successfully selected Field with name {0:s} (Field ID = {1:d})".format(selectFieldName, selectFieldID))
-        selection = fieldIDs == selectFieldID
     else:
         if verbose > 1:
             caracal.log.info("      Will process all available fields: {0:}".format(fieldNames))
-        selection = fieldIDs >= fieldIDs.min()
+        selectFieldID = None
+
+    # select Stokes I-related corrs
+    icorrs = []
+    for cc, corr in enumerate(corrs):
+        if corr in "I,RR,LL,XX,YY,".split(","):
+            icorrs.append(cc)
+        elif verbose > 1:
+            caracal.log.info("      Discarding correlation {0:s} for predicting the Stokes I noise".format(corr))
+    corrs = [corrs[cc] for cc in icorrs]
+    if verbose > 1:
+        caracal.log.info("      Retained correlations {0:}".format(corrs))
+
+    # Rows per chunk, from the size of the FLAG cells
+    nrow = t.nrows()
+    nchan, ncorr = t.getcell("FLAG", 0).shape if nrow else (channelWidths.shape[-1], len(icorrs))
+    chunkRows = max(1, int(chunkSize * 2**20) // (nchan * ncorr)) if chunkSize > 0 else max(nrow, 1)
+
+    if verbose > 1:
+        caracal.log.info("      Loading flags and intervals in chunks of {0:d} rows ...".format(chunkRows))
+    antennas = set()
+    intervals = set()
+    nrAutoCorr = 0
+    nrSelected = 0
+    intervalSum = 0.0
+    unflaggedIntegration = np.zeros(nchan)  # total integration per channel adding up all UNFLAGGED integrations and polarisations (sec)
+    for startrow in range(0, nrow, chunkRows):
+        nr = min(chunkRows, nrow - startrow)
+        ant1 = t.getcol("ANTENNA1", startrow, nr)
+        ant2 = t.getcol("ANTENNA2", startrow, nr)
+        antennas.update(np.unique(ant1))
+        antennas.update(np.unique(ant2))
+        selection = ant1 != ant2
+        nrAutoCorr += nr - selection.sum()
+        if selectFieldID is not None:
+            selection &= t.getcol("FIELD_ID", startrow, nr) == selectFieldID
+        if not selection.any():
+            continue
+        interval = t.getcol("INTERVAL", startrow, nr)[selection]
+        if verbose > 1:
+            intervals.update(np.unique(interval))
+        nrSelected += interval.shape[0]
+        intervalSum += interval.sum()
+        flag = t.getcol("FLAG", startrow, nr)  # flagged data have flag = True
+        unflagged = np.zeros(flag.shape[:2], dtype=np.int32)
+        for cc in icorrs:
+            unflagged += ~flag[:, :, cc]
+        unflaggedIntegration += interval @ unflagged[selection]
+    t.close()
 
-    autoCorr = ant1 == ant2
+    nrAnt = len(antennas)
+    nrBaseline = nrAnt * (nrAnt - 1) // 2
     if verbose > 1:
-        if autoCorr.sum():
+        if nrAutoCorr:
             caracal.log.info("      Successfully selected crosscorrelations only")
         else:
             caracal.log.info("      Found crosscorrelations only")
-    selection *= ant1 != ant2
-    nrAnt = np.unique(np.concatenate((ant1, ant2))).shape[0]
-    nrBaseline = nrAnt * (nrAnt - 1) // 2
-    if verbose > 1:
         caracal.log.info("      Number of antennas  = {0:d}".format(nrAnt))
         caracal.log.info("      Number of baselines = {0:d}".format(nrBaseline))
         caracal.log.info("      Frequency coverage  = {0:.5e} Hz - {1:.5e} Hz".format(channelFreqs.min(), channelFreqs.max()))
@@ -96,52 +140,30 @@ def ProcessSingleMS(ms, kB, tsyseff, tsyseffFile, Aant, selectFieldName, verbose
             caracal.log.info("      Channel width = {0:.5e} Hz".format(np.unique(channelWidths)[0]))
         else:
             caracal.log.info("      The channel width takes the following unique values: {0:} Hz".format(np.unique(channelWidths)))
-
-    if verbose > 1:
-        caracal.log.info("      Loading flags and intervals ...")
-    flag = t.getcol("FLAG")[selection]  # flagged data have flag = True
-    # select Stokes I-related corrs
-    cc = 0
-    while cc < len(corrs):
-        if corrs[cc] not in "I,RR,LL,XX,YY,".split(","):
-            if verbose > 1:
-                caracal.log.info("      Discarding correlation {0:s} for predicting the Stokes I noise".format(corrs[cc]))
-            flag = np.delete(flag, cc, axis=2)
-            del corrs[cc]
+        if len(intervals) == 1:
+            caracal.log.info("      Interval = {0:.5e} sec".format(intervals.pop()))
         else:
-            cc += 1
-    if verbose > 1:
-        caracal.log.info("      Retained correlations {0:}".format(corrs))
-    interval = t.getcol("INTERVAL")[selection]
-    if verbose > 1:
-        if np.unique(interval).shape[0] == 1:
-            caracal.log.info("      Interval = {0:.5e} sec".format(np.unique(interval)[0]))
-        else:
-            caracal.log.info("      The interval takes the following unique values: {0:} sec".format(np.unique(interval)))
-    t.close()
-
-    if verbose > 1:
-        caracal.log.info("      The *flag* array has shape (Nr_integrations, Nr_channels, Nr_polarisations) = {0:}".format(flag.shape))
-        caracal.log.info("      The *interval* array has shape (Nr_integrations) = {0:}".format(interval.shape))
+            caracal.log.info("      The interval takes the following unique values: {0:} sec".format(np.array(sorted(intervals))))
+        caracal.log.info("      Selected (Nr_integrations, Nr_channels, Nr_polarisations) = {0:}".format((nrSelected, nchan, len(icorrs))))
         caracal.log.info("      The *channel* width array has shape (-, Nr_channels) = {0:}".format(channelWidths.shape))
+        caracal.log.info("      Total Integration on selected field(s) = {0:.2f} h ({1:d} polarisations)".format(intervalSum / nrBaseline / 3600, len(icorrs)))
 
-    if verbose > 1:
-        caracal.log.info("      Total Integration on selected field(s) = {0:.2f} h ({1:d} polarisations)".format(interval.sum() / nrBaseline / 3600, flag.shape[2]))
     if tsyseffFile is not None:
-        rms = np.sqrt(2) * kB * InterpolateTsyseff(tsyseff, channelFreqs) / Aant / np.sqrt(channelWidths * interval.sum() * flag.shape[2])
+        rms = np.sqrt(2) * kB * InterpolateTsyseff(tsyseff, channelFreqs) / Aant / np.sqrt(channelWidths * intervalSum * len(icorrs))
     else:
-        rms = np.sqrt(2) * kB * tsyseff / Aant / np.sqrt(channelWidths * interval.sum() * flag.shape[2])
+        rms = np.sqrt(2) * kB * tsyseff / Aant / np.sqrt(channelWidths * intervalSum * len(icorrs))
     if len(rms.shape) == 2 and rms.shape[0] == 1:
         rms = rms[0]
 
     if verbose > 1:
         caracal.log.info("      SINGLE MS median natural noise ignoring flags = {0:.3e} Jy/beam".format(np.nanmedian(rms)))
 
-    return flag, interval, channelWidths, channelFreqs, rms
+    return unflaggedIntegration, channelWidths, channelFreqs, rms
 
 
 # Predict natural rms for an arbitrary number of MS files (both ignoring and applying flags)
-def PredictNoise(MS, tsyseff, diam, selectFieldName, verbose=0):
+# MS files are processed by up to nproc processes at a time, reading chunkSize MB of flags at a time
+def PredictNoise(MS, tsyseff, diam, selectFieldName, verbose=0, nproc=1, chunkSize=CHUNK_SIZE):
     # Get Tsys/eff either from table
     # (col1 = frequency, col2 = Tsys/eff) or as a float values
     #  (frequency independent Tsys/eff value)
@@ -151,15 +173,22 @@ def PredictNoise(MS, tsyseff, diam, selectFieldName, verbose=0):
     kB = 1380.6  # Boltzmann constant (Jy m^2 / K)
     Aant = np.pi * (diam / 2) ** 2  # collecting area of 1 antenna (m^2)
 
-    # Read MS files to get the flags and calculate single-MS natural rms values (ignoring flags)
+    # Read MS files to get the unflagged integration per channel and calculate single-MS natural rms values (ignoring flags)
+    args = [(ms, kB, tsyseff, tsyseffFile, Aant, selectFieldName, verbose, chunkSize) for ms in MS]
+    nproc = max(1, min(nproc, len(MS)))
+    if nproc > 1:
+        with ProcessPoolExecutor(nproc) as executor:
+            results = list(executor.map(ProcessSingleMS, *zip(*args)))
+    else:
+        results = [ProcessSingleMS(*arg) for arg in args]
 
     # Start with first file ...
-    flag0, interval0, channelWidths0, channelFreqs0, rms0 = ProcessSingleMS(MS[0], kB, tsyseff, tsyseffFile, Aant, selectFieldName, verbose=verbose)
+    unflaggedIntegration, channelWidths0, channelFreqs0, rms0 = results[0]
     rmsAll = [rms0]
 
-    # ... and do the same for all other MS's appending to the flag array, checking that the channelisation is the same
+    # ... and add up all other MS's, checking that the channelisation is the same
     for ii in range(1, len(MS)):
-        flagi, intervali, channelWidthsi, channelFreqsi, rmsi = ProcessSingleMS(MS[ii], kB, tsyseff, tsyseffFile, Aant, selectFieldName, verbose=verbose)
+        unflaggedIntegrationi, channelWidthsi, channelFreqsi, rmsi = results[ii]
 
         if channelWidths0.shape != channelWidthsi.shape or (channelWidths0 != channelWidthsi).sum() or (channelFreqs0 != channelFreqsi).sum():
             caracal.log.info("")
@@ -169,23 +198,15 @@ def PredictNoise(MS, tsyseff, diam, selectFieldName, verbose=0):
             caracal.log.info(" Aborting ...")
             sys.exit()
         else:
-            flag0 = np.concatenate((flag0, flagi), axis=0)
-            interval0 = np.concatenate((interval0, intervali), axis=0)
+            unflaggedIntegration = unflaggedIntegration + unflaggedIntegrationi
             rmsAll.append(rmsi)
 
-    # Message concatenated files
     if verbose > 1 and len(MS) > 1:
-        caracal.log.info("    Concatenating all {0:d} MS files ...".format(len(MS)))
-        caracal.log.info(f"      The concatenated *flag* array has shape (Nr_integrations, Nr_channels, Nr_polarisations) = {flag.shape}")
-        caracal.log.info("      The concatenated *interval* array has shape (Nr_integrations) = {0:}".format(interval0.shape))
-        caracal.log.info("      The concatenated *channel* width array has shape (-, Nr_channels) = {0:}".format(channelWidths0.shape))
+        caracal.log.info("    Combining all {0:d} MS files ...".format(len(MS)))
+        caracal.log.info("      The *channel* width array has shape (-, Nr_channels) = {0:}".format(channelWidths0.shape))
 
-    # Reshape arrays
-    if verbose > 1 and len(MS) > 1:
-        caracal.log.info("      Reshaping arrays ...")
-    interval0.resize((interval0.shape[0], 1, 1))
-    channelWidths0.resize((channelWidths0.shape[1]))
-    channelFreqs0.resize((channelFreqs0.shape[1]))
+    channelWidths0 = channelWidths0.reshape(channelWidths0.shape[1])
+    channelFreqs0 = channelFreqs0.reshape(channelFreqs0.shape[1])
 
     # Interpolate Tsys
     if tsyseffFile is not None:
@@ -194,7 +215,6 @@ def PredictNoise(MS, tsyseff, diam, selectFieldName, verbose=0):
     # Calculate theoretical natural rms
     rmsAll = np.array(rmsAll)
     rmsAll = 1.0 / np.sqrt((1.0 / rmsAll**2).sum(axis=0))
-    unflaggedIntegration = (interval0 * (1 - flag0.astype(int))).sum(axis=(0, 2))  # total integration per channel adding up all UNFLAGGED integrations and polarisations (sec)
     unflaggedIntegration[unflaggedIntegration == 0] = np.nan
     rmsUnflagged = np.sqrt(2) * kB * tsyseff / Aant / np.sqrt(channelWidths0 * unflaggedIntegration)
 
@@ -211,3 +231,5 @@ def PredictNoise(MS, tsyseff, diam, selectFieldName, verbose=0):
                     np.nanmedian(rmsUnflagged), np.nanmin(rmsUnflagged), np.nanmax(rmsUnflagged)
                 )
             )
+
+    return rmsAll, rmsUnflagged
@@ -0,0 +1,259 @@
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import psutil
+
+import caracal
+from caracal import log
+
+# the active profiler, if profiling is enabled (see set_profiler)
+_PROFILER = None
+
+
+def set_profiler(profiler):
+    """Makes profiler the active one (None disables profiling)"""
+    global _PROFILER
+    _PROFILER = profiler
+
+
+def get_profiler():
+    return _PROFILER
+
+
+@contextmanager
+def profiled(label, kind="function", worker=None):
+    """Context manager that profiles a block of code (e.g. a Python post-processing call made directly by a worker)
+    using the active profiler. Does nothing when profiling is disabled."""
+    if _PROFILER is None:
+        yield
+        return
+    with _PROFILER.profile(label, kind=kind, worker=worker):
+        yield
+
+
+class _ResourceSampler(threading.Thread):
+    def __init__(self, interval):
+        """Periodically samples RSS and I/O of this process and all its children"""
+        threading.Thread.__init__(self, daemon=True)
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._proc = psutil.Process()
+        self.peak_rss = 0
+        # last seen I/O counters of each process, keyed by pid
+        self.io_start = {}
+        self.io_last = {}
+        self.sample()
+        self.io_start = dict(self.io_last)
+
+    def sample(self):
+        try:
+            procs = [self._proc] + self._proc.children(recursive=True)
+        except psutil.Error:
+            return
+        rss = 0
+        for proc in procs:
+            try:
+                with proc.oneshot():
+                    rss += proc.memory_info().rss
+                    io = proc.io_counters()
+                    self.io_last[proc.pid] = io.read_bytes, io.write_bytes
+            except (psutil.Error, AttributeError):
+                # processes come and go, and io_counters() is not available everywhere
+                continue
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self._stop_event.set()
+        self.sample()
+
+    @property
+    def io_bytes(self):
+        """Returns (read, written) bytes since sampling started"""
+        read = written = 0
+        for pid, (rb, wb) in self.io_last.items():
+            rb0, wb0 = self.io_start.get(pid, (0, 0))
+            read += rb - rb0
+            written += wb - wb0
+        return read, written
+
+
+class Profiler(object):
+    def __init__(self, perf_dir, timestamp, interval=1.0):
+        """
+        Collects per-step and per-worker resource usage, and writes a machine-readable report.
+
+        Wall time is exact. CPU time counts this process plus all child processes (e.g. singularity containers)
+        that have exited. Peak RSS and I/O are sampled every 'interval' seconds across this process and its
+        children. Docker and podman containers run under the container daemon rather than as our children, so
+        their CPU, RSS and I/O are not visible. Steps that overlap (when workers run concurrently) share the
+        process-wide counters. Container start-up is the time from launching a container to its first line of
+        output, which covers image start and e.g. the CASA import. Steps run in a warm pool (see WarmPool) also
+        record the time spent starting their instance (zero when an instance was reused).
+
+        Args:
+        @perf_dir: directory for reports
+        @timestamp: pipeline run timestamp, used to name the report
+        @interval: sampling interval in seconds
+        """
+        self.perf_dir = perf_dir
+        self.report_file = os.path.join(perf_dir, f"{timestamp}.json")
+        self.interval = interval
+        self.start_time = datetime.now()
+        self.steps = []
+        self.workers = []
+        self._lock = threading.Lock()
+        # name of the worker running in each thread, to attribute steps to
+        self._context = threading.local()
+
+    @contextmanager
+    def profile(self, label, kind="function", worker=None, **extra):
+        """Profiles a block of code. Yields the record dict, which the caller may add to (e.g. a status)"""
+        record = dict(
+            worker=worker or getattr(self._context, "worker", None),
+            label=label,
+            kind=kind,
+            start=datetime.now().isoformat(timespec="seconds"),
+            status="completed",
+            **extra,
+        )
+        sampler = _ResourceSampler(self.interval)
+        sampler.start()
+        cpu0 = psutil.Process().cpu_times()
+        children0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+        t0 = time.perf_counter()
+        try:
+            yield record
+        except BaseException:
+            record["status"] = "failed"
+            raise
+        finally:
+            record["wall"] = time.perf_counter() - t0
+            sampler.stop()
+            cpu1 = psutil.Process().cpu_times()
+            children1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+            record["cpu_user"] = (cpu1.user - cpu0.user) + (children1.ru_utime - children0.ru_utime)
+            record["cpu_system"] = (cpu1.system - cpu0.system) + (children1.ru_stime - children0.ru_stime)
+            record["peak_rss"] = sampler.peak_rss
+            record["read_bytes"], record["write_bytes"] = sampler.io_bytes
+            with self._lock:
+                self.steps.append(record)
+
+    @contextmanager
+    def profile_job(self, job, worker=None):
+        """Profiles a stimela job. For container jobs, also records start-up time until the first line of output."""
+        if isinstance(job.job, dict):
+            kind, name = "function", job.job["function"].__name__
+        else:
+            kind, name = "cab", getattr(job.job, "cabname", job.name)
+        first_output = []
+        wrangler = job.apply_output_wranglers
+        record = {}
+        t0 = time.perf_counter()
+
+        def _timed_wrangler(output, severity, logger):
+            if not first_output:
+                first_output.append(time.perf_counter())
+            return wrangler(output, severity, logger)
+
+        # stimela looks the wrangler up on the job at run time, so an instance attribute takes precedence
+        job.apply_output_wranglers = _timed_wrangler
+        try:
+            with self.profile(job.label, kind=kind, worker=worker, name=name) as record:
+                yield record
+        finally:
+            del job.apply_output_wranglers
+            record["startup"] = first_output[0] - t0 if first_output and kind == "cab" else None
+            record["warm_start"] = getattr(job.job, "warm_start", None) if kind == "cab" else None
+
+    def add_skipped(self, job, worker=None):
+        """Records a step that was skipped (e.g. by the step cache)"""
+        record = dict(
+            worker=worker or getattr(self._context, "worker", None),
+            label=job.label,
+            kind="skipped",
+            start=datetime.now().isoformat(timespec="seconds"),
+            status="skipped",
+            wall=0.0,
+        )
+        with self._lock:
+            self.steps.append(record)
+
+    @contextmanager
+    def profile_worker(self, name):
+        """Profiles the wall time of a worker. Steps run by the worker (in the same thread) are attributed to it."""
+        self._context.worker = name
+        t0 = time.perf_counter()
+        record = dict(name=name, start=datetime.now().isoformat(timespec="seconds"), status="completed")
+        try:
+            yield record
+        except BaseException:
+            record["status"] = "failed"
+            raise
+        finally:
+            record["wall"] = time.perf_counter() - t0
+            self._context.worker = None
+            with self._lock:
+                self.workers.append(record)
+
+    def write_report(self):
+        """Writes the JSON report, and returns its filename"""
+        if not os.path.exists(self.perf_dir):
+            os.makedirs(self.perf_dir, exist_ok=True)
+        report = dict(
+            caracal_version=caracal.__version__,
+            start=self.start_time.isoformat(timespec="seconds"),
+            end=datetime.now().isoformat(timespec="seconds"),
+            sample_interval=self.interval,
+            workers=self.workers,
+            steps=self.steps,
+        )
+        with open(self.report_file, "w") as stdw:
+            json.dump(report, stdw, indent=2)
+        return self.report_file
+
+    def log_summary(self, top=10):
+        """Logs a summary table: time per worker, time per cab/function, and the most expensive steps"""
+
+        def _gb(nbytes):
+            return f"{nbytes / 2**30:.2f}"
+
+        log.info("Performance summary (wall time in seconds):")
+        for rec in self.workers:
+            log.info(f"  {rec['name']:30} {rec['wall']:12.1f}  {rec['status']}")
+
+        by_name = {}
+        for rec in self.steps:
+            if rec["kind"] == "skipped":
+                continue
+            entry = by_name.setdefault(rec.get("name") or rec["label"], [0, 0.0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += rec["wall"]
+            entry[2] += rec["cpu_user"] + rec["cpu_system"]
+            entry[3] += rec.get("startup") or 0
+        log.info(f"  {'cab/function':30} {'calls':>6} {'wall':>12} {'cpu':>12} {'startup':>10}")
+        for name, (ncalls, wall, cpu, startup) in sorted(by_name.items(), key=lambda item: -item[1][1]):
+            log.info(f"  {name:30} {ncalls:6d} {wall:12.1f} {cpu:12.1f} {startup:10.1f}")
+
+        steps = sorted((rec for rec in self.steps if rec["kind"] != "skipped"), key=lambda rec: -rec["wall"])[:top]
+        if steps:
+            log.info(f"  {len(steps)} most expensive steps (wall, cpu, peak RSS GB, read GB, written GB):")
+            for rec in steps:
+                log.info(
+                    f"    {rec['label'][:60]:60} {rec['wall']:10.1f} {rec['cpu_user'] + rec['cpu_system']:10.1f} "
+                    f"{_gb(rec['peak_rss']):>8} {_gb(rec['read_bytes']):>8} {_gb(rec['write_bytes']):>8}"
+                )
+        warm = [rec["warm_start"] for rec in self.steps if rec.get("warm_start") is not None]
+        if warm:
+            log.info(f"  {len(warm)} step(s) ran in warm containers, {sum(ws > 0 for ws in warm)} instance(s) started in {sum(warm):.1f}s")
+        nskipped = sum(rec["kind"] == "skipped" for rec in self.steps)
+        if nskipped:
+            log.info(f"  {nskipped} step(s) skipped")
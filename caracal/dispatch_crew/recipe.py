@@ -0,0 +1,65 @@
+from contextlib import nullcontext
+
+import stimela
+
+from caracal import log
+
+
+class CaracalRecipe(stimela.Recipe):
+    def __init__(self, name, step_cache=None, profiler=None, warm_pool=None, **kw):
+        """
+        Stimela recipe with CARACal-specific execution services. Workers use it exactly like a stimela.Recipe.
+
+        Args:
+        @name: recipe name (as for stimela.Recipe)
+        @step_cache: optional StepCache. If given, the steps of a run are skipped if they all completed
+                     previously, from the same states of their files.
+        @profiler: optional Profiler. If given, the resource usage of each step is recorded.
+        @warm_pool: optional WarmPool. If given, singularity steps run in long-lived container instances.
+        """
+        super().__init__(name, **kw)
+        self.step_cache = step_cache
+        self.profiler = profiler
+        self.warm_pool = warm_pool
+
+    def spawn(self, name):
+        """Returns a new, empty recipe with the same settings and execution services, e.g. to run independent
+        chains of steps concurrently"""
+        recipe = CaracalRecipe(
+            name,
+            step_cache=self.step_cache,
+            profiler=self.profiler,
+            warm_pool=self.warm_pool,
+            ms_dir=self.msdir,
+            singularity_image_dir=self.singularity_image_dir,
+            cabspecs=self.cabspecs,
+            logfile=False,
+            logfile_task=self.logfile_task,
+        )
+        recipe.JOB_TYPE = self.JOB_TYPE
+        return recipe
+
+    def run(self, steps=None, resume=False, redo=None):
+        if (self.step_cache is None and self.profiler is None and self.warm_pool is None) or steps is not None or resume or redo:
+            return super().run(steps=steps, resume=resume, redo=redo)
+
+        # A recipe's steps are skipped all together or not at all: if any of them has to run, the steps before it
+        # (e.g. flag version rewinds) must run too, to bring its files to the state it expects. Steps that do not
+        # refer to any files are always run.
+        cache = self.step_cache
+        cached = cache is not None and cache.skip(self.jobs, self)
+        # Steps are run one by one, since each step can change the files that the next one refers to
+        for step, job in enumerate(self.jobs, 1):
+            if cached and cache.job_paths(job, self):
+                log.info(f"step cache: skipping {job.label}, it ran before from the same state of its files")
+                if self.profiler is not None:
+                    self.profiler.add_skipped(job)
+                self.completed.append(job)
+                continue
+            inputs = cache.fingerprints(job, self) if cache is not None else None
+            with self.profiler.profile_job(job) if self.profiler is not None else nullcontext():
+                with self.warm_pool.attach(job) if self.warm_pool is not None else nullcontext():
+                    super().run(steps=[step])
+            if cache is not None:
+                cache.record(job, self, inputs)
+        return 0
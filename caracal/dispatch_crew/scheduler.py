@@ -0,0 +1,195 @@
+import threading
+from dataclasses import dataclass
+from dataclasses import field as dc_field
+from typing import Any, Callable, Dict, Set
+
+import psutil
+
+from caracal import log
+
+# Workers that only read their input MSs (plots and the like), and so may share them with other readers
+READ_ONLY_WORKERS = {"inspect", "mosaic", "mask"}
+# Workers that split their input MSs into new ones, and only modify the input when rewinding its flags
+SPLITTING_WORKERS = {"transform"}
+# Workers whose label_out names an output product rather than an MS
+PRODUCT_LABEL_WORKERS = {"mask"}
+
+# Output products (i.e. directories under output/) written and read by each worker type. These dependencies are
+# not visible through labels, e.g. masks made by the mask worker from selfcal images.
+PRODUCTS_OUT = {
+    "crosscal": {"crosscal_continuum"},
+    "selfcal": {"continuum"},
+    "ddcal": {"continuum"},
+    "polimg": {"continuum"},
+    "mask": {"masking"},
+    "line": {"cubes"},
+    "mosaic": {"mosaics"},
+}
+PRODUCTS_IN = {
+    "selfcal": {"masking"},
+    "ddcal": {"continuum", "masking"},
+    "mask": {"continuum"},
+    "line": {"continuum", "masking"},
+    "mosaic": {"continuum", "cubes"},
+}
+
+# Workers that set attributes on the pipeline object as a side effect, and so must not overlap with one another
+PIPELINE_STATE = {
+    "crosscal": {"fluxscale_reference"},
+}
+
+
+def _find_callib_refs(section):
+    """Recursively collects callib names and labels referred to by (nested) otfcal-like config sections"""
+    refs = set()
+    for value in section.values():
+        if isinstance(value, dict):
+            if value.get("enable", True) is False:
+                continue
+            for subkey in "callib", "label_cal", "pol_callib", "label_pcal":
+                if value.get(subkey):
+                    refs.add(f"callib:{value[subkey]}")
+            refs |= _find_callib_refs(value)
+    return refs
+
+
+def worker_io(wtype, config):
+    """
+    Works out what a worker reads and writes, given the worker type (name sans '__suffix') and its config section.
+
+    Returns tuple of (reads, writes), which are sets of resource strings:
+        ms:<label>          MSs of a given label (in-place flagging and calibration counts as a write)
+        callib:<label>      calibration library
+        product:<name>      output products such as images or masks
+        pipeline:<attr>     pipeline attribute set as a side-effect
+    """
+    reads, writes = set(), set()
+    label_in = config.get("label_in")
+    if label_in is not None:
+        # concat mode of transform takes a comma-separated list of labels
+        labels_in = {f"ms:{label.strip()}" for label in label_in.split(",")}
+        reads |= labels_in
+        if wtype in SPLITTING_WORKERS:
+            if config.get("rewind_flags", {}).get("enable"):
+                writes |= labels_in
+        elif wtype not in READ_ONLY_WORKERS:
+            writes |= labels_in
+    if config.get("label_out") is not None and wtype not in PRODUCT_LABEL_WORKERS:
+        writes.add(f"ms:{config['label_out']}")
+    if config.get("label_cal"):
+        writes.add(f"callib:{config['label_cal']}")
+    reads |= _find_callib_refs(config)
+    reads |= {f"product:{x}" for x in PRODUCTS_IN.get(wtype, ())}
+    writes |= {f"product:{x}" for x in PRODUCTS_OUT.get(wtype, ())}
+    writes |= {f"pipeline:{x}" for x in PIPELINE_STATE.get(wtype, ())}
+    return reads, writes
+
+
+@dataclass
+class WorkerNode:
+    """A worker in the dependency graph"""
+
+    name: str
+    reads: Set[str]
+    writes: Set[str]
+    ncpu: int = 1
+    mem: float = 0
+    payload: Any = None
+    deps: Set[str] = dc_field(default_factory=set)
+
+    def conflicts_with(self, other: "WorkerNode") -> bool:
+        """True if the two workers cannot run concurrently (read-after-write, write-after-read or write-after-write).
+        A worker with no known inputs or outputs conflicts with everything."""
+        if not (self.reads or self.writes) or not (other.reads or other.writes):
+            return True
+        return bool(self.writes & (other.reads | other.writes) or self.reads & other.writes)
+
+
+class WorkerScheduler(object):
+    def __init__(self, ncpu: int = 0, mem_limit: float = 0, worker_ncpu: int = 1, worker_mem: float = 0):
+        """
+        Runs a graph of workers concurrently, within a CPU and memory budget
+
+        Args:
+        @ncpu: total number of CPUs to hand out. If 0, all available CPUs
+        @mem_limit: total memory (in GB) to hand out. If 0, all available memory
+        @worker_ncpu: CPUs reserved by a worker that has no ncpu setting of its own
+        @worker_mem: memory (in GB) reserved by each worker
+        """
+        self.ncpu = ncpu or psutil.cpu_count()
+        self.mem_limit = mem_limit or psutil.virtual_memory().total / 2**30
+        self.worker_ncpu = worker_ncpu
+        self.worker_mem = worker_mem
+        self.nodes = []
+        self._cond = threading.Condition()
+
+    def add_worker(self, name: str, wtype: str, config: Dict, payload: Any = None) -> WorkerNode:
+        """Adds a worker to the graph. Workers must be added in config order, which is the order in which
+        conflicting workers are serialized. Workers configured with ncpu=0 (i.e. use all CPUs) reserve
+        the whole CPU budget."""
+        reads, writes = worker_io(wtype, config)
+        ncpu = config.get("ncpu", self.worker_ncpu) or self.ncpu
+        node = WorkerNode(name, reads, writes, ncpu=min(int(ncpu), self.ncpu), mem=self.worker_mem, payload=payload)
+        node.deps = {prev.name for prev in self.nodes if node.conflicts_with(prev)}
+        self.nodes.append(node)
+        return node
+
+    def add_task(self, name: str, ncpu: int = None, mem: float = None, payload: Any = None) -> WorkerNode:
+        """Adds an independent task (e.g. a chain of steps on one MS) that may run alongside any other. By default
+        it reserves worker_ncpu CPUs and worker_mem GB."""
+        ncpu = self.worker_ncpu if ncpu is None else ncpu
+        node = WorkerNode(name, set(), set(), ncpu=min(int(ncpu or self.ncpu), self.ncpu), mem=self.worker_mem if mem is None else mem, payload=payload)
+        self.nodes.append(node)
+        return node
+
+    def log_graph(self):
+        for node in self.nodes:
+            deps = ", ".join(sorted(node.deps)) or "none"
+            log.info(f"  {node.name}: {node.ncpu} CPU(s), {node.mem:g} GB, waits for: {deps}")
+
+    def run(self, runner: Callable[[WorkerNode], None]):
+        """Calls runner(node) for every node, in separate threads, as soon as its dependencies have completed and
+        the budget allows. An oversized worker is allowed to run on its own. Once a worker fails, no new workers are
+        started; the first error is re-raised once the running ones have finished."""
+        pending = list(self.nodes)
+        done = set()
+        running = {}
+        errors = []
+        cpu_free, mem_free = self.ncpu, self.mem_limit
+
+        def _thread(node):
+            try:
+                runner(node)
+            except BaseException as exc:  # noqa: BLE001
+                errors.append((node, exc))
+            with self._cond:
+                running.pop(node.name)
+                done.add(node.name)
+                self._cond.notify_all()
+
+        with self._cond:
+            while pending or running:
+                if not errors:
+                    for node in list(pending):
+                        if not node.deps.issubset(done):
+                            continue
+                        fits = node.ncpu <= cpu_free and node.mem <= mem_free
+                        if fits or not running:
+                            pending.remove(node)
+                            cpu_free -= node.ncpu
+                            mem_free -= node.mem
+                            log.info(f"scheduler: starting {node.name} ({len(running) + 1} worker(s) now running)")
+                            running[node.name] = node
+                            threading.Thread(target=_thread, args=(node,), name=node.name, daemon=True).start()
+                elif not running:
+                    break
+                self._cond.wait()
+                # recompute budget from the set of running workers
+                cpu_free = self.ncpu - sum(n.ncpu for n in running.values())
+                mem_free = self.mem_limit - sum(n.mem for n in running.values())
+
+        if errors:
+            node, exc = errors[0]
+            if pending:
+                log.error(f"scheduler: {node.name} failed, not starting {', '.join(n.name for n in pending)}")
+            raise exc
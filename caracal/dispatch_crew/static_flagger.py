@@ -0,0 +1,302 @@
+import fnmatch
+import re
+from datetime import datetime
+
+import numpy as np
+from casacore.tables import table
+
+from caracal import log
+from caracal.dispatch_crew import msinfo
+from caracal.dispatch_crew.flagversions import CHUNK_SIZE, row_ranges
+
+# casa_flagdata modes that the engine handles. All of them only ever add flags, so rules can be applied in any order
+MODES = ("manual", "quack")
+# casa_flagdata selection keywords that the engine handles (ignored: keywords that do not affect the flags)
+SELECTION_KEYS = {"field", "spw", "timerange", "scan", "antenna", "correlation", "autocorr"}
+QUACK_KEYS = {"quackinterval", "quackmode"}
+IGNORED_KEYS = {"vis", "mode", "flagbackup"}
+QUACK_MODES = ("beg", "endb", "end", "tail")
+
+_FREQ_UNITS = {"ghz": 1e9, "mhz": 1e6, "khz": 1e3, "hz": 1.0}
+# MJD epoch, as used by the MS TIME column
+_MJD0 = datetime(1858, 11, 17)
+_DATE_RE = re.compile(r"^(\d{4})/(\d{1,2})/(\d{1,2})(?:/(.+))?$")
+_TIME_RE = re.compile(r"^(\d{1,2}):(\d{1,2})(?::(\d{1,2}(?:\.\d*)?))?$")
+
+
+class UnsupportedRule(ValueError):
+    """Raised for casa_flagdata arguments that the engine cannot handle (these are left to casa_flagdata)"""
+
+
+def _items(value, sep=","):
+    return [item.strip() for item in str(value).split(sep) if item.strip()]
+
+
+def _int_ranges(value):
+    """Parses a CASA list of integers and integer ranges (e.g. '1,3~5')"""
+    ints = set()
+    for item in _items(value):
+        lo, _, hi = item.partition("~")
+        if not lo.isdigit() or (hi and not hi.isdigit()):
+            raise UnsupportedRule(f"unsupported selection '{value}'")
+        ints.update(range(int(lo), int(hi or lo) + 1))
+    return ints
+
+
+def _parse_time(value, ref_day):
+    """Parses a CASA time (YYYY/MM/DD[/hh:mm[:ss]] or hh:mm[:ss] on the reference day), returning MJD seconds"""
+    day, hms = ref_day, value
+    match = _DATE_RE.match(value)
+    if match:
+        year, month, mday, hms = match.groups()
+        day = (datetime(int(year), int(month), int(mday)) - _MJD0).days
+        if hms is None:
+            return day * 86400.0
+    match = _TIME_RE.match(hms)
+    if not match:
+        raise UnsupportedRule(f"unsupported time '{value}'")
+    hours, minutes, seconds = match.groups()
+    return day * 86400.0 + int(hours) * 3600.0 + int(minutes) * 60.0 + float(seconds or 0)
+
+
+def _parse_chans(chansel, freqs):
+    """Parses a CASA channel selection (e.g. '0~100;200~300' or '856~880MHz') into a channel mask"""
+    mask = np.zeros(len(freqs), bool)
+    for item in _items(chansel, ";"):
+        unit = re.search(r"([a-zA-Z]+)$", item)
+        scale = None
+        if unit:
+            scale = _FREQ_UNITS.get(unit.group(1).lower())
+            if scale is None:
+                raise UnsupportedRule(f"unsupported channel selection '{chansel}'")
+            item = item[: unit.start()]
+        values = []
+        for vv in item.split("~"):
+            vunit = re.search(r"([a-zA-Z]+)$", vv)
+            if vunit:
+                if vunit.group(1).lower() not in _FREQ_UNITS:
+                    raise UnsupportedRule(f"unsupported channel selection '{chansel}'")
+                scale = scale or _FREQ_UNITS[vunit.group(1).lower()]
+                vv = vv[: vunit.start()]
+            try:
+                values.append(float(vv))
+            except ValueError:
+                raise UnsupportedRule(f"unsupported channel selection '{chansel}'")
+        if len(values) not in (1, 2):
+            raise UnsupportedRule(f"unsupported channel selection '{chansel}'")
+        lo, hi = values[0], values[-1]
+        if scale is None:
+            if lo != int(lo) or hi != int(hi):
+                raise UnsupportedRule(f"unsupported channel selection '{chansel}'")
+            mask[int(lo) : int(hi) + 1] = True
+        else:
+            mask |= (freqs >= lo * scale) & (freqs <= hi * scale)
+    return mask
+
+
+class StaticRule(object):
+    def __init__(self, label, args, info, ref_day=0):
+        """
+        A static flagging rule, given by casa_flagdata arguments, compiled against the metadata of an MS.
+        Raises UnsupportedRule if the arguments use a mode or selection syntax that is not handled here.
+
+        Args:
+        @label: rule name, used in the report
+        @args: casa_flagdata arguments (mode 'manual' or 'quack', with field, spw, timerange, scan, antenna,
+               correlation and autocorr selections)
+        @info: MSInfo of the MS
+        @ref_day: MJD of the first day of the observation, for times given without a date
+        """
+        self.label = label
+        mode = args.get("mode", "manual")
+        if mode not in MODES:
+            raise UnsupportedRule(f"unsupported mode '{mode}'")
+        unknown = set(args) - SELECTION_KEYS - IGNORED_KEYS - (QUACK_KEYS if mode == "quack" else set())
+        if unknown:
+            raise UnsupportedRule(f"unsupported arguments {sorted(unknown)}")
+        value = {key: val for key, val in args.items() if val not in (None, "", [])}
+
+        self.fields = None
+        if "field" in value:
+            self.fields = set()
+            for item in _items(value["field"]):
+                if item.isdigit():
+                    self.fields.add(int(item))
+                else:
+                    matches = [idx for idx, name in enumerate(info.field_names) if fnmatch.fnmatchcase(name, item)]
+                    if not matches:
+                        raise UnsupportedRule(f"unknown field '{item}'")
+                    self.fields.update(matches)
+
+        self.scans = _int_ranges(value["scan"]) if "scan" in value else None
+
+        self.antennas = None
+        if "antenna" in value:
+            self.antennas = set()
+            for item in _items(value["antenna"]):
+                if item in info.antenna_names:
+                    self.antennas.add(info.antenna_index(item))
+                elif item.isdigit():
+                    self.antennas.add(int(item))
+                else:
+                    raise UnsupportedRule(f"unsupported antenna selection '{value['antenna']}'")
+
+        self.autocorr = value.get("autocorr") in (True, "true", "True")
+
+        self.timeranges = None
+        if "timerange" in value:
+            self.timeranges = []
+            for item in _items(value["timerange"]):
+                if item.count("~") != 1:
+                    raise UnsupportedRule(f"unsupported time range '{item}'")
+                self.timeranges.append(tuple(_parse_time(tt.strip(), ref_day) for tt in item.split("~")))
+
+        # channel mask of each selected SPW
+        self.chans = None
+        if "spw" in value:
+            self.chans = {}
+            nspw = len(info.chan_freqs)
+            for item in _items(value["spw"]):
+                spwsel, colon, chansel = item.partition(":")
+                spws = range(nspw) if spwsel == "*" else sorted(_int_ranges(spwsel))
+                for spw in spws:
+                    if spw >= nspw:
+                        continue
+                    mask = _parse_chans(chansel, info.chan_freqs[spw]) if colon else np.ones(len(info.chan_freqs[spw]), bool)
+                    self.chans[spw] = self.chans.get(spw, False) | mask
+
+        self.corrs = None
+        if "correlation" in value:
+            corrs = [cc.upper() for cc in _items(value["correlation"])]
+            if not set(corrs) <= set(info.corr_types):
+                raise UnsupportedRule(f"unsupported correlation selection '{value['correlation']}'")
+            self.corrs = [info.corr_types.index(cc) for cc in corrs]
+
+        self.quack = None
+        if mode == "quack":
+            quackmode = value.get("quackmode", "beg")
+            if quackmode not in QUACK_MODES:
+                raise UnsupportedRule(f"unsupported quack mode '{quackmode}'")
+            self.quack = float(value.get("quackinterval", 0)), quackmode
+
+    def row_mask(self, cols, scan_bounds):
+        """Returns the mask of rows selected by the rule, given the MS columns of a chunk of rows"""
+        mask = np.ones(len(cols["TIME"]), bool)
+        if self.fields is not None:
+            mask &= np.isin(cols["FIELD_ID"], list(self.fields))
+        if self.scans is not None:
+            mask &= np.isin(cols["SCAN_NUMBER"], list(self.scans))
+        if self.antennas is not None:
+            mask &= np.isin(cols["ANTENNA1"], list(self.antennas)) | np.isin(cols["ANTENNA2"], list(self.antennas))
+        if self.autocorr:
+            mask &= cols["ANTENNA1"] == cols["ANTENNA2"]
+        if self.timeranges is not None:
+            mask &= np.any([(cols["TIME"] >= t0) & (cols["TIME"] <= t1) for t0, t1 in self.timeranges], axis=0)
+        if self.quack is not None:
+            interval, mode = self.quack
+            starts, ends = scan_bounds
+            rowstart = cols["TIME"] - cols["INTERVAL"] / 2
+            rowend = cols["TIME"] + cols["INTERVAL"] / 2
+            scanstart = starts[np.searchsorted(starts[:, 0], cols["SCAN_NUMBER"]), 1]
+            scanend = ends[np.searchsorted(ends[:, 0], cols["SCAN_NUMBER"]), 1]
+            if mode == "beg":
+                mask &= rowstart < scanstart + interval
+            elif mode == "endb":
+                mask &= rowend > scanend - interval
+            elif mode == "end":
+                mask &= rowstart >= scanstart + interval
+            else:
+                mask &= rowend <= scanend - interval
+        if self.chans is not None:
+            mask &= np.isin(cols["SPW"], list(self.chans))
+        return mask
+
+    def cell_mask(self, rows, spws, shape):
+        """Returns the (row, channel, correlation) flags of the rule, given its row mask and the SPW of each row"""
+        flag = np.broadcast_to(rows[:, None, None], shape)
+        if self.chans is not None:
+            chans = np.zeros(shape[:2], bool)
+            for spw, mask in self.chans.items():
+                sel = rows & (spws == spw)
+                chans[sel] = mask[: shape[1]]
+            flag = flag & chans[:, :, None]
+        if self.corrs is not None:
+            corrs = np.zeros(shape[2], bool)
+            corrs[self.corrs] = True
+            flag = flag & corrs[None, None, :]
+        return flag
+
+
+def supported(args, info):
+    """Returns True if the engine can handle a casa_flagdata step with the given arguments"""
+    try:
+        StaticRule("", args, info)
+    except UnsupportedRule:
+        return False
+    return True
+
+
+def _scan_bounds(t):
+    """Returns the (scan, start) and (scan, end) time arrays of all scans in the MS, sorted by scan number"""
+    scans = t.getcol("SCAN_NUMBER")
+    time, interval = t.getcol("TIME"), t.getcol("INTERVAL")
+    uscans, index = np.unique(scans, return_inverse=True)
+    starts = np.full(len(uscans), np.inf)
+    ends = np.full(len(uscans), -np.inf)
+    np.minimum.at(starts, index, time - interval / 2)
+    np.maximum.at(ends, index, time + interval / 2)
+    return np.stack([uscans, starts], axis=1), np.stack([uscans, ends], axis=1)
+
+
+def flag_ms(ms, rules, summary, chunkSize=CHUNK_SIZE):
+    """
+    Applies static flagging rules to an MS in a single pass over its FLAG column, reading chunkSize MB of flags at
+    a time. Flags are only ever added. Returns, and logs, the fraction of visibilities selected by each rule and
+    the fraction newly flagged by it (i.e. not flagged before, nor by an earlier rule).
+
+    Args:
+    @ms: MS name
+    @rules: list of (label, casa_flagdata arguments) (see StaticRule)
+    @summary: MS summary file (see dispatch_crew.msinfo)
+    """
+    info = msinfo.load(summary)
+    with table(f"{ms}::DATA_DESCRIPTION", ack=False) as ddesc:
+        ddid_spw = ddesc.getcol("SPECTRAL_WINDOW_ID")
+
+    stats = {label: [0, 0] for label, args in rules}
+    total = flagged_before = 0
+    with table(ms, readonly=False, ack=False) as t:
+        ref_day = int(t.getcell("TIME", 0) // 86400) if t.nrows() else 0
+        compiled = [StaticRule(label, args, info, ref_day=ref_day) for label, args in rules]
+        scan_bounds = _scan_bounds(t) if any(rule.quack for rule in compiled) else None
+
+        for start, nrow in row_ranges(t, chunkSize):
+            cols = {col: t.getcol(col, start, nrow) for col in ("ANTENNA1", "ANTENNA2", "FIELD_ID", "SCAN_NUMBER", "TIME", "INTERVAL")}
+            cols["SPW"] = ddid_spw[t.getcol("DATA_DESC_ID", start, nrow)]
+            flag = t.getcol("FLAG", start, nrow)
+            total += flag.size
+            flagged_before += int(flag.sum())
+            changed = False
+            for rule in compiled:
+                rows = rule.row_mask(cols, scan_bounds)
+                if not rows.any():
+                    continue
+                rule_flag = rule.cell_mask(rows, cols["SPW"], flag.shape)
+                new = rule_flag & ~flag
+                stats[rule.label][0] += int(rule_flag.sum())
+                nnew = int(new.sum())
+                if nnew:
+                    stats[rule.label][1] += nnew
+                    flag |= new
+                    changed = True
+            if changed:
+                t.putcol("FLAG", flag, start, nrow)
+                t.putcol("FLAG_ROW", t.getcol("FLAG_ROW", start, nrow) | flag.all(axis=(1, 2)), start, nrow)
+
+    total = max(total, 1)
+    log.info(f"Static flagging of {ms} in a single pass: {100.0 * flagged_before / total:.2f}% flagged before")
+    report = {}
+    for label, (selected, new) in stats.items():
+        report[label] = dict(selected=selected / total, new=new / total)
+        log.info(f"  {label}: {100.0 * selected / total:.2f}% selected, {100.0 * new / total:.2f}% newly flagged")
+    return report
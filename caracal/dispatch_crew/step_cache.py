@@ -0,0 +1,222 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+
+from caracal import log
+
+# files that change whenever a table is merely opened, and so must not count towards its fingerprint
+_IGNORED_FILES = {"table.lock"}
+# stimela's suffixes for parameters that refer to a file in one of the mounted directories
+_IO_SUFFIXES = ("msfile", "input", "output")
+
+
+def fingerprint(path):
+    """
+    Returns a cheap fingerprint of a file or directory (e.g. an MS or caltable), as a list of
+    [name, size, mtime_ns] entries. For directories, the top-level files are used, as casacore rewrites these
+    whenever a table changes. An MS also includes its .flagversions list.
+    A path that does not exist is fingerprinted by the files starting with it, so that stimela-style output
+    prefixes (e.g. wsclean's 'name') cover the products they generate.
+    """
+    if not os.path.lexists(path):
+        return [[os.path.basename(p)] + fingerprint(p) for p in sorted(glob.glob(glob.escape(path) + "*"))]
+    if not os.path.isdir(path):
+        st = os.stat(path)
+        return [["", st.st_size, st.st_mtime_ns]]
+    entries = []
+    for entry in sorted(os.scandir(path), key=lambda e: e.name):
+        if entry.name in _IGNORED_FILES or not entry.is_file():
+            continue
+        st = entry.stat()
+        entries.append([entry.name, st.st_size, st.st_mtime_ns])
+    flaglist = os.path.join(f"{path.rstrip('/')}.flagversions", "FLAG_VERSION_LIST")
+    if os.path.exists(flaglist):
+        st = os.stat(flaglist)
+        entries.append(["FLAG_VERSION_LIST", st.st_size, st.st_mtime_ns])
+    return entries
+
+
+def _strings(value):
+    """Yields all strings found in a (nested) parameter value"""
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from _strings(item)
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _strings(item)
+
+
+class StepCache(object):
+    def __init__(self, cache_dir):
+        """
+        Persistent cache of completed recipe steps.
+
+        A step is identified by its cab (name, image and version) or Python function, its parameters, and the
+        fingerprints of all files it refers to (MSs, caltables, images, etc.) just before it ran. For each such step,
+        the fingerprints of the files after it ran are recorded.
+
+        Since in-place steps (flagging, applycal, etc.) change the MS, a rerun finds it as the previous run left it,
+        not in the state each step started from. So for each file, the state it was in when the previous run started
+        using it, and the state that run left it in, are recorded as well. If a file is still as the previous run
+        left it, its steps are replayed from that start state: each step that comes up with the same parameters and
+        input state is skipped, and moves the file on to the state it led to. A step that differs in any way, or a
+        file changed by anything other than recorded steps, ends the replay, and the steps run again from the
+        actual state of the files. Steps that do not refer to any files on disk are always run.
+
+        Args:
+        @cache_dir: directory holding one JSON file per cached step, and the start and end states of each file
+                    under files/
+        """
+        self.cache_dir = cache_dir
+        self.files_dir = os.path.join(cache_dir, "files")
+        if not os.path.exists(self.files_dir):
+            os.makedirs(self.files_dir, exist_ok=True)
+        # for each file seen in this run: the state that its steps are at (replayed or actually run), the state it
+        # is actually in, and the state the run started from
+        self._lock = threading.Lock()
+        self._virtual, self._actual, self._start = {}, {}, {}
+
+    @staticmethod
+    def job_identity(job):
+        """Returns a dict describing what a stimela job runs and with which parameters"""
+        if isinstance(job.job, dict):
+            function = job.job["function"]
+            code = getattr(function, "__code__", None)
+            code_hash = hashlib.sha1(code.co_code + repr(code.co_consts).encode()).hexdigest() if code else ""
+            return dict(
+                function=f"{function.__module__}.{function.__qualname__}",
+                code=code_hash,
+                params=job.job["parameters"],
+            )
+        cont = job.job
+        return dict(cab=cont.cabname, image=cont.image, version=job.version, tag=job.tag, params=cont.config)
+
+    @staticmethod
+    def job_paths(job, recipe):
+        """Returns the set of paths on the host that a job refers to through its parameters"""
+        if isinstance(job.job, dict):
+            dirs = dict(msfile=recipe.msdir, input=recipe.indir, output=recipe.outdir)
+            params = job.job["parameters"]
+            bare_dirs = [os.getcwd()]
+        else:
+            # map container mount points back to host directories
+            mounts = {}
+            for volume in job.job.volumes:
+                host, cont_path = volume.split(":")[:2]
+                mounts[cont_path] = host
+            dirs = {kind: mounts.get(job.job.IODEST[kind]) for kind in _IO_SUFFIXES}
+            params = job.job.config
+            bare_dirs = []
+        # bare names are looked up in the MS, input and output directories, in that order
+        bare_dirs += [d for d in (dirs.get("msfile"), dirs.get("input"), dirs.get("output")) if d]
+
+        paths = set()
+        for value in _strings(params):
+            if not value or len(value) > 1024 or "\n" in value:
+                continue
+            name, _, kind = value.rpartition(":")
+            if kind in _IO_SUFFIXES and name:
+                if dirs.get(kind):
+                    paths.add(os.path.abspath(os.path.join(dirs[kind], name)))
+                continue
+            for dirname in bare_dirs:
+                path = os.path.join(dirname, value)
+                if os.path.exists(path):
+                    paths.add(os.path.abspath(path))
+                    break
+        return paths
+
+    def _key(self, identity):
+        return hashlib.sha1(json.dumps(identity, sort_keys=True, default=repr).encode()).hexdigest()
+
+    @staticmethod
+    def _write(path, content):
+        # write via a temporary file, so that concurrent workers never see a partial file
+        tmp_file = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp_file, "w") as stdw:
+            json.dump(content, stdw, default=repr)
+        os.replace(tmp_file, path)
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as stdr:
+                return json.load(stdr)
+        except (OSError, ValueError):
+            return None
+
+    def _file_record(self, path):
+        return os.path.join(self.files_dir, hashlib.sha1(path.encode()).hexdigest() + ".json")
+
+    def _entry_file(self, job, inputs):
+        """Returns the entry file of a job run from the states inputs ({path: fingerprint}) of its files"""
+        return os.path.join(self.cache_dir, self._key(dict(self.job_identity(job), inputs=inputs)) + ".json")
+
+    def _state(self, path):
+        """Returns the state that the steps of a file are at (call with the lock held). A file seen for the first
+        time is replayed from the start of the previous run if it is as that run left it; a file changed by
+        anything but recorded steps since it was last seen is taken as it is."""
+        actual = fingerprint(path)
+        if path not in self._virtual:
+            record = self._read(self._file_record(path))
+            start = record["start"] if record and record.get("end") == actual else actual
+            self._virtual[path], self._actual[path], self._start[path] = start, actual, start
+        elif actual != self._actual[path]:
+            self._virtual[path], self._actual[path], self._start[path] = actual, actual, actual
+        return self._virtual[path]
+
+    def skip(self, jobs, recipe):
+        """
+        Returns True if all jobs that refer to files can be skipped: each of them ran before, with the same
+        parameters, from the states its files are at once the jobs before it are replayed. Their files then move on
+        to the states these jobs led to. Otherwise nothing changes, and all jobs are to be run (see fingerprints()
+        and record()).
+        """
+        with self._lock:
+            states = {}
+            for job in jobs:
+                paths = sorted(self.job_paths(job, recipe))
+                if not paths:
+                    continue
+                inputs = {path: states[path] if path in states else self._state(path) for path in paths}
+                entry = self._read(self._entry_file(job, inputs))
+                if not entry or set(entry.get("outputs", {})) != set(paths):
+                    return False
+                states.update(entry["outputs"])
+            self._virtual.update(states)
+        return True
+
+    def fingerprints(self, job, recipe):
+        """Returns the states of the files that a job refers to, to be passed to record() once it completes"""
+        with self._lock:
+            return {path: self._state(path) for path in sorted(self.job_paths(job, recipe))}
+
+    def record(self, job, recipe, inputs):
+        """Records a successfully completed job, run from the states inputs (see fingerprints()) of its files, along
+        with the states it left them in"""
+        paths = self.job_paths(job, recipe) | set(inputs)
+        if not paths:
+            return
+        with self._lock:
+            outputs = {}
+            for path in sorted(paths):
+                outputs[path] = fingerprint(path)
+                if path not in self._start:
+                    self._start[path] = inputs.get(path, [])
+                self._virtual[path] = self._actual[path] = outputs[path]
+                self._write(self._file_record(path), dict(path=path, start=self._start[path], end=outputs[path]))
+        identity = self.job_identity(job)
+        entry = dict(
+            label=job.label,
+            name=identity.get("cab") or identity.get("function"),
+            time=time.strftime("%Y-%m-%d %H:%M:%S"),
+            inputs={path: inputs.get(path, []) for path in sorted(paths)},
+            outputs=outputs,
+        )
+        self._write(self._entry_file(job, entry["inputs"]), entry)
+        log.debug(f"step cache: recorded {job.label}")
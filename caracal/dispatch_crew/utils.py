@@ -11,6 +11,7 @@ import numpy
 import caracal
 import caracal.dispatch_crew.caltables as mkct
 from caracal import utils
+from caracal.dispatch_crew import msinfo
 
 np = numpy
 
@@ -56,12 +57,7 @@ def angular_dist_pos_angle(ra1, dec1, ra2, dec2):
 
 
 def categorize_fields(info):
-    if isinstance(info, str):
-        info = utils.load_yaml(info)
-
-    names = info["FIELD"]["NAME"]
-    intents = info["FIELD"]["INTENTS"]
-    intent_ids = info["FIELD"]["STATE_ID"]
+    info = msinfo.as_msinfo(info)
 
     mapping = {
         "fcal": (["CALIBRATE_FLUX"], []),
@@ -70,16 +66,14 @@ def categorize_fields(info):
         "target": (["TARGET"], []),
         "xcal": (["CALIBRATE_POLARIZATION"], []),
     }
-    if intents:
-        for i, field in enumerate(names):
-            ints = intents[intent_ids[i]].split(",")
-            for intent in ints:
-                # for the intents with #, the string after the # does not look useful for us
-                # This can be reviewed if need be (Issue 1130)
-                intent = intent.split("#")[0]
-                for ftype in mapping:
-                    if intent in mapping[ftype][0]:
-                        mapping[ftype][-1].append(field)
+    for field, ints in zip(info.field_names, info.field_intents):
+        for intent in ints:
+            # for the intents with #, the string after the # does not look useful for us
+            # This can be reviewed if need be (Issue 1130)
+            intent = intent.split("#")[0]
+            for ftype in mapping:
+                if intent in mapping[ftype][0]:
+                    mapping[ftype][-1].append(field)
 
     return mapping
 
@@ -91,16 +85,14 @@ def get_field_id(info, field_name):
     elif isinstance(field_name, str):
         field_name = field_name.split(",")
 
-    if isinstance(info, str):
-        info = utils.load_yaml(info)
+    info = msinfo.as_msinfo(info)
 
-    names = info["FIELD"]["NAME"]
     results = []
     for fn in field_name:
-        if fn not in names:
-            raise KeyError(f"Could not find field '{fn}' in the field list {names}")
-        else:
-            results.append(names.index(fn))
+        try:
+            results.append(info.field_index(fn))
+        except ValueError:
+            raise KeyError(f"Could not find field '{fn}' in the field list {info.field_names}")
     return results
 
 
@@ -108,46 +100,29 @@ def select_gcal(info, targets, calibrators, mode="nearest"):
     """
     Automatically select gain calibrator
     """
-    if isinstance(info, str):
-        info = utils.load_yaml(info)
-
-    fields = Fields(
-        names=info["FIELD"]["NAME"],
-        ids=info["FIELD"]["SOURCE_ID"],
-        dirs=info["FIELD"]["REFERENCE_DIR"],
-    )
+    info = msinfo.as_msinfo(info)
 
     if mode == "most_scans":
         most_scans = 0
         gcal = None
         for fid in calibrators:
-            idx = fields.index(fid)
-            field_id = str(fields.ids[idx])
-            if most_scans < len(info["SCAN"][field_id]):
-                most_scans = len(info["SCAN"][field_id])
-                gcal = fields.names[idx]
+            idx = info.field_index(fid)
+            if most_scans < len(info.scan_numbers[idx]):
+                most_scans = len(info.scan_numbers[idx])
+                gcal = info.field_names[idx]
     elif mode == "nearest":
-        tras = []
-        tdecs = []
-        for target in targets:
-            idx = fields.index(target)
-
-            tras.append(fields.dirs[idx][0][0])
-            tdecs.append(fields.dirs[idx][0][1])
-
-        mean_ra = numpy.mean(tras)
-        mean_dec = numpy.mean(tdecs)
+        tdirs = info.reference_dirs[[info.field_index(target) for target in targets]]
+        mean_ra, mean_dec = tdirs.mean(axis=0)
 
         nearest_dist = numpy.inf
         gcal = None
         for field in calibrators:
-            idx = fields.index(field)
-            ra = fields.dirs[idx][0][0]
-            dec = fields.dirs[idx][0][1]
+            idx = info.field_index(field)
+            ra, dec = info.reference_dirs[idx]
             distance = angular_dist_pos_angle(mean_ra, mean_dec, ra, dec)[0]
             if nearest_dist > distance:
                 nearest_dist = distance
-                gcal = fields.names[idx]
+                gcal = info.field_names[idx]
     else:
         raise ValueError(f"Unkown mode '{mode}' for select_gcal() ")
 
@@ -165,24 +140,16 @@ def observed_longest(info: Dict, calfields: List[Union[str, int]]):
     :type calfields: List[Union[str, int]]
     """
 
-    if isinstance(info, str):
-        info = utils.load_yaml(info)
-
-    fields = Fields(
-        names=info["FIELD"]["NAME"],
-        ids=info["FIELD"]["SOURCE_ID"],
-        dirs=info["FIELD"]["REFERENCE_DIR"],
-    )
+    info = msinfo.as_msinfo(info)
 
     most_time = 0
     field = None
     for calfield in calfields:
-        idx = fields.index(calfield)
-        _calfield = str(fields.ids[idx])
-        total_time = numpy.sum(list(info["SCAN"][_calfield].values()))
+        idx = info.field_index(calfield)
+        total_time = info.scan_lengths[idx].sum()
         if total_time > most_time:
             most_time = total_time
-            field = fields.names[idx]
+            field = info.field_names[idx]
 
     return field
 
@@ -200,16 +167,9 @@ def field_observation_length(info: Dict, field: Union[str, int], return_scans: b
     :return: observation length in seconds or the observation length and the scan lengths
     :rtype: Tuple[float, List] | float
     """
-    if isinstance(info, str):
-        info = utils.load_yaml(info)
-
-    fields = Fields(
-        names=info["FIELD"]["NAME"],
-        ids=info["FIELD"]["SOURCE_ID"],
-    )
+    info = msinfo.as_msinfo(info)
 
-    field = str(fields.ids[fields.index(field)])
-    scans = list(info["SCAN"][field].values())
+    scans = info.field_scans(field)[1].tolist()
     tobs = numpy.sum(scans)
     if return_scans:
         return tobs, scans
@@ -239,27 +199,24 @@ def hetfield(info, field, db, tol=2.9e-3):
     Find match of fields in info
 
     Parameters:
-    info (dict): dictionary of obsinfo as read by yaml
+    info (dict, str or MSInfo): MS summary dict, summary file, or MSInfo
     field (str): field name
-    db (dict):   calibrator data base as returned by
+    db (catalog_parser): calibrator data base as returned by
                  calibrator_database()
 
-    Go through all calibrators in db and return the first that matches
+    Look up the calibrators of db and return the first that matches
     the coordinates of field in msinfo. Return empty string if not
     found.
     """
 
+    info = msinfo.as_msinfo(info)
+
     # Get position of field in msinfo
-    ind = info["FIELD"]["NAME"].index(field)
-    firade = info["FIELD"]["DELAY_DIR"][ind][0]
+    firade = info.delay_dirs[info.field_index(field)].copy()
     firade[0] = numpy.mod(firade[0], 2 * numpy.pi)
 
-    dbcp = db.db
-    for key in dbcp.keys():
-        carade = [dbcp[key]["ra"], dbcp[key]["decl"]]
-        if closeby(carade, firade, tol=tol):
-            return key
-    return False
+    name = db.crossmatch(firade[0], firade[1], tol=tol)[0][0]
+    return name if name is not None else False
 
 
 def find_in_native_calibrators(info, field, mode="both"):
@@ -268,8 +225,7 @@ def find_in_native_calibrators(info, field, mode="both"):
     Return a crystalball model if specified and available.
     Otherwise, return False.
     """
-    if isinstance(info, str):
-        info = utils.load_yaml(info)
+    info = msinfo.as_msinfo(info)
 
     returnsky = False
     returnmod = False
@@ -309,8 +265,7 @@ def find_in_casa_calibrators(info, field):
     Return model if it is. Else, return False.
     """
 
-    if isinstance(info, str):
-        info = utils.load_yaml(info)
+    info = msinfo.as_msinfo(info)
     db = utils.load_yaml(os.path.join(caracal.pckgdir, "data/casa_calibrators.yml"))
 
     dbc = mkct.casa_calibrator_database()
@@ -334,9 +289,6 @@ def read_taylor_legodi_row(info, field):
     """
     Read the model from `taylor_legodi_2024.txt`
     """
-    if isinstance(info, str):
-        info = utils.load(info)
-
     file_path = caracal.pckgdir + "/data/taylor_legodi_2024.txt"
 
     with open(file_path, mode="r", encoding="utf-8") as file:
@@ -412,12 +364,11 @@ def estimate_solints(msinfo, skymodel, Tsys_eta, dish_diameter, npol, gain_tol=0
 
 
 def imaging_params(info, spwid=0):
-    if isinstance(info, str):
-        info = utils.load(info)
+    info = msinfo.as_msinfo(info)
 
     maxbl = info["MAXBL"]
-    dish_size = numpy.mean(info["ANTENNA"]["DISH_DIAMETER"])
-    freq = info["SPW"]["REF_FREQUENCY"][spwid]
+    dish_size = numpy.mean(info.dish_diameters)
+    freq = info.ref_frequencies[spwid]
     wavelength = 2.998e8 / freq
 
     FoV = numpy.rad2deg(1.22 * wavelength / dish_size)
@@ -0,0 +1,230 @@
+import itertools
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from stimela import singularity
+from stimela.cargo.cab import MOUNT
+from stimela.utils import xrun
+
+from caracal import log
+
+# where the pool's own files are mounted in each instance
+WARM_MOUNT = f"{MOUNT}/warm"
+
+# the runscript executed in an instance for each step. Like stimela's runscript, but with the cab code and
+# parameter file taken from the pool mounts (see WarmPool.run())
+RUNSCRIPT = "/warm_run"
+_RUNSCRIPT_TEXT = """#!/usr/bin/env bash
+set -u
+/etc/init.d/xvfb start >/dev/null 2>&1 || true
+python $WARM_CODE/run.py 2>&1
+EXIT_STAT=$?
+/etc/init.d/xvfb stop >/dev/null 2>&1 || true
+exit $EXIT_STAT
+"""
+
+
+class _Instance(object):
+    def __init__(self, name, key):
+        self.name = name
+        self.key = key
+        self.users = 0
+        self.started = threading.Event()
+        self.failed = False
+
+
+class WarmPool(object):
+    def __init__(self, pool_dir, max_instances=4):
+        """
+        Pool of long-lived Singularity/Apptainer instances that recipe steps are executed in, so that steps
+        which mount the same directories into the same image share one container start instead of paying for
+        one each (see CaracalRecipe).
+
+        Instances are keyed by image and by the directories that a step mounts. The per-step mounts (parameter
+        file and cab code) are replaced by pool-wide mounts of the parameter files and cab directories, so that
+        consecutive steps of a worker, running different cabs of the same image on the same MS directory,
+        normally share an instance. Steps that cannot use an instance fall back to a normal container run.
+
+        Args:
+        @pool_dir: scratch directory for the pool (parameter files, runscript, instance workdirs)
+        @max_instances: maximum number of instances kept running. The least recently used idle one is stopped
+                        when a new one is needed.
+        """
+        self.pool_dir = os.path.abspath(pool_dir)
+        self.max_instances = max_instances
+        self.config_dir = os.path.join(self.pool_dir, "configs")
+        os.makedirs(self.config_dir, exist_ok=True)
+        self.runscript = os.path.join(self.pool_dir, "warm_run")
+        with open(self.runscript, "w") as stdw:
+            stdw.write(_RUNSCRIPT_TEXT)
+        os.chmod(self.runscript, 0o755)
+        self._instances = OrderedDict()
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+
+    @staticmethod
+    def instance_binds(cont):
+        """
+        Returns (key, binds) for running a stimela singularity container in an instance: the instance key, and
+        the container's volumes that stay fixed for the lifetime of an instance
+        """
+        per_step = {f"{MOUNT}/configfile", f"{MOUNT}/code", "/etc/passwd", "/etc/group", cont.RUNSCRIPT}
+        binds = []
+        code = None
+        for volume in cont.volumes:
+            host, dest, perm = volume.rsplit(":", 2)
+            if dest == f"{MOUNT}/code":
+                code = host
+            elif dest not in per_step:
+                binds.append(volume)
+        # the instance mounts the directory holding the cab's directory, so that all of its cabs can run in it
+        cab_root = os.path.dirname(os.path.dirname(os.path.abspath(code))) if code else None
+        return (cont.image, cab_root, tuple(sorted(binds))), binds
+
+    def _passwd_files(self, cont):
+        """Copies the container's passwd and group files into the pool, since the recipe's copies are removed with it"""
+        files = []
+        for volume in cont.volumes:
+            host, dest, perm = volume.rsplit(":", 2)
+            if dest in ("/etc/passwd", "/etc/group"):
+                pool_file = os.path.join(self.pool_dir, os.path.basename(dest))
+                if not os.path.exists(pool_file):
+                    shutil.copyfile(host, pool_file)
+                files.append(f"{pool_file}:{dest}:rw")
+        return files
+
+    def _acquire(self, cont):
+        """Returns (instance, start-up seconds) for a container, starting an instance if needed"""
+        key, binds = self.instance_binds(cont)
+        evicted = []
+        with self._lock:
+            inst = self._instances.get(key)
+            if inst is not None:
+                self._instances.move_to_end(key)
+                inst.users += 1
+                new = False
+            else:
+                inst = _Instance(f"caracal-{os.getpid()}-{next(self._counter)}", key)
+                inst.users = 1
+                self._instances[key] = inst
+                new = True
+                for other in list(self._instances.values()):
+                    if len(self._instances) <= self.max_instances:
+                        break
+                    if other.users == 0:
+                        del self._instances[other.key]
+                        evicted.append(other)
+        for other in evicted:
+            self._stop(other)
+
+        if not new:
+            inst.started.wait()
+            return inst, 0.0
+
+        t0 = time.perf_counter()
+        workdir = os.path.join(self.pool_dir, "scratch", inst.name)
+        os.makedirs(workdir, exist_ok=True)
+        binds = (
+            binds
+            + self._passwd_files(cont)
+            + [
+                f"{self.config_dir}:{WARM_MOUNT}/configs:ro",
+                f"{self.runscript}:{RUNSCRIPT}:ro",
+            ]
+        )
+        if key[1]:
+            binds.append(f"{key[1]}:{WARM_MOUNT}/cabs:ro")
+        try:
+            xrun(
+                f"{singularity.BINARY} instance start --contain --workdir {workdir}",
+                [" ".join(f"--bind {bind}" for bind in binds), cont.image, inst.name],
+                log=cont.logger,
+                timeout=cont.time_out,
+                env=cont._env,
+                logfile=cont.logfile,
+            )
+        except Exception as exc:
+            log.warning(f"warm pool: could not start instance for {cont.image} ({exc}), falling back to a normal container run")
+            inst.failed = True
+        finally:
+            inst.started.set()
+        return inst, time.perf_counter() - t0
+
+    def _release(self, inst):
+        with self._lock:
+            inst.users -= 1
+            if inst.failed and self._instances.get(inst.key) is inst:
+                del self._instances[inst.key]
+
+    def _stop(self, inst):
+        if inst.failed:
+            return
+        try:
+            xrun(f"{singularity.BINARY} instance stop", [inst.name])
+        except Exception as exc:
+            log.warning(f"warm pool: could not stop instance {inst.name}: {exc}")
+
+    def run(self, cont, output_wrangler=None):
+        """Runs a stimela singularity container in a pool instance. Sets cont.warm_start to the instance start-up time"""
+        if not os.path.exists(cont.image):
+            # let stimela report the missing image
+            return singularity.Container.run(cont, output_wrangler=output_wrangler)
+
+        inst, cont.warm_start = self._acquire(cont)
+        try:
+            if inst.failed:
+                return singularity.Container.run(cont, output_wrangler=output_wrangler)
+
+            config = f"{next(self._counter)}-{os.path.basename(cont.parameter_file_name)}"
+            shutil.copyfile(cont.parameter_file_name, os.path.join(self.config_dir, config))
+            code = [volume.rsplit(":", 2)[0] for volume in cont.volumes if volume.rsplit(":", 2)[1] == f"{MOUNT}/code"]
+            prefix = f"{singularity.BINARY_NAME.upper()}ENV_"
+            env = dict(cont._env)
+            env[f"{prefix}CONFIG"] = f"{WARM_MOUNT}/configs/{config}"
+            if code:
+                env[f"{prefix}WARM_CODE"] = f"{WARM_MOUNT}/cabs/{os.path.basename(os.path.dirname(code[0]))}/src"
+            cont.status = "running"
+            try:
+                xrun(
+                    f"{singularity.BINARY} exec instance://{inst.name}",
+                    [RUNSCRIPT],
+                    log=cont.logger,
+                    timeout=cont.time_out,
+                    output_wrangler=output_wrangler,
+                    env=env,
+                    logfile=cont.logfile,
+                )
+            finally:
+                os.remove(os.path.join(self.config_dir, config))
+            cont.status = "exited"
+            return 0
+        finally:
+            self._release(inst)
+
+    @contextmanager
+    def attach(self, job):
+        """Context manager that makes a stimela job run in the pool. Jobs that are not singularity containers run as usual"""
+        if isinstance(job.job, dict) or getattr(job, "jtype", None) != "singularity":
+            yield
+            return
+        cont = job.job
+        cont.warm_start = None
+        # stimela calls job.job.run() at run time, so an instance attribute takes precedence
+        cont.run = lambda *args, output_wrangler=None: self.run(cont, output_wrangler=output_wrangler)
+        try:
+            yield
+        finally:
+            del cont.run
+
+    def shutdown(self):
+        """Stops all instances and removes the pool directory"""
+        with self._lock:
+            instances = list(self._instances.values())
+            self._instances.clear()
+        for inst in instances:
+            self._stop(inst)
+        shutil.rmtree(self.pool_dir, ignore_errors=True)
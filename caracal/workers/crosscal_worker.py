@@ -9,7 +9,9 @@ from casacore.tables import table
 
 import caracal
 import caracal.dispatch_crew.utils as utils
-from caracal.workers.utils import callibs
+from caracal.dispatch_crew import flagstats
+from caracal.dispatch_crew.scheduler import WorkerScheduler
+from caracal.workers.utils import band_parallel, callibs, manage_caltabs
 from caracal.workers.utils import manage_antennas as manants
 from caracal.workers.utils import manage_flagsets as manflags
 
@@ -134,6 +136,7 @@ def solve(
     prev=None,
     prev_name=None,
     smodel=False,
+    fluxscale_reference=None,
 ):
     """ """
     gaintables = []
@@ -234,14 +237,37 @@ def solve(
                     },
                     label="{0}:: Copy parimary gains".format(step),
                 )
-            recipe.add(
-                RULES[term]["cab"],
-                step,
-                copy.deepcopy(params),
-                input=pipeline.input,
-                output=pipeline.caltables,
-                label="%s:: %s calibration" % (step, term),
-            )
+            nchunks = config[ftype]["b_nchunks"] if term == "B" else 1
+            if nchunks > 1 and len(msinfo.num_chans) != 1:
+                caracal.log.warning("Band-parallel bandpass solves need an MS with a single SPW. Solving the whole band at once")
+                nchunks = 1
+            if nchunks > 1:
+                recipe.add(
+                    band_parallel.solve_bandpass,
+                    step,
+                    {
+                        "cab": RULES[term]["cab"],
+                        "step": step,
+                        "params": copy.deepcopy(params),
+                        "nchunks": nchunks,
+                        "msdir": pipeline.msdir,
+                        "input": pipeline.input,
+                        "output": pipeline.caltables,
+                        "settings": band_parallel.recipe_settings(recipe),
+                    },
+                    input=pipeline.input,
+                    output=pipeline.caltables,
+                    label="%s:: %s calibration in %d channel chunks" % (step, term, nchunks),
+                )
+            else:
+                recipe.add(
+                    RULES[term]["cab"],
+                    step,
+                    copy.deepcopy(params),
+                    input=pipeline.input,
+                    output=pipeline.caltables,
+                    label="%s:: %s calibration" % (step, term),
+                )
             if term == "F":
                 transfer_fluxscale(
                     msname,
@@ -250,7 +276,7 @@ def solve(
                     caltable + ":output",
                     pipeline,
                     iobs,
-                    reference=pipeline.fluxscale_reference,
+                    reference=fluxscale_reference,
                     label=label,
                 )
             elif term == "B" and config[ftype]["b_smoothwindow"] > 1:
@@ -523,16 +549,8 @@ def applycal(order, msname, recipe, gaintable, interp, gainfield, field, pipelin
 
 
 def smooth_bandpass(bptable, window, filter_type="mean"):
-    from scipy import ndimage
-
-    caracal.log.info("Smoothing {0:s} with {2:s} window of width {1:d} channels".format(bptable, window, filter_type))
-    bp = table(bptable, ack=False).getcol("CPARAM")
-    bp = [np.real(bp), np.imag(bp)]
-    if filter_type == "median":
-        bp = [ndimage.median_filter(bb, size=(1, window, 1)) for bb in bp]
-    elif filter_type == "mean":
-        bp = [ndimage.uniform_filter(bb, size=(1, window, 1)) for bb in bp]
-    table(bptable, ack=False, readonly=False).putcol("CPARAM", bp[0] + 1j * bp[1])
+    """Smooths a bandpass table along frequency, leaving flagged channels out of the running windows"""
+    manage_caltabs.smooth_table(bptable, window, mode=filter_type)
 
 
 def worker(pipeline, recipe, config):
@@ -542,8 +560,9 @@ def worker(pipeline, recipe, config):
     label = config["label_cal"]
     label_in = config["label_in"]
 
-    # loop over all MSs for this label
-    for i, msbase in enumerate(pipeline.msbasenames):
+    def calibrate_ms(i, recipe):
+        """Adds the solve and apply steps of MS i to recipe, and writes its callib. Returns the fluxscale reference field"""
+        msbase = pipeline.msbasenames[i]
         msname = pipeline.form_msname(msbase, label_in)
         msinfo = pipeline.get_msinfo(msname)
         prefix_msbase = f"{pipeline.prefix_msbases[i]}-{label}"
@@ -636,8 +655,6 @@ def worker(pipeline, recipe, config):
         else:
             fluxscale_field = pipeline.fcal[i][0]
 
-        pipeline.fluxscale_reference = fluxscale_field
-
         if pipeline.enable_task(config, "set_model"):
             if config["set_model"]["unity"]:
                 opts = {
@@ -719,7 +736,7 @@ def worker(pipeline, recipe, config):
         no_secondary = gcal_set == set() or len(gcal_set - fcal_set) == 0
         if no_secondary:
             primary_order = config["primary"]["order"]
-            primary = solve(msname, msinfo, recipe, config, pipeline, i, prefix_msbase, label=label, ftype="primary")
+            primary = solve(msname, msinfo, recipe, config, pipeline, i, prefix_msbase, label=label, ftype="primary", fluxscale_reference=fluxscale_field)
             caracal.log.info("Secondary calibrator is the same as the primary. Skipping fluxscale")
             interps = primary["interps"]
             gainfields = primary["gainfield"]
@@ -768,7 +785,7 @@ def worker(pipeline, recipe, config):
                     label=label,
                 )
         else:
-            primary = solve(msname, msinfo, recipe, config, pipeline, i, prefix_msbase, label=label, ftype="primary")
+            primary = solve(msname, msinfo, recipe, config, pipeline, i, prefix_msbase, label=label, ftype="primary", fluxscale_reference=fluxscale_field)
 
             secondary = solve(
                 msname,
@@ -783,6 +800,7 @@ def worker(pipeline, recipe, config):
                 prev=primary,
                 prev_name="primary",
                 smodel=True,
+                fluxscale_reference=fluxscale_field,
             )
 
             interps = primary["interps"]
@@ -876,13 +894,12 @@ def worker(pipeline, recipe, config):
         if pipeline.enable_task(config, "summary"):
             step = "summary-{0:s}-{1:d}".format(label, i)
             recipe.add(
-                "cab/flagstats",
+                flagstats.save_statistics,
                 step,
                 {
-                    "msname": msname,
-                    "plot": True,
-                    "outfile": ("{0:s}-{1:s}-crosscal-summary-{2:d}.json").format(prefix_msbase, wname, i),
-                    "htmlfile": ("{0:s}-{1:s}-crosscal-summary-plots-{2:d}.html").format(prefix_msbase, wname, i),
+                    "msname": os.path.join(pipeline.msdir, msname),
+                    "outfile": os.path.join(pipeline.diagnostic_plots, ("{0:s}-{1:s}-crosscal-summary-{2:d}.json").format(prefix_msbase, wname, i)),
+                    "htmlfile": os.path.join(pipeline.diagnostic_plots, ("{0:s}-{1:s}-crosscal-summary-plots-{2:d}.html").format(prefix_msbase, wname, i)),
                 },
                 input=pipeline.input,
                 output=pipeline.diagnostic_plots,
@@ -891,3 +908,34 @@ def worker(pipeline, recipe, config):
             recipe.run()
             # Empty job que after execution
             recipe.jobs = []
+
+        return fluxscale_field
+
+    nms = len(pipeline.msbasenames)
+    if pipeline.enable_task(config, "ms_parallel") and nms > 1:
+        # the solve and apply chains of different MSs are independent, so each runs in its own recipe
+        scheduler = WorkerScheduler(
+            ncpu=config["ms_parallel"]["ncpu"],
+            mem_limit=config["ms_parallel"]["mem_limit"],
+            worker_ncpu=config["ms_parallel"]["ms_ncpu"],
+            worker_mem=config["ms_parallel"]["ms_mem"],
+        )
+        for i in range(nms):
+            scheduler.add_task(f"{wname}-ms{i}", payload=(i, recipe.spawn(f"{recipe.name}-ms{i}")))
+        caracal.log.info(f"Calibrating {nms} MSs concurrently, using {scheduler.ncpu} CPU(s) and {scheduler.mem_limit:.1f} GB of memory")
+        fluxscale_fields = {}
+
+        def _runner(node):
+            i, ms_recipe = node.payload
+            fluxscale_fields[i] = calibrate_ms(i, ms_recipe)
+            ms_recipe.run()
+            ms_recipe.jobs = []
+
+        scheduler.run(_runner)
+        fluxscale_fields = [fluxscale_fields[i] for i in range(nms)]
+    else:
+        fluxscale_fields = [calibrate_ms(i, recipe) for i in range(nms)]
+
+    # as when the MSs are calibrated one after another, the last MS sets the reference
+    if fluxscale_fields:
+        pipeline.fluxscale_reference = fluxscale_fields[-1]
@@ -5,7 +5,7 @@ import re
 import stimela.dismissable as sdm
 
 import caracal
-from caracal.dispatch_crew import utils
+from caracal.dispatch_crew import flagstats, static_flagger, utils
 from caracal.workers.utils import manage_fields as manfields
 from caracal.workers.utils import manage_flagsets as manflags
 
@@ -138,6 +138,44 @@ def worker(pipeline, recipe, config):
             field_ids = utils.get_field_id(msdict, fields)
             fields = ",".join(fields)
 
+            # With the static flagger, the casa_flagdata steps that it supports are collected in static_rules,
+            # and applied in a single pass over the MS by flush_static_rules()
+            static_rules = [] if pipeline.enable_task(config, "static_flagger") else None
+
+            def flush_static_rules():
+                if static_rules:
+                    step = "{0:s}-static-ms{1:d}".format(wname, msiter)
+                    recipe.add(
+                        static_flagger.flag_ms,
+                        step,
+                        {
+                            "ms": os.path.join(pipeline.msdir, msname),
+                            "rules": list(static_rules),
+                            "summary": os.path.join(pipeline.msdir, os.path.splitext(msname)[0] + "-summary.json"),
+                        },
+                        input=pipeline.input,
+                        output=pipeline.output,
+                        label="{0:s}:: Static flagging ({2:s}) ms={1:s}".format(step, msname, ", ".join(rule_step for rule_step, args in static_rules)),
+                    )
+                    del static_rules[:]
+
+            def add_flagdata(step, args, label):
+                """Adds a casa_flagdata step, or collects it for the static flagger if that supports it"""
+                if static_rules is not None and static_flagger.supported(args, msdict):
+                    static_rules.append((step, args))
+                    return
+                # only unflagging undoes flags, so only then must the collected rules be applied first
+                if args.get("mode") == "unflag":
+                    flush_static_rules()
+                recipe.add(
+                    "cab/casa_flagdata",
+                    step,
+                    dict({"vis": msname, "flagbackup": False}, **args),
+                    input=pipeline.input,
+                    output=pipeline.output,
+                    label=label,
+                )
+
             if pipeline.enable_task(config, "unflag"):
                 step = "{0:s}-unflag-ms{1:d}".format(wname, msiter)
                 recipe.add(
@@ -183,36 +221,26 @@ def worker(pipeline, recipe, config):
 
             if pipeline.enable_task(config, "flag_autocorr"):
                 step = "{0:s}-autocorr-ms{1:d}".format(wname, msiter)
-                recipe.add(
-                    "cab/casa_flagdata",
+                add_flagdata(
                     step,
                     {
-                        "vis": msname,
                         "mode": "manual",
                         "autocorr": True,
                         "field": fields,
-                        "flagbackup": False,
                     },
-                    input=pipeline.input,
-                    output=pipeline.output,
                     label="{0:s}:: Flag auto-correlations ms={1:s}".format(step, msname),
                 )
 
             if pipeline.enable_task(config, "flag_quack"):
                 step = "{0:s}-quack-ms{1:d}".format(wname, msiter)
-                recipe.add(
-                    "cab/casa_flagdata",
+                add_flagdata(
                     step,
                     {
-                        "vis": msname,
                         "mode": "quack",
                         "quackinterval": config["flag_quack"]["interval"],
                         "quackmode": config["flag_quack"]["mode"],
                         "field": fields,
-                        "flagbackup": False,
                     },
-                    input=pipeline.input,
-                    output=pipeline.output,
                     label="{0:s}:: Quack flagging ms={1:s}".format(step, msname),
                 )
 
@@ -317,18 +345,13 @@ def worker(pipeline, recipe, config):
                         )
 
                 if found_valid_data or not config["flag_spw"]["ensure_valid"]:
-                    recipe.add(
-                        "cab/casa_flagdata",
+                    add_flagdata(
                         step,
                         {
-                            "vis": msname,
                             "mode": "manual",
                             "spw": flagspwselection,
                             "field": fields,
-                            "flagbackup": False,
                         },
-                        input=pipeline.input,
-                        output=pipeline.output,
                         label="{0:s}::Flag out channels ms={1:s}".format(step, msname),
                     )
 
@@ -353,35 +376,25 @@ def worker(pipeline, recipe, config):
                             " of the flagging worker."
                         )
                 if found_valid_data or not config["flag_time"]["ensure_valid"]:
-                    recipe.add(
-                        "cab/casa_flagdata",
+                    add_flagdata(
                         step,
                         {
-                            "vis": msname,
                             "mode": "manual",
                             "timerange": config["flag_time"]["timerange"],
-                            "flagbackup": False,
                             "field": fields,
                         },
-                        input=pipeline.input,
-                        output=pipeline.output,
                         label="{0:s}::Flag out channels ms={1:s}".format(step, msname),
                     )
 
             if pipeline.enable_task(config, "flag_scan"):
                 step = "{0:s}-scan-ms{1:d}".format(wname, msiter)
-                recipe.add(
-                    "cab/casa_flagdata",
+                add_flagdata(
                     step,
                     {
-                        "vis": msname,
                         "mode": "manual",
                         "scan": config["flag_scan"]["scans"],
-                        "flagbackup": False,
                         "field": fields,
                     },
-                    input=pipeline.input,
-                    output=pipeline.output,
                     label="{0:s}::Flag out channels ms={1:s}".format(step, msname),
                 )
 
@@ -412,19 +425,14 @@ def worker(pipeline, recipe, config):
                 for nn, antenna in enumerate(antennas):
                     antstep = "ant-{0:s}-ms{1:d}-antsel{2:d}".format(wname, i, nn)
                     if found_valid_data[nn] or not ensure:
-                        recipe.add(
-                            "cab/casa_flagdata",
+                        add_flagdata(
                             antstep,
                             {
-                                "vis": msname,
                                 "mode": "manual",
                                 "antenna": antenna,
                                 "timerange": times[nn],
                                 "field": fields,
-                                "flagbackup": False,
                             },
-                            input=pipeline.input,
-                            output=pipeline.output,
                             label="{0:s}:: Flagging bad antenna {2:s} ms={1:s}".format(antstep, msname, antenna),
                         )
                     elif ensure and not found_valid_data[nn]:
@@ -468,20 +476,13 @@ def worker(pipeline, recipe, config):
                     caracal.log.info(f"adding manual flagging rule for {pattern}")
                     step = f"{wname}-manual-ms{msiter}-{irule}"
                     args = {
-                        "vis": msname,
                         "mode": "manual",
-                        "flagbackup": False,
                         "field": fields,
                     }
                     args.update(keywords)
-                    recipe.add(
-                        "cab/casa_flagdata",
-                        step,
-                        args,
-                        input=pipeline.input,
-                        output=pipeline.output,
-                        label=f"{step}::Flag ms={msname} using {rule}",
-                    )
+                    add_flagdata(step, args, label=f"{step}::Flag ms={msname} using {rule}")
+
+            flush_static_rules()
 
             if pipeline.enable_task(config, "flag_rfi"):
                 step = "{0:s}-rfi-ms{1:d}".format(wname, msiter)
@@ -628,13 +629,12 @@ def worker(pipeline, recipe, config):
                 __label = config["label_in"]
                 step = "{0:s}-summary-ms{1:d}".format(wname, msiter)
                 recipe.add(
-                    "cab/flagstats",
+                    flagstats.save_statistics,
                     step,
                     {
-                        "msname": msname,
-                        "plot": True,
-                        "outfile": ("{0:s}-{1:s}-flagging-summary-{2:d}.json").format(prefix, wname, i),
-                        "htmlfile": ("{0:s}-{1:s}-flagging-summary-plots-{2:d}.html").format(prefix, wname, i),
+                        "msname": os.path.join(pipeline.msdir, msname),
+                        "outfile": os.path.join(pipeline.diagnostic_plots, ("{0:s}-{1:s}-flagging-summary-{2:d}.json").format(prefix, wname, i)),
+                        "htmlfile": os.path.join(pipeline.diagnostic_plots, ("{0:s}-{1:s}-flagging-summary-plots-{2:d}.html").format(prefix, wname, i)),
                     },
                     input=pipeline.input,
                     output=pipeline.diagnostic_plots,
@@ -1,7 +1,6 @@
 import datetime
 import glob
 import itertools
-import json
 import os
 import re
 import shutil
@@ -15,8 +14,8 @@ from casacore.tables import table
 
 import caracal
 from caracal import log
-from caracal.dispatch_crew import noisy, utils
-from caracal.workers.utils import flag_Uzeros, remove_output_products
+from caracal.dispatch_crew import noisy, profiler, utils
+from caracal.workers.utils import flag_Uzeros, regrid_mask, remove_output_products
 from caracal.workers.utils import manage_flagsets as manflags
 
 C = 2.99792458e8  # m/s
@@ -831,7 +830,8 @@ def worker(pipeline, recipe, config):
             else:
                 msname_Flag = msname
 
-            uZeros.run_flagUzeros(pipeline, all_targets, msname_Flag)
+            with profiler.profiled("Flag u=0 stripes"):
+                uZeros.run_flagUzeros(pipeline, all_targets, msname_Flag)
 
         if pipeline.enable_task(config, "sunblocker"):
             if config["sunblocker"]["use_mstransform"]:
@@ -904,7 +904,8 @@ def worker(pipeline, recipe, config):
             else:
                 mslist = ms_dict[target]
             caracal.log.info("  Target #{0:d}: {1:}, files {2:}".format(tt, target, mslist))
-            noisy.PredictNoise(["{0:s}/{1:s}".format(pipeline.msdir, mm) for mm in mslist], str(tsyseff), diam, target, verbose=2)
+            with profiler.profiled(f"Predict noise for target {target}"):
+                noisy.PredictNoise(["{0:s}/{1:s}".format(pipeline.msdir, mm) for mm in mslist], str(tsyseff), diam, target, verbose=2, nproc=ncpu)
 
     if pipeline.enable_task(config, "make_cube") and config["make_cube"]["image_with"] == "wsclean":
         nchans_all, specframe_all = [], []
@@ -1040,11 +1041,9 @@ def worker(pipeline, recipe, config):
                         # C = 2.99792458e8  # m/s
                         femit = [r.strip() for r in re.split(r"([-+]?\d+\.\d+)|([-+]?\d+)", restfreq.strip()) if r is not None and r.strip() != ""]
                         femit = (eval(femit[0]) * units.Unit(femit[1])).to(units.Hz).value  # Hz
-                        t = mslist[0].replace(".ms", "-summary.json")  # first file given to WSClean as input
-                        with open("{}/{}".format(pipeline.msdir, t)) as f:
-                            obsDict = json.load(f)
-                        raTarget = np.round(obsDict["FIELD"]["REFERENCE_DIR"][0][0][0] / np.pi * 180, 5)
-                        decTarget = np.round(obsDict["FIELD"]["REFERENCE_DIR"][0][0][1] / np.pi * 180, 5)
+                        obsDict = pipeline.get_msinfo(mslist[0])  # first file given to WSClean as input
+                        raTarget = np.round(obsDict.reference_dirs[0, 0] / np.pi * 180, 5)
+                        decTarget = np.round(obsDict.reference_dirs[0, 1] / np.pi * 180, 5)
                         cubeHeight = config["make_cube"]["npix"][0]
                         cubeWidth = config["make_cube"]["npix"][1] if len(config["make_cube"]["npix"]) == 2 else cubeHeight
 
@@ -1106,105 +1105,18 @@ def worker(pipeline, recipe, config):
                                 #  that the ms file and mask were not created with the same original spectral grid.
                                 doSpec = None
 
-                            if doProj:
-                                ax3param = []
-                                for key in ["NAXIS3", "CTYPE3", "CRPIX3", "CRVAL3", "CDELT3"]:
-                                    ax3param.append(hdul[0].header[key])
-
                         caracal.log.info("doSpecProj = {}".format(doSpec))
                         caracal.log.info("doSpaceProj = {}".format(doProj))
 
                         if doProj:
-                            """
-                            MAKE HDR FILE FOR REGRIDDING THE USER SUPPLIED MASK AND REPROJECT
-                            """
-                            with open("{}/tmp.hdr".format(pipeline.masking), "w") as file:
-                                file.write("SIMPLE  =   T\n")
-                                file.write("BITPIX  =   -64\n")
-                                file.write("NAXIS   =   2\n")
-                                file.write("NAXIS1  =   {}\n".format(cubeWidth))
-                                file.write("CTYPE1  =   'RA---SIN'\n")
-                                file.write("CRVAL1  =   {}\n".format(raTarget))
-                                file.write("CRPIX1  =   {}\n".format(cubeWidth / 2 + 1))
-                                file.write("CDELT1  =   {}\n".format(-1 * config["make_cube"]["cell"] / 3600.0))
-                                file.write("NAXIS2  =   {}\n".format(cubeHeight))
-                                file.write("CTYPE2  =   'DEC--SIN'\n")
-                                file.write("CRVAL2  =   {}\n".format(decTarget))
-                                file.write("CRPIX2  =   {}\n".format(cubeHeight / 2 + 1))
-                                file.write("CDELT2  =   {}\n".format(config["make_cube"]["cell"] / 3600.0))
-                                file.write("EXTEND  =   T\n")
-                                file.write("EQUINOX =   2000.0\n")
-                                file.write("END\n")
-
-                            if os.path.exists("{}/{}".format(pipeline.masking, postGridMask)):
-                                os.remove("{}/{}".format(pipeline.masking, postGridMask))
-
-                            with fits.open("{}/{}".format(pipeline.masking, preGridMask)) as hdul:
-                                if np.amax(hdul[0].data) > 1:
-                                    mask = np.where(hdul[0].data > 0)
-                                    hdul[0].data[mask] = 1
-                                    preGridMaskNew = preGridMask.replace(".fits", "_01.fits")
-                                    hdul.writeto("{}/{}".format(pipeline.masking, preGridMaskNew), overwrite=True)
-                                    preGridMask = preGridMaskNew
                             caracal.log.info("Reprojecting mask {} to match the grid of the cube.".format(preGridMask))
-
-                            step = "reprojectMask-field{}".format(tt)
-                            recipe.add(
-                                "cab/mProjectCube",
-                                step,
-                                {
-                                    "in.fits": preGridMask,
-                                    "out.fits": postGridMask,
-                                    "hdr.template": "tmp.hdr",
-                                },
-                                input=pipeline.masking,
-                                output=pipeline.masking,
-                                label="{0:s}:: Reprojecting user input mask {1:s} to match the grid of the cube".format(step, preGridMask),
+                            regrid_mask.reproject_mask(
+                                "{}/{}".format(pipeline.masking, preGridMask),
+                                "{}/{}".format(pipeline.masking, postGridMask),
+                                regrid_mask.sky_header(cubeWidth, cubeHeight, raTarget, decTarget, config["make_cube"]["cell"] / 3600.0, cubeWidth / 2 + 1, cubeHeight / 2 + 1),
+                                cachedir=pipeline.masking,
                             )
 
-                            # In order to make sure that we actually find
-                            # stuff in the images we execute the rec ipe here
-                            recipe.run()
-                            # Empty job que after execution
-                            recipe.jobs = []
-
-                            if not os.path.exists("{}/{}".format(pipeline.masking, postGridMask)):
-                                raise IOError(f"The regridded mask {postGridMask} does not exist. The original mask likely has no overlap with the cube")
-
-                            with fits.open("{}/{}".format(pipeline.masking, postGridMask), mode="update") as hdul:
-                                for i, key in enumerate(["NAXIS3", "CTYPE3", "CRPIX3", "CRVAL3", "CDELT3"]):
-                                    hdul[0].header[key] = ax3param[i]
-                                axDict = {"1": [2, cubeWidth], "2": [1, cubeHeight]}
-                                for i in ["1", "2"]:
-                                    cent, _ = hdul[0].header["CRPIX" + i], hdul[0].header["NAXIS" + i]
-                                    if cent < axDict[i][1] / 2 + 1:
-                                        delt = int(axDict[i][1] / 2 + 1 - cent)
-                                        if i == "1":
-                                            toAdd = np.zeros([hdul[0].header["NAXIS3"], hdul[0].data.shape[1], delt])
-                                        else:
-                                            toAdd = np.zeros([hdul[0].header["NAXIS3"], delt, hdul[0].data.shape[2]])
-                                        hdul[0].data = np.concatenate([toAdd, hdul[0].data], axis=axDict[i][0])
-                                        hdul[0].header["CRPIX" + i] = cent + delt
-                                    if hdul[0].data.shape[axDict[i][0]] < axDict[i][1]:
-                                        delt = int(axDict[i][1] - hdul[0].data.shape[axDict[i][0]])
-                                        if i == "1":
-                                            toAdd = np.zeros([hdul[0].header["NAXIS3"], hdul[0].data.shape[1], delt])
-                                        else:
-                                            toAdd = np.zeros([hdul[0].header["NAXIS3"], delt, hdul[0].data.shape[2]])
-                                        hdul[0].data = np.concatenate([hdul[0].data, toAdd], axis=axDict[i][0])
-                                    if hdul[0].data.shape[axDict[i][0]] > axDict[i][1]:
-                                        delt = int(hdul[0].data.shape[axDict[i][0]] - axDict[i][1])
-                                        hdul[0].data = hdul[0].data[:, :, -delt] if i == "1" else hdul[0].data[:, -delt, :]
-                                        if cent > axDict[i][1] / 2 + 1:
-                                            hdul[0].header["CRPIX" + i] = hdul[0].data.shape[axDict[i][0]] / 2 + 1
-
-                                hdul[0].data = np.around(hdul[0].data.astype(np.float32)).astype(np.int16)
-                                try:
-                                    del hdul[0].header["EN"]
-                                except KeyError:
-                                    pass
-                                hdul.flush()
-
                             line_image_opts.update({"fitsmask": "{0:s}/{1:s}:output".format(get_relative_path(pipeline.masking, pipeline), postGridMask.split("/")[-1])})
 
                         else:
@@ -1504,7 +1416,8 @@ def worker(pipeline, recipe, config):
 
                 if not config["make_cube"]["wscl_onlypsf"]:
                     cubename_file = "{0:s}/cube_{1:d}/{2:s}_{3:s}_{4:s}_{1:d}.image.fits".format(pipeline.cubes, jj, pipeline.prefix, field, line_name)
-                    rms_values.append(calc_rms(cubename_file, line_clean_mask_file))
+                    with profiler.profiled(f"Calculate RMS of {os.path.basename(cubename_file)}"):
+                        rms_values.append(calc_rms(cubename_file, line_clean_mask_file))
                     caracal.log.info("RMS = {0:.3e} Jy/beam for {1:s}".format(rms_values[-1], cubename_file))
 
                 # if the RMS has decreased by a factor < wscl_tol compared to the previous cube then cleaning
@@ -379,13 +379,11 @@ def worker(pipeline, recipe, config):
 
     flabel = config["label_in"]
     all_targets, all_msfiles, ms_dict = pipeline.get_target_mss(flabel)
-    msinfo = pipeline.get_msinfo(all_msfiles[0])
 
     for target in all_targets:
         if centre[0] == "HH:MM:SS" and centre[1] == "DD:MM:SS":
-            targetpos = msinfo["REFERENCE_DIR"]
-            while len(targetpos) == 1:
-                targetpos = targetpos[0]
+            msinfo = pipeline.get_msinfo(ms_dict[target][0])
+            targetpos = msinfo.reference_dirs[msinfo.field_index(target)]
             coords = [targetpos[0] / np.pi * 180.0, targetpos[1] / np.pi * 180.0]
             centreCoord = coord.SkyCoord(coords[0], coords[1], frame="icrs", unit=(u.deg, u.deg))
             centre[0] = centreCoord.ra.hms
@@ -8,7 +8,7 @@ import yaml
 
 import caracal
 import caracal.dispatch_crew.utils as utils
-from caracal.workers.utils import callibs
+from caracal.workers.utils import callibs, manage_caltabs
 from caracal.workers.utils import manage_antennas as manants
 from caracal.workers.utils import manage_flagsets as manflags
 
@@ -30,6 +30,22 @@ def scan_length(msinfo, field):
     return float(utils.field_observation_length(msinfo, field)) / len(msinfo["SCAN"][str(idx)])
 
 
+def select_best_scan(gaintable, outfile):
+    """Returns the scan of gaintable where the X and Y gain amplitudes are closest (the scan with the least
+    polarized signal in XX and YY), ignoring flagged solutions, and writes it to outfile (JSON)"""
+    with manage_caltabs.CalTable(gaintable) as ct:
+        gains, flags, scans = ct.read("CPARAM"), ct.read("FLAG"), ct.scans[ct.spws[0]]
+    good = ~(flags[..., 0] | flags[..., 1])
+    deviation = numpy.where(good, numpy.abs(gains[..., 0]) / numpy.where(good, numpy.abs(gains[..., 1]), 1) - 1.0, 0) ** 2
+    scanlist = numpy.unique(scans)
+    ratios = numpy.array([numpy.sqrt(deviation[scans == scan].sum() / max(good[scans == scan].sum(), 1)) for scan in scanlist])
+    ratios[[not good[scans == scan].any() for scan in scanlist]] = numpy.inf
+    bestscan = int(scanlist[numpy.argmin(ratios)])
+    with open(outfile, "w") as json_file:
+        json.dump({"bestscan": bestscan}, json_file, indent=4)
+    return bestscan
+
+
 def xcal_model_fcal_leak(
     msname,
     msinfo,
@@ -857,51 +873,7 @@ def xcal_from_pa_xcal_leak(
 
         # We search for the scan where the polarization signal is minimum in XX and YY
         # (i.e., maximum in XY and YX):
-        recipe.add(
-            "cab/pycasacore",
-            "select_best_scan",
-            {
-                "msname": msname,
-                "script": f"""
-import json
-import os
-from casacore.tables import table as tb
-import numpy
-
-OUTPUT=os.environ['OUTPUT']
-ext_prefix = os.path.join(OUTPUT, '{prefix}')
-with tb(ext_prefix + '.Gpol1') as t:
-    scans = t.getcol('SCAN_NUMBER')
-    gains = numpy.squeeze(t.getcol('CPARAM'))
-    t.close()
-scanlist = numpy.array(list(set(scans)))
-ratios = numpy.zeros(len(scanlist))
-
-for si, s in enumerate(scanlist):
-    filt = scans == s
-    ratio = numpy.sqrt(
-        numpy.average(numpy.power(numpy.abs(gains[filt, 0]) / numpy.abs(gains[filt, 1]) - 1.0, 2.0))
-    )
-    ratios[si] = ratio
-outfile = ext_prefix + '_bestscan.json'
-bestscidx = numpy.argmin(ratios)
-bestscan = scanlist[bestscidx]
-bestscan=int(bestscan)
-with open(outfile, 'w') as json_file:
-    json.dump({{'bestscan': bestscan}}, json_file, indent=4)
-""",
-            },
-            input=pipeline.caltables,
-            output=pipeline.caltables,
-            label="select_best_scan",
-        )
-
-        recipe.run()
-        recipe.jobs = []
-
-        with open(os.path.join(pipeline.caltables, prefix) + "_bestscan.json", "r") as json_file:
-            data = json.load(json_file)
-            bestscan = data["bestscan"]
+        bestscan = select_best_scan(os.path.join(pipeline.caltables, prefix + ".Gpol1"), os.path.join(pipeline.caltables, prefix + "_bestscan.json"))
 
         # Kcross
         tmp_gtab = caltablelist + [prefix + ".Gpol1"]
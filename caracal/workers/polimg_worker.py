@@ -1,5 +1,4 @@
 import glob
-import json
 import os
 
 import numpy as np
@@ -149,11 +148,10 @@ def worker(pipeline, recipe, config):
             os.rename(fname, fname[:-13] + stokes + "-residual.fits")
 
     def fix_freq(nch):
-        summary = f"{mslist[0][:-3]}-summary.json"
-        summary_file = json.load(open(os.path.join(pipeline.msdir, summary)))
-        freq0 = float(summary_file["SPW"]["REF_FREQUENCY"][0])
-        bw = float(summary_file["SPW"]["TOTAL_BANDWIDTH"][0])
-        nchan = int(summary_file["SPW"]["NUM_CHAN"][0])
+        msinfo = pipeline.get_msinfo(mslist[0])
+        freq0 = float(msinfo.ref_frequencies[0])
+        bw = float(msinfo.total_bandwidths[0])
+        nchan = int(msinfo.num_chans[0])
         res = bw / nchan
         chout = config["make_images"]["img_nchans"]
         if config["make_images"]["img_chan_range"]:
@@ -4,7 +4,6 @@ import numpy as np
 
 import caracal
 import caracal.dispatch_crew.caltables as mkct
-from caracal.dispatch_crew.utils import closeby
 from caracal.workers.utils import manage_flagsets as manflags
 
 NAME = "Prepare Data for Processing"
@@ -17,31 +16,28 @@ def getfield_coords(info, field, db, tol=2.9e-3, tol_diff=4.8481e-6):
     from the database.
     Find match of fields in info
     Parameters:
-    info (dict): dictionary of obsinfo as read by yaml
+    info (MSInfo): MS metadata as returned by pipeline.get_msinfo()
     field (str): field name
-    db (dict):   calibrator data base as returned by
+    db (catalog_parser): calibrator data base as returned by
                 calibrator_database()
-    Go through all calibrators in db and return the first that matches
+    Look up the calibrators of db and return the first that matches
     the coordinates of field in msinfo. Return empty string if not
     found.
     If coordinates difference is larger than tol_diff, return the correct coordinates, else return empty string.
     """
 
     # Get position of field in msinfo
-    ind = info["FIELD"]["NAME"].index(field)
-    firade = info["FIELD"]["DELAY_DIR"][ind][0]
+    firade = info.delay_dirs[info.field_index(field)].copy()
     firade[0] = np.mod(firade[0], 2 * np.pi)
-    dbcp = db.db
     caracal.log.info("Checking for crossmatch")
-    caracal.log.info(f"Database keys: {dbcp.keys()}")
-    for key in dbcp.keys():
-        carade = [dbcp[key]["ra"], dbcp[key]["decl"]]
-        if closeby(carade, firade, tol=tol):
-            if not closeby(carade, firade, tol=tol_diff):
-                return key, dbcp[key]["ra"], dbcp[key]["decl"]
-            else:
-                caracal.log.info("Calibrator coordinates match within the specified tolerance.")
-                return None, None, None
+    caracal.log.info(f"Database keys: {db.db.keys()}")
+    names, dists = db.crossmatch(firade[0], firade[1], tol=tol)
+    key = names[0]
+    if key is None:
+        return None, None, None
+    if dists[0] >= tol_diff:
+        return key, db.db[key]["ra"], db.db[key]["decl"]
+    caracal.log.info("Calibrator coordinates match within the specified tolerance.")
     return None, None, None
 
 
@@ -2,7 +2,9 @@ import copy
 import glob
 import json
 import os
+import re
 import shutil
+import threading
 
 import astropy.io.fits as fits
 import numpy as np
@@ -12,14 +14,27 @@ from casacore.tables import table
 from stimela.pathformatter import pathformatter as spf
 
 import caracal
-from caracal.dispatch_crew import utils
+from caracal.dispatch_crew import fidelity, flagstats, utils
+from caracal.dispatch_crew.scheduler import WorkerScheduler
+from caracal.workers.utils import cubical_chunks, psf_reuse, regrid_mask
 from caracal.workers.utils import manage_flagsets as manflags
 
 NAME = "Continuum Imaging and Self-calibration Loop"
 LABEL = "selfcal"
 
 
-# self_cal_iter_counter is used as a global variable.
+class SelfcalState(object):
+    def __init__(self, start_iter):
+        """
+        State of the selfcal loop of a target: the iteration counter, and the bookkeeping of the two-step (meqtrees)
+        calibration that quality_check() uses to stop and roll back. Each target has its own, so that the loops of
+        different targets can run concurrently.
+        """
+        self.iter_counter = start_iter
+        self.reset_cal = 0
+        self.trace_SN = []
+        self.trace_matrix = []
+
 
 # To split out continuum/<dir> from output/continuum/dir
 
@@ -284,6 +299,11 @@ def worker(pipeline, recipe, config):
         ncpu = min(ncpu, psutil.cpu_count())
     nwlayers_factor = config["img_nwlayers_factor"]
     nrdeconvsubimg = ncpu if config["img_nrdeconvsubimg"] == 0 else config["img_nrdeconvsubimg"]
+    # PSF reuse needs a wsclean cab with the reuse-psf option
+    reuse_psf = config["image"]["reuse_psf"]
+    if reuse_psf and not psf_reuse.cab_supports(psf_reuse.REUSE_OPTION):
+        caracal.log.warning("image: reuse_psf is enabled, but the wsclean cab does not support '{0:s}'. The PSF will be remade in every iteration.".format(psf_reuse.REUSE_OPTION))
+        reuse_psf = False
     if nrdeconvsubimg == 1:
         wscl_parallel_deconv = None
     else:
@@ -489,7 +509,7 @@ def worker(pipeline, recipe, config):
 
     prefix = pipeline.prefix
 
-    def fake_image(trg, num, img_dir, mslist, field):
+    def fake_image(recipe, trg, num, img_dir, mslist, field):
         key = "image"
         ncpu_img = config[key]["ncpu_img"] if config[key]["ncpu_img"] else ncpu
         absmem = config[key]["absmem"]
@@ -563,7 +583,7 @@ def worker(pipeline, recipe, config):
             label="{:s}:: Make image after first round of calibration".format(step),
         )
 
-    def image(trg, num, img_dir, mslist, field):
+    def image(recipe, state, trg, num, img_dir, mslist, field):
         key = "image"
 
         ncpu_img = config[key]["ncpu_img"] if config[key]["ncpu_img"] else ncpu
@@ -572,11 +592,11 @@ def worker(pipeline, recipe, config):
         caracal.log.info(ncpu_img)
         # If we have a two_step selfcal and Gaindiag we want to use  CORRECTED_DATA
         if config["calibrate_with"].lower() == "meqtrees" and config["cal_meqtrees"]["two_step"] and num > 1:
-            if trace_matrix[-1] == "GainDiag":
+            if state.trace_matrix[-1] == "GainDiag":
                 imcolumn = "CORRECTED_DATA"
             # If we do not have gaindiag but do have two step selfcal check against
             # stupidity and that we are actually ending with ampphase cal and written to a special phase column
-            elif trace_matrix[-1] == "GainDiagPhase":
+            elif state.trace_matrix[-1] == "GainDiagPhase":
                 imcolumn = "CORRECTED_DATA_PHASE"
             # If none of these apply then do our normal sefcal
             else:
@@ -698,15 +718,10 @@ def worker(pipeline, recipe, config):
 
             postGridMask = preGridMask.replace(".fits", "_{}_regrid.fits".format(pipeline.prefix))
 
-            msname_base = os.path.splitext(mslist[0])[0]
-
-            t = f"{msname_base}-summary.json"
+            obsDict = pipeline.get_msinfo(mslist[0])
 
-            with open("{}/{}".format(pipeline.msdir, t)) as f:
-                obsDict = json.load(f)
-
-            raTarget = obsDict["FIELD"]["REFERENCE_DIR"][0][0][0] / np.pi * 180
-            decTarget = obsDict["FIELD"]["REFERENCE_DIR"][0][0][1] / np.pi * 180
+            raTarget = obsDict.reference_dirs[0, 0] / np.pi * 180
+            decTarget = obsDict.reference_dirs[0, 1] / np.pi * 180
 
             with fits.open("{}/{}".format(pipeline.masking, preGridMask)) as hdul:
                 caracal.log.info("An input mask for cleaning is provided checking if regridding is needed")
@@ -721,72 +736,15 @@ def worker(pipeline, recipe, config):
                     doProj = None
 
             if doProj:
-                """
-                MAKE HDR FILE FOR REGRIDDING THE USER SUPPLIED MASK
-                """
                 caracal.log.info("Regridding the fitsmask for cleaning")
-
-                caracal.log.info("Write header for new mask {} to match the grid of the image".format(postGridMask))
-
-                with open("{}/tmp.hdr".format(pipeline.masking), "w") as file:
-                    file.write("SIMPLE  =   T\n")
-                    file.write("BITPIX  =   -64\n")
-                    file.write("NAXIS   =   2\n")
-                    file.write("NAXIS1  =   {}\n".format(imgWidth))
-                    file.write("CTYPE1  =   'RA---SIN'\n")
-                    file.write("CRVAL1  =   {}\n".format(raTarget))
-                    file.write("CRPIX1  =   {}\n".format(imgWidth / 2))
-                    file.write("CDELT1  =   {}\n".format(-1 * config["img_cell"] / 3600.0))
-                    file.write("NAXIS2  =   {}\n".format(imgHeight))
-                    file.write("CTYPE2  =   'DEC--SIN'\n")
-                    file.write("CRVAL2  =   {}\n".format(decTarget))
-                    file.write("CRPIX2  =   {}\n".format(imgHeight / 2))
-                    file.write("CDELT2  =   {}\n".format(config["img_cell"] / 3600.0))
-                    file.write("EXTEND  =   T\n")
-                    file.write("EQUINOX =   2000.0\n")
-                    file.write("SPECSYS =   TOPOCENT\n")
-                    file.write("END\n")
-
-                if os.path.exists("{}/{}".format(pipeline.masking, postGridMask)):
-                    os.remove("{}/{}".format(pipeline.masking, postGridMask))
-
-                with fits.open("{}/{}".format(pipeline.masking, preGridMask)) as hdul:
-                    if np.amax(hdul[0].data) > 1:
-                        mask = np.where(hdul[0].data > 0)
-                        hdul[0].data[mask] = 1
-                        preGridMaskNew = preGridMask.replace(".fits", "_01.fits")
-                        hdul.writeto("{}/{}".format(pipeline.masking, preGridMaskNew), overwrite=True)
-                        preGridMask = preGridMaskNew
-
                 caracal.log.info("Reprojecting mask {} to match the grid of the image.".format(preGridMask))
-
-                # REPROJECT user supplied mask
-                step = "reprojectMask-img-{}-field-{}".format(trg, num)
-                recipe.add(
-                    "cab/mProject",
-                    step,
-                    {
-                        "in.fits": preGridMask,
-                        "out.fits": postGridMask,
-                        "hdr.template": "tmp.hdr",
-                        "f": True,
-                    },
-                    input=pipeline.masking,
-                    output=pipeline.masking,
-                    label="{0:s}:: Reprojecting user input mask {1:s} to match the grid of the image".format(step, preGridMask),
+                regrid_mask.reproject_mask(
+                    "{}/{}".format(pipeline.masking, preGridMask),
+                    "{}/{}".format(pipeline.masking, postGridMask),
+                    regrid_mask.sky_header(imgWidth, imgHeight, raTarget, decTarget, config["img_cell"] / 3600.0, imgWidth / 2, imgHeight / 2),
+                    cachedir=pipeline.masking,
                 )
 
-                recipe.run()
-                recipe.jobs = []
-
-                if not os.path.exists("{}/{}".format(pipeline.masking, postGridMask)):
-                    raise IOError(f"The regridded mask {postGridMask} does not exist. The original mask likely has no overlap with the cube.")
-
-                # convert floats of mask to integers
-                with fits.open("{}/{}".format(pipeline.masking, postGridMask), mode="update") as hdul:
-                    hdul[0].data = np.around(hdul[0].data.astype(np.float32)).astype(np.int16)
-                    hdul.flush()
-
                 # update fitsmask keyword of wsclean
                 image_opts.update(
                     {
@@ -795,6 +753,20 @@ def worker(pipeline, recipe, config):
                     }
                 )
 
+        psf_signature, psf_prefix = None, None
+        if reuse_psf:
+            # steps queued before this one (e.g. calibration) may still change the flags, so they run first
+            recipe.run()
+            recipe.jobs = []
+            psf_signature = psf_reuse.signature(image_opts, ["{0:s}/{1:s}".format(pipeline.msdir, ms) for ms in mslist])
+            psf_reuse.forget(pipeline.output, image_opts["prefix"])
+            if num > 1:
+                previous = "{0:s}/{1:s}_{2:s}_{3:d}".format(img_dir, prefix, field, num - 1)
+                psf_prefix = psf_reuse.reusable_psf(pipeline.output, previous, psf_signature)
+            if psf_prefix:
+                caracal.log.info("Imaging geometry and weighting are unchanged since iteration {0:d}. Reusing its PSF.".format(num - 1))
+                image_opts[psf_reuse.REUSE_OPTION] = psf_prefix
+
         recipe.add(
             "cab/wsclean",
             step,
@@ -806,8 +778,10 @@ def worker(pipeline, recipe, config):
         recipe.run()
         # Empty job que after execution
         recipe.jobs = []
+        if psf_signature:
+            psf_reuse.record(pipeline.output, image_opts["prefix"], psf_signature, psf_prefix=psf_prefix)
 
-    def sofia_mask(trg, num, img_dir, field):
+    def sofia_mask(recipe, trg, num, img_dir, mslist, field):
         step = "make-sofia_mask-field{0:d}-iter{1:d}".format(trg, num)
         key = "img_sofia_settings"
 
@@ -869,22 +843,16 @@ def worker(pipeline, recipe, config):
 
         # check if inputmask is provided by input
         preGridMask = config[key]["inputmask"]
-        postGridMask = preGridMask.replace(".fits", "_{}_regrid.fits".format(pipeline.prefix))
 
         if num == 0 and preGridMask:
             caracal.log.info("Inputmask {} found in Cycle-0. Checking if regridding is needed, and proceed if true".format(preGridMask))
 
             doProj = False
 
-            msname_base = os.path.splitext(mslist[0])[0]
-
-            t = f"{msname_base}-summary.json"
-
-            with open("{}/{}".format(pipeline.msdir, t)) as f:
-                obsDict = json.load(f)
+            obsDict = pipeline.get_msinfo(mslist[0])
 
-            raTarget = obsDict["FIELD"]["REFERENCE_DIR"][0][0][0] / np.pi * 180
-            decTarget = obsDict["FIELD"]["REFERENCE_DIR"][0][0][1] / np.pi * 180
+            raTarget = obsDict.reference_dirs[0, 0] / np.pi * 180
+            decTarget = obsDict.reference_dirs[0, 1] / np.pi * 180
             with fits.open("{}/{}".format(pipeline.masking, preGridMask)) as hdul:
                 imgHeight = config["img_npix"]
                 imgWidth = config["img_npix"]
@@ -894,75 +862,17 @@ def worker(pipeline, recipe, config):
                     doProj = True if (hdul[0].header["CRVAL1"] != raTarget) | (hdul[0].header["CRVAL2"] != decTarget) else None
 
             if doProj:
-                # MAKE HDR FILE FOR REGRIDDING THE USER SUPPLIED MASK
-
                 caracal.log.info("Regridding input {} mask".format(preGridMask))
-                caracal.log.info("Write header for new mask {} to match the grid of the image".format(postGridMask))
                 hduImage = fits.getheader("{}/{}".format(pipeline.output, imagename))
-
-                with open("{}/tmp.hdr".format(pipeline.masking), "w") as file:
-                    file.write("SIMPLE  =   T\n")
-                    file.write("BITPIX  =   -64\n")
-                    file.write("NAXIS   =   {}\n".format(hduImage["NAXIS"]))
-                    file.write("NAXIS1  =   {}\n".format(hduImage["NAXIS1"]))
-                    file.write("CTYPE1  =   'RA---SIN'\n")
-                    file.write("CRVAL1  =   {}\n".format(hduImage["CRVAL1"]))
-                    file.write("CRPIX1  =   {}\n".format(hduImage["CRPIX1"]))
-                    file.write("CDELT1  =   {}\n".format(hduImage["CDELT1"]))
-                    file.write("NAXIS2  =   {}\n".format(hduImage["NAXIS2"]))
-                    file.write("CTYPE2  =   'DEC--SIN'\n")
-                    file.write("CRVAL2  =   {}\n".format(hduImage["CRVAL2"]))
-                    file.write("CRPIX2  =   {}\n".format(hduImage["CRPIX2"]))
-                    file.write("CDELT2  =   {}\n".format(hduImage["CDELT2"]))
-                    file.write("EXTEND  =   T\n")
-                    file.write("EQUINOX =   2000.0\n")
-                    file.write("SPECSYS =   TOPOCENT\n")
-                    file.write("END\n")
-
-                if os.path.exists("{}/{}".format(pipeline.masking, postGridMask)):
-                    os.remove("{}/{}".format(pipeline.masking, postGridMask))
-
-                # turn mask into zeros and ones
-                with fits.open("{}/{}".format(pipeline.masking, preGridMask)) as hdul:
-                    if np.amax(hdul[0].data) > 1:
-                        mask = np.where(hdul[0].data > 0)
-                        hdul[0].data[mask] = 1
-
-                    preGridMaskNew = preGridMask.replace(".fits", "_01.fits")
-                    hdul.writeto("{}/{}".format(pipeline.masking, preGridMaskNew), overwrite=True)
-
-                caracal.log.info("Reprojecting mask {} to match the grid of the image.".format(preGridMask))
-
-                # REPROJECT user supplied mask
-                step = "reprojectMask-img-{}-field-{}".format(trg, num)
-                recipe.add(
-                    "cab/mProject",
-                    step,
-                    {
-                        "in.fits": preGridMaskNew,
-                        "out.fits": postGridMask,
-                        "hdr.template": "tmp.hdr",
-                        "f": True,
-                    },
-                    input=pipeline.masking,
-                    output=pipeline.masking,
-                    label="{0:s}:: Reprojecting user input mask {1:s} to match the grid of the image".format(step, preGridMaskNew),
-                )
-
-                recipe.run()
-                recipe.jobs = []
-
-                # turn nans of regridded mask into zeros
-                datTmp = fits.getdata("{}/{}".format(pipeline.masking, postGridMask))
-                headTmp = fits.getheader("{}/{}".format(pipeline.masking, postGridMask))
-
-                idxNan = np.isnan(datTmp)
-                datTmp[idxNan] = 0.0
-                datNew = np.around(datTmp.astype(np.float32)).astype(np.int16)
-
                 postGridMaskSof = preGridMask.replace(".fits", "_{}_regridSof.fits".format(pipeline.prefix))
-
-                fits.writeto("{}/{}".format(pipeline.masking, postGridMaskSof), datNew, headTmp, overwrite=True)
+                regrid_mask.reproject_mask(
+                    "{}/{}".format(pipeline.masking, preGridMask),
+                    "{}/{}".format(pipeline.masking, postGridMaskSof),
+                    regrid_mask.sky_header(
+                        hduImage["NAXIS1"], hduImage["NAXIS2"], hduImage["CRVAL1"], hduImage["CRVAL2"], hduImage["CDELT2"], hduImage["CRPIX1"], hduImage["CRPIX2"]
+                    ),
+                    cachedir=pipeline.masking,
+                )
 
         elif num > 0 and preGridMask:
             caracal.log.info("Cycle > 0 and user provided inputmask")
@@ -1019,7 +929,7 @@ def worker(pipeline, recipe, config):
 
             caracal.log.info("Mask saved, ready for cleaning")
 
-    def breizorro_mask(trg, num, img_dir, field):
+    def breizorro_mask(recipe, trg, num, img_dir, field):
         step = "make-breizorro_mask-field{0:d}-iter{1:d}".format(trg, num)
         key = "img_breizorro_settings"
 
@@ -1049,7 +959,7 @@ def worker(pipeline, recipe, config):
             label="{0:s}:: Make Breizorro".format(step),
         )
 
-    def make_cube(num, img_dir, field, imtype="model"):
+    def make_cube(recipe, num, img_dir, field, imtype="model"):
         im = "{0:s}/{1:s}_{2:s}_{3}-cube.fits:output".format(img_dir, prefix, field, num)
         step = "makecube-{}".format(num)
         images = ["{0:s}/{1:s}_{2:s}_{3}-{4:04d}-{5:s}.fits:output".format(img_dir, prefix, field, num, i, imtype) for i in range(config["img_nchans"])]
@@ -1069,7 +979,7 @@ def worker(pipeline, recipe, config):
 
         return im
 
-    def extract_sources(trg, num, img_dir, field):
+    def extract_sources(recipe, trg, num, img_dir, field):
         key = "extract_sources"
         if config[key]["detection_image"]:
             step = "detection_image-field{0:d}-iter{1:d}".format(trg, num)
@@ -1094,7 +1004,7 @@ def worker(pipeline, recipe, config):
         if sourcefinder == "pybdsm" or sourcefinder == "pybdsf":
             spi_do = config[key]["spi"]
             if spi_do:
-                im = make_cube(num, get_dir_path(pipeline.continuum, pipeline) + "/" + img_dir.split("/")[-1], field, "image")
+                im = make_cube(recipe, num, get_dir_path(pipeline.continuum, pipeline) + "/" + img_dir.split("/")[-1], field, "image")
                 im = im.split("/")[-1]
             else:
                 im = "{0:s}_{1:s}_{2:d}{3:s}-image.fits:output".format(prefix, field, num, mfsprefix)
@@ -1184,7 +1094,7 @@ def worker(pipeline, recipe, config):
                 label="{0:s}:: Convert extracted sources to tigger model".format(step),
             )
 
-    def combine_models(models, num, img_dir, field, enable=True):
+    def combine_models(recipe, models, num, img_dir, field, enable=True):
         model_names = [
             "{0:s}/{1:s}_{2:s}_{3:s}-pybdsm.lsm.html:output".format(get_dir_path("{0:s}/image_{1:d}".format(pipeline.continuum, int(m)), pipeline), prefix, field, m)
             for m in models
@@ -1193,7 +1103,7 @@ def worker(pipeline, recipe, config):
         model_names_fits = [
             "{0:s}/{1:s}_{2:s}_{3:s}-pybdsm.fits".format(get_dir_path("{0:s}/image_{1:d}".format(pipeline.continuum, int(m)), pipeline), prefix, field, m) for m in models
         ]
-        calmodel = "{0:s}/{1:s}_{2:d}-pybdsm-combined.lsm.html:output".format(img_dir, prefix, num)
+        calmodel = "{0:s}/{1:s}_{2:s}_{3:d}-pybdsm-combined.lsm.html:output".format(img_dir, prefix, field, num)
 
         if enable:
             step = "combine_models-" + "_".join(map(str, models))
@@ -1214,9 +1124,8 @@ def worker(pipeline, recipe, config):
 
         return calmodel, model_names_fits
 
-    def calibrate_meqtrees(trg, num, prod_path, img_dir, mslist, field):
+    def calibrate_meqtrees(recipe, state, trg, num, prod_path, img_dir, mslist, field):
         key = "calibrate"
-        global reset_cal, trace_SN, trace_matrix
 
         # force to calibrate with model data column if specified by user
 
@@ -1237,7 +1146,7 @@ def worker(pipeline, recipe, config):
             modelcolumn = "MODEL_DATA"
             if isinstance(model, str) and len(model.split("+")) > 1:
                 mm = model.split("+")
-                calmodel, fits_model = combine_models(mm, num, img_dir, field, enable=False if pipeline.enable_task(config, "aimfast") else True)
+                calmodel, fits_model = combine_models(recipe, mm, num, img_dir, field, enable=False if pipeline.enable_task(config, "aimfast") else True)
             else:
                 model = int(model)
                 calmodel = "{0:s}/{1:s}_{2:s}_{3:d}-pybdsm.lsm.html:output".format(img_dir, prefix, field, model)
@@ -1253,7 +1162,7 @@ def worker(pipeline, recipe, config):
 
             if isinstance(model, str) and len(model.split("+")) > 1:
                 mm = model.split("+")
-                calmodel, fits_model = combine_models(mm, num, img_dir, field, enable=False if pipeline.enable_task(config, "aimfast") else True)
+                calmodel, fits_model = combine_models(recipe, mm, num, img_dir, field, enable=False if pipeline.enable_task(config, "aimfast") else True)
             else:
                 model = int(model)
                 calmodel = "{0:s}/{1:s}_{2:s}_{3:d}-pybdsm.lsm.html:output".format(img_dir, prefix, field, model)
@@ -1291,8 +1200,8 @@ def worker(pipeline, recipe, config):
                     matrix_type = "GainDiagPhase"
                     SN = 3
                 else:
-                    matrix_type = trace_matrix[num - 2]
-                    SN = trace_SN[num - 2]
+                    matrix_type = state.trace_matrix[num - 2]
+                    SN = state.trace_SN[num - 2]
                 fidelity_data = get_aimfast_data()
                 obs_data = get_obs_data(msname)
                 int_time = obs_data["EXPOSURE"]
@@ -1313,14 +1222,14 @@ def worker(pipeline, recipe, config):
                 else:
                     prev_solvetime = solvetime + 1
 
-                if (solvetime >= prev_solvetime or reset_cal == 1) and matrix_type == "GainDiagPhase":
+                if (solvetime >= prev_solvetime or state.reset_cal == 1) and matrix_type == "GainDiagPhase":
                     matrix_type = "GainDiag"
                     SN = 8
                     solvetime = int(Noise**2 * SN**2 * tot_time * no_ant / (flux**2 * 2.0) / int_time)
                     gsols_[0] = int(solvetime / num)
                 elif solvetime >= prev_solvetime and matrix_type == "GainDiag":
                     gsols_[0] = int(prev_solvetime / num - 1)
-                    reset_cal = 2
+                    state.reset_cal = 2
                 else:
                     gsols_[0] = int(solvetime / num)
                 if matrix_type == "GainDiagPhase":
@@ -1330,9 +1239,9 @@ def worker(pipeline, recipe, config):
                 if minsolvetime > gsols_[0]:
                     gsols_[0] = minsolvetime
                     if matrix_type == "GainDiag":
-                        reset_cal = 2
-                trace_SN.append(SN)
-                trace_matrix.append(matrix_type)
+                        state.reset_cal = 2
+                state.trace_SN.append(SN)
+                state.trace_matrix.append(matrix_type)
                 if matrix_type == "GainDiagPhase" and config["cal_meqtrees"]["two_step"]:
                     outcolumn = "CORRECTED_DATA_PHASE"
                     incolumn = "DATA"
@@ -1414,7 +1323,7 @@ def worker(pipeline, recipe, config):
                 label="{0:s}:: Calibrate step {1:d} ms={2:s}".format(step, num, msname),
             )
 
-    def calibrate_cubical(trg, num, prod_path, img_dir, mslist, field):
+    def calibrate_cubical(recipe, state, trg, num, prod_path, img_dir, mslist, field):
         key = "calibrate"
 
         modellist = []
@@ -1427,7 +1336,7 @@ def worker(pipeline, recipe, config):
         # If the model string contains a +, then combine the appropriate models
         if isinstance(model, str) and len(model.split("+")) > 1:
             mm = model.split("+")
-            calmodel, _ = combine_models(mm, num, img_dir, field)
+            calmodel, _ = combine_models(recipe, mm, num, img_dir, field)
         # If it doesn't then don't combine.
         else:
             model = int(model)
@@ -1640,11 +1549,26 @@ def worker(pipeline, recipe, config):
                         "b-max-post-error": config["cal_cubical"]["max_post_error"],
                     }
                 )
-            # Time chunk and freq chunk have been checked and approved before so they are what they are
+            # Time chunk and freq chunk have been checked and approved before so they are what they are,
+            # unless the automatic ones (-1) are to be fitted to the memory limit
+            ms_time_chunk, ms_freq_chunk = time_chunk, freq_chunk
+            if config["cal_cubical"]["mem_limit"] > 0:
+                sols = [gsols_] + ([bsols_] if config["cal_bjones"] else []) + ([gasols_] if second_matrix_invoked else [])
+                ms_time_chunk, ms_freq_chunk, _ = cubical_chunks.tune_for_ms(
+                    pipeline.get_msinfo(msname),
+                    msname,
+                    [int(sol[0]) for sol in sols],
+                    [int(sol[1]) for sol in sols],
+                    ncpu,
+                    config["cal_cubical"]["mem_limit"],
+                    max_chunks=config["cal_cubical"]["dist_max_chunks"],
+                    time_chunk=int(config["cal_timeslots_chunk"]),
+                    freq_chunk=int(config["cal_cubical"]["chan_chunk"]),
+                )
             cubical_opts.update(
                 {
-                    "data-time-chunk": time_chunk,
-                    "data-freq-chunk": freq_chunk,
+                    "data-time-chunk": ms_time_chunk,
+                    "data-freq-chunk": ms_freq_chunk,
                 }
             )
             recipe.add(
@@ -1657,7 +1581,7 @@ def worker(pipeline, recipe, config):
                 label="{0:s}:: Calibrate step {1:d} ms={2:s}".format(step, num, msname),
             )
 
-    def restore(num, prod_path, mslist_out, enable_inter=True):
+    def restore(recipe, num, prod_path, mslist, mslist_out, enable_inter=True):
         key = "calibrate"
         # to achieve accurate restauration we need to reset all parameters properly
         matrix_type = config[key]["gain_matrix_type"][num - 1 if len(config[key]["gain_matrix_type"]) >= num else -1]
@@ -1978,18 +1902,16 @@ def worker(pipeline, recipe, config):
         "Extracts data from the json data file"
         return pipeline.get_msinfo(msname)
 
-    def quality_check(n, field, enable=True):
-        "Examine the aimfast results to see if they meet specified conditions"
+    def quality_check(recipe, state, n, field, enable=True):
+        "Examine the image fidelity metrics to see if they meet specified conditions"
         # If total number of iterations is reached stop
-        global reset_cal
-
         if enable:
             # The recipe has to be executed at this point to get the image fidelity results
 
             recipe.run()
             # Empty job que after execution
             recipe.jobs = []
-            if reset_cal >= 2:
+            if state.reset_cal >= 2:
                 return False
             key = "aimfast"
             tol = config[key]["tol"]
@@ -1997,7 +1919,11 @@ def worker(pipeline, recipe, config):
             # Ensure atleast one iteration is ran to compare previous and subsequent images
             # And atleast one convergence criteria is specified
             if n >= 2 and not config["cal_meqtrees"]["two_step"] and conv_crit:
-                fidelity_data = get_aimfast_data()
+                # The metrics of the images of both iterations are cached in-process, so this is not a second pass
+                fidelity_data = {}
+                for nn in (n - 1, n):
+                    img_dir = get_dir_path("{0:s}/image_{1:d}".format(pipeline.continuum, nn), pipeline)
+                    fidelity_data.update(fidelity.fidelity_results(**fidelity_inputs(nn, img_dir, field)))
                 conv_crit = [cc.upper() for cc in conv_crit]
                 # Ensure atleast one iteration is ran to compare previous and subsequent images
                 residual0 = fidelity_data["{0}_{1}_{2}-residual".format(prefix, field, n - 1)]
@@ -2069,15 +1995,14 @@ def worker(pipeline, recipe, config):
                     caracal.log.info("The weights used DR={:f}, Skew={:f}, Kurt={:f}, Mean={:f}, Noise={:f} ".format(drweight, skewweight, kurtweight, meanweight, noiseweight))
                     caracal.log.info("{:f} < {:f}".format(1 - tol, HolisticCheck))
                     #   If we stop we want change the final output model to the previous iteration
-                    global self_cal_iter_counter
-                    reset_cal += 1
-                    if reset_cal == 1:
-                        self_cal_iter_counter -= 1
+                    state.reset_cal += 1
+                    if state.reset_cal == 1:
+                        state.iter_counter -= 1
                     else:
-                        self_cal_iter_counter -= 2
+                        state.iter_counter -= 2
 
-                    if self_cal_iter_counter < 1:
-                        self_cal_iter_counter = 1
+                    if state.iter_counter < 1:
+                        state.iter_counter = 1
                     return False
         # If we reach the number of iterations we want to stop.
         if n == cal_niter + 1:
@@ -2086,76 +2011,66 @@ def worker(pipeline, recipe, config):
         # If no condition is met return true to continue
         return True
 
-    def image_quality_assessment(num, img_dir, field):
-        # Check if more than two calibration iterations to combine successive models
-        # Combine models <num-1> (or combined) to <num> creat <num+1>-pybdsm-combine
-        # This was based on thres_pix but change to model as when extract_sources = True is will take the last settings
+    def fidelity_inputs(num, img_dir, field):
+        """Returns the images (and PyBDSF models) whose fidelity metrics decide the convergence of iteration num"""
         if len(config["calibrate"]["model"]) >= num:
-            model = config["calibrate"]["model"][num - 1]
-            if isinstance(model, str) and len(model.split("+")) == 2:
-                mm = model.split("+")
-                combine_models(mm, num, img_dir, field)
+            model = str(config["calibrate"]["model"][num - 1])
         else:
             model = str(num)
-        # in case we are in the last round, imaging has made a model that is longer then the expected model column
-        # Therefore we take this last model if model is not defined
-        if num == cal_niter + 1:
-            try:
-                model.split()
-            except NameError:
-                model = str(num)
-
-        step = "aimfast"
-        aimfast_settings = {
-            "residual-image": "{0:s}/{1:s}_{2:s}_{3:d}{4:s}-residual.fits:output".format(img_dir, prefix, field, num, mfsprefix),
-            "normality-test": config[step]["normality_model"],
-            "area-factor": config[step]["area_factor"],
+        key = "aimfast"
+        inputs = {
             "label": "{0:s}_{1:s}_{2:d}".format(prefix, field, num),
-            "outfile": "{0:s}_fidelity_results.json".format(prefix),
+            "residual": "{0:s}/{1:s}/{2:s}_{3:s}_{4:d}{5:s}-residual.fits".format(pipeline.output, img_dir, prefix, field, num, mfsprefix),
+            "area_factor": config[key]["area_factor"],
+            "normality": config[key]["normality_model"],
         }
 
         # if we run pybdsm we want to use the  model as well. Otherwise we want to use the image.
         if pipeline.enable_task(config, "extract_sources"):
             if config["calibrate"].get("output_data")[-1] == "CORR_DATA":
-                aimfast_settings.update({"tigger-model": "{0:s}/{1:s}_{2:s}_{3:d}-pybdsm.lsm.html:output".format(img_dir, prefix, field, num)})
-            else:
+                inputs["gauls"] = ["{0:s}/{1:s}/{2:s}_{3:s}_{4:d}-pybdsm.gaul".format(pipeline.output, img_dir, prefix, field, num)]
+            elif len(model.split("+")) >= 2:
                 # In the case of RES_DATA we need the combined models to compute the dynamic range.
-                aimfast_settings.update(
-                    {
-                        "tigger-model": "{0:s}/{1:s}_{2:s}_{3:d}-pybdsm{4:s}.lsm.html:output".format(
-                            img_dir,
-                            prefix,
-                            field,
-                            num if num <= len(config["calibrate"].get("model")) else len(config["calibrate"].get("model")),
-                            "-combined" if len(model.split("+")) >= 2 else "",
-                        )
-                    }
-                )
-
+                inputs["gauls"] = ["{0:s}/image_{1:s}/{2:s}_{3:s}_{1:s}-pybdsm.gaul".format(pipeline.continuum, mm, prefix, field) for mm in model.split("+")]
+            else:
+                nmodel = num if num <= len(config["calibrate"].get("model")) else len(config["calibrate"].get("model"))
+                inputs["gauls"] = ["{0:s}/{1:s}/{2:s}_{3:s}_{4:d}-pybdsm.gaul".format(pipeline.output, img_dir, prefix, field, nmodel)]
         else:
             # Use the image
             if (
                 config["calibrate"]["output_data"][num - 1 if num <= len(config["calibrate"]["output_data"]) else -1] == "CORR_DATA"
                 or config["calibrate"]["output_data"][num - 1 if num <= len(config["calibrate"]["output_data"]) else -1] == "CORRECTED_DATA"
             ):
-                aimfast_settings.update({"restored-image": "{0:s}/{1:s}_{2:s}_{3:d}{4:s}-image.fits:output".format(img_dir, prefix, field, num, mfsprefix)})
-
+                im = num
             else:
                 try:
                     im = config["calibrate"]["output_data"].index("CORR_RES") + 1
                 except ValueError:
                     im = num
-                aimfast_settings.update({"restored-image": "{0:s}/{1:s}_{2:s}_{3:d}{4:s}-image.fits:output".format(img_dir, prefix, field, im, mfsprefix)})
+            inputs["restored"] = "{0:s}/{1:s}/{2:s}_{3:s}_{4:d}{5:s}-image.fits".format(pipeline.output, img_dir, prefix, field, im, mfsprefix)
+        return inputs
+
+    def image_quality_assessment(recipe, num, img_dir, field):
+        # Check if more than two calibration iterations to combine successive models
+        # Combine models <num-1> (or combined) to <num> creat <num+1>-pybdsm-combine
+        # This was based on thres_pix but change to model as when extract_sources = True is will take the last settings
+        if len(config["calibrate"]["model"]) >= num:
+            model = config["calibrate"]["model"][num - 1]
+            if isinstance(model, str) and len(model.split("+")) == 2:
+                mm = model.split("+")
+                combine_models(recipe, mm, num, img_dir, field)
+
+        step = "aimfast"
         recipe.add(
-            "cab/aimfast",
+            fidelity.save_fidelity_results,
             step,
-            aimfast_settings,
+            dict(outfile="{0:s}/{1:s}_fidelity_results.json".format(pipeline.output, prefix), **fidelity_inputs(num, img_dir, field)),
             input=pipeline.output,
             output=pipeline.output,
             label="{0:s}_{1:d}:: Image fidelity assessment for {2:d}".format(step, num, num),
         )
 
-    def aimfast_plotting(field):
+    def aimfast_plotting(recipe, field):
         """Plot comparisons of catalogs and residuals"""
 
         # Get residuals to compare
@@ -2228,7 +2143,7 @@ def worker(pipeline, recipe, config):
                 label="Plotting source residuals comparisons",
             )
 
-    def aimfast_compare_online_catalog(field):
+    def aimfast_compare_online_catalog(recipe, field):
         """Compare local models to online catalog"""
         model_files = []
         # Get models to compare
@@ -2254,19 +2169,28 @@ def worker(pipeline, recipe, config):
             recipe.run()
             recipe.jobs = []
 
-    def plotting_cubical_tables():
-        """Plot self-cal gain tables"""
+    def plotting_cubical_tables(recipe, mslist):
+        """Plot the self-cal gain tables of the MSs in mslist (other targets' tables may still be being written)"""
 
         step = "plot-solutions"
-        gain_tables = glob.glob(
-            "{0:s}/{1:s}/{2:s}/{3:s}".format(
-                pipeline.output,
-                get_dir_path(pipeline.continuum, pipeline),
-                "selfcal_products",
-                f"{pipeline.prefix}*.parmdb",
-            )
-        )
-        for gt in gain_tables:
+        gain_tables = []
+        for msname in mslist:
+            msbase = os.path.splitext(msname)[0]
+            # tables are named <prefix>-<term>-gains-<iteration>-<msbase>.parmdb
+            pattern = re.compile(r".*-gains-\d+-{0:s}\.parmdb".format(re.escape(msbase)))
+            gain_tables += [
+                gt
+                for gt in glob.glob(
+                    "{0:s}/{1:s}/{2:s}/{3:s}".format(
+                        pipeline.output,
+                        get_dir_path(pipeline.continuum, pipeline),
+                        "selfcal_products",
+                        f"{glob.escape(pipeline.prefix)}*-{glob.escape(msbase)}.parmdb",
+                    )
+                )
+                if pattern.fullmatch(os.path.basename(gt))
+            ]
+        for gt in sorted(gain_tables):
             if any(key in gt for key in ["g-delay", "g-amp", "g-phase"]):
                 gain_table_name = gt.split(pipeline.output)[-1]
                 outname = gain_table_name.rsplit(".", 1)[0]
@@ -2307,108 +2231,104 @@ def worker(pipeline, recipe, config):
         if config["aimfast"]["plot"]:
             config["extract_sources"]["enable"] = True
 
-    target_iter = 0
-    for target in all_targets:
+    # With a SoFiA clean mask for the first iteration, each target's mask is made from a preliminary image
+    # (iteration 0), and the mask methods of the later iterations shift by one. The mask method of the first
+    # iteration is the one before the shift.
+    cleanmask_method = config["image"]["cleanmask_method"]
+    start_iter = config["start_iter"]
+    first_mask_key = cleanmask_method[start_iter - 1 if len(cleanmask_method) >= start_iter else -1]
+    if pipeline.enable_task(config, "image") and first_mask_key == "sofia":
+        cleanmask_method.insert(1, cleanmask_method[start_iter if len(cleanmask_method) > start_iter else -1])
+
+    aimfast_lock = threading.Lock()
+
+    def selfcal_target(target_iter, target, recipe):
+        """Runs the selfcal loop of a target, and its follow-up steps, through recipe"""
         mslist = ms_dict[target]
         field = utils.filter_name(target)
 
-        global self_cal_iter_counter
-        self_cal_iter_counter = config["start_iter"]
-        global reset_cal
-        reset_cal = 0
-        global trace_SN
-        trace_SN = []
-        global trace_matrix
-        trace_matrix = []
-        image_path = "{0:s}/image_{1:d}".format(pipeline.continuum, self_cal_iter_counter)
+        state = SelfcalState(config["start_iter"])
+        image_path = "{0:s}/image_{1:d}".format(pipeline.continuum, state.iter_counter)
         # I think it is best to always define selfcal_products as it might be needed for transfer gains or restore
 
         selfcal_products = "{0:s}/{1:s}".format(pipeline.continuum, "selfcal_products")
         # When we do not start at iteration 1 we need to restore the data set
-        if self_cal_iter_counter != 1:
+        if state.iter_counter != 1:
             if not os.path.exists(image_path):
-                raise IOError("Trying to restore step {0:d} but the correct direcory ({1:s}) does not exist.".format(self_cal_iter_counter - 1, image_path))
-            restore(self_cal_iter_counter - 1, selfcal_products, mslist, enable_inter=False)
+                raise IOError("Trying to restore step {0:d} but the correct direcory ({1:s}) does not exist.".format(state.iter_counter - 1, image_path))
+            restore(recipe, state.iter_counter - 1, selfcal_products, mslist, mslist, enable_inter=False)
 
-        if not os.path.exists(image_path):
-            os.mkdir(image_path)
+        os.makedirs(image_path, exist_ok=True)
 
-        mask_key = config["image"]["cleanmask_method"][self_cal_iter_counter - 1 if len(config["image"]["cleanmask_method"]) >= self_cal_iter_counter else -1]
+        mask_key = first_mask_key
         if pipeline.enable_task(config, "image"):
             if mask_key == "sofia":
                 image_path = "{0:s}/image_0".format(
                     pipeline.continuum,
                 )
-                if not os.path.exists(image_path):
-                    os.mkdir(image_path)
-                fake_image(target_iter, 0, get_dir_path(image_path, pipeline), mslist, field)
+                os.makedirs(image_path, exist_ok=True)
+                fake_image(recipe, target_iter, 0, get_dir_path(image_path, pipeline), mslist, field)
                 recipe.run()
                 recipe.jobs = []
-                sofia_mask(target_iter, 0, get_dir_path(image_path, pipeline), field)
-                config["image"]["cleanmask_method"].insert(
-                    1,
-                    config["image"]["cleanmask_method"][self_cal_iter_counter if len(config["image"]["cleanmask_method"]) > self_cal_iter_counter else -1],
-                )
-                image_path = "{0:s}/image_{1:d}".format(pipeline.continuum, self_cal_iter_counter)
-                image(target_iter, self_cal_iter_counter, get_dir_path(image_path, pipeline), mslist, field)
+                sofia_mask(recipe, target_iter, 0, get_dir_path(image_path, pipeline), mslist, field)
+                image_path = "{0:s}/image_{1:d}".format(pipeline.continuum, state.iter_counter)
+                image(recipe, state, target_iter, state.iter_counter, get_dir_path(image_path, pipeline), mslist, field)
             elif mask_key == "breizorro":
-                if self_cal_iter_counter == 1:
+                if state.iter_counter == 1:
                     image_path = "{0:s}/image_{1:d}".format(pipeline.continuum, 0)
-                    if not os.path.exists(image_path):
-                        os.mkdir(image_path)
-                    fake_image(target_iter, 0, get_dir_path(image_path, pipeline), mslist, field)
-                    breizorro_mask(target_iter, 0, get_dir_path(image_path, pipeline), field)
+                    os.makedirs(image_path, exist_ok=True)
+                    fake_image(recipe, target_iter, 0, get_dir_path(image_path, pipeline), mslist, field)
+                    breizorro_mask(recipe, target_iter, 0, get_dir_path(image_path, pipeline), field)
                     recipe.run()
                     recipe.jobs = []
-                    image(target_iter, self_cal_iter_counter, get_dir_path(image_path, pipeline), mslist, field)
+                    image(recipe, state, target_iter, state.iter_counter, get_dir_path(image_path, pipeline), mslist, field)
                 else:
-                    image_path = "{0:s}/image_{1:d}".format(pipeline.continuum, self_cal_iter_counter)
-                    image(target_iter, self_cal_iter_counter, get_dir_path(image_path, pipeline), mslist, field)
+                    image_path = "{0:s}/image_{1:d}".format(pipeline.continuum, state.iter_counter)
+                    image(recipe, state, target_iter, state.iter_counter, get_dir_path(image_path, pipeline), mslist, field)
             else:
-                image(target_iter, self_cal_iter_counter, get_dir_path(image_path, pipeline), mslist, field)
+                image(recipe, state, target_iter, state.iter_counter, get_dir_path(image_path, pipeline), mslist, field)
         if pipeline.enable_task(config, "extract_sources"):
-            extract_sources(target_iter, self_cal_iter_counter, get_dir_path(image_path, pipeline), field)
+            extract_sources(recipe, target_iter, state.iter_counter, get_dir_path(image_path, pipeline), field)
         if pipeline.enable_task(config, "aimfast"):
-            image_quality_assessment(self_cal_iter_counter, get_dir_path(image_path, pipeline), field)
+            image_quality_assessment(recipe, state.iter_counter, get_dir_path(image_path, pipeline), field)
 
-        while quality_check(self_cal_iter_counter, field, enable=pipeline.enable_task(config, "aimfast")):
+        while quality_check(recipe, state, state.iter_counter, field, enable=pipeline.enable_task(config, "aimfast")):
             if pipeline.enable_task(config, "calibrate"):
-                if not os.path.exists(selfcal_products):
-                    os.mkdir(selfcal_products)
+                os.makedirs(selfcal_products, exist_ok=True)
                 calibrate(
+                    recipe,
+                    state,
                     target_iter,
-                    self_cal_iter_counter,
+                    state.iter_counter,
                     selfcal_products,
                     get_dir_path(image_path, pipeline),
                     mslist,
                     field,
                 )
-            mask_key = config["image"]["cleanmask_method"][self_cal_iter_counter if len(config["image"]["cleanmask_method"]) > self_cal_iter_counter else -1]
-            if mask_key == "sofia" and self_cal_iter_counter != cal_niter + 1 and pipeline.enable_task(config, "image"):
-                sofia_mask(target_iter, self_cal_iter_counter, get_dir_path(image_path, pipeline), field)
+            mask_key = config["image"]["cleanmask_method"][state.iter_counter if len(config["image"]["cleanmask_method"]) > state.iter_counter else -1]
+            if mask_key == "sofia" and state.iter_counter != cal_niter + 1 and pipeline.enable_task(config, "image"):
+                sofia_mask(recipe, target_iter, state.iter_counter, get_dir_path(image_path, pipeline), mslist, field)
                 recipe.run()
                 recipe.jobs = []
-            elif mask_key == "breizorro" and self_cal_iter_counter != cal_niter + 1 and pipeline.enable_task(config, "image"):
-                breizorro_mask(target_iter, self_cal_iter_counter, get_dir_path(image_path, pipeline), field)
+            elif mask_key == "breizorro" and state.iter_counter != cal_niter + 1 and pipeline.enable_task(config, "image"):
+                breizorro_mask(recipe, target_iter, state.iter_counter, get_dir_path(image_path, pipeline), field)
                 recipe.run()
                 recipe.jobs = []
-            self_cal_iter_counter += 1
-            image_path = "{0:s}/image_{1:d}".format(pipeline.continuum, self_cal_iter_counter)
-            if not os.path.exists(image_path):
-                os.mkdir(image_path)
+            state.iter_counter += 1
+            image_path = "{0:s}/image_{1:d}".format(pipeline.continuum, state.iter_counter)
+            os.makedirs(image_path, exist_ok=True)
             if pipeline.enable_task(config, "image"):
-                image(target_iter, self_cal_iter_counter, get_dir_path(image_path, pipeline), mslist, field)
+                image(recipe, state, target_iter, state.iter_counter, get_dir_path(image_path, pipeline), mslist, field)
             if pipeline.enable_task(config, "extract_sources"):
-                extract_sources(target_iter, self_cal_iter_counter, get_dir_path(image_path, pipeline), field)
+                extract_sources(recipe, target_iter, state.iter_counter, get_dir_path(image_path, pipeline), field)
             if pipeline.enable_task(config, "aimfast"):
-                image_quality_assessment(self_cal_iter_counter, get_dir_path(image_path, pipeline), field)
+                image_quality_assessment(recipe, state.iter_counter, get_dir_path(image_path, pipeline), field)
 
         # Copy plots from the selfcal_products to the diagnotic plots IF calibrate OR transfer_gains is enabled
         if pipeline.enable_task(config, "calibrate") or pipeline.enable_task(config, "transfer_apply_gains"):
             selfcal_products = "{0:s}/{1:s}".format(pipeline.continuum, "selfcal_products")
             plot_path = "{0:s}/{1:s}".format(pipeline.diagnostic_plots, "selfcal")
-            if not os.path.exists(plot_path):
-                os.mkdir(plot_path)
+            os.makedirs(plot_path, exist_ok=True)
 
             selfcal_plots = glob.glob("{0:s}/{1:s}*.png".format(selfcal_products, pipeline.prefix))
             for plot in selfcal_plots:
@@ -2416,36 +2336,37 @@ def worker(pipeline, recipe, config):
 
         if pipeline.enable_task(config, "transfer_apply_gains"):
             mslist_out = ms_dict_tgain[target]
-            if self_cal_iter_counter > cal_niter:
-                restore(self_cal_iter_counter - 1, selfcal_products, mslist_out, enable_inter=True)
+            if state.iter_counter > cal_niter:
+                restore(recipe, state.iter_counter - 1, selfcal_products, mslist, mslist_out, enable_inter=True)
             else:
-                restore(self_cal_iter_counter, selfcal_products, mslist_out, enable_inter=True)
+                restore(recipe, state.iter_counter, selfcal_products, mslist, mslist_out, enable_inter=True)
 
-        if pipeline.enable_task(config, "aimfast"):
-            if config["aimfast"]["plot"]:
-                aimfast_plotting(field)
-                recipe.run()
-                # Empty job que after execution
-                recipe.jobs = []
+        # aimfast writes its plots to the output directory under fixed names, so targets make and move them in turn
+        with aimfast_lock:
+            if pipeline.enable_task(config, "aimfast"):
+                if config["aimfast"]["plot"]:
+                    aimfast_plotting(recipe, field)
+                    recipe.run()
+                    # Empty job que after execution
+                    recipe.jobs = []
 
-            if config["aimfast"]["online_catalog"]:
-                aimfast_compare_online_catalog(field)
-                recipe.run()
-                # Empty job que after execution
-                recipe.jobs = []
+                if config["aimfast"]["online_catalog"]:
+                    aimfast_compare_online_catalog(recipe, field)
+                    recipe.run()
+                    # Empty job que after execution
+                    recipe.jobs = []
 
-            # Move the aimfast html plots
-            plot_path = "{0:s}/{1:s}".format(pipeline.diagnostic_plots, "selfcal")
-            if not os.path.exists(plot_path):
-                os.mkdir(plot_path)
-            aimfast_plots = glob.glob("{0:s}/{1:s}".format(pipeline.output, "*.html"))
-            for plot in aimfast_plots:
-                shutil.copyfile(plot, "{0:s}/{1:s}".format(plot_path, os.path.basename(plot)))
-                os.remove(plot)
+                # Move the aimfast html plots
+                plot_path = "{0:s}/{1:s}".format(pipeline.diagnostic_plots, "selfcal")
+                os.makedirs(plot_path, exist_ok=True)
+                aimfast_plots = glob.glob("{0:s}/{1:s}".format(pipeline.output, "*.html"))
+                for plot in aimfast_plots:
+                    shutil.copyfile(plot, "{0:s}/{1:s}".format(plot_path, os.path.basename(plot)))
+                    os.remove(plot)
 
         try:
             if config["cal_cubical"]["gain_plot"]["enable"]:
-                plotting_cubical_tables()
+                plotting_cubical_tables(recipe, mslist)
         # TODO(Sphe) this need catch a specific exception here
         except:  # noqa: E722
             caracal.log.warning("Please check if the gain tables exist.")
@@ -2456,14 +2377,14 @@ def worker(pipeline, recipe, config):
                 num = config["restore_model"]["model"]
                 if isinstance(num, str) and len(num.split("+")) == 2:
                     mm = num.split("+")
-                    if int(mm[-1]) > self_cal_iter_counter:
-                        num = str(self_cal_iter_counter)
+                    if int(mm[-1]) > state.iter_counter:
+                        num = str(state.iter_counter)
             else:
-                extract_sources = len(config["extract_sources"]["thr_isl"])
-                if extract_sources > 1:
-                    num = "{:d}+{:d}".format(self_cal_iter_counter - 1, self_cal_iter_counter)
+                nextract = len(config["extract_sources"]["thr_isl"])
+                if nextract > 1:
+                    num = "{:d}+{:d}".format(state.iter_counter - 1, state.iter_counter)
                 else:
-                    num = self_cal_iter_counter
+                    num = state.iter_counter
             if isinstance(num, str) and len(num.split("+")) == 2:
                 mm = num.split("+")
                 models = [
@@ -2514,8 +2435,8 @@ def worker(pipeline, recipe, config):
 
             if config["restore_model"]["clean_model"]:
                 num = int(config["restore_model"]["clean_model"])
-                if num > self_cal_iter_counter:
-                    num = self_cal_iter_counter
+                if num > state.iter_counter:
+                    num = state.iter_counter
 
                 conv_model = "{0:s}/image_{1:d}/{2:s}_{3:s}-convolved_model.fits\
 :output".format(get_dir_path(pipeline.continuum, pipeline), num, prefix, field)
@@ -2573,13 +2494,12 @@ def worker(pipeline, recipe, config):
             if pipeline.enable_task(config, "flagging_summary"):
                 step = "flagging_summary-selfcal-ms{0:d}".format(i)
                 recipe.add(
-                    "cab/flagstats",
+                    flagstats.save_statistics,
                     step,
                     {
-                        "msname": msname,
-                        "plot": True,
-                        "outfile": ("{0:s}-{1:s}-selfcal-summary-{2:d}.json").format(prefix, wname, i),
-                        "htmlfile": ("{0:s}-{1:s}-selfcal-summary-plots-{2:d}.html").format(prefix, wname, i),
+                        "msname": os.path.join(pipeline.msdir, msname),
+                        "outfile": os.path.join(pipeline.diagnostic_plots, ("{0:s}-{1:s}-selfcal-summary-{2:d}.json").format(prefix, wname, i)),
+                        "htmlfile": os.path.join(pipeline.diagnostic_plots, ("{0:s}-{1:s}-selfcal-summary-plots-{2:d}.html").format(prefix, wname, i)),
                     },
                     input=pipeline.input,
                     output=pipeline.diagnostic_plots,
@@ -2587,11 +2507,11 @@ def worker(pipeline, recipe, config):
                 )
 
         if pipeline.enable_task(config, "transfer_model"):
-            image_path = "{0:s}/image_{1:d}".format(pipeline.continuum, self_cal_iter_counter)
+            image_path = "{0:s}/image_{1:d}".format(pipeline.continuum, state.iter_counter)
             crystalball_model = config["transfer_model"]["model"]
             mslist_out = ms_dict_tmodel[target]
             if crystalball_model == "auto":
-                crystalball_model = "{0:s}/{1:s}_{2:s}_{3:d}-sources.txt".format(get_dir_path(image_path, pipeline), prefix, field, self_cal_iter_counter)
+                crystalball_model = "{0:s}/{1:s}_{2:s}_{3:d}-sources.txt".format(get_dir_path(image_path, pipeline), prefix, field, state.iter_counter)
             for i, msname in enumerate(mslist_out):
                 step = "transfer_model-field{0:d}-ms{1:d}".format(target_iter, i)
                 recipe.add(
@@ -2613,18 +2533,43 @@ def worker(pipeline, recipe, config):
                     label="{0:s}:: Transfer model {2:s} to ms={1:s}".format(step, msname, crystalball_model),
                 )
 
-        target_iter += 1
+    ntargets = len(all_targets)
+    target_parallel = pipeline.enable_task(config, "target_parallel") and ntargets > 1
+    if target_parallel and len(set(all_msfile)) < len(all_msfile):
+        caracal.log.warning("Some targets share an MS, so their selfcal loops will run one after another")
+        target_parallel = False
+    if target_parallel:
+        # the steps that save or rewind the flags of all MSs come first
+        recipe.run()
+        recipe.jobs = []
+        # the selfcal loops of different targets are independent, so each runs in its own recipe
+        scheduler = WorkerScheduler(
+            ncpu=config["target_parallel"]["ncpu"],
+            mem_limit=config["target_parallel"]["mem_limit"],
+            worker_ncpu=config["target_parallel"]["target_ncpu"] or ncpu,
+            worker_mem=config["target_parallel"]["target_mem"],
+        )
+        for target_iter, target in enumerate(all_targets):
+            scheduler.add_task(f"{wname}-field{target_iter}", payload=(target_iter, target, recipe.spawn(f"{recipe.name}-field{target_iter}")))
+        caracal.log.info(f"Running the selfcal loops of {ntargets} targets concurrently, using {scheduler.ncpu} CPU(s) and {scheduler.mem_limit:.1f} GB of memory")
+
+        def _runner(node):
+            target_iter, target, target_recipe = node.payload
+            selfcal_target(target_iter, target, target_recipe)
+            target_recipe.run()
+            target_recipe.jobs = []
+
+        scheduler.run(_runner)
+    else:
+        for target_iter, target in enumerate(all_targets):
+            selfcal_target(target_iter, target, recipe)
 
-    i = 0
     # Write and manage flag versions only if flagging tasks are being
-    # executed on these .MS files
+    # executed on these .MS files. The versions of all MSs are saved in parallel
     if flag_main_ms:
-        for i, m in enumerate(all_msfile):
-            substep = "save-{0:s}-ms{1:d}".format(flags_after_worker, i)
-            manflags.add_cflags(pipeline, recipe, flags_after_worker, m, cab_name=substep, overwrite=config["overwrite_flagvers"])
+        substep = "save-{0:s}-ms".format(flags_after_worker)
+        manflags.add_cflags(pipeline, recipe, flags_after_worker, all_msfile, cab_name=substep, overwrite=config["overwrite_flagvers"], nproc=ncpu)
 
-    i += 1
     if pipeline.enable_task(config, "transfer_apply_gains"):
-        for j, m in enumerate(all_msfile_tgain):
-            substep = "save-{0:s}-ms{1:d}".format(flags_after_worker, i + j)
-            manflags.add_cflags(pipeline, recipe, flags_after_worker, m, cab_name=substep, overwrite=config["overwrite_flagvers"])
+        substep = "save-{0:s}-ms-tgain".format(flags_after_worker)
+        manflags.add_cflags(pipeline, recipe, flags_after_worker, all_msfile_tgain, cab_name=substep, overwrite=config["overwrite_flagvers"], nproc=ncpu)
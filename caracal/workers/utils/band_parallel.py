@@ -0,0 +1,261 @@
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import psutil
+import stimela
+from casacore.tables import table
+
+import caracal
+from caracal.dispatch_crew import flagstats
+from caracal.workers.utils import manage_caltabs
+
+# stimela names the recipe work directory by timestamp, so concurrent recipes are created one at a time
+_recipeLock = threading.Lock()
+# MS rows read at a time when looking for fully flagged channels
+CHUNK_ROWS = 100000
+
+# caltable columns that identify a solution (along with its time)
+_KEY_COLUMNS = ("FIELD_ID", "SPECTRAL_WINDOW_ID", "OBSERVATION_ID", "SCAN_NUMBER", "ANTENNA1")
+# caltable columns of shape (nchan, npol), with their values for channels that have no solution
+_DATA_COLUMNS = {"CPARAM": 1 + 0j, "FPARAM": 0.0, "PARAMERR": 0.0, "FLAG": True, "SNR": 0.0, "WEIGHT": 0.0}
+# SPECTRAL_WINDOW columns describing the channels, which the merged table takes from the MS
+_SPW_COLUMNS = ("CHAN_FREQ", "CHAN_WIDTH", "EFFECTIVE_BW", "RESOLUTION", "NUM_CHAN", "TOTAL_BANDWIDTH", "REF_FREQUENCY")
+
+
+def recipe_settings(recipe):
+    """Returns the settings needed to create recipes that run cabs the way recipe does"""
+    return dict(
+        ms_dir=recipe.msdir,
+        singularity_image_dir=recipe.singularity_image_dir,
+        cabspecs=recipe.cabspecs,
+        logfile_task=recipe.logfile_task,
+        JOB_TYPE=recipe.JOB_TYPE,
+    )
+
+
+def channel_chunks(nchan, nchunks):
+    """Splits nchan channels into up to nchunks contiguous ranges of near-equal size, as (first, last) channel tuples"""
+    edges = np.linspace(0, nchan, min(nchunks, nchan) + 1).astype(int)
+    return [(int(lo), int(hi) - 1) for lo, hi in zip(edges[:-1], edges[1:])]
+
+
+def _slots(groups, times, intervals):
+    """
+    Assigns solution rows to solution slots. Rows of the same group (see _KEY_COLUMNS, without the antenna) whose
+    times are within half a solution interval share a slot: the chunks' solution times differ slightly, since each
+    is the mean time of the data that went into the solution. Returns the slot of each row and the time of each slot.
+    """
+    order = np.lexsort((times, *groups.T[::-1]))
+    newgroup = np.concatenate([[True], (np.diff(groups[order], axis=0) != 0).any(axis=1)])
+    tolerance = 0.5 * np.maximum(intervals[order], 1.0)
+    newslot = newgroup | np.concatenate([[True], np.diff(times[order]) > tolerance[1:]])
+    slots = np.empty(len(times), int)
+    slots[order] = np.cumsum(newslot) - 1
+    # number the slots in time order
+    slot_times = times[order][newslot]
+    rank = np.argsort(slot_times, kind="stable")
+    renumber = np.empty_like(rank)
+    renumber[rank] = np.arange(len(rank))
+    return renumber[slots], slot_times[rank]
+
+
+def merge_caltables(chunk_tables, caltable, ms, spw, chunks):
+    """
+    Stitches the caltables of channel chunks of an SPW into a single caltable covering the SPW, with the channels of the MS.
+    chunk_tables[i] is the solution for the channels chunks[i] (None if the chunk was not solved), and may hold either
+    those channels or all channels of the SPW. Channels of solutions that a chunk does not have are flagged.
+    """
+    with table(f"{ms}::SPECTRAL_WINDOW", ack=False) as st:
+        nchan = int(st.getcell("NUM_CHAN", spw))
+    solved = [(path, chunk) for path, chunk in zip(chunk_tables, chunks) if path]
+    if not solved:
+        raise caracal.BadDataError(f"no channel chunk of SPW {spw} of {ms} has solutions")
+
+    keys, times, intervals, data = [], [], [], []
+    for path, (lo, hi) in solved:
+        with table(path, ack=False) as t:
+            keys.append(np.stack([t.getcol(col) for col in _KEY_COLUMNS], axis=1))
+            times.append(t.getcol("TIME"))
+            intervals.append(t.getcol("INTERVAL"))
+            columns = {col: t.getcol(col) for col in _DATA_COLUMNS if col in t.colnames() and t.nrows() and t.iscelldefined(col, 0)}
+        for col, value in columns.items():
+            if value.shape[1] == nchan:
+                columns[col] = value[:, lo : hi + 1]
+            elif value.shape[1] != hi - lo + 1:
+                raise caracal.BadDataError(f"{path} has {value.shape[1]} channels, expected {hi - lo + 1} or {nchan}")
+        data.append(columns)
+
+    # a solution is a slot of a group, for one antenna
+    allkeys = np.concatenate(keys)
+    slots, slot_times = _slots(allkeys[:, :-1], np.concatenate(times), np.concatenate(intervals))
+    solutions, solution_of_row = np.unique(np.stack([slots, allkeys[:, -1]], axis=1), axis=0, return_inverse=True)
+    solution_of_row = solution_of_row.ravel()
+    # the metadata of a solution comes from its first row
+    first_row = np.full(len(solutions), -1)
+    first_row[solution_of_row[::-1]] = np.arange(len(solution_of_row))[::-1]
+
+    template = solved[0][0]
+    if os.path.exists(caltable):
+        shutil.rmtree(caltable)
+    with table(template, ack=False) as t:
+        t.copy(caltable, deep=True).close()
+    rows_of_chunk = np.cumsum([0] + [len(tt) for tt in times])
+    with table(caltable, readonly=False, ack=False) as t:
+        meta = {}
+        for col in t.colnames():
+            if col in _DATA_COLUMNS:
+                continue
+            values = []
+            for path, _ in solved:
+                with table(path, ack=False) as ct:
+                    values.append(ct.getcol(col))
+            meta[col] = np.concatenate(values)[first_row]
+        meta["TIME"] = slot_times[solutions[:, 0]]
+        t.removerows(np.arange(t.nrows()))
+        t.addrows(len(solutions))
+        for col, value in meta.items():
+            t.putcol(col, value)
+
+        for col, fill in _DATA_COLUMNS.items():
+            chunk_data = [(ii, columns[col]) for ii, columns in enumerate(data) if col in columns]
+            if not chunk_data:
+                continue
+            npol = chunk_data[0][1].shape[2]
+            merged = np.full((len(solutions), nchan, npol), fill, dtype=chunk_data[0][1].dtype)
+            for ii, value in chunk_data:
+                lo, hi = solved[ii][1]
+                merged[solution_of_row[rows_of_chunk[ii] : rows_of_chunk[ii + 1]], lo : hi + 1] = value
+            t.putcol(col, merged)
+
+    with table(f"{ms}::SPECTRAL_WINDOW", ack=False) as mst, table(f"{caltable}::SPECTRAL_WINDOW", readonly=False, ack=False) as st:
+        for col in _SPW_COLUMNS:
+            if col in st.colnames() and mst.iscelldefined(col, spw):
+                st.putcell(col, spw, mst.getcell(col, spw))
+
+
+def normalise(caltable):
+    """
+    Normalises each bandpass solution (per row and correlation) across the band, so that its mean amplitude is 1
+    and its mean phase 0 over the unflagged channels (as casa_bandpass' solnorm does)
+    """
+    with table(caltable, readonly=False, ack=False) as t:
+        cparam, flag = t.getcol("CPARAM"), t.getcol("FLAG")
+        good = ~flag & (cparam != 0)
+        ngood = good.sum(axis=1)
+        amp = np.where(good, np.abs(cparam), 0).sum(axis=1) / np.maximum(ngood, 1)
+        phasor = np.where(good, cparam / np.where(good, np.abs(cparam), 1), 0).sum(axis=1)
+        phasor = np.where(np.abs(phasor) > 0, phasor / np.where(np.abs(phasor) > 0, np.abs(phasor), 1), 1)
+        norm = np.where(ngood > 0, amp * phasor, 1)
+        t.putcol("CPARAM", cparam / norm[:, None, :])
+        if "PARAMERR" in t.colnames():
+            t.putcol("PARAMERR", t.getcol("PARAMERR") / np.where(ngood > 0, amp, 1)[:, None, :])
+
+
+def flagged_channels(ms, field, spw, chunk_rows=CHUNK_ROWS):
+    """
+    Returns, for each channel of SPW spw of the MS, whether it is fully flagged in the rows of field (field names or
+    IDs separated by commas, as for CASA tasks; all fields if empty). Returns None if field names something else, e.g.
+    a pattern.
+    """
+    with table(f"{ms}::FIELD", ack=False) as ft:
+        names = list(ft.getcol("NAME")) if ft.nrows() else []
+    ids = []
+    for item in str(field or "").split(","):
+        item = item.strip()
+        if item.isdigit():
+            ids.append(int(item))
+        elif item in names:
+            ids.append(names.index(item))
+        elif item:
+            return None
+    with table(f"{ms}::DATA_DESCRIPTION", ack=False) as ddt:
+        ddids = [int(ddid) for ddid in np.where(ddt.getcol("SPECTRAL_WINDOW_ID") == spw)[0]]
+    with table(f"{ms}::SPECTRAL_WINDOW", ack=False) as st:
+        flagged = np.ones(int(st.getcell("NUM_CHAN", spw)), bool)
+    query = f"DATA_DESC_ID IN {ddids}" + (f" AND FIELD_ID IN {ids}" if ids else "")
+    with table(ms, ack=False) as t, t.query(query, columns="FLAG") as sel:
+        for row0 in range(0, sel.nrows(), chunk_rows):
+            flagged &= sel.getcol("FLAG", row0, chunk_rows).all(axis=(0, 2))
+            if not flagged.any():
+                break
+    return flagged
+
+
+def solve_bandpass(cab, step, params, nchunks, msdir, output, settings, input=None, label=""):
+    """
+    Solves a bandpass in channel chunks of its SPW, concurrently, each in its own cab run, and merges the chunks into
+    the single caltable that params asks for. Gaps are filled (params["fillgaps"]) and solutions normalised
+    (params["solnorm"]) after the merge, so that gaps across chunk edges are filled, and solutions are normalised
+    across the whole band. Chunks that are fully flagged in the field(s) being solved are not solved, and chunks whose
+    solve fails or yields no solutions are left out of the merge, so that both end up flagged.
+
+    Args:
+    @cab, step, params: the bandpass cab, step name and parameters, as for recipe.add() (the MS must have one SPW)
+    @nchunks: number of channel chunks
+    @msdir, output, input: MS, output (caltable) and input directories of the step
+    @settings: recipe_settings() of the worker's recipe
+    """
+    ms = os.path.join(msdir, params["vis"])
+    caltable = os.path.join(output, params["caltable"].rsplit(":", 1)[0])
+    spw = 0
+    flagged = flagged_channels(ms, params.get("field"), spw)
+    if flagged is None:
+        flagged = flagstats.get(ms).fraction("channel")[spw] == 1
+    chunks = channel_chunks(len(flagged), nchunks)
+    tosolve = [not np.all(flagged[lo : hi + 1]) for lo, hi in chunks]
+    errors = []
+
+    def _discard(chunk_table):
+        if os.path.exists(chunk_table):
+            shutil.rmtree(chunk_table)
+        return None
+
+    def _solve(ii):
+        lo, hi = chunks[ii]
+        chunk_table = f"{caltable}.chunk{ii}"
+        if os.path.exists(chunk_table):
+            shutil.rmtree(chunk_table)
+        chunk_params = dict(params, spw=f"{spw}:{lo}~{hi}", caltable=f"{os.path.basename(chunk_table)}:output", fillgaps=0, solnorm=False)
+        kw = dict(settings)
+        job_type = kw.pop("JOB_TYPE")
+        with _recipeLock:
+            recipe = stimela.Recipe(f"{step}-chunk{ii}", logfile=False, **kw)
+        recipe.JOB_TYPE = job_type
+        recipe.add(cab, f"{step}-chunk{ii}", chunk_params, input=input, output=output, label=f"{label or step}:: channels {lo}~{hi}")
+        try:
+            recipe.run()
+        except Exception as exc:
+            errors.append(exc)
+            caracal.log.warning(f"Solving channels {lo}~{hi} of {params['vis']} failed ({exc}). They will be flagged in {os.path.basename(caltable)}")
+            return _discard(chunk_table)
+        if not os.path.exists(chunk_table):
+            nrows = 0
+        else:
+            with table(chunk_table, ack=False) as t:
+                nrows = t.nrows()
+        if not nrows:
+            caracal.log.warning(f"Channels {lo}~{hi} of {params['vis']} have no solutions, and will be flagged in {os.path.basename(caltable)}")
+            return _discard(chunk_table)
+        return chunk_table
+
+    nparallel = max(min(sum(tosolve), psutil.cpu_count() or 1), 1)
+    caracal.log.info(f"Solving {os.path.basename(caltable)} in {len(chunks)} channel chunks, {nparallel} at a time")
+    for (lo, hi), ok in zip(chunks, tosolve):
+        if not ok:
+            caracal.log.warning(f"Channels {lo}~{hi} of {params['vis']} are fully flagged, and will be flagged in {os.path.basename(caltable)}")
+    with ThreadPoolExecutor(nparallel) as pool:
+        chunk_tables = list(pool.map(lambda ii: _solve(ii) if tosolve[ii] else None, range(len(chunks))))
+
+    # if no chunk could be solved because of an error, that error is the one to report
+    if errors and not any(chunk_tables):
+        raise errors[0]
+    merge_caltables(chunk_tables, caltable, ms, spw, chunks)
+    for chunk_table in filter(None, chunk_tables):
+        shutil.rmtree(chunk_table)
+    if params.get("fillgaps"):
+        manage_caltabs.interpolate_table(caltable, maxgap=params["fillgaps"])
+    if params.get("solnorm"):
+        normalise(caltable)
@@ -0,0 +1,103 @@
+import math
+
+import numpy as np
+
+from caracal import log
+
+# bytes per complex visibility (CubiCal works in complex64), per weight and per flag
+VIS_BYTES = 8
+WEIGHT_BYTES = 4
+FLAG_BYTES = 1
+# visibility cubes that CubiCal keeps per chunk besides the model(s): data, residuals, corrected data and
+# the solver's work array
+WORK_CUBES = 4
+# chunk sizes tried are these multiples of the (least common multiple of the) solution intervals, along with
+# the one that spans the whole axis
+MULTIPLES = [2**k for k in range(16)]
+
+
+class MSDims(object):
+    def __init__(self, msinfo):
+        """
+        Dimensions of an MS that CubiCal's memory use depends on, from its MSInfo (or summary dict): the
+        number of timeslots of each scan, rows per timeslot, channels per SPW, antennas and correlations
+        """
+        exposure = float(msinfo["EXPOSURE"])
+        lengths = [length for scans in msinfo["SCAN"].values() for length in scans.values()]
+        self.scan_slots = np.maximum(1, np.ceil(np.array(lengths, dtype=float) / exposure - 1e-6)).astype(int)
+        self.rows_per_slot = int(math.ceil(msinfo["NROW"] / max(1, self.scan_slots.sum())))
+        self.nchan = int(max(msinfo["SPW"]["NUM_CHAN"]))
+        self.nant = len(msinfo["ANT"]["NAME"])
+        self.ncorr = int(msinfo["NCOR"])
+
+
+def chunk_memory(dims, nslots, nchan, ndir=1):
+    """
+    Returns the predicted memory (in bytes) of one CubiCal chunk of nslots timeslots by nchan channels: the
+    row-ordered data, model(s), weights and flags read from the MS, and the (time, freq, antenna, antenna,
+    2x2 correlation) cubes of the model(s) and of the data that the solver works on
+    """
+    rows = nslots * dims.rows_per_slot * nchan * dims.ncorr * (VIS_BYTES * (ndir + 1) + WEIGHT_BYTES + FLAG_BYTES)
+    cubes = nslots * nchan * dims.nant**2 * 4 * VIS_BYTES * (ndir + WORK_CUBES)
+    return rows + cubes
+
+
+def _candidates(chunk, intervals, axis_length):
+    """Returns the chunk sizes to try along an axis, largest first: the configured chunk, if not -1 (auto);
+    0 (the whole axis), if any solution interval is 0; otherwise multiples of all solution intervals"""
+    if chunk != -1:
+        return [chunk]
+    if not intervals or 0 in intervals:
+        return [0]
+    step = math.lcm(*intervals)
+    sizes = []
+    for multiple in MULTIPLES:
+        sizes.append(step * multiple)
+        if step * multiple >= axis_length:
+            break
+    return sizes[::-1]
+
+
+def tune(dims, time_intervals, freq_intervals, ncpu, mem_limit, ndir=1, max_chunks=0, time_chunk=-1, freq_chunk=-1):
+    """
+    Chooses the CubiCal data-time-chunk and data-freq-chunk for an MS of dimensions dims (see MSDims).
+
+    Chunk sizes set to -1 are chosen among the multiples of all solution intervals (time_intervals in timeslots,
+    freq_intervals in channels), or are 0 (the whole scan or SPW) if any interval is 0. Other chunk sizes are kept.
+    The largest chunks are chosen that fit the chunks of all CubiCal workers (ncpu - 1, or max_chunks if it is
+    smaller, as CubiCal loads no more chunks than that at once) into mem_limit GB, while giving each worker a chunk.
+    Larger frequency chunks are preferred. If no choice fits, the smallest chunks are chosen.
+
+    Returns (time_chunk, freq_chunk, predicted peak memory in GB)
+    """
+    nworkers = max(1, ncpu - 1)
+    if max_chunks > 0:
+        nworkers = min(nworkers, max_chunks)
+    max_slots = int(dims.scan_slots.max())
+    best, best_key = None, None
+    for fchunk in _candidates(freq_chunk, freq_intervals, dims.nchan):
+        nchan = min(fchunk, dims.nchan) if fchunk else dims.nchan
+        for tchunk in _candidates(time_chunk, time_intervals, max_slots):
+            nslots = min(tchunk, max_slots) if tchunk else max_slots
+            peak = nworkers * chunk_memory(dims, nslots, nchan, ndir) / 2**30
+            # chunks do not cross scan or SPW boundaries
+            nchunks = int(np.ceil(dims.scan_slots / nslots).sum()) * int(math.ceil(dims.nchan / nchan))
+            # fitting in memory comes first, then keeping the workers busy, then the size of the chunks. Failing
+            # that, the least memory.
+            key = (1, min(nchunks, nworkers), nchan, nslots) if peak <= mem_limit else (0, -peak, 0, 0)
+            if best_key is None or key > best_key:
+                best, best_key = (tchunk, fchunk, peak), key
+    return best
+
+
+def tune_for_ms(msinfo, msname, time_intervals, freq_intervals, ncpu, mem_limit, **kw):
+    """Chooses the CubiCal chunks of an MS (see tune()), and logs them along with the predicted peak memory"""
+    dims = MSDims(msinfo)
+    time_chunk, freq_chunk, peak = tune(dims, time_intervals, freq_intervals, ncpu, mem_limit, **kw)
+    log.info(
+        f"CubiCal chunks for {msname}: {time_chunk} timeslots by {freq_chunk} channels (0: whole scan/SPW), "
+        f"predicted peak memory {peak:.1f} GB over {ncpu} CPU(s) (limit {mem_limit:g} GB)"
+    )
+    if peak > mem_limit:
+        log.warning(f"The smallest CubiCal chunks allowed by the solution intervals are predicted to need {peak:.1f} GB, more than the limit of {mem_limit:g} GB")
+    return time_chunk, freq_chunk, peak
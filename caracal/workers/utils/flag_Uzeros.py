@@ -2,13 +2,18 @@
 
 import gc
 import os
+import resource
 import shutil
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 
 import astropy.io.ascii as astasc
 import casacore.measures as measures
 import casacore.tables as tables
 import numpy as np
+import psutil
 import scipy.constants as scconstants
 import scipy.optimize as optimize
 import stimela.recipe
@@ -22,12 +27,19 @@ from matplotlib import pyplot as plt
 from scipy import stats
 
 import caracal
+from caracal.dispatch_crew import flagversions
 from caracal.workers.utils import remove_output_products
 
 dm = measures.measures()
 
 timeInit = time.time()
 
+# pyplot is not thread-safe, and scans may be processed concurrently
+_plotLock = threading.Lock()
+_recipeLock = threading.Lock()
+# scan tables all refer to the same parent MS, which casacore does not let threads access concurrently
+_tableLock = threading.Lock()
+
 
 class UzeroFlagger:
     global u, SkyCoord, astviz, WCS, Table, Column, fits, astasc
@@ -35,6 +47,75 @@ class UzeroFlagger:
 
     def __init__(self, config):
         self.config = config
+        # largest FLAG chunk held in memory so far, in bytes
+        self.peakChunkBytes = 0
+
+    def flagChunks(self, t):
+        """Yields (startrow, nrow) chunks of table t, such that each chunk of the FLAG column is at most
+        flag_u_zeros: chunk_size MB. A chunk_size of 0 yields a single chunk spanning the whole table."""
+        nrows = t.nrows()
+        chunkSize = self.config["flag_u_zeros"]["chunk_size"]
+        if not nrows:
+            return
+        if chunkSize:
+            # FLAG is stored as one byte per visibility
+            rowBytes = int(np.prod(t.getcell("FLAG", 0).shape))
+            chunkRows = max(int(chunkSize * 2**20) // rowBytes, 1)
+        else:
+            chunkRows = nrows
+        for startrow in range(0, nrows, chunkRows):
+            yield startrow, min(chunkRows, nrows - startrow)
+
+    def getFlagPercent(self, t):
+        """Returns the percentage of flagged visibilities in table t, reading the FLAG column chunk by chunk"""
+        nflagged, ntotal = 0, 0
+        for startrow, nrow in self.flagChunks(t):
+            flags = t.getcol("FLAG", startrow, nrow)
+            self.peakChunkBytes = max(self.peakChunkBytes, flags.nbytes)
+            nflagged += np.count_nonzero(flags)
+            ntotal += flags.size
+            del flags
+        return nflagged / float(ntotal) * 100.0 if ntotal else 0.0
+
+    def addRowFlags(self, t, rowFlags, undo=None):
+        """Flags all channels and correlations of the rows of table t selected by the boolean array rowFlags, reading
+        and writing the FLAG column chunk by chunk. Returns the percentage of flagged visibilities before and after.
+        If undo is a list, the original flags of the newly flagged rows are appended to it (see restoreRowFlags)."""
+        if len(rowFlags) != t.nrows():
+            raise caracal.BadDataError(f"Cannot apply stripe flags for {len(rowFlags)} rows to {t.name()}, which has {t.nrows()} rows")
+        nbefore, nafter, ntotal = 0, 0, 0
+        for startrow, nrow in self.flagChunks(t):
+            flags = t.getcol("FLAG", startrow, nrow)
+            self.peakChunkBytes = max(self.peakChunkBytes, flags.nbytes)
+            nbefore += np.count_nonzero(flags)
+            ntotal += flags.size
+            chunkRowFlags = rowFlags[startrow : startrow + nrow]
+            if chunkRowFlags.any():
+                if undo is not None:
+                    undo.append((startrow, nrow, chunkRowFlags.copy(), flags[chunkRowFlags]))
+                flags[chunkRowFlags] = True
+                t.putcol("FLAG", flags, startrow, nrow)
+            nafter += np.count_nonzero(flags)
+            del flags
+        if not ntotal:
+            return 0.0, 0.0
+        return nbefore / float(ntotal) * 100.0, nafter / float(ntotal) * 100.0
+
+    def restoreRowFlags(self, t, undo):
+        """Restores the flags saved in undo by addRowFlags (most recent first), and empties undo"""
+        while undo:
+            startrow, nrow, chunkRowFlags, rowFlags = undo.pop()
+            flags = t.getcol("FLAG", startrow, nrow)
+            flags[chunkRowFlags] = rowFlags
+            t.putcol("FLAG", flags, startrow, nrow)
+            del flags
+
+    def scanRows(self, t):
+        """Returns a dict mapping each SCAN_NUMBER of table t to the (sorted) numbers of its rows"""
+        scans = t.getcol("SCAN_NUMBER")
+        order = np.argsort(scans, kind="stable")
+        scanNums, starts = np.unique(scans[order], return_index=True)
+        return {scan: rows for scan, rows in zip(scanNums.tolist(), np.split(order, starts[1:]))}
 
     def setDirs(self, output):
         self.config["flag_u_zeros"]["stripeDir"] = output + "/stripeAnalysis/"
@@ -45,10 +126,6 @@ class UzeroFlagger:
         if not os.path.exists(self.config["flag_u_zeros"]["stripeLogDir"]):
             os.mkdir(self.config["flag_u_zeros"]["stripeLogDir"])
 
-        self.config["flag_u_zeros"]["stripeMSDir"] = self.config["flag_u_zeros"]["stripeDir"] + "msdir/"
-        if not os.path.exists(self.config["flag_u_zeros"]["stripeMSDir"]):
-            os.mkdir(self.config["flag_u_zeros"]["stripeMSDir"])
-
         self.config["flag_u_zeros"]["stripeCubeDir"] = self.config["flag_u_zeros"]["stripeDir"] + "cubes/"
         if not os.path.exists(self.config["flag_u_zeros"]["stripeCubeDir"]):
             os.mkdir(self.config["flag_u_zeros"]["stripeCubeDir"])
@@ -71,129 +148,49 @@ class UzeroFlagger:
 
         return
 
-    def saveFlags(self, pipeline, inVis, msdir, flagname):
-        recipe = stimela.Recipe(
-            "saveFlagZeros",
-            ms_dir=msdir,
-            singularity_image_dir=pipeline.singularity_image_dir,
-            log_dir=self.config["flag_u_zeros"]["stripeLogDir"],
-            logfile=False,  # no logfiles for recipes
-        )
+    def newRecipe(self, pipeline, name, msdir):
+        # stimela names the recipe work directory by timestamp, so recipes of concurrent scans are created one at a time
+        with _recipeLock:
+            recipe = stimela.Recipe(
+                name,
+                ms_dir=msdir,
+                singularity_image_dir=pipeline.singularity_image_dir,
+                log_dir=self.config["flag_u_zeros"]["stripeLogDir"],
+                logfile=False,  # no logfiles for recipes
+            )
         recipe.JOB_TYPE = pipeline.container_tech
+        return recipe
 
-        step = "saveFlag"
-
-        recipe.add(
-            "cab/casa_flagmanager",
-            step,
-            {
-                "vis": inVis,
-                "mode": "save",
-                "versionname": flagname,
-            },
-            input=pipeline.input,
-            output=pipeline.output,
-            label="{0:s}:: Save flag version",
-        )
-
-        recipe.run()
+    def saveFlags(self, pipeline, inVis, msdir, flagname):
+        flagversions.save(os.path.join(msdir, inVis), flagname)
 
     def deleteFlags(self, pipeline, inVis, msdir, flagname):
-        recipe = stimela.Recipe(
-            "saveFlagZeros",
-            ms_dir=msdir,
-            singularity_image_dir=pipeline.singularity_image_dir,
-            log_dir=self.config["flag_u_zeros"]["stripeLogDir"],
-            logfile=False,  # no logfiles for recipes
-        )
-        recipe.JOB_TYPE = pipeline.container_tech
-
-        step = "deleteFlag"
-
-        recipe.add(
-            "cab/casa_flagmanager",
-            step,
-            {
-                "vis": inVis,
-                "mode": "delete",
-                "versionname": flagname,
-            },
-            input=pipeline.input,
-            output=pipeline.output,
-            label="Delete flag version",
-        )
-
-        recipe.run()
+        flagversions.delete(os.path.join(msdir, inVis), flagname)
 
     def restoreFlags(self, pipeline, inVis, msdir, flagname):
-        recipe = stimela.Recipe(
-            "saveFlagZeros",
-            ms_dir=msdir,
-            singularity_image_dir=pipeline.singularity_image_dir,
-            log_dir=self.config["flag_u_zeros"]["stripeLogDir"],
-            logfile=False,  # no logfiles for recipes
-        )
-        recipe.JOB_TYPE = pipeline.container_tech
+        flagversions.restore(os.path.join(msdir, inVis), flagname)
 
-        step = "restoreFlag"
-
-        recipe.add(
-            "cab/casa_flagmanager",
-            step,
-            {
-                "vis": inVis,
-                "mode": "restore",
-                "versionname": flagname,
-            },
-            input=pipeline.input,
-            output=pipeline.output,
-            label="Restore flag version",
-        )
-
-        recipe.run()
-
-    def splitScans(self, pipeline, msdir, inVis, scanNums):
+    def makeScanTables(self, inVis, scanRows):
+        """Makes a reference table for each scan of MS inVis, given the rows of each scan (see scanRows). Reference
+        tables only hold row numbers, so nothing is copied, and flags written to them go straight to the parent MS.
+        They are made next to the parent MS, since they refer to it by relative path."""
         scanVisList = []
         scanVisNames = []
 
-        for scan in scanNums:
-            baseVis = os.path.basename(inVis)
-            outVis = baseVis.split(".ms")[0] + "_scn" + str(scan) + ".ms"
-            # if os.path.exists(self.config['flag_u_zeros']['stripeMSDir']+outVis):
-            #     shutil.rmtree(self.config['flag_u_zeros']['stripeMSDir']+outVis)
-            # if os.path.exists(self.config['flag_u_zeros']['stripeMSDir']+outVis+'.flagversions'):
-            #     shutil.rmtree(self.config['flag_u_zeros']['stripeMSDir']+outVis+'.flagversions')
-            remove_output_products((outVis, outVis + ".flagversions"), directory=self.config["flag_u_zeros"]["stripeMSDir"])
-
-            recipe = stimela.Recipe(
-                "flagUzerosMST",
-                ms_dir=msdir,
-                singularity_image_dir=pipeline.singularity_image_dir,
-                log_dir=self.config["flag_u_zeros"]["stripeLogDir"],
-                logfile=False,  # no logfiles for recipes
-            )
-            recipe.JOB_TYPE = pipeline.container_tech
-
-            step = "splitScans"
-            recipe.add(
-                "cab/casa_mstransform",
-                step,
-                {
-                    "msname": baseVis,
-                    "outputvis": outVis + ":output",
-                    "datacolumn": "data",
-                    "scan": str(scan),
-                },
-                input=msdir,
-                output=self.config["flag_u_zeros"]["stripeMSDir"],
-                label="{0:s}:: Image Line".format(step),
-            )
-            recipe.run()
+        t = tables.table(inVis, readonly=True, ack=False)
+        for scan, rows in scanRows.items():
+            outVis = os.path.basename(inVis).split(".ms")[0] + "_scn" + str(scan) + ".ms"
+            outAddress = os.path.join(os.path.dirname(inVis), outVis)
+            remove_output_products((outAddress,))
+            scanTable = t.selectrows(rows)
+            scanTable.copy(outAddress, deep=False)
+            scanTable.close()
 
-            scanVisList.append(self.config["flag_u_zeros"]["stripeMSDir"] + outVis)
+            scanVisList.append(outAddress)
             scanVisNames.append(outVis)
+        t.close()
 
-        caracal.log.info("All Scans splitted")
+        caracal.log.info("Reference tables made for all scans")
 
         return scanVisList, scanVisNames
 
@@ -221,21 +218,14 @@ class UzeroFlagger:
 
         return data, flags
 
-    def makeCube(self, pipeline, msdir, inVis, outCubePrefix, kind="scan"):
+    def makeCube(self, pipeline, msdir, inVis, outCubePrefix, kind="scan", threads=0):
         robust = self.config["flag_u_zeros"]["robust"]
         imsize = int(self.config["flag_u_zeros"]["imsize"])
         cell = self.config["flag_u_zeros"]["cell"]
         chanMin = int(self.config["flag_u_zeros"]["chans"][0])
         chanMax = int(self.config["flag_u_zeros"]["chans"][1])
 
-        recipe = stimela.Recipe(
-            "flagUzeros",
-            ms_dir=msdir,
-            singularity_image_dir=pipeline.singularity_image_dir,
-            log_dir=self.config["flag_u_zeros"]["stripeLogDir"],
-            logfile=False,  # no logfiles for recipes
-        )
-        recipe.JOB_TYPE = pipeline.container_tech
+        recipe = self.newRecipe(pipeline, "flagUzeros", msdir)
 
         line_image_opts = {
             "msname": inVis,
@@ -257,6 +247,8 @@ class UzeroFlagger:
 
         if self.config["flag_u_zeros"]["taper"]:
             line_image_opts.update({"taper-gaussian": str(self.config["flag_u_zeros"]["taper"])})
+        if threads:
+            line_image_opts["threads"] = threads
 
         step = "makeCube"
         recipe.add(
@@ -464,11 +456,6 @@ class UzeroFlagger:
         if os.path.exists(self.config["flag_u_zeros"]["stripeFFTDir"]):
             shutil.rmtree(self.config["flag_u_zeros"]["stripeFFTDir"])
 
-        caracal.log.info("Deleting .ms scans")
-
-        if os.path.exists(self.config["flag_u_zeros"]["stripeMSDir"]):
-            shutil.rmtree(self.config["flag_u_zeros"]["stripeMSDir"])
-
         caracal.log.info("Cleanup done")
 
         return 0
@@ -491,52 +478,31 @@ class UzeroFlagger:
         dilateU,
         dilateV,
         makePlots,
+        undo=None,
     ):
-        xCol = np.zeros([len(U) * len(V)])
-        yCol = np.zeros([len(U) * len(V)])
-        BIN_ID = np.arange(0, len(U) * len(V), 1)
-        tabGen = np.column_stack([BIN_ID, xCol, yCol])
-        dt = np.dtype([("BIN_ID", np.int32), ("U", np.int32), ("V", np.int32)])
-        tabGen = np.array(list(map(tuple, tabGen)), dtype=dt)
-
-        namBins = tuple(["BIN_ID", "U", "V", "Amp"])
-
-        tabArr = np.zeros([len(tabGen)], dtype={"names": namBins, "formats": ("i4", "f8", "f8", "f8")})
-
-        indexBin = 0
-        for i in range(0, len(U)):
-            for j in range(0, len(V)):
-                tabArr["BIN_ID"][indexBin] = indexBin
-                tabArr["U"][indexBin] = U[i]
-                tabArr["V"][indexBin] = V[j]
-                tabArr["Amp"][indexBin] = inFFT[j, i]
-
-                indexBin += 1
-
-        hdr = fits.Header()
-        hdr["COMMENT"] = "This is the table of the FFT"
-        hdr["COMMENT"] = "Ext 1 = FFT table"
+        # Amplitudes of the FFT cells (U along axis 1, V along axis 0)
+        amp = np.asarray(inFFT[: len(V), : len(U)], dtype=np.float64)
 
         if method == "madThreshold":
             cutoff = self.sunBlockStats(inFFT, galaxy, msid, track, scan, makePlots, "mad", threshold, ax=None, title="", verb=True)
         else:
             if self.config["flag_u_zeros"]["taper"]:
-                cutoff = np.nanpercentile(tabArr["Amp"], 99.99)
+                cutoff = np.nanpercentile(amp, 99.99)
             else:
-                cutoff = np.nanpercentile(tabArr["Amp"], 99.9999)
+                cutoff = np.nanpercentile(amp, 99.9999)
 
-        if cutoff > np.nanmax(tabArr["Amp"]):
+        if cutoff > np.nanmax(amp):
             willflag = False
-            caracal.log.warn("Cutoff is larger than max amplitude. Notihng will be flagged.")
-            # cutoff = tabArr['Amp'].max()
+            caracal.log.warning("Cutoff is larger than max amplitude. Notihng will be flagged.")
+            # cutoff = amp.max()
         else:
             willflag = True
 
-        # This is where we decide where to flag
-        index = np.where(tabArr["Amp"] >= cutoff)[0]
+        # This is where we decide where to flag: cells are listed in order of U, then V
+        iU, iV = np.nonzero(amp.T >= cutoff)
 
         # And this is where we apply that flagging selection to the U,V,Amp arrays
-        newtab = Table(names=["u", "v", "amp"], data=(tabArr["U"][index], tabArr["V"][index], tabArr["Amp"][index]))
+        newtab = Table(names=["u", "v", "amp"], data=(np.asarray(U, dtype=np.float64)[iU], np.asarray(V, dtype=np.float64)[iV], amp[iV, iU]))
 
         # Some stats ...
         if willflag:
@@ -547,7 +513,7 @@ class UzeroFlagger:
         caracal.log.info("Flagging scan")
 
         # the following scanFlags are the stripe flags for this scan
-        scanFlags, percent = self.flagQuartile(visName, newtab, inFFTHeader, method, dilateU, dilateV, qrtdebug=False)
+        scanFlags, percent = self.flagQuartile(visName, newtab, inFFTHeader, method, dilateU, dilateV, qrtdebug=False, undo=undo)
 
         return statsArray, scanFlags, percent, cutoff
 
@@ -688,24 +654,25 @@ class UzeroFlagger:
             makePlots = None
 
         if makePlots:
-            self.plotSunblocker(
-                bin_centers,
-                bin_edges,
-                npoints,
-                widthes,
-                average,
-                stdev,
-                med,
-                mad,
-                popt,
-                hist,
-                threshold,
-                galaxy,
-                msid,
-                track,
-                scan,
-                ave + float(threshold) * std,
-            )
+            with _plotLock:
+                self.plotSunblocker(
+                    bin_centers,
+                    bin_edges,
+                    npoints,
+                    widthes,
+                    average,
+                    stdev,
+                    med,
+                    mad,
+                    popt,
+                    hist,
+                    threshold,
+                    galaxy,
+                    msid,
+                    track,
+                    scan,
+                    ave + float(threshold) * std,
+                )
         else:
             caracal.log.warn("For some reasons I am not making the fftstats plots!")
 
@@ -713,94 +680,105 @@ class UzeroFlagger:
 
         return ave + float(threshold) * std
 
-    def flagQuartile(self, inVis, tableFlags, inFFTHeader, method, dilateU, dilateV, qrtdebug=False):
+    def matchCellRows(self, uv, UV, cellSize, dilateU, dilateV, qrtdebug=False):
+        """Returns a boolean array selecting the rows whose uv (shape (nrows, 2)) fall within any of the FFT cells
+        centred on UV (shape (2, ncells)), extended by dilateU and dilateV cells on either side. A cell centred on c
+        covers c - cellSize/2 < u <= c + cellSize/2. Rows are binned onto the grid of FFT cells in a single pass, and
+        looked up in a boolean grid of selected cells."""
+        rowFlags = np.zeros(uv.shape[0], bool)
+        if not UV.shape[1] or not uv.shape[0]:
+            return rowFlags
+        dilate = np.array([[dilateU], [dilateV]])
+        origin = UV[:, :1]
+        cellIndex = np.rint((UV - origin) / cellSize).astype(int)
+
+        if not np.allclose(cellIndex * cellSize + origin, UV, rtol=0, atol=1e-6 * cellSize):
+            # Cells do not lie on a regular grid of this cell size, so match them one at a time
+            caracal.log.warning("Selected UV cells are not on a regular grid, matching MS rows cell by cell")
+            for i in range(UV.shape[1]):
+                rowFlags |= np.all(
+                    np.logical_and(
+                        uv.T > UV[:, i : i + 1] - (1 / 2 + dilate) * cellSize,
+                        uv.T <= UV[:, i : i + 1] + (1 / 2 + dilate) * cellSize,
+                    ),
+                    axis=0,
+                )
+            return rowFlags
+
+        # Boolean grid of selected cells, dilated, with its lower corner at cell index lo
+        lo = cellIndex.min(axis=1, keepdims=True) - dilate
+        gridShape = cellIndex.max(axis=1, keepdims=True) + dilate - lo + 1
+        grid = np.zeros(gridShape[:, 0], bool)
+        for du in range(-dilateU, dilateU + 1):
+            for dv in range(-dilateV, dilateV + 1):
+                grid[cellIndex[0] - lo[0] + du, cellIndex[1] - lo[1] + dv] = True
+
+        # Grid cell of each row
+        rowIndex = np.ceil((uv.T - origin) / cellSize - 1 / 2).astype(int) - lo
+        inGrid = np.all(np.logical_and(rowIndex >= 0, rowIndex < gridShape), axis=0)
+        rowFlags[inGrid] = grid[rowIndex[0, inGrid], rowIndex[1, inGrid]]
+
+        if qrtdebug:
+            for i in range(UV.shape[1]):
+                caracal.log.info("\tcell {0:d}, [U,V] = {1}".format(i, UV[:, i]))
+                caracal.log.info("\t\tflagging u range = {0:.3f} - {1:.3f}".format(UV[0, i] - (1 / 2 + dilateU) * cellSize, UV[0, i] + (1 / 2 + dilateU) * cellSize))
+                caracal.log.info("\t\tflagging v range = {0:.3f} - {1:.3f}".format(UV[1, i] - (1 / 2 + dilateV) * cellSize, UV[1, i] + (1 / 2 + dilateV) * cellSize))
+                indexTot = np.where(np.all(np.abs(rowIndex - (cellIndex[:, i : i + 1] - lo)) <= dilate, axis=0))[0]
+                caracal.log.info("\t\t{0:d} rows found".format(indexTot.shape[0]))
+                if indexTot.shape[0]:
+                    caracal.log.info("\t\tSelected rows have uv in the following ranges")
+                    caracal.log.info("\t\tu: {0:.3f} - {1:.3f}".format(np.nanmin(uv[indexTot, 0]), np.nanmax(uv[indexTot, 0])))
+                    caracal.log.info("\t\tv: {0:.3f} - {1:.3f}".format(np.nanmin(uv[indexTot, 1]), np.nanmax(uv[indexTot, 1])))
+
+        return rowFlags
+
+    def flagQuartile(self, inVis, tableFlags, inFFTHeader, method, dilateU, dilateV, qrtdebug=False, undo=None):
         U = tableFlags["u"]
         V = tableFlags["v"]
         UV = np.array([U, V])
 
-        t = tables.table(inVis, readonly=False, ack=False)
-        # Take existing flags from MS of this scan to estimate flagged starting flagged fraction
-        flags = t.getcol("FLAG")
-        percTot = np.nansum(flags) / float(flags.shape[0] * flags.shape[1] * flags.shape[2]) * 100.0
-        # Reset to no flags and build up stripe flags
-        flags = np.zeros(flags.shape, bool)
+        with _tableLock:
+            t = tables.table(inVis, readonly=False, ack=False)
+            # Take existing flags from MS of this scan to estimate flagged starting flagged fraction
+            percTot = self.getFlagPercent(t)
+            # uvw=np.array(t.getcol('UVW'),dtype=float) # This is never used
+            spw = tables.table(inVis + "::SPECTRAL_WINDOW", ack=False)
+            avspecchan = np.average(spw.getcol("CHAN_FREQ"))
+            spw.close()
+            uv = t.getcol("UVW")[:, :2] * avspecchan / scconstants.c
         caracal.log.info("Scan flags before stripe-flagging: {percent:.3f}%".format(percent=percTot))
-        # uvw=np.array(t.getcol('UVW'),dtype=float) # This is never used
-        spw = tables.table(inVis + "/SPECTRAL_WINDOW", ack=False)
-        avspecchan = np.average(spw.getcol("CHAN_FREQ"))
-        uv = t.getcol("UVW")[:, :2] * avspecchan / scconstants.c
 
         caracal.log.info("{0:d} UV cells in the FFT image selected for flagging".format(U.shape[0]))
 
         if qrtdebug and U.shape[0]:
             caracal.log.info("\tamplitude of selected cells in range {0:.3f} - {1:.3f}".format(np.nanmin(tableFlags["amp"]), np.nanmax(tableFlags["amp"])))
-            caracal.log.info("\t{0} total rows in scan MS".format(flags.shape))
+            caracal.log.info("\t{0} total rows in scan MS".format(uv.shape[0]))
 
         if U.shape[0]:
             caracal.log.info("Finding MS rows within flagged cells +/- {0:d} U cell(s) and +/- {1:d} V cell(s)".format(dilateU, dilateV))
 
-        percent = 0.0
-        for i in range(0, UV.shape[1]):
-            indexU = np.where(
-                np.logical_and(
-                    uv[:, 0] > UV[0, i] - (1 / 2 + dilateU) * inFFTHeader["CDELT2"],
-                    uv[:, 0] <= UV[0, i] + (1 / 2 + dilateU) * inFFTHeader["CDELT2"],
-                )
-            )[0]
-            indexV = np.where(
-                np.logical_and(
-                    uv[:, 1] > UV[1, i] - (1 / 2 + dilateV) * inFFTHeader["CDELT2"],
-                    uv[:, 1] <= UV[1, i] + (1 / 2 + dilateV) * inFFTHeader["CDELT2"],
-                )
-            )[0]
-
-            if qrtdebug:
-                caracal.log.info("\tcell {0:d}, [U,V] = {1}".format(i, UV[:, i]))
-                caracal.log.info(
-                    "\t\tflagging u range = {0:.3f} - {1:.3f}".format(
-                        UV[0, i] - (1 / 2 + dilateU) * inFFTHeader["CDELT2"],
-                        UV[0, i] + (1 / 2 + dilateU) * inFFTHeader["CDELT2"],
-                    )
-                )
-                caracal.log.info(
-                    "\t\tflagging v range = {0:.3f} - {1:.3f}".format(
-                        UV[1, i] - (1 / 2 + dilateV) * inFFTHeader["CDELT2"],
-                        UV[1, i] + (1 / 2 + dilateV) * inFFTHeader["CDELT2"],
-                    )
-                )
-
-            # Combine U and V selection into final selection
-            indexTot = np.intersect1d(indexU, indexV)
-
-            if qrtdebug:
-                caracal.log.info("\t\t{0:d} rows found".format(indexTot.shape[0]))
-                if indexTot.shape[0]:
-                    caracal.log.info("\t\tSelected rows have uv in the following ranges")
-                    caracal.log.info("\t\tu: {0:.3f} - {1:.3f}".format(np.nanmin(uv[indexTot, 0]), np.nanmax(uv[indexTot, 0])))
-                    caracal.log.info("\t\tv: {0:.3f} - {1:.3f}".format(np.nanmin(uv[indexTot, 1]), np.nanmax(uv[indexTot, 1])))
-
-            # Add to stripe flags of this scan
-            flags[indexTot, :, :] = True
-            percent += float(len(indexTot)) / float(flags.shape[0]) * 100.0
+        flags = self.matchCellRows(uv, UV, inFFTHeader["CDELT2"], dilateU, dilateV, qrtdebug=qrtdebug)
+        percent = np.count_nonzero(flags) / float(flags.shape[0]) * 100.0 if flags.shape[0] else 0.0
 
         # Save modified flags to MS of this scan
-        t.putcol("FLAG", t.getcol("FLAG") + flags)
-        t.close()
+        with _tableLock:
+            self.addRowFlags(t, flags, undo=undo)
+            t.close()
         caracal.log.info("Flag scan done")
         return flags, percent
 
-    def putFlags(self, pipeline, pf_inVis, pf_inVisName, pf_stripeFlags):
-        caracal.log.info("Opening full MS file to add stripe flags")
-        t = tables.table(pf_inVis, readonly=False, ack=False)
-        flagOld = t.getcol("FLAG")
-        percTotBefore = np.nansum(flagOld) / float(flagOld.shape[0] * flagOld.shape[1] * flagOld.shape[2]) * 100.0
-        caracal.log.info("Total Flags Before: {percent:.3f} %".format(percent=percTotBefore))
-        flagNew = np.sum([pf_stripeFlags, flagOld], axis=0)
-        percTotAfter = np.nansum(flagNew) / float(flagNew.shape[0] * flagNew.shape[1] * flagNew.shape[2]) * 100.0
-        caracal.log.info("Total Flags After: {percent:.3f} %".format(percent=percTotAfter))
-        t.putcol("FLAG", flagNew)
-        del flagOld
-        del flagNew
+    def putFlags(self, pipeline, pf_inVis, pf_inVisName, pf_stripeFlags, applied=False):
+        """Adds the stripe flags to an MS, and saves flag version 'stripe_flag_after'. If applied is True, the flags
+        were already written to this MS through its scan tables, and only the flag version is saved."""
+        if applied:
+            t = tables.table(pf_inVis, ack=False)
+            caracal.log.info("Total Flags After: {percent:.3f} %".format(percent=self.getFlagPercent(t)))
+        else:
+            caracal.log.info("Opening full MS file to add stripe flags")
+            t = tables.table(pf_inVis, readonly=False, ack=False)
+            percTotBefore, percTotAfter = self.addRowFlags(t, pf_stripeFlags)
+            caracal.log.info("Total Flags Before: {percent:.3f} %".format(percent=percTotBefore))
+            caracal.log.info("Total Flags After: {percent:.3f} %".format(percent=percTotAfter))
         gc.collect()
         t.close()
         caracal.log.info("MS flagged")
@@ -809,6 +787,155 @@ class UzeroFlagger:
 
         return 0
 
+    def rewindScan(self, visAddress, undo):
+        """Restores the flags of a scan table saved in undo by addRowFlags"""
+        if not undo:
+            return
+        with _tableLock:
+            t = tables.table(visAddress, readonly=False, ack=False)
+            self.restoreRowFlags(t, undo)
+            t.close()
+
+    def processScan(self, pipeline, scan, visName, visAddress, galaxy, mfsOb, track, method, thresholds, dilateU, dilateV, makePlots, threads=0):
+        """Images, FFTs and stripe-flags a single scan table, trying all thresholds and keeping the one that minimises
+        the image noise. Returns a dict of the results needed to merge the scan flags and plot the scan. Scans are
+        independent of one another, so this can be called concurrently for different scans. The FFTs of the scan
+        images (preFFT and postFFT) are only returned if makePlots."""
+        caracal.log.info("----------------------------------------------------")
+        caracal.log.info("\tWorking on scan {}".format(str(scan)))
+        caracal.log.info("----------------------------------------------------")
+
+        # Original flags of the rows flagged so far, to rewind the scan to its initial flags between thresholds
+        undo = []
+
+        caracal.log.info("Imaging scan for stripe analysis")
+        outCubePrefix_0 = galaxy + track + "_scan" + str(scan)
+        outCubeName_0 = self.config["flag_u_zeros"]["stripeCubeDir"] + outCubePrefix_0 + "-dirty.fits"
+        if os.path.exists(outCubeName_0):
+            os.remove(outCubeName_0)
+        self.makeCube(pipeline, os.path.dirname(visAddress), visName, outCubePrefix_0, threads=threads)
+
+        caracal.log.info("Making FFT of image")
+
+        inFFTData, inFFTHeader = self.makeFFT(outCubeName_0)
+
+        U = (np.linspace(1, inFFTData.shape[1], inFFTData.shape[1]) - inFFTHeader["CRPIX1"]) * inFFTHeader["CDELT1"] + inFFTHeader["CRVAL1"]
+        V = (np.linspace(1, inFFTData.shape[1], inFFTData.shape[1]) - inFFTHeader["CRPIX2"] - 1) * inFFTHeader["CDELT2"] + inFFTHeader["CRVAL2"]
+
+        el = 0
+        az = 0
+
+        outCubePrefix = galaxy + track + "_scan" + str(scan) + "_stripeFlag"
+        outCubeName = self.config["flag_u_zeros"]["stripeCubeDir"] + outCubePrefix + "-dirty.fits"
+
+        rms_thresh = []
+
+        if len(thresholds) > 1:
+            caracal.log.info("Start iterating over all requested thresholds {} to find the optimal one".format(thresholds))
+        # iterate over all thresholds
+        for threshold in thresholds:
+            if len(thresholds) > 1:
+                caracal.log.info("New iter")
+            # Rewind flags of this scan to their initial state
+            self.rewindScan(visAddress, undo)
+
+            caracal.log.info("Computing statistics on FFT and flagging scan for threshold {0}".format(threshold))
+            # scanFlags below are the stripe flags for this scan
+            statsArray, scanFlags, percent, cutoff_scan = self.saveFFTTable(
+                inFFTData,
+                inFFTHeader,
+                visAddress,
+                np.flip(U),
+                V,
+                galaxy,
+                mfsOb,
+                track,
+                scan,
+                el,
+                az,
+                method,
+                threshold,
+                dilateU,
+                dilateV,
+                makePlots,
+                undo=undo,
+            )
+            caracal.log.info("Scan flags from stripe-flagging: {percent:.3f}%".format(percent=percent))
+            caracal.log.info("Making post-flagging image")
+
+            if os.path.exists(outCubeName):
+                os.remove(outCubeName)
+            self.makeCube(pipeline, os.path.dirname(visAddress), visName, outCubePrefix, threads=threads)
+            fitsdata = fits.open(outCubeName)
+            rms_thresh.append(np.std(fitsdata[0].data[0, 0]))
+            caracal.log.info("Image noise = {0:.3e} Jy/beam".format(rms_thresh[-1]))
+            fitsdata.close()
+
+        # Select best threshold (minimum noise), re-flag and re-image
+        if len(thresholds) > 1:
+            caracal.log.info("Done iterating over all requested thresholds")
+            threshold = thresholds[rms_thresh.index(min(rms_thresh))]
+            caracal.log.info("\tThe threshold that minimises the image noise is {}".format(threshold))
+            caracal.log.info("Repeating flagging and imaging steps with the selected threshold(yes, the must be a better way...)")
+            # Rewind flags of this scan to their initial state
+            self.rewindScan(visAddress, undo)
+            # Re-flag with selected threshold
+            caracal.log.info("Computing statistics on FFT and flagging scan for threshold {0}".format(threshold))
+            statsArray, scanFlags, percent, cutoff_scan = self.saveFFTTable(
+                inFFTData,
+                inFFTHeader,
+                visAddress,
+                np.flip(U),
+                V,
+                galaxy,
+                mfsOb,
+                track,
+                scan,
+                el,
+                az,
+                method,
+                threshold,
+                dilateU,
+                dilateV,
+                makePlots,
+                undo=undo,
+            )
+            caracal.log.info("Scan flags from stripe-flagging: {percent:.3f}%".format(percent=percent))
+            # Re-image
+            caracal.log.info("Making post-flagging image")
+            if os.path.exists(outCubeName):
+                os.remove(outCubeName)
+            self.makeCube(pipeline, os.path.dirname(visAddress), visName, outCubePrefix, threads=threads)
+
+        result = dict(statsArray=statsArray, scanFlags=scanFlags, percent=percent, cutoff=cutoff_scan, preCube=outCubeName_0, postCube=outCubeName)
+        # the FFTs are only needed for the plots, and are left out otherwise, so that the results of many scans can
+        # wait to be merged without holding on to them
+        if makePlots:
+            caracal.log.info("Making FFT of post-flagging image")
+            result.update(preFFT=(inFFTData, inFFTHeader), postFFT=self.makeFFT(outCubeName))
+        return result
+
+    def processScans(self, processScan, scanNums, scanRows, nrows, nParallel, plotScan=None):
+        """Runs processScan(kk) for each scan scanNums[kk], nParallel at a time, and merges the results in scan order as
+        they come in, so that only the results of scans that finished early are kept waiting. Returns the stats array
+        of all scans, the per-row stripe flags of the full MS and the stripe flag percentage of each scan.
+        plotScan(kk, result), if given, is called with each result as it is merged."""
+        arr = np.empty((0, 7))
+        # the per-row stripeFlags array of the full MS, to which scans are added one by one
+        stripeFlags = np.zeros(nrows, bool)
+        percTotAv = []
+        with ThreadPoolExecutor(nParallel) if nParallel > 1 else nullcontext() as pool:
+            scanResults = (pool.map if pool is not None else map)(processScan, range(len(scanNums)))
+            for kk, result in enumerate(scanResults):
+                # Save stats for the selected threshold
+                arr = np.vstack((arr, result["statsArray"]))
+                percTotAv.append(result["percent"])
+                # Add the stripe flags of this scan to the stripe flags of the full MS
+                stripeFlags[scanRows[scanNums[kk]]] = result["scanFlags"]
+                if plotScan is not None:
+                    plotScan(kk, result)
+        return arr, stripeFlags, percTotAv
+
     def run_flagUzeros(self, pipeline, targets, msname):
         method = self.config["flag_u_zeros"]["method"]
         makePlots = self.config["flag_u_zeros"]["make_plots"]
@@ -885,8 +1012,8 @@ class UzeroFlagger:
             caracal.log.info("\tWorking on {} ".format(inVisName))
             caracal.log.info("====================================================")
 
-            if os.path.exists(inVis + ".flagversions"):
-                fvers = [ii.split(" :")[0] for ii in open(inVis + ".flagversions/FLAG_VERSION_LIST").readlines()]
+            fvers = [name for name, comment in flagversions.list_versions(inVis)]
+            if fvers:
                 if "stripe_flag_before" in fvers:
                     caracal.log.info("Before we start, restore existing flag version 'stripe_flag_before'")
                     self.restoreFlags(pipeline, inVisName, msdir=pipeline.msdir, flagname="stripe_flag_before")
@@ -908,14 +1035,14 @@ class UzeroFlagger:
             # For the first lw, do all that follows
             caracal.log.info("Opening full MS file")
             t = tables.table(inVis, readonly=True, ack=False)
-            scans = t.getcol("SCAN_NUMBER")
-            FlagTot = t.getcol("FLAG")
-            scanNums = np.unique(scans)
+            scanRows = self.scanRows(t)
+            nrows = t.nrows()
+            percTot = self.getFlagPercent(t)
+            scanNums = list(scanRows)
             spw = tables.table(inVis + "/SPECTRAL_WINDOW", ack=False)
             spw.close()
             t.close()
 
-            percTot = np.nansum(FlagTot) / float(FlagTot.shape[0] * FlagTot.shape[1] * FlagTot.shape[2]) * 100.0
             caracal.log.info("Flagged visibilites so far: {percTot:.3f} %".format(percTot=percTot))
 
             anttab = tables.table(inVis + "::ANTENNA", ack=False)
@@ -980,11 +1107,10 @@ class UzeroFlagger:
 
             caracal.log.info("----------------------------------------------------")
 
-            caracal.log.info("Splitting scans".format())
+            caracal.log.info("Selecting scans".format())
 
-            scanVisList, scanVisNames = self.splitScans(pipeline, pipeline.msdir, inVis, scanNums)
+            scanVisList, scanVisNames = self.makeScanTables(inVis, scanRows)
 
-            arr = np.empty((0, 7))
             NS = len(scanNums)
             if makePlots:
                 fig1 = plt.figure(figsize=(8, 21.73227), constrained_layout=False)
@@ -995,178 +1121,74 @@ class UzeroFlagger:
                 gs1 = gridspec.GridSpec(nrows=NS, ncols=2, figure=fig1, hspace=0, wspace=0.0)
                 gs2 = gridspec.GridSpec(nrows=NS, ncols=2, figure=fig2, hspace=0, wspace=0.0)
 
-            # Initialising the stripeFlags array, to which scans will be added one by one
-            stripeFlags = np.empty(((0), FlagTot.shape[1], FlagTot.shape[2]))
-            percTotAv = []
-
-            del FlagTot
-            gc.collect()
+            nParallel = max(min(self.config["flag_u_zeros"]["nscans_parallel"], len(scanNums)), 1)
+            threads = self.config["flag_u_zeros"]["wsclean_threads"]
+            if nParallel > 1 and not threads:
+                # share the CPUs of the line worker among the concurrent wsclean runs
+                threads = max((self.config["ncpu"] or psutil.cpu_count()) // nParallel, 1)
+
+            def _processScan(kk):
+                return self.processScan(
+                    pipeline,
+                    scanNums[kk],
+                    scanVisNames[kk],
+                    scanVisList[kk],
+                    galaxy,
+                    mfsOb,
+                    track,
+                    method,
+                    thresholds,
+                    dilateU,
+                    dilateV,
+                    makePlots,
+                    threads=threads,
+                )
 
-            for kk in range(len(scanNums)):
+            def _plotScan(kk, result):
+                nonlocal fig1, fig2, comvmax_scan
                 scan = scanNums[kk]
-                caracal.log.info("----------------------------------------------------")
-                caracal.log.info("\tWorking on scan {}".format(str(scan)))
-                visName = scanVisNames[kk]
-                visAddress = scanVisList[kk]
-                caracal.log.info("----------------------------------------------------")
-
-                # Save flag version before start iterating over all thresholds
-                self.saveFlags(pipeline, visName, msdir=self.config["flag_u_zeros"]["stripeMSDir"], flagname="scan_flags_start")
-
-                caracal.log.info("Imaging scan for stripe analysis")
-                outCubePrefix_0 = galaxy + track + "_scan" + str(scan)
-                outCubeName_0 = self.config["flag_u_zeros"]["stripeCubeDir"] + outCubePrefix_0 + "-dirty.fits"
-                if os.path.exists(outCubeName_0):
-                    os.remove(outCubeName_0)
-                self.makeCube(pipeline, self.config["flag_u_zeros"]["stripeMSDir"], visName, outCubePrefix_0)
-
-                caracal.log.info("Making FFT of image")
-
-                inFFTData, inFFTHeader = self.makeFFT(outCubeName_0)
-
-                U = (np.linspace(1, inFFTData.shape[1], inFFTData.shape[1]) - inFFTHeader["CRPIX1"]) * inFFTHeader["CDELT1"] + inFFTHeader["CRVAL1"]
-                V = (np.linspace(1, inFFTData.shape[1], inFFTData.shape[1]) - inFFTHeader["CRPIX2"] - 1) * inFFTHeader["CDELT2"] + inFFTHeader["CRVAL2"]
-
-                el = 0
-                az = 0
-
-                outCubePrefix = galaxy + track + "_scan" + str(scan) + "_stripeFlag"
-                outCubeName = self.config["flag_u_zeros"]["stripeCubeDir"] + outCubePrefix + "-dirty.fits"
-
-                rms_thresh = []
-
-                if len(thresholds) > 1:
-                    caracal.log.info("Start iterating over all requested thresholds {} to find the optimal one".format(thresholds))
-                # iterate over all thresholds
-                for threshold in thresholds:
-                    if len(thresholds) > 1:
-                        caracal.log.info("New iter")
-                    # Rewind flags of this scan to their initial state
-                    fvers = [ii.split(" :")[0] for ii in open(visAddress + ".flagversions/FLAG_VERSION_LIST").readlines()]
-                    self.restoreFlags(pipeline, visName, msdir=self.config["flag_u_zeros"]["stripeMSDir"], flagname="scan_flags_start")
-
-                    while fvers[-1] != "scan_flags_start":
-                        self.deleteFlags(pipeline, visName, msdir=self.config["flag_u_zeros"]["stripeMSDir"], flagname=fvers[-1])
-                        fvers = fvers[:-1]
-
-                    caracal.log.info("Computing statistics on FFT and flagging scan for threshold {0}".format(threshold))
-                    # scanFlags below are the stripe flags for this scan
-                    statsArray, scanFlags, percent, cutoff_scan = self.saveFFTTable(
-                        inFFTData,
-                        inFFTHeader,
-                        visAddress,
-                        np.flip(U),
-                        V,
-                        galaxy,
-                        mfsOb,
-                        track,
-                        scan,
-                        el,
-                        az,
-                        method,
-                        threshold,
-                        dilateU,
-                        dilateV,
-                        makePlots,
-                    )
-                    caracal.log.info("Scan flags from stripe-flagging: {percent:.3f}%".format(percent=percent))
-                    caracal.log.info("Making post-flagging image")
-
-                    if os.path.exists(outCubeName):
-                        os.remove(outCubeName)
-                    self.makeCube(pipeline, self.config["flag_u_zeros"]["stripeMSDir"], visName, outCubePrefix)
-                    fitsdata = fits.open(outCubeName)
-                    rms_thresh.append(np.std(fitsdata[0].data[0, 0]))
-                    caracal.log.info("Image noise = {0:.3e} Jy/beam".format(rms_thresh[-1]))
-                    fitsdata.close()
-
-                # Select best threshold (minimum noise), re-flag and re-image
-                if len(thresholds) > 1:
-                    caracal.log.info("Done iterating over all requested thresholds")
-                    threshold = thresholds[rms_thresh.index(min(rms_thresh))]
-                    caracal.log.info("\tThe threshold that minimises the image noise is {}".format(threshold))
-                    caracal.log.info("Repeating flagging and imaging steps with the selected threshold(yes, the must be a better way...)")
-                    # Rewind flags of this scan to their initial state
-                    fvers = [ii.split(" :")[0] for ii in open(visAddress + ".flagversions/FLAG_VERSION_LIST").readlines()]
-                    self.restoreFlags(pipeline, visName, msdir=self.config["flag_u_zeros"]["stripeMSDir"], flagname="scan_flags_start")
-
-                    while fvers[-1] != "scan_flags_start":
-                        self.deleteFlags(pipeline, visName, msdir=self.config["flag_u_zeros"]["stripeMSDir"], flagname=fvers[-1])
-
-                        fvers = fvers[:-1]
-                    # Re-flag with selected threshold
-                    caracal.log.info("Computing statistics on FFT and flagging scan for threshold {0}".format(threshold))
-                    statsArray, scanFlags, percent, cutoff_scan = self.saveFFTTable(
-                        inFFTData,
-                        inFFTHeader,
-                        visAddress,
-                        np.flip(U),
-                        V,
-                        galaxy,
-                        mfsOb,
-                        track,
-                        scan,
-                        el,
-                        az,
-                        method,
-                        threshold,
-                        dilateU,
-                        dilateV,
-                        makePlots,
-                    )
-                    caracal.log.info("Scan flags from stripe-flagging: {percent:.3f}%".format(percent=percent))
-                    # Re-image
-                    caracal.log.info("Making post-flagging image")
-                    if os.path.exists(outCubeName):
-                        os.remove(outCubeName)
-                    self.makeCube(pipeline, self.config["flag_u_zeros"]["stripeMSDir"], visName, outCubePrefix)
-
-                # Save stats for the selected threshold
-                arr = np.vstack((arr, statsArray))
-                percTotAv.append(percent)
-
-                # Add the stripe flags of this scan to the stripe flags of all the scans done previously
-                stripeFlags = np.concatenate([stripeFlags, scanFlags])
-
-                if makePlots:
-                    fig1, comvmax_scan = self.plotAll(
-                        fig1,
-                        gs1,
-                        NS,
-                        kk,
-                        outCubeName_0,
-                        inFFTData,
-                        inFFTHeader,
-                        galaxy,
-                        track,
-                        scan,
-                        None,
-                        comvmax_scan,
-                        cutoff_scan,
-                        type=None,
-                    )
+                inFFTData, inFFTHeader = result["preFFT"]
+                fig1, comvmax_scan = self.plotAll(
+                    fig1,
+                    gs1,
+                    NS,
+                    kk,
+                    result["preCube"],
+                    inFFTData,
+                    inFFTHeader,
+                    galaxy,
+                    track,
+                    scan,
+                    None,
+                    comvmax_scan,
+                    result["cutoff"],
+                    type=None,
+                )
 
-                caracal.log.info("Making FFT of post-flagging image")
+                inFFTData, inFFTHeader = result["postFFT"]
+                fig2, comvmax_scan = self.plotAll(
+                    fig2,
+                    gs2,
+                    NS,
+                    kk,
+                    result["postCube"],
+                    inFFTData,
+                    inFFTHeader,
+                    galaxy,
+                    track,
+                    scan,
+                    result["percent"],
+                    comvmax_scan,
+                    0,
+                    type="postFlag",
+                )
 
-                inFFTData, inFFTHeader = self.makeFFT(outCubeName)
+            if nParallel > 1:
+                caracal.log.info("Processing {0:d} scans, {1:d} at a time, with {2:d} wsclean thread(s) each".format(len(scanNums), nParallel, threads))
+            arr, stripeFlags, percTotAv = self.processScans(_processScan, scanNums, scanRows, nrows, nParallel, plotScan=_plotScan if makePlots else None)
 
-                if makePlots:
-                    fig2, comvmax_scan = self.plotAll(
-                        fig2,
-                        gs2,
-                        NS,
-                        kk,
-                        outCubeName,
-                        inFFTData,
-                        inFFTHeader,
-                        galaxy,
-                        track,
-                        scan,
-                        percent,
-                        comvmax_scan,
-                        0,
-                        type="postFlag",
-                    )
+            # The stripe flags are in the full MS already, so the scan tables are no longer needed
+            remove_output_products(scanVisList)
 
             if makePlots:
                 caracal.log.info("----------------------------------------------------")
@@ -1191,7 +1213,7 @@ class UzeroFlagger:
                 caracal.log.info("====================================================")
                 caracal.log.info("\tWorking on {}".format(inVisName))
                 caracal.log.info("====================================================")
-                self.putFlags(pipeline, inVis, inVisName, stripeFlags)
+                self.putFlags(pipeline, inVis, inVisName, stripeFlags, applied=True)
                 caracal.log.info("Making post-flagging image")
 
                 outCubePrefix = galaxy + track + "_tot_stripeFlag"
@@ -1205,12 +1227,9 @@ class UzeroFlagger:
 
                 inFFTData, inFFTHeader = self.makeFFT(outCubeName)
 
-                U = (np.linspace(1, inFFTData.shape[1], inFFTData.shape[1]) - inFFTHeader["CRPIX1"]) * inFFTHeader["CDELT1"] + inFFTHeader["CRVAL1"]
-                V = (np.linspace(1, inFFTData.shape[1], inFFTData.shape[1]) - inFFTHeader["CRPIX2"] - 1) * inFFTHeader["CDELT2"] + inFFTHeader["CRVAL2"]
-
                 caracal.log.info("Saving total stripe flagging diagnostic plots".format())
 
-                percTotAfter = np.nansum(stripeFlags) / float(stripeFlags.shape[0] * stripeFlags.shape[1] * stripeFlags.shape[2]) * 100.0
+                percTotAfter = np.count_nonzero(stripeFlags) / float(stripeFlags.shape[0]) * 100.0
                 caracal.log.info("Total stripe flags: {percent:.3f} %".format(percent=percTotAfter))
                 caracal.log.info("----------------------------------------------------")
 
@@ -1246,4 +1265,11 @@ class UzeroFlagger:
         if doCleanUp is True:
             self.cleanUp(galaxy)
 
+        # ru_maxrss is in kB on Linux
+        caracal.log.info(
+            "Peak memory: {chunk:.1f} MB in FLAG chunks, {rss:.1f} MB process total".format(
+                chunk=self.peakChunkBytes / 2.0**20, rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2.0**10
+            )
+        )
+
         return timeFlag
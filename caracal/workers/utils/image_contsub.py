@@ -1,8 +1,13 @@
 #! /usr/bin/env python
 
 import argparse
+import math
+import os
+import shutil
 import sys
+import tempfile
 import textwrap
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
 import numpy as np
@@ -10,11 +15,29 @@ import numpy as np
 version = "1.0.2"
 
 
+# Rough number of bytes held in memory per voxel of a chunk (input, mask, fit and temporaries of the fit or
+# convolution), used to turn the chunksize into a number of rows or channels
+BYTES_PER_VOXEL = 64
+# Number of pixels that tiles of the out-of-core fit are aligned to (see imcontsub_chunked)
+TILE_ALIGN = 64
+
+
 def printime(string):
     now = datetime.now().strftime("%H:%M:%S")
     print("{} {}".format(now, string))
 
 
+def make_kernel(kertyp, kersiz):
+    """Returns the 1D kernel to spatially convolve the continuum cube with"""
+    import scipy.signal as scipy_signal
+
+    if kertyp == "gauss":
+        return scipy_signal.windows.gaussian(int(10.0 * kersiz / np.sqrt(np.log(256.0))) // 2 * 2 + 1, kersiz / np.sqrt(np.log(256.0)))
+    klength = int(10.0 * kersiz) // 2 * 2 + 1
+    coordinates = np.arange(klength, dtype=int) - int(klength) // 2
+    return np.fabs(coordinates) < (kersiz // 2 + 1)
+
+
 def imcontsub(
     incubus,
     outcubus=None,
@@ -28,6 +51,9 @@ def imcontsub(
     fitted=None,
     confit=None,
     clobber=False,
+    chunksize=0,
+    nworkers=1,
+    polymask="channel",
 ):
     """Continuum subtraction in a fits data cube
 
@@ -48,6 +74,13 @@ def imcontsub(
         confit (str): Name of fitted and convolved continuum cube (optional
             output)
         clobber (bool): Overwrite output if set
+        chunksize (float): If > 0, process the cube out of core, in chunks
+            of about this size (MB), rather than loading it into memory
+        nworkers (int): Number of processes working on chunks in parallel
+            (only if chunksize > 0)
+        polymask (str): Masking of the polynomial fit: 'channel' excludes
+            channels masked in any pixel from the fits of all pixels,
+            'pixel' fits each pixel to its own unmasked channels
 
     Returns:
         None
@@ -79,13 +112,42 @@ def imcontsub(
     optionally supply the name of the output fitted data cube and with
     the parameter confit the user specifies the name of the fitted and
     convolved output data cube. The parameter clobber determines
-    whether the output will be overwritten (if True).
+    whether the output will be overwritten (if True). If chunksize is
+    set, the cubes are memory-mapped rather than read, the fit is done
+    on spatial tiles, and the convolution and subtraction on spectral
+    chunks, which are streamed to the output cubes. The results are
+    identical to those of the in-memory processing. With polymask =
+    'pixel', pixels sharing the same mask are fitted together with a
+    single pseudo-inverse, and the remaining pixels with a batched
+    solution of their normal equations (see batched_polyfit).
     """
 
     import astropy.io.fits as astropy_io_fits
     import scipy
     import scipy.signal as scipy_signal
 
+    if polymask not in ("channel", "pixel"):
+        raise ValueError("polymask must be 'channel' or 'pixel', not '{}'".format(polymask))
+
+    if chunksize:
+        return imcontsub_chunked(
+            incubus,
+            outcubus=outcubus,
+            fitmode=fitmode,
+            length=length,
+            polyorder=polyorder,
+            mask=mask,
+            sgiters=sgiters,
+            kertyp=kertyp,
+            kersiz=kersiz,
+            fitted=fitted,
+            confit=confit,
+            clobber=clobber,
+            chunksize=chunksize,
+            nworkers=nworkers,
+            polymask=polymask,
+        )
+
     # Read cube
     begin = datetime.now()
     print("")
@@ -135,11 +197,17 @@ def imcontsub(
         incubus_data_flat = incubus_data_masked.reshape((incubus_data.shape[0], incubus_data.shape[1] * incubus_data.shape[2]))
         x = np.ma.masked_array(np.arange(incubus_data.shape[0]), False)
 
-        printime("Fitting polynomial of order {}".format(polyorder))
-        fitpars = np.array(np.flip(np.ma.polyfit(x, incubus_data_flat, polyorder)))
+        if polymask == "pixel":
+            printime("Fitting polynomial of order {} to each pixel".format(polyorder))
+            fit = batched_polyfit(np.ma.getdata(incubus_data_flat), np.ma.getmaskarray(incubus_data_flat), polyorder).reshape(incubus_data.shape)
+        else:
+            printime("Fitting polynomial of order {}".format(polyorder))
+            fitpars = np.array(np.flip(np.ma.polyfit(x, incubus_data_flat, polyorder)))
 
-        printime("Creating continuum cube")
-        fit = np.flip(np.polynomial.polynomial.polyval(np.flip(np.array(x), 0), fitpars).transpose()).reshape((incubus_data.shape[0], incubus_data.shape[1], incubus_data.shape[2]))
+            printime("Creating continuum cube")
+            fit = np.flip(np.polynomial.polynomial.polyval(np.flip(np.array(x), 0), fitpars).transpose()).reshape(
+                (incubus_data.shape[0], incubus_data.shape[1], incubus_data.shape[2])
+            )
         # Make sure that the fit cube can be convolved
         if np.nanmax(incubus_data) > 0.0:
             maxincube = np.nanmax(incubus_data) * 10.0
@@ -207,13 +275,7 @@ def imcontsub(
 
     if kersiz > 0:
         printime("Spatially convolving continuum cube")
-        if kertyp == "gauss":
-            kernel = scipy_signal.gaussian(int(10.0 * kersiz / np.sqrt(np.log(256.0))) // 2 * 2 + 1, kersiz / np.sqrt(np.log(256.0)))
-        else:
-            klength = int(10.0 * kersiz) // 2 * 2 + 1
-            coordinates = np.arange(klength, dtype=int) - int(klength) // 2
-            kernel = np.fabs(coordinates) < (kersiz // 2 + 1)
-
+        kernel = make_kernel(kertyp, kersiz)
         kernel = np.outer(kernel, kernel).reshape((1, kernel.size, kernel.size))
         kernel = np.repeat(kernel, fit.shape[0], axis=0)
         fitmask = np.isnan(fit)
@@ -250,6 +312,331 @@ def imcontsub(
     print("")
 
 
+def batched_polyfit(data, mask, polyorder, min_group=16):
+    """Fits a polynomial to each column of data, ignoring masked values, and returns the fitted values
+
+    Parameters:
+        data (ndarray): (nchan, npix) spectra
+        mask (ndarray): (nchan, npix) boolean mask, True where excluded
+        polyorder (int): Polynomial order
+        min_group (int): Minimum number of pixels sharing a mask to be
+            fitted with a common pseudo-inverse
+
+    Returns:
+        ndarray: (nchan, npix) fitted spectra
+
+    Pixels are grouped by mask pattern. Each group of at least
+    min_group pixels is fitted with a single matrix product with the
+    pseudo-inverse of its Vandermonde matrix. The remaining pixels are
+    fitted together by solving their weighted normal equations as a
+    batch. Both give least-squares solutions (minimum-norm ones where a
+    pixel has too few unmasked channels).
+    """
+    nchan, npix = data.shape
+    # Vandermonde matrix on [-1, 1], for a well-conditioned fit
+    t = np.linspace(-1.0, 1.0, nchan) if nchan > 1 else np.zeros(1)
+    vander = np.polynomial.polynomial.polyvander(t, polyorder)
+    values = np.where(mask, 0.0, data)
+    coeffs = np.zeros((polyorder + 1, npix))
+
+    # group pixels by mask pattern
+    packed = np.ascontiguousarray(np.packbits(mask, axis=0).T)
+    keys = packed.view(np.dtype((np.void, packed.shape[1]))).ravel()
+    _, group, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    group = group.ravel()
+    large = counts[group] >= min_group
+
+    # the pixels of each group, from a single sort of the group ids
+    order = np.argsort(group, kind="stable")
+    for pixels in np.split(order, np.cumsum(counts)[:-1]):
+        if len(pixels) < min_group:
+            continue
+        valid = np.where(~mask[:, pixels[0]])[0]
+        coeffs[:, pixels] = np.linalg.pinv(vander[valid]) @ values[np.ix_(valid, pixels)]
+
+    pixels = np.where(~large)[0]
+    if len(pixels):
+        weights = (~mask[:, pixels]).astype(float)
+        normal = np.einsum("cp,ci,cj->pij", weights, vander, vander)
+        rhs = np.einsum("cp,ci,cp->pi", weights, vander, values[:, pixels])
+        coeffs[:, pixels] = np.einsum("pij,pj->ip", np.linalg.pinv(normal), rhs)
+
+    return vander @ coeffs
+
+
+def _open_cube(cube):
+    """Returns (hdulist, 3D data) of a cube given as file name (memory-mapped) or HDUList"""
+    import astropy.io.fits as astropy_io_fits
+
+    hdul = astropy_io_fits.open(cube, memmap=True) if isinstance(cube, str) else cube
+    data = hdul[0].data
+    if len(data.shape) == 4:
+        data = data[0, :]
+    return hdul, data
+
+
+def _close_cube(cube, hdul):
+    if isinstance(cube, str):
+        hdul.close()
+
+
+def _fit_spectra(data, mask, fitmode, length, polyorder, sgiters, polymask, chanmask, minmax):
+    """Fits the spectra of a (nchan, ny, nx) block of the cube, exactly as imcontsub does for the whole cube.
+    chanmask selects the channels excluded from the polynomial fit, and minmax gives the limits of the
+    polynomial fit, both of which depend on the whole cube."""
+    import scipy
+    import scipy.signal as scipy_signal
+
+    if fitmode == "poly":
+        flat = data.reshape((data.shape[0], data.shape[1] * data.shape[2]))
+        if polymask == "pixel":
+            pixmask = np.isnan(flat)
+            if mask is not None:
+                pixmask = (mask.reshape(flat.shape) > 0) + pixmask
+            fit = batched_polyfit(flat, pixmask, polyorder).reshape(data.shape)
+        else:
+            x = np.arange(data.shape[0])
+            not_m = ~chanmask
+            fitpars = np.array(np.flip(np.polyfit(x[not_m], flat[not_m], polyorder)))
+            fit = np.flip(np.polynomial.polynomial.polyval(np.flip(x, 0), fitpars).transpose()).reshape(data.shape)
+        minincube, maxincube = minmax
+        fit[fit > maxincube] = maxincube
+        fit[fit < minincube] = minincube
+        fit[np.logical_not(np.isfinite(fit))] = 0.0
+    elif fitmode == "median" and length:
+        fit = scipy.ndimage.median_filter(data, (length, 1, 1))
+    elif fitmode == "savgol" and length:
+        sgmask = np.isnan(data)
+        if mask is not None:
+            sgmask = (mask > 0) + sgmask
+        sgincubus = data.copy()
+        sgincubus[sgmask] = 0.0
+        if sgiters > 0:
+            fit = scipy.ndimage.median_filter(sgincubus, (length, 1, 1))
+            for i in range(sgiters):
+                fit = scipy_signal.savgol_filter(fit, length, polyorder, axis=0, mode="interp")
+        else:
+            fit = scipy_signal.savgol_filter(sgincubus, length, polyorder, axis=0, mode="interp")
+    else:
+        # no filtering, nothing is subtracted
+        fit = np.zeros(data.shape, data.dtype)
+    return fit
+
+
+def _fit_tile(incubus, mask, store, y0, y1, fitpars):
+    """Fits rows y0:y1 of the cube, and writes the fit to the store (a .npy file)"""
+    hdul, data = _open_cube(incubus)
+    mask_data = None
+    if mask is not None:
+        hdul_mask, mask_data = _open_cube(mask)
+        mask_data = np.array(mask_data[:, y0:y1])
+        _close_cube(mask, hdul_mask)
+    fit = _fit_spectra(np.array(data[:, y0:y1]), mask_data, **fitpars)
+    _close_cube(incubus, hdul)
+    fit_store = np.load(store, mmap_mode="r+")
+    fit_store[:, y0:y1] = fit
+    fit_store.flush()
+    del fit_store
+
+
+def _create_output(filename, header, shape, clobber):
+    """Creates a float32 FITS cube of the given shape with the given header, without writing its data. Returns the
+    offset of the data in the file."""
+    import astropy.io.fits as astropy_io_fits
+
+    hdu = astropy_io_fits.PrimaryHDU(data=np.zeros((1,) * len(shape), dtype="float32"), header=header.copy())
+    for i, size in enumerate(reversed(shape)):
+        hdu.header["NAXIS{}".format(i + 1)] = size
+    # reserve the cards, so that they can be updated in place at the end
+    hdu.header["DATAMAX"] = 0.0
+    hdu.header["DATAMIN"] = 0.0
+    hdu.header.tofile(filename, overwrite=clobber)
+    offset = os.path.getsize(filename)
+    nbytes = int(np.prod(shape)) * 4
+    with open(filename, "rb+") as stdw:
+        stdw.seek(offset + (nbytes + 2879) // 2880 * 2880 - 1)
+        stdw.write(b"\0")
+    return offset
+
+
+def _subtract_chunk(incubus, store, outputs, c0, c1, kernel):
+    """Convolves the fit of channels c0:c1 and subtracts it from the cube. outputs maps 'fitted', 'confit' and
+    'outcubus' to (filename, data offset, shape) of the output cubes, or None. Returns the maximum of each
+    output chunk."""
+    import scipy.signal as scipy_signal
+
+    fit = np.array(np.load(store, mmap_mode="r")[c0:c1])
+    maxima = {}
+
+    def _write(name, values):
+        filename, offset, shape = outputs[name]
+        out = np.memmap(filename, dtype=">f4", mode="r+", offset=offset, shape=shape)
+        out = out.reshape((shape[-3],) + shape[-2:])
+        out[c0:c1] = values.astype("float32")
+        out.flush()
+        with np.errstate(invalid="ignore"):
+            maxima[name] = np.fmax.reduce(values.astype("float32"), axis=None)
+        del out
+
+    if outputs["fitted"]:
+        _write("fitted", fit)
+
+    if kernel is not None:
+        kernel = np.repeat(kernel, fit.shape[0], axis=0)
+        fitmask = np.isnan(fit)
+        fit[fitmask] = 0.0
+        convolved = scipy_signal.fftconvolve(fit, kernel, mode="same", axes=(1, 2)) / kernel[0].sum()
+        convolved[fitmask] = np.nan
+    else:
+        convolved = fit
+
+    if outputs["confit"]:
+        _write("confit", convolved)
+
+    if outputs["outcubus"]:
+        hdul, data = _open_cube(incubus)
+        _write("outcubus", data[c0:c1] - convolved)
+        _close_cube(incubus, hdul)
+    return maxima
+
+
+def imcontsub_chunked(
+    incubus,
+    outcubus=None,
+    fitmode="median",
+    length=0,
+    polyorder=None,
+    mask=None,
+    sgiters=0,
+    kertyp="gauss",
+    kersiz=0,
+    fitted=None,
+    confit=None,
+    clobber=False,
+    chunksize=1024,
+    nworkers=1,
+    polymask="channel",
+):
+    """Out-of-core continuum subtraction, with the same parameters and results as imcontsub
+
+    The input and mask cubes are memory-mapped. Spectra are fitted in
+    spatial tiles (blocks of rows), which are written to a temporary
+    store next to the output. The fit is then convolved and subtracted
+    in spectral chunks (blocks of channels), which are streamed to the
+    output cubes. Each stage holds about chunksize MB per worker, and
+    tiles and chunks are spread over nworkers processes. Cubes given
+    as HDUList rather than file name are processed in this process.
+    """
+    import astropy.io.fits as astropy_io_fits
+
+    begin = datetime.now()
+    print("")
+    print("Welcome to image_contsub.py")
+
+    hdul_incubus, incubus_data = _open_cube(incubus)
+    header = hdul_incubus[0].header
+    shape = hdul_incubus[0].data.shape
+    nchan, ny, nx = incubus_data.shape
+    if not (isinstance(incubus, str) and (mask is None or isinstance(mask, str))):
+        nworkers = 1
+
+    if fitmode == "poly" and isinstance(polyorder, type(None)):
+        polyorder = length
+    if fitmode == "savgol" and isinstance(polyorder, type(None)):
+        polyorder = 0
+
+    budget = chunksize * 2.0**20 / BYTES_PER_VOXEL
+    # The least-squares fits (polynomials, and the edges of the Savitzky-Golay filter) are done for many pixels at
+    # once, and LAPACK may round the last few pixels of a block differently. Tiles are therefore made a multiple of
+    # TILE_ALIGN pixels, so that every pixel is treated exactly as in a fit to the whole cube.
+    row_step = TILE_ALIGN // math.gcd(nx, TILE_ALIGN)
+    tile_rows = int(min(max(budget // (nchan * nx * row_step), 1) * row_step, ny))
+    chunk_chans = int(min(max(budget // (ny * nx), 1), nchan))
+    printime("Processing cube in tiles of {} rows, and chunks of {} channels, with {} process(es)".format(tile_rows, chunk_chans, nworkers))
+
+    # The polynomial fit excludes channels that are masked anywhere, and is limited by the range of the cube
+    chanmask = np.zeros(nchan, bool)
+    minmax = (0.0, 0.0)
+    if fitmode == "poly":
+        printime("Reading cube statistics")
+        if mask is not None:
+            hdul_mask, mask_data = _open_cube(mask)
+        datamax, datamin = np.nan, np.nan
+        for c0 in range(0, nchan, chunk_chans):
+            chunk = np.array(incubus_data[c0 : c0 + chunk_chans])
+            chunkmask = np.isnan(chunk)
+            if mask is not None:
+                chunkmask = (np.array(mask_data[c0 : c0 + chunk_chans]) > 0) + chunkmask
+            chanmask[c0 : c0 + chunk_chans] = chunkmask.reshape((chunk.shape[0], -1)).any(axis=1)
+            with np.errstate(invalid="ignore"):
+                datamax = np.fmax(datamax, np.fmax.reduce(chunk, axis=None))
+                datamin = np.fmin(datamin, np.fmin.reduce(chunk, axis=None))
+        if mask is not None:
+            _close_cube(mask, hdul_mask)
+        maxincube = datamax * 10.0 if datamax > 0.0 else 0
+        minincube = datamin * 10.0 if datamin < 0.0 else 0.0
+        minmax = (minincube, maxincube)
+    fitpars = dict(fitmode=fitmode, length=length, polyorder=polyorder, sgiters=sgiters, polymask=polymask, chanmask=chanmask, minmax=minmax)
+
+    # the fit is stored next to the first output requested, or else next to the input cube
+    outdir = os.path.dirname(os.path.abspath(next((name for name in (outcubus, fitted, confit) if name is not None), incubus)))
+    tmpdir = tempfile.mkdtemp(prefix="imcontsub-", dir=outdir)
+    try:
+        # the type of the fit depends on the mode and the input, so fit a single row to find out
+        fit_dtype = _fit_spectra(np.array(incubus_data[:, :1, :1]), None, **fitpars).dtype
+        store = os.path.join(tmpdir, "fit.npy")
+        np.lib.format.open_memmap(store, mode="w+", dtype=fit_dtype, shape=(nchan, ny, nx)).flush()
+
+        outputs = dict(fitted=None, confit=None, outcubus=None)
+        for name, filename in ("fitted", fitted), ("confit", confit), ("outcubus", outcubus):
+            if filename is not None:
+                outputs[name] = (filename, _create_output(filename, header, shape, clobber), shape)
+
+        executor = ProcessPoolExecutor(nworkers) if nworkers > 1 else None
+        try:
+            printime("Fitting spectra ({})".format(fitmode))
+            tiles = [(y0, min(y0 + tile_rows, ny)) for y0 in range(0, ny, tile_rows)]
+            args = [(incubus, mask, store, y0, y1, fitpars) for y0, y1 in tiles]
+            if executor:
+                list(executor.map(_fit_tile, *zip(*args)))
+            else:
+                for arg in args:
+                    _fit_tile(*arg)
+
+            kernel = None
+            if kersiz > 0:
+                printime("Spatially convolving continuum cube")
+                kernel = make_kernel(kertyp, kersiz)
+                kernel = np.outer(kernel, kernel).reshape((1, kernel.size, kernel.size))
+
+            printime("Subtracting continuum.")
+            chunks = [(c0, min(c0 + chunk_chans, nchan)) for c0 in range(0, nchan, chunk_chans)]
+            args = [(incubus, store, outputs, c0, c1, kernel) for c0, c1 in chunks]
+            if executor:
+                results = list(executor.map(_subtract_chunk, *zip(*args)))
+            else:
+                results = [_subtract_chunk(*arg) for arg in args]
+        finally:
+            if executor:
+                executor.shutdown()
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    # DATAMIN is set to the maximum, as in imcontsub
+    for name, output in outputs.items():
+        if output is None:
+            continue
+        datamax = np.fmax.reduce([result[name] for result in results])
+        with astropy_io_fits.open(output[0], mode="update", memmap=True) as hdul:
+            hdul[0].header["DATAMAX"] = datamax
+            hdul[0].header["DATAMIN"] = datamax
+
+    _close_cube(incubus, hdul_incubus)
+    now = datetime.now()
+    printime("Time elapsed: {:.1f} minutes".format((now - begin).total_seconds() / 60.0))
+    print("")
+
+
 def description():
     """
     Verbose description of the module
@@ -282,7 +669,10 @@ def description():
         "optionally supply the name of the output fitted data cube and with"
         "the parameter confit the user specifies the name of the fitted and"
         "convolved output data cube. The parameter clobber determines"
-        "whether the output will be overwritten (if True)."
+        "whether the output will be overwritten (if True). With the parameter "
+        "polymask set to 'pixel' each pixel is fitted to its own unmasked "
+        "channels, rather than excluding channels that are masked in any "
+        "pixel from all fits."
     )
 
 
@@ -319,6 +709,13 @@ def parsing():
     parser.add_argument("--fitted", help="Name of fitted continuum cube (optinal output)", type=str)
     parser.add_argument("--confit", help="Name of fitted and convolved continuum cube (optional output)", type=str)
     parser.add_argument("--clobber", "-c", help="overwrite output if set", default=False, action="store_true")
+    parser.add_argument("--chunksize", help="Process the cube out of core, in chunks of about this size (MB)", type=str)
+    parser.add_argument("--nworkers", "-n", help="Number of processes working on chunks in parallel (with --chunksize)", type=str)
+    parser.add_argument(
+        "--polymask",
+        help="Masking of the polynomial fit: 'channel' excludes channels masked in any pixel, 'pixel' fits each pixel to its own unmasked channels",
+        type=str,
+    )
 
     whatnot = parser.parse_args()
     inpars = vars(whatnot)
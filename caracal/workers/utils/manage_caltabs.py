@@ -0,0 +1,227 @@
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import psutil
+from casacore.tables import table
+
+from caracal import log
+
+# solution columns, of shape (nchan, ncorr) per row, with the value that stands in for missing solutions
+COLUMNS = {"CPARAM": 1 + 0j, "FPARAM": 0.0, "PARAMERR": 0.0, "FLAG": True, "SNR": 0.0}
+# antennas read at a time by CalTable.apply()
+ANTENNA_CHUNK = 8
+
+
+class CalTable(object):
+    def __init__(self, path, readonly=True):
+        """
+        Solutions of a caltable, as (slot, antenna, channel, correlation) cubes per SPW. A slot is a solution
+        time of a field. Solutions that the table does not have read as flagged.
+
+        Cubes are read and written for a subset of antennas at a time (see apply()), so that large tables need not
+        be held in memory at once.
+
+        Args:
+        @path: caltable path
+        @readonly: open the table read-only
+        """
+        self.path = path
+        self._table = table(path, readonly=readonly, ack=False)
+        # casacore does not let threads access a table concurrently
+        self._lock = threading.Lock()
+        t = self._table
+        self.param = "CPARAM" if "CPARAM" in t.colnames() else "FPARAM"
+        self.columns = [col for col in COLUMNS if col in t.colnames()]
+        spws, fields, times = t.getcol("SPECTRAL_WINDOW_ID"), t.getcol("FIELD_ID"), t.getcol("TIME")
+        self._antenna = t.getcol("ANTENNA1")
+        scans = t.getcol("SCAN_NUMBER")
+        self.nant = int(self._antenna.max()) + 1 if t.nrows() else 0
+        self.spws = np.unique(spws)
+        # per SPW: rows, and their slot indices; and the time, field and scan of each slot
+        self._rows, self._slot, self.times, self.fields, self.scans = {}, {}, {}, {}, {}
+        for spw in self.spws:
+            rows = np.nonzero(spws == spw)[0]
+            slots, first, inverse = np.unique(np.stack([times[rows], fields[rows]], axis=1), axis=0, return_index=True, return_inverse=True)
+            self._rows[spw], self._slot[spw] = rows, inverse.ravel()
+            self.times[spw], self.fields[spw] = slots[:, 0], slots[:, 1].astype(int)
+            self.scans[spw] = scans[rows][first]
+
+    def close(self):
+        self._table.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _select(self, spw, antennas):
+        rows, slots = self._rows[spw], self._slot[spw]
+        ants = self._antenna[rows]
+        if antennas is not None:
+            sel = np.isin(ants, antennas)
+            rows, slots, ants = rows[sel], slots[sel], ants[sel]
+        antennas = np.arange(self.nant) if antennas is None else np.asarray(antennas)
+        return rows, slots, np.searchsorted(antennas, ants), len(antennas)
+
+    def read(self, col, spw=None, antennas=None):
+        """Returns a column of an SPW (by default, the first), as a (slot, antenna, channel, correlation) cube of the
+        given antennas (a sorted list of IDs, by default all)"""
+        spw = self.spws[0] if spw is None else spw
+        rows, slots, ants, nant = self._select(spw, antennas)
+        with self._lock:
+            values = self._table.selectrows(rows).getcol(col) if len(rows) else np.zeros((0, 0, 0))
+        cube = np.full((len(self.times[spw]), nant) + values.shape[1:], COLUMNS.get(col, 0), dtype=values.dtype)
+        cube[slots, ants] = values
+        return cube
+
+    def write(self, col, cube, spw=None, antennas=None):
+        """Writes a cube, as returned by read(), back to the solutions that the table has"""
+        spw = self.spws[0] if spw is None else spw
+        rows, slots, ants, nant = self._select(spw, antennas)
+        if len(rows):
+            with self._lock:
+                self._table.selectrows(rows).putcol(col, cube[slots, ants])
+
+    def apply(self, function, columns, nthreads=0, chunk=ANTENNA_CHUNK):
+        """
+        Calls function(**cubes) on cubes of the given columns, chunk antennas at a time, in up to nthreads threads
+        (0: one per CPU). The function returns a dict of the cubes to write back.
+        """
+
+        def _process(args):
+            spw, antennas = args
+            cubes = {col.lower(): self.read(col, spw, antennas) for col in columns}
+            for col, cube in function(**cubes).items():
+                self.write(col.upper(), cube, spw, antennas)
+
+        tasks = [(spw, list(range(lo, min(lo + chunk, self.nant)))) for spw in self.spws for lo in range(0, self.nant, chunk)]
+        nthreads = min(nthreads or psutil.cpu_count() or 1, len(tasks))
+        if nthreads > 1:
+            with ThreadPoolExecutor(nthreads) as pool:
+                list(pool.map(_process, tasks))
+        else:
+            list(map(_process, tasks))
+
+
+def _window_sums(values, window):
+    """Sums of values over running windows of window channels (centred, and truncated at the band edges)"""
+    nchan = values.shape[-2]
+    csum = np.concatenate([np.zeros_like(values[..., :1, :]), np.cumsum(values, axis=-2)], axis=-2)
+    chans = np.arange(nchan)
+    lo, hi = np.clip(chans - window // 2, 0, nchan), np.clip(chans - window // 2 + window, 0, nchan)
+    return csum[..., hi, :] - csum[..., lo, :]
+
+
+def smooth(values, flags, window, mode="mean"):
+    """
+    Smooths solutions (..., channel, correlation) along the channel axis with a running mean or median of window
+    channels. Flagged channels are left out of the windows, and keep their values. Returns the smoothed values.
+    """
+    good = ~flags
+    if mode == "mean":
+        counts = _window_sums(good.astype(float), window)
+        sums = _window_sums(np.where(good, values, 0), window)
+        smoothed = sums / np.maximum(counts, 1)
+    elif mode == "median":
+        pad = [(0, 0)] * (values.ndim - 2) + [(window // 2, window - 1 - window // 2), (0, 0)]
+
+        def _median(part):
+            windows = np.lib.stride_tricks.sliding_window_view(np.pad(np.where(good, part, np.nan), pad, constant_values=np.nan), window, axis=-2)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                return np.nanmedian(windows, axis=-1)
+
+        smoothed = _median(values.real) + 1j * _median(values.imag) if np.iscomplexobj(values) else _median(values)
+    else:
+        raise ValueError(f"unknown smoothing mode '{mode}'")
+    return np.where(good, smoothed, values).astype(values.dtype)
+
+
+def interpolate(values, flags, maxgap=None):
+    """
+    Fills flagged channels of solutions (..., channel, correlation) by linear interpolation between the unflagged
+    channels either side: in amplitude and phase for complex solutions. Only gaps of up to maxgap channels (if
+    given) with unflagged channels on both sides are filled. Returns the new values and flags.
+    """
+    nchan = values.shape[-2]
+    good = ~flags
+    chans = np.arange(nchan).reshape(nchan, 1)
+    # the unflagged channels either side of each channel (-1 or nchan if there are none)
+    last = np.maximum.accumulate(np.where(good, chans, -1), axis=-2)
+    nxt = np.flip(np.minimum.accumulate(np.flip(np.where(good, chans, nchan), axis=-2), axis=-2), axis=-2)
+    fill = ~good & (last >= 0) & (nxt < nchan)
+    if maxgap is not None:
+        fill &= nxt - last - 1 <= maxgap
+    lo, hi = np.clip(last, 0, nchan - 1), np.clip(nxt, 0, nchan - 1)
+    weight = (chans - lo) / np.maximum(hi - lo, 1)
+
+    def _interp(part):
+        return np.where(fill, np.take_along_axis(part, lo, -2) * (1 - weight) + np.take_along_axis(part, hi, -2) * weight, part)
+
+    if np.iscomplexobj(values):
+        # phases are unwrapped along the unflagged channels (flagged channels hold the last unflagged phase)
+        phase = np.unwrap(np.take_along_axis(np.angle(values), lo, -2), axis=-2)
+        filled = _interp(np.abs(values)) * np.exp(1j * _interp(phase))
+    else:
+        filled = _interp(values)
+    return np.where(fill, filled, values).astype(values.dtype), flags & ~fill
+
+
+def clip_outliers(values, flags, nsigma=5.0, window=None):
+    """
+    Flags solutions (..., channel, correlation) that deviate from the running median of window channels (or from
+    the median over the band, if no window is given) by more than nsigma times the robust (MAD-based) scatter of
+    their solution. Returns the new flags.
+    """
+    good = ~flags
+    with warnings.catch_warnings():
+        # solutions that are fully flagged have no median
+        warnings.simplefilter("ignore", RuntimeWarning)
+        if window:
+            model = smooth(values, flags, window, mode="median")
+        else:
+            masked = np.where(good, values, np.nan)
+            model = np.nanmedian(masked.real, axis=-2, keepdims=True)
+            if np.iscomplexobj(values):
+                model = model + 1j * np.nanmedian(masked.imag, axis=-2, keepdims=True)
+        resid = np.abs(values - model)
+        sigma = 1.4826 * np.nanmedian(np.where(good, resid, np.nan), axis=-2, keepdims=True)
+    return flags | (good & (resid > nsigma * np.nan_to_num(sigma, nan=np.inf)))
+
+
+def smooth_table(path, window, mode="mean", nthreads=0):
+    """Smooths the solutions of a caltable in place (see smooth())"""
+    with CalTable(path, readonly=False) as ct:
+        param = ct.param
+
+        def _smooth(**cubes):
+            return {param: smooth(cubes[param.lower()], cubes["flag"], window, mode)}
+
+        ct.apply(_smooth, [param, "FLAG"], nthreads=nthreads)
+    log.info(f"Smoothed {path} with a {mode} window of {window} channels")
+
+
+def interpolate_table(path, maxgap=None, nthreads=0):
+    """Fills flagged channels of the solutions of a caltable in place (see interpolate())"""
+    with CalTable(path, readonly=False) as ct:
+        param = ct.param
+
+        def _interpolate(**cubes):
+            values, flags = interpolate(cubes[param.lower()], cubes["flag"], maxgap)
+            return {param: values, "FLAG": flags}
+
+        ct.apply(_interpolate, [param, "FLAG"], nthreads=nthreads)
+
+
+def clip_table(path, nsigma=5.0, window=None, nthreads=0):
+    """Flags outlying solutions of a caltable in place (see clip_outliers())"""
+    with CalTable(path, readonly=False) as ct:
+        param = ct.param
+
+        def _clip(**cubes):
+            return {"FLAG": clip_outliers(cubes[param.lower()], cubes["flag"], nsigma, window)}
+
+        ct.apply(_clip, [param, "FLAG"], nthreads=nthreads)
@@ -1,6 +1,7 @@
 import os
 
 from caracal import log
+from caracal.dispatch_crew import flagversions
 
 
 def conflict(conflict_type, pipeline, wname, ms, config, flags_bw, flags_aw, read_version="version"):
@@ -76,15 +77,7 @@ def conflict(conflict_type, pipeline, wname, ms, config, flags_bw, flags_aw, rea
 
 
 def get_flags(pipeline, ms):
-    flaglist_file = "{folder:s}/{ms:s}.flagversions/FLAG_VERSION_LIST".format(folder=pipeline.msdir, ms=ms)
-    flaglist = []
-    if not os.path.exists(flaglist_file):
-        return []
-    with open(flaglist_file) as stdr:
-        for line in stdr.readlines():
-            flag = line.split()[0]
-            flaglist.append(flag)
-    return flaglist
+    return [name for name, comment in flagversions.list_versions(os.path.join(pipeline.msdir, ms))]
 
 
 def delete_cflags(pipeline, recipe, flagname, ms, cab_name="rando_cab", label=""):
@@ -99,12 +92,11 @@ def delete_cflags(pipeline, recipe, flagname, ms, cab_name="rando_cab", label=""
 
     for i, flag in enumerate(remove_us):
         recipe.add(
-            "cab/casa_flagmanager",
+            flagversions.delete,
             "{0:s}_{1:d}".format(cab_name, i),
             {
-                "vis": ms,
-                "mode": "delete",
-                "versionname": flag,
+                "ms": os.path.join(pipeline.msdir, ms),
+                "name": flag,
             },
             input=pipeline.input,
             output=pipeline.output,
@@ -115,44 +107,33 @@ def delete_cflags(pipeline, recipe, flagname, ms, cab_name="rando_cab", label=""
 def restore_cflags(pipeline, recipe, flagname, ms, cab_name="rando_cab", label="", merge=False):
     if flagname in get_flags(pipeline, ms):
         recipe.add(
-            "cab/casa_flagmanager",
+            flagversions.restore,
             cab_name,
             {
-                "vis": ms,
-                "mode": "restore",
-                "versionname": flagname,
-                "merge": "replace",
+                "ms": os.path.join(pipeline.msdir, ms),
+                "name": flagname,
             },
             input=pipeline.input,
             output=pipeline.output,
             label="{0:s}:: Restoring flags to flag version [{1:s}]".format(label or cab_name, flagname),
         )
     else:
-        log.warn("Flag version [{0:s}] could not be found".format(flagname))
+        log.warning("Flag version [{0:s}] could not be found".format(flagname))
 
 
-def add_cflags(pipeline, recipe, flagname, ms, cab_name="rando_cab", label="", overwrite=False):
-    if flagname in get_flags(pipeline, ms) and overwrite:
-        recipe.add(
-            "cab/casa_flagmanager",
-            cab_name.replace("save", "delete"),
-            {
-                "vis": ms,
-                "mode": "delete",
-                "versionname": flagname,
-            },
-            input=pipeline.input,
-            output=pipeline.output,
-            label="{0:s}:: Delete flag version".format(label or cab_name.replace("save", "delete")),
-        )
-
+def add_cflags(pipeline, recipe, flagname, ms, cab_name="rando_cab", label="", overwrite=False, nproc=1):
+    """
+    Saves the current flags of an MS as a flag version. An existing version of the same name is replaced.
+    ms may also be a list of MSs, which are then saved in a single step using up to nproc processes.
+    """
+    mslist = [ms] if isinstance(ms, str) else ms
     recipe.add(
-        "cab/casa_flagmanager",
+        flagversions.save_all,
         cab_name,
         {
-            "vis": ms,
-            "mode": "save",
-            "versionname": flagname,
+            "mslist": [os.path.join(pipeline.msdir, msname) for msname in mslist],
+            "nproc": nproc,
+            "name": flagname,
         },
         input=pipeline.input,
         output=pipeline.output,
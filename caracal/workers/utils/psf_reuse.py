@@ -0,0 +1,123 @@
+import glob
+import json
+import os
+import re
+
+import casacore.tables as tables
+import stimela
+
+from caracal.dispatch_crew import step_cache
+
+# wsclean options that determine the PSF: the image geometry, the gridder and the weighting and uv-selection
+PSF_OPTIONS = (
+    "weight",
+    "npix",
+    "padding",
+    "scale",
+    "pol",
+    "channelsout",
+    "channelrange",
+    "joinchannels",
+    "nomfsweighting",
+    "maxuv-l",
+    "taper-tukey",
+    "taper-gaussian",
+    "minuvw-m",
+    "nwlayers-factor",
+    "use-wgridder",
+)
+# MS columns that the PSF is computed from. Any change to the data manager files holding them rules out reuse.
+MS_COLUMNS = ("UVW", "FLAG", "FLAG_ROW", "WEIGHT", "WEIGHT_SPECTRUM", "SIGMA", "SIGMA_SPECTRUM", "DATA_DESC_ID", "FIELD_ID")
+# the wsclean option that reads the PSF from a previous run
+REUSE_OPTION = "reuse-psf"
+
+
+def columns_fingerprint(msname, columns=MS_COLUMNS):
+    """
+    Returns a fingerprint of some columns of an MS: its number of rows, and the [name, size, mtime_ns] of the data
+    manager files that hold each column (None for missing columns). Unlike the fingerprint of the whole MS,
+    this is unaffected by writes to other columns, e.g. the calibrated data.
+    """
+    with tables.table(msname, ack=False) as tb:
+        nrows, names = tb.nrows(), set(tb.colnames())
+        seqnrs = {col: tb.getdminfo(col)["SEQNR"] for col in columns if col in names}
+    files = sorted(os.listdir(msname))
+    result = {"nrows": nrows}
+    for col in columns:
+        if col not in seqnrs:
+            result[col] = None
+            continue
+        pattern = re.compile(r"table\.f{}(i|_.*)?$".format(seqnrs[col]))
+        result[col] = [[name] + step_cache.fingerprint(os.path.join(msname, name))[0][1:] for name in files if pattern.match(name)]
+    return result
+
+
+def signature(image_opts, msnames):
+    """Returns the PSF signature of a wsclean run: its PSF_OPTIONS, and the MSs (paths on the host) and the
+    fingerprints of their MS_COLUMNS"""
+    sig = {
+        "options": {opt: image_opts.get(opt) for opt in PSF_OPTIONS},
+        "ms": [[os.path.abspath(ms), columns_fingerprint(ms)] for ms in msnames],
+    }
+    # compare as it reads back from JSON
+    return json.loads(json.dumps(sig))
+
+
+def psf_products(prefix):
+    """Returns the PSF images made by a wsclean run with prefix (a path on the host)"""
+    return sorted(glob.glob(glob.escape(prefix) + "-psf.fits") + glob.glob(glob.escape(prefix) + "-*-psf.fits"))
+
+
+def _record_file(outdir, prefix):
+    return os.path.join(outdir, f"{prefix}-psf.json")
+
+
+def forget(outdir, prefix):
+    """Removes the record of the wsclean run with prefix (relative to outdir), ahead of a new run with that prefix"""
+    if os.path.exists(_record_file(outdir, prefix)):
+        os.remove(_record_file(outdir, prefix))
+
+
+def record(outdir, prefix, sig, psf_prefix=None):
+    """
+    Records the PSF signature of a completed wsclean run with prefix (relative to outdir), along with the
+    fingerprints of its PSF images, or of those of psf_prefix, if the run reused them
+    """
+    psf_prefix = psf_prefix or prefix
+    products = psf_products(os.path.join(outdir, psf_prefix))
+    if not products:
+        return
+    entry = {
+        "signature": sig,
+        "psf_prefix": psf_prefix,
+        "products": {os.path.basename(path): step_cache.fingerprint(path) for path in products},
+    }
+    with open(_record_file(outdir, prefix), "w") as stdw:
+        json.dump(entry, stdw)
+
+
+def reusable_psf(outdir, prefix, sig):
+    """
+    Returns the prefix (relative to outdir) of the PSF images that a wsclean run with signature sig can reuse from
+    the run with prefix, or None. They are reusable only if that run was recorded with the same signature, and its
+    PSF images are all still there, unchanged.
+    """
+    try:
+        with open(_record_file(outdir, prefix)) as stdr:
+            entry = json.load(stdr)
+    except (OSError, ValueError):
+        return None
+    if entry["signature"] != sig:
+        return None
+    products = psf_products(os.path.join(outdir, entry["psf_prefix"]))
+    if not products or sorted(entry["products"]) != [os.path.basename(path) for path in products]:
+        return None
+    if any(step_cache.fingerprint(path) != entry["products"][os.path.basename(path)] for path in products):
+        return None
+    return entry["psf_prefix"]
+
+
+def cab_supports(option, cab="wsclean"):
+    """Returns True if the stimela cab accepts the option"""
+    with open(os.path.join(stimela.CAB_PATH, cab, "parameters.json")) as stdr:
+        return option in {param["name"] for param in json.load(stdr)["parameters"]}
@@ -0,0 +1,128 @@
+import hashlib
+import os
+import threading
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from caracal import log
+
+# rows of the target grid mapped at a time
+CHUNK_ROWS = 256
+# celestial header keywords of the target grid, which replace those of the mask
+_SKY_KEYWORDS = ("NAXIS1", "NAXIS2", "CTYPE1", "CTYPE2", "CRVAL1", "CRVAL2", "CRPIX1", "CRPIX2", "CDELT1", "CDELT2", "CUNIT1", "CUNIT2")
+# keywords of the mask that no longer apply once it is regridded
+_DROPPED_KEYWORDS = ("CROTA1", "CROTA2", "PC1_1", "PC1_2", "PC2_1", "PC2_2", "CD1_1", "CD1_2", "CD2_1", "CD2_2", "BSCALE", "BZERO", "BLANK")
+
+# process-wide cache: mapping key -> mapping
+_CACHE = {}
+_CACHE_LOCK = threading.Lock()
+
+
+def sky_header(npix_x, npix_y, ra, dec, cell, crpix_x, crpix_y):
+    """Returns the header of a SIN-projected grid of npix_x by npix_y pixels of cell deg, centred on ra, dec (deg) at
+    pixel crpix_x, crpix_y"""
+    header = fits.Header()
+    header.update(
+        NAXIS=2,
+        NAXIS1=npix_x,
+        NAXIS2=npix_y,
+        CTYPE1="RA---SIN",
+        CTYPE2="DEC--SIN",
+        CRVAL1=ra,
+        CRVAL2=dec,
+        CRPIX1=crpix_x,
+        CRPIX2=crpix_y,
+        CDELT1=-cell,
+        CDELT2=cell,
+        CUNIT1="deg",
+        CUNIT2="deg",
+        EQUINOX=2000.0,
+    )
+    return header
+
+
+def _sky(header):
+    """Returns the celestial WCS and shape (ny, nx) of a header"""
+    return WCS(header).celestial, (int(header["NAXIS2"]), int(header["NAXIS1"]))
+
+
+def _key(source, target):
+    """Returns a key identifying the pixel mapping between the celestial grids of two headers"""
+    text = ""
+    for header in (source, target):
+        wcs, shape = _sky(header)
+        text += f"{wcs.to_header_string(relax=True)}{shape}"
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def compute_mapping(source, target):
+    """
+    Returns, for every pixel of the target grid (header target), the index of the nearest pixel of the flattened
+    (y, x) plane of the source grid (header source), or -1 where the target pixel falls outside the source grid
+    """
+    src_wcs, (src_ny, src_nx) = _sky(source)
+    tgt_wcs, (tgt_ny, tgt_nx) = _sky(target)
+    mapping = np.full((tgt_ny, tgt_nx), -1, dtype=np.int64 if src_ny * src_nx >= 2**31 else np.int32)
+    x = np.arange(tgt_nx)
+    for row0 in range(0, tgt_ny, CHUNK_ROWS):
+        yy, xx = np.meshgrid(np.arange(row0, min(row0 + CHUNK_ROWS, tgt_ny)), x, indexing="ij")
+        with np.errstate(invalid="ignore"):
+            ra, dec = tgt_wcs.all_pix2world(xx, yy, 0)
+            sx, sy = src_wcs.all_world2pix(ra, dec, 0)
+        sx, sy = np.round(np.nan_to_num(sx, nan=-1)), np.round(np.nan_to_num(sy, nan=-1))
+        inside = (sx >= 0) & (sx < src_nx) & (sy >= 0) & (sy < src_ny)
+        mapping[row0 : row0 + CHUNK_ROWS][inside] = (sy[inside] * src_nx + sx[inside]).astype(mapping.dtype)
+    return mapping
+
+
+def get_mapping(source, target, cachedir=None):
+    """
+    Returns the pixel mapping from the grid of header source to that of header target (see compute_mapping()),
+    computing it only once per pair of grids. Mappings are also saved in cachedir (if given), so that later runs
+    reuse them.
+    """
+    key = _key(source, target)
+    with _CACHE_LOCK:
+        mapping = _CACHE.get(key)
+    if mapping is not None:
+        return mapping
+    cachefile = os.path.join(cachedir, f"regrid-{key}.npy") if cachedir else None
+    if cachefile and os.path.exists(cachefile):
+        mapping = np.load(cachefile)
+    else:
+        mapping = compute_mapping(source, target)
+        if cachefile:
+            os.makedirs(cachedir, exist_ok=True)
+            np.save(cachefile, mapping)
+    with _CACHE_LOCK:
+        _CACHE[key] = mapping
+    return mapping
+
+
+def reproject_mask(infile, outfile, target, cachedir=None):
+    """
+    Regrids a mask (2-D, or a cube, which is regridded per channel) onto the celestial grid of header target, by
+    nearest neighbour. Pixels > 0 are in the mask, and pixels outside the mask's grid are not. Any other axes
+    (e.g. frequency) keep those of the mask. The regridded mask is written to outfile as int16 (0 or 1).
+    """
+    with fits.open(infile, memmap=True) as hdul:
+        header, data = hdul[0].header.copy(), hdul[0].data
+        mapping = get_mapping(header, target, cachedir=cachedir)
+        valid = mapping >= 0
+        flat_mapping = np.where(valid, mapping, 0)
+        regridded = np.zeros(data.shape[:-2] + mapping.shape, dtype=np.int16)
+        for idx in np.ndindex(data.shape[:-2]):
+            plane = np.asarray(data[idx]).ravel()
+            with np.errstate(invalid="ignore"):
+                regridded[idx] = valid & (plane[flat_mapping] > 0)
+    if not regridded.any():
+        log.warning(f"The regridded mask {os.path.basename(outfile)} is empty. The mask {os.path.basename(infile)} likely has no overlap with the image")
+    for key in _DROPPED_KEYWORDS:
+        header.remove(key, ignore_missing=True)
+    for key in _SKY_KEYWORDS:
+        if key in target:
+            header[key] = target[key]
+    fits.PrimaryHDU(regridded, header).writeto(outfile, overwrite=True)
+    log.info(f"Regridded mask {os.path.basename(infile)} onto a {mapping.shape[1]}x{mapping.shape[0]} grid as {os.path.basename(outfile)}")
@@ -3,17 +3,23 @@ import itertools
 import os
 import shutil
 import sys
+import threading
 import traceback
+from contextlib import nullcontext
 from datetime import datetime
 
-import stimela
-
 import caracal
 from caracal import log, notebooks, pckgdir
 from caracal import utils as main_utils
-from caracal.dispatch_crew import utils
+from caracal.dispatch_crew import msinfo, profiler, utils
+from caracal.dispatch_crew.recipe import CaracalRecipe
+from caracal.dispatch_crew.scheduler import WorkerScheduler
+from caracal.dispatch_crew.step_cache import StepCache
+from caracal.dispatch_crew.warm_pool import WarmPool
 
 REPORTS = True
+# workers that set up pipeline-wide state, and always run first
+MANDATORY_WORKERS = "getdata", "obsconf"
 
 
 class WorkerAdministrator(object):
@@ -52,12 +58,17 @@ class WorkerAdministrator(object):
         self.cubes = f"{self.output}/cubes"
         self.mosaic_continuum = f"{self.continuum}/mosaics"
         self.mosaic_line = f"{self.cubes}/mosaics"
+        self.step_cache_dir = f"{self.output}/step_cache"
+        self.perf_dir = f"{self.output}/perf"
+        self.warm_pool_dir = f"{self.output}/warm_pool"
         self.generate_reports = generate_reports
         self.timeNow = "{:%Y%m%d-%H%M%S}".format(datetime.now())
         self.ms_extension = self.config["getdata"]["extension"]
         self.ignore_missing = self.config["getdata"]["ignore_missing"]
 
-        self._msinfo_cache = {}
+        # name of current worker is kept per-thread, since the scheduler can run workers concurrently
+        self._worker_context = threading.local()
+        self._report_lock = threading.Lock()
 
         self.logs_symlink = f"{self.output}/logs"
         self.logs = "{}-{}".format(self.logs_symlink, self.timeNow)
@@ -123,6 +134,12 @@ class WorkerAdministrator(object):
                 self.flags[_name] = ["_".join([_name, suffix]) if suffix else _name for suffix in wkr.FLAG_NAMES]
 
         self.recipes = {}
+        # persistent cache of completed steps, if enabled (set up in run_workers)
+        self.step_cache = None
+        # resource profiler, if enabled (set up in run_workers)
+        self.profiler = None
+        # pool of long-lived container instances, if enabled (set up in run_workers)
+        self.warm_pool = None
         # Workers to skip
         self.skip = []
         # Initialize empty lists for ddids, leave this up to getdata worker to define
@@ -154,6 +171,14 @@ class WorkerAdministrator(object):
         log.info(f"Saving full configuration as {outConfigName}")
         main_utils.write_yaml(self.config, outConfigName)  # config+command line
 
+    @property
+    def CURRENT_WORKER(self):
+        return getattr(self._worker_context, "name", None)
+
+    @CURRENT_WORKER.setter
+    def CURRENT_WORKER(self, name):
+        self._worker_context.name = name
+
     def init_names(self, dataids):
         """iniitalize names to be used throughout the pipeline and associated
         general fields that must be propagated
@@ -192,18 +217,12 @@ class WorkerAdministrator(object):
                 setattr(self, item, value)
 
     def get_msinfo(self, msname):
-        """Returns info dict corresponding to an MS. Caches and reloads as needed"""
+        """Returns the MSInfo (see dispatch_crew.msinfo) of an MS. This is indexed once, and reloaded if the MS summary changes"""
         msinfo_file = os.path.splitext(msname)[0] + "-summary.json"
         msinfo_path = os.path.join(self.msdir, msinfo_file)
-        msdict, mtime_cache = self._msinfo_cache.get(msname, (None, 0))
         if not os.path.exists(msinfo_path):
             raise RuntimeError(f"MS summary file {msinfo_file} not found at expected location. This is a bug or a misconfiguration. Was the MS transformed properly?")
-        # reload cached dict if file on disk is newer
-        mtime = os.path.getmtime(msinfo_path)
-        if msdict is None or mtime > mtime_cache:
-            msdict = main_utils.load_yaml(msinfo_path)
-            self._msinfo_cache[msname] = msdict, mtime
-        return msdict
+        return msinfo.load(msinfo_path)
 
     # The following three methods provide MS naming services for workers
 
@@ -382,6 +401,19 @@ class WorkerAdministrator(object):
                 traceback.print_exc()
                 raise ImportError('Worker "{0:s}" could not be found at {1:s}'.format(_worker, self.workers_directory))
 
+        if self.config["general"]["step_cache"]["enable"]:
+            log.info(f"Step cache enabled: unchanged steps that completed in a previous run will be skipped (see {self.step_cache_dir})")
+            self.step_cache = StepCache(self.step_cache_dir)
+        if self.config["general"]["profiling"]["enable"]:
+            self.profiler = profiler.Profiler(self.perf_dir, self.timeNow, interval=self.config["general"]["profiling"]["interval"])
+            profiler.set_profiler(self.profiler)
+        if self.config["general"]["warm_pool"]["enable"]:
+            if self.container_tech == "singularity":
+                log.info("Warm pool enabled: cabs will run in long-lived Singularity/Apptainer instances")
+                self.warm_pool = WarmPool(self.warm_pool_dir, max_instances=self.config["general"]["warm_pool"]["max_instances"])
+            else:
+                log.warning(f"Warm pool is only supported with Singularity/Apptainer, ignoring it for {self.container_tech}")
+
         if self.config["general"]["cabs"]:
             log.info("Configuring cab specification overrides")
             cabspecs_general = self.parse_cabspec_dict(self.config["general"]["cabs"])
@@ -410,60 +442,114 @@ class WorkerAdministrator(object):
             active_workers.append((_name, worker, config, cabspecs))
 
         # now run the actual pipeline
-        # for _name, _worker, i in self.workers:
-        for _name, worker, config, cabspecs in active_workers:
-            # Define stimela recipe instance for worker
-            # Also change logger name to avoid duplication of logging info
-            label = getattr(worker, "LABEL", None)
-            if label is None:
-                # if label is not set, take filename, and split off _worker.py
-                label = os.path.basename(worker.__file__).rsplit("_", 1)[0]
-            # if worker name has a __suffix, add that to label
-            if "__" in _name:
-                label += "__" + _name.split("__", 1)[1]
-
-            recipe = stimela.Recipe(
-                label,
-                ms_dir=self.msdir,
-                singularity_image_dir=self.singularity_image_dir,
-                log_dir=self.logs,
-                cabspecs=cabspecs,
-                logfile=False,  # no logfiles for recipes
-                logfile_task=f"{self.logs}/log-{label}-{{task}}-{self.timeNow}.txt",
-            )
+        scheduler_config = self.config["general"]["scheduler"]
+        try:
+            if scheduler_config["enable"]:
+                report_updated = self._run_workers_concurrently(active_workers, scheduler_config)
+            else:
+                for _name, worker, config, cabspecs in active_workers:
+                    report_updated = self._run_worker(_name, worker, config, cabspecs)
+        finally:
+            # the performance report is written for failed runs too, since these are often the interesting ones
+            if self.profiler is not None:
+                self.profiler.log_summary()
+                log.info(f"Performance report written to {self.profiler.write_report()}")
+                profiler.set_profiler(None)
+            if self.warm_pool is not None:
+                self.warm_pool.shutdown()
+                self.warm_pool = None
+
+        # generate final report
+        if self.config["general"]["final_report"] and self.generate_reports and not report_updated:
+            self.regenerate_reports()
 
-            recipe.JOB_TYPE = self.container_tech
-            self.CURRENT_WORKER = _name
-            # Don't allow pipeline-wide resume
-            # functionality
-            os.system("rm -f {}".format(recipe.resume_file))
-            # Get recipe steps
-            # 1st get correct section of config file
-            log_label = "" if _name == label or _name.startswith(label + "__") else f" ({label})"
-            log.info(f"{_name}{log_label}: initializing", extra=dict(color="GREEN"))
+        log.info("pipeline run complete")
+
+    def _run_worker(self, _name, worker, config, cabspecs):
+        """Runs a single worker. Returns True if the report was updated at the end of it"""
+        # Define stimela recipe instance for worker
+        # Also change logger name to avoid duplication of logging info
+        label = getattr(worker, "LABEL", None)
+        if label is None:
+            # if label is not set, take filename, and split off _worker.py
+            label = os.path.basename(worker.__file__).rsplit("_", 1)[0]
+        # if worker name has a __suffix, add that to label
+        if "__" in _name:
+            label += "__" + _name.split("__", 1)[1]
+
+        recipe = CaracalRecipe(
+            label,
+            step_cache=self.step_cache,
+            profiler=self.profiler,
+            warm_pool=self.warm_pool,
+            ms_dir=self.msdir,
+            singularity_image_dir=self.singularity_image_dir,
+            log_dir=self.logs,
+            cabspecs=cabspecs,
+            logfile=False,  # no logfiles for recipes
+            logfile_task=f"{self.logs}/log-{label}-{{task}}-{self.timeNow}.txt",
+        )
+
+        recipe.JOB_TYPE = self.container_tech
+        self.CURRENT_WORKER = _name
+        # Don't allow pipeline-wide resume
+        # functionality
+        os.system("rm -f {}".format(recipe.resume_file))
+        # Get recipe steps
+        # 1st get correct section of config file
+        log_label = "" if _name == label or _name.startswith(label + "__") else f" ({label})"
+        log.info(f"{_name}{log_label}: initializing", extra=dict(color="GREEN"))
+        with self.profiler.profile_worker(_name) if self.profiler is not None else nullcontext():
             worker.worker(self, recipe, config)
             log.info(f"{_name}{log_label}: running")
             recipe.run()
-            log.info(f"{_name}{log_label}: finished")
+        log.info(f"{_name}{log_label}: finished")
 
-            # this should be in the cab cleanup code, no?
+        # this should be in the cab cleanup code, no?
 
-            casa_last = glob.glob(self.output + "/*.last")
-            for file_ in casa_last:
+        casa_last = glob.glob(self.output + "/*.last")
+        for file_ in casa_last:
+            if os.path.exists(file_):
                 os.remove(file_)
 
-            # update report at end of worker if so configured
-            if self.generate_reports and config["report"]:
+        # update report at end of worker if so configured
+        if self.generate_reports and config["report"]:
+            with self._report_lock:
                 self.regenerate_reports()
-                report_updated = True
+            return True
+        return False
+
+    def _run_workers_concurrently(self, active_workers, scheduler_config):
+        """Runs workers via the dependency graph scheduler. Mandatory workers (getdata, obsconf) set up
+        pipeline-wide state, so they always run first, in order. Returns True if the report was updated
+        by the last worker to finish"""
+        scheduler = WorkerScheduler(
+            ncpu=scheduler_config["ncpu"],
+            mem_limit=scheduler_config["mem_limit"],
+            worker_ncpu=scheduler_config["worker_ncpu"],
+            worker_mem=scheduler_config["worker_mem"],
+        )
+        report_updated = False
+        for _name, worker, config, cabspecs in active_workers:
+            wtype = _name.split("__")[0]
+            if wtype in MANDATORY_WORKERS:
+                report_updated = self._run_worker(_name, worker, config, cabspecs)
             else:
-                report_updated = False
+                scheduler.add_worker(_name, wtype, config, payload=(worker, config, cabspecs))
 
-        # generate final report
-        if self.config["general"]["final_report"] and self.generate_reports and not report_updated:
-            self.regenerate_reports()
+        if not scheduler.nodes:
+            return report_updated
 
-        log.info("pipeline run complete")
+        log.info(f"Running {len(scheduler.nodes)} worker(s) concurrently using {scheduler.ncpu} CPU(s) and {scheduler.mem_limit:.1f} GB of memory:")
+        scheduler.log_graph()
+
+        def _runner(node):
+            nonlocal report_updated
+            worker, config, cabspecs = node.payload
+            report_updated = self._run_worker(node.name, worker, config, cabspecs)
+
+        scheduler.run(_runner)
+        return report_updated
 
     def regenerate_reports(self):
         notebooks.generate_report_notebooks(self._report_notebooks, self.output, self.prefix, self.container_tech)
@@ -0,0 +1,131 @@
+import os
+
+import casacore.tables as tables
+import numpy as np
+
+from caracal.workers.utils import band_parallel
+
+NCHAN, NANT, NPOL = 32, 3, 2
+FREQS = 1.4e9 + 1e5 * np.arange(NCHAN)
+TIMES = [5e9, 5e9 + 100.0]
+
+
+def _gains(ant, chans):
+    return (1 + 0.1 * ant) * np.exp(1j * 0.01 * chans)[:, None] * np.ones(NPOL)
+
+
+def _make_ms(path):
+    t = tables.default_ms(str(path))
+    t.addrows(2 * NANT)
+    t.putcol("ANTENNA1", np.tile(np.arange(NANT), 2))
+    t.putcol("ANTENNA2", np.tile((np.arange(NANT) + 1) % NANT, 2))
+    t.putcol("FIELD_ID", np.repeat([0, 1], NANT))
+    flag = np.zeros((2 * NANT, NCHAN, NPOL), bool)
+    # the third chunk is fully flagged on the bandpass calibrator, but not on the target
+    flag[:NANT, 16:24] = True
+    t.putcol("FLAG", flag)
+    t.close()
+    for subtable, nrow, cols in [
+        ("FIELD", 2, dict(NAME=["bpcal", "target"])),
+        ("ANTENNA", NANT, dict(NAME=[f"m00{ii}" for ii in range(NANT)])),
+        ("SPECTRAL_WINDOW", 1, dict(NUM_CHAN=[NCHAN], CHAN_FREQ=FREQS[None], TOTAL_BANDWIDTH=[1e5 * NCHAN])),
+        ("POLARIZATION", 1, dict(NUM_CORR=[NPOL])),
+        ("DATA_DESCRIPTION", 1, dict(SPECTRAL_WINDOW_ID=[0], POLARIZATION_ID=[0])),
+    ]:
+        with tables.table(f"{path}/{subtable}", readonly=False, ack=False) as st:
+            st.addrows(nrow)
+            for col, val in cols.items():
+                st.putcol(col, val)
+
+
+def _make_caltable(path, ms, ii, lo, hi):
+    """Writes the bandpass of channels lo~hi as solved by chunk ii, in the layout of a CASA caltable"""
+    rows = [(tt + 0.5 * ii, ant) for tt in TIMES for ant in range(NANT) if not (ii == 3 and ant == 2)]
+    desc = tables.maketabdesc(
+        [tables.makescacoldesc(col, 0) for col in band_parallel._KEY_COLUMNS + ("ANTENNA2",)]
+        + [tables.makescacoldesc(col, 0.0) for col in ("TIME", "INTERVAL")]
+        + [tables.makearrcoldesc("CPARAM", 0j, ndim=2), tables.makearrcoldesc("FLAG", False, ndim=2), tables.makearrcoldesc("SNR", 0.0, ndim=2)]
+    )
+    chans = np.arange(lo, hi + 1)
+    with tables.table(path, desc, nrow=len(rows), ack=False) as t:
+        t.putcol("TIME", np.array([tt for tt, ant in rows]))
+        t.putcol("INTERVAL", np.full(len(rows), 100.0))
+        t.putcol("ANTENNA1", np.array([ant for tt, ant in rows]))
+        t.putcol("CPARAM", np.array([_gains(ant, chans) for tt, ant in rows]))
+        flag = np.zeros((len(rows), len(chans), NPOL), bool)
+        if ii == 1:
+            # antenna 0 has no solution in the last channel of the chunk, next to the flagged chunk
+            flag[[ant == 0 for tt, ant in rows], -1] = True
+        t.putcol("FLAG", flag)
+        t.putcol("SNR", np.full(flag.shape, 10.0))
+        with tables.table(f"{ms}/SPECTRAL_WINDOW", ack=False) as st:
+            st.copy(f"{path}/SPECTRAL_WINDOW", deep=True).close()
+        with tables.table(f"{path}/SPECTRAL_WINDOW", readonly=False, ack=False) as st:
+            st.putcell("NUM_CHAN", 0, len(chans))
+            st.putcell("CHAN_FREQ", 0, FREQS[lo : hi + 1])
+        t.putkeyword("SPECTRAL_WINDOW", f"Table: {path}/SPECTRAL_WINDOW")
+
+
+def test_solve_bandpass(tmp_path, monkeypatch):
+    msdir, output = str(tmp_path / "msdir"), str(tmp_path / "caltables")
+    os.makedirs(output)
+    os.makedirs(msdir)
+    _make_ms(f"{msdir}/test.ms")
+    solves = []
+
+    class FakeRecipe(object):
+        def __init__(self, name, **kw):
+            self.JOB_TYPE = None
+
+        def add(self, cab, name, params, input=None, output=None, label=None):
+            self.params, self.output = params, output
+
+        def run(self):
+            spw, _, chans = self.params["spw"].partition(":")
+            lo, hi = map(int, chans.split("~"))
+            solves.append((lo, hi, self.params["fillgaps"], self.params["solnorm"]))
+            name = self.params["caltable"].rsplit(":", 1)[0]
+            _make_caltable(f"{self.output}/{name}", f"{msdir}/test.ms", int(name[-1]), lo, hi)
+
+    monkeypatch.setattr(band_parallel.stimela, "Recipe", FakeRecipe)
+    params = {"vis": "test.ms", "caltable": "test.B0:output", "field": "bpcal", "fillgaps": 10, "solnorm": False}
+    settings = dict(ms_dir=msdir, JOB_TYPE="singularity")
+    band_parallel.solve_bandpass("cab/casa_bandpass", "bp", params, 4, msdir, output, settings)
+    # the chunk that is fully flagged on the calibrator is not solved, and the chunks are solved without gap filling
+    assert sorted(solves) == [(0, 7, 0, False), (8, 15, 0, False), (24, 31, 0, False)]
+    assert os.listdir(output) == ["test.B0"]
+
+    with tables.table(f"{output}/test.B0", ack=False) as t:
+        times, ants = t.getcol("TIME"), t.getcol("ANTENNA1")
+        cparam, flag = t.getcol("CPARAM"), t.getcol("FLAG")
+    with tables.table(f"{output}/test.B0::SPECTRAL_WINDOW", ack=False) as st:
+        assert st.getcell("NUM_CHAN", 0) == NCHAN and (st.getcell("CHAN_FREQ", 0) == FREQS).all()
+    # chunk solution times differ slightly, but each solution is one row
+    assert list(times) == [TIMES[0]] * NANT + [TIMES[1]] * NANT and list(ants) == [0, 1, 2] * 2
+    # gaps across chunk edges are filled, but antenna 2 has no solutions from channel 16 to the band edge
+    assert not flag[ants != 2].any()
+    assert (flag[ants == 2] == (np.arange(NCHAN) >= 16)[:, None]).all()
+    for row, ant in enumerate(ants):
+        assert np.allclose(cparam[row][~flag[row]], _gains(ant, np.arange(NCHAN))[~flag[row]])
+
+    params["solnorm"] = True
+    band_parallel.solve_bandpass("cab/casa_bandpass", "bp", params, 4, msdir, output, settings)
+    with tables.table(f"{output}/test.B0", ack=False) as t:
+        cparam, flag = t.getcol("CPARAM"), t.getcol("FLAG")
+    assert np.allclose(np.abs(cparam[~flag]), 1)
+    assert np.allclose(np.angle(np.where(flag, 0, cparam).sum(axis=1)), 0)
+
+    # a chunk whose solve fails ends up flagged too
+    def _fail(self):
+        if self.params["spw"] == "0:0~7":
+            raise RuntimeError("casa_bandpass failed")
+        _run(self)
+
+    _run = FakeRecipe.run
+    monkeypatch.setattr(FakeRecipe, "run", _fail)
+    params["solnorm"] = False
+    band_parallel.solve_bandpass("cab/casa_bandpass", "bp", params, 4, msdir, output, settings)
+    assert os.listdir(output) == ["test.B0"]
+    with tables.table(f"{output}/test.B0", ack=False) as t:
+        flag = t.getcol("FLAG")
+    assert flag[:, :8].all() and not flag[:, 8:16].any()
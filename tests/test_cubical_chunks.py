@@ -0,0 +1,39 @@
+from caracal.workers.utils import cubical_chunks
+
+# 2 fields of 2 scans, 8 s integrations, 64 antennas, 4096 channels
+MSINFO = {
+    "EXPOSURE": 8.0,
+    "NROW": 2016 * (450 + 450 + 225 + 100),
+    "NCOR": 4,
+    "SCAN": {"0408-65": {"1": 3600.0, "3": 3600.0}, "J0000": {"2": 1800.0, "4": 800.0}},
+    "SPW": {"NUM_CHAN": [4096]},
+    "ANT": {"NAME": [f"m{i:03d}" for i in range(64)]},
+}
+
+
+def test_tune():
+    dims = cubical_chunks.MSDims(MSINFO)
+    assert list(dims.scan_slots) == [450, 450, 225, 100] and dims.rows_per_slot == 2016
+    assert dims.nchan == 4096 and dims.nant == 64 and dims.ncorr == 4
+
+    # chunks are multiples of all solution intervals, and all workers' chunks fit in memory
+    tchunk, fchunk, peak = cubical_chunks.tune(dims, [6, 4], [64, 32], ncpu=9, mem_limit=40)
+    assert tchunk % 12 == 0 and fchunk % 64 == 0
+    assert peak <= 40
+    assert peak == 8 * cubical_chunks.chunk_memory(dims, tchunk, fchunk) / 2**30
+    # the largest such chunks are chosen
+    assert 8 * cubical_chunks.chunk_memory(dims, tchunk, 2 * fchunk) / 2**30 > 40
+    assert 8 * cubical_chunks.chunk_memory(dims, 2 * tchunk, fchunk) / 2**30 > 40
+
+    # more memory, larger chunks; CubiCal loading fewer chunks at once, larger chunks
+    assert cubical_chunks.tune(dims, [6, 4], [64, 32], ncpu=9, mem_limit=400)[:2] > (tchunk, fchunk)
+    assert cubical_chunks.tune(dims, [6, 4], [64, 32], ncpu=9, mem_limit=40, max_chunks=2)[:2] > (tchunk, fchunk)
+
+    # an interval of 0 spans the whole axis, and chunks that are set are kept
+    assert cubical_chunks.tune(dims, [0, 4], [64], ncpu=2, mem_limit=1000)[0] == 0
+    tchunk, fchunk, peak = cubical_chunks.tune(dims, [6], [64], ncpu=9, mem_limit=40, time_chunk=10, freq_chunk=100)
+    assert (tchunk, fchunk) == (10, 100) and peak == 8 * cubical_chunks.chunk_memory(dims, 10, 100) / 2**30
+
+    # when nothing fits, the smallest chunks
+    tchunk, fchunk, peak = cubical_chunks.tune(dims, [6], [64], ncpu=9, mem_limit=0.01)
+    assert (tchunk, fchunk) == (6, 64) and peak > 0.01
@@ -1,7 +1,9 @@
 import os.path
 
+import numpy as np
 import pytest
 
+import caracal.dispatch_crew.caltables as mkct
 from caracal import utils
 from caracal.dispatch_crew import utils as dc_utils
 
@@ -59,3 +61,27 @@ def test_fieldinfo():
 
     assert not dc_utils.closeby([0, 0], [0, 3.14 / 2])
     assert dc_utils.closeby([0, 0], [0, 3.14 / 10], 3.14 / 2)
+
+
+def test_crossmatch():
+    db = mkct.calibrator_database()
+    sources = db.db
+    with pytest.raises(TypeError):
+        sources["J0000-0000"] = {}
+    with pytest.raises(TypeError):
+        sources[next(iter(sources))]["ra"] = 0.0
+
+    # calibrator positions, offset by up to 20 arcmin, and random positions
+    rng = np.random.default_rng(0)
+    ra = np.array([src["ra"] for src in sources.values()])
+    dec = np.array([src["decl"] for src in sources.values()])
+    ra = np.concatenate([ra + rng.uniform(-5e-3, 5e-3, len(ra)) / np.cos(dec), rng.uniform(0, 2 * np.pi, 100)])
+    dec = np.concatenate([dec + rng.uniform(-5e-3, 5e-3, len(dec)), np.arcsin(rng.uniform(-1, 1, 100))])
+    names, dists = db.crossmatch(ra, dec)
+    # the same matches as a linear search through the database
+    for radec, name, dist in zip(zip(ra, dec), names, dists):
+        expected = next((key for key, src in sources.items() if dc_utils.closeby([src["ra"], src["decl"]], radec)), None)
+        assert name == expected
+        if name is not None:
+            assert dist == pytest.approx(dc_utils.angular_dist_pos_angle(sources[name]["ra"], sources[name]["decl"], *radec)[0], abs=1e-9)
+    assert any(names) and not all(names)
@@ -0,0 +1,107 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from scipy import stats
+
+from caracal.dispatch_crew import fidelity
+
+NY, NX = 300, 200
+PEAK = (120, 80)
+
+
+def _write_image(path, data):
+    header = fits.Header()
+    header.update(CTYPE1="RA---SIN", CTYPE2="DEC--SIN", CRPIX1=NX // 2 + 1, CRPIX2=NY // 2 + 1, CRVAL1=30.0, CRVAL2=-30.0)
+    header.update(CDELT1=-1 / 3600, CDELT2=1 / 3600, CUNIT1="deg", CUNIT2="deg", BMAJ=5 / 3600, BMIN=5 / 3600)
+    header.update(CTYPE3="FREQ", CRPIX3=1, CRVAL3=1.4e9, CDELT3=1e6, CTYPE4="STOKES", CRPIX4=1, CRVAL4=1, CDELT4=1)
+    fits.PrimaryHDU(data[None, None].astype(np.float32), header).writeto(path, overwrite=True)
+
+
+def _images(tmp_path):
+    rng = np.random.default_rng(0)
+    residual = rng.normal(1e-5, 1e-3, (NY, NX))
+    residual[:10, :10] = np.nan
+    # the residual is noisier around the source
+    residual[PEAK[0] - 5 : PEAK[0] + 6, PEAK[1] - 5 : PEAK[1] + 6] *= 2
+    restored = residual.copy()
+    restored[PEAK] = 1.0
+    restored[200, 50] = -0.01
+    _write_image(tmp_path / "residual.fits", residual)
+    _write_image(tmp_path / "restored.fits", restored)
+    return residual.astype(np.float32).astype(float), str(tmp_path / "residual.fits"), str(tmp_path / "restored.fits")
+
+
+def test_stats(tmp_path):
+    data, residual, restored = _images(tmp_path)
+    values = data[np.isfinite(data)]
+    # chunks of rows, in threads, give the moments of the whole image
+    st = fidelity.compute(residual, chunk_rows=7, nthreads=4)
+    assert st.n == values.size and st.shape == (NY, NX)
+    assert st.mean == pytest.approx(values.mean()) and st.std == pytest.approx(values.std())
+    assert st.rms == pytest.approx(np.sqrt(np.mean(values**2)))
+    assert st.skew == pytest.approx(stats.skew(values)) and st.kurt == pytest.approx(stats.kurtosis(values, fisher=False))
+    assert st.mad == pytest.approx(stats.median_abs_deviation(values))
+    assert st.normality() == pytest.approx(list(stats.normaltest(values)))
+    img = fidelity.compute(restored, chunk_rows=64)
+    assert img.max == pytest.approx(1.0) and img.argmax == PEAK and img.argmin == (200, 50)
+
+    # a subsample is kept for the median and the normality test of large images
+    fidelity.SAMPLE_SIZE, size = 1000, fidelity.SAMPLE_SIZE
+    try:
+        sub = fidelity.compute(residual, chunk_rows=7)
+    finally:
+        fidelity.SAMPLE_SIZE = size
+    assert 900 < len(sub.sample) <= 1000 and sub.mad == pytest.approx(st.mad, rel=0.1)
+
+    # the statistics are cached until the image changes
+    assert fidelity.get(residual) is fidelity.get(residual)
+    cached = fidelity.get(residual)
+    _write_image(residual, 2 * data)
+    assert fidelity.get(residual) is not cached and fidelity.get(residual).std == pytest.approx(2 * st.std)
+
+
+def test_fidelity_results(tmp_path):
+    data, residual, restored = _images(tmp_path)
+    gaul = tmp_path / "model.gaul"
+    gaul.write_text(
+        "# PyBDSF Gaussian list for test\n#\n"
+        "# Gaus_id Isl_id Source_id Wave_id RA E_RA DEC E_DEC Total_flux E_Total_flux Peak_flux E_Peak_flux\n"
+        "0 0 0 0 29.99 0.0 -30.01 0.0 0.1 0.0 0.05 0.0\n"
+        "1 1 1 0 30.00 0.0 -29.99 0.0 2.0 0.0 0.50 0.0\n"
+    )
+    outfile = str(tmp_path / "fidelity_results.json")
+    fidelity.save_fidelity_results(outfile, "im_1", residual, restored=restored, area_factor=2)
+    fidelity.save_fidelity_results(outfile, "im_2", residual, gauls=[str(gaul)], area_factor=2)
+    with open(outfile) as stdr:
+        results = json.load(stdr)
+    assert set(results) == {"im_1-residual", "im_1-restored", "im_2-residual"}
+    assert results["im_1-residual"]["STDDev"] == pytest.approx(fidelity.get(residual).std)
+
+    # the dynamic range is measured against the residual standard deviation, and locally against the (noisier)
+    # residual around the peak
+    box = data[PEAK[0] - 5 : PEAK[0] + 6, PEAK[1] - 5 : PEAK[1] + 6]
+    restored_dr = results["im_1-restored"]
+    assert restored_dr["DR"] == restored_dr["DR_global_rms"] == pytest.approx(1.0 / fidelity.get(residual).std, rel=1e-4)
+    assert restored_dr["DR_local_rms"] == pytest.approx(1.0 / box.std(), rel=1e-4)
+    # the deepest negative is that of the residual near the peak, not of the whole restored image
+    assert restored_dr["DR_deepest_negative"] == pytest.approx(1.0 / abs(box.min()), rel=1e-4)
+    # the brightest model component is 36 arcsec north of the image centre
+    model_dr = results["im_2-residual"]["im_2-model"]
+    north = data[NY // 2 + 36 - 5 : NY // 2 + 36 + 6, NX // 2 - 5 : NX // 2 + 6]
+    assert model_dr["DR"] == pytest.approx(0.5 / fidelity.get(residual).std, rel=1e-4)
+    assert model_dr["DR_local_rms"] == pytest.approx(0.5 / north.std(), rel=1e-3)
+
+
+def test_concurrent_results(tmp_path):
+    # targets processed concurrently add their metrics to the same file
+    data, residual, restored = _images(tmp_path)
+    outfile = str(tmp_path / "fidelity_results.json")
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda num: fidelity.save_fidelity_results(outfile, f"im_{num}", residual, restored=restored), range(16)))
+    with open(outfile) as stdr:
+        results = json.load(stdr)
+    assert len(results) == 32 and results["im_15-restored"] == results["im_0-restored"]
+    assert not list(tmp_path.glob("*.tmp"))
@@ -0,0 +1,159 @@
+import time
+
+import casacore.tables as tables
+import numpy as np
+import pytest
+
+from caracal.workers.utils.flag_Uzeros import UzeroFlagger
+
+
+def _make_table(path, flags):
+    desc = tables.maketabdesc([tables.makearrcoldesc("FLAG", False, ndim=2, shape=flags.shape[1:])])
+    t = tables.table(str(path), desc, nrow=flags.shape[0], ack=False)
+    t.putcol("FLAG", flags)
+    return t
+
+
+@pytest.mark.parametrize("chunk_size", [0, 1])
+def test_add_row_flags(tmp_path, chunk_size):
+    rng = np.random.default_rng(1)
+    # 10 kB per row, so that a 1 MB chunk holds 104 rows
+    flags = rng.random((1000, 2560, 4)) < 0.1
+    rowFlags = rng.random(1000) < 0.2
+    flagger = UzeroFlagger({"flag_u_zeros": {"chunk_size": chunk_size}})
+
+    t = _make_table(tmp_path / "test.ms", flags)
+    assert flagger.getFlagPercent(t) == pytest.approx(flags.mean() * 100)
+    before, after = flagger.addRowFlags(t, rowFlags)
+
+    expected = flags.copy()
+    expected[rowFlags] = True
+    assert np.array_equal(t.getcol("FLAG"), expected)
+    assert before == pytest.approx(flags.mean() * 100)
+    assert after == pytest.approx(expected.mean() * 100)
+    if chunk_size:
+        assert flagger.peakChunkBytes <= 2**20
+    with pytest.raises(RuntimeError):
+        flagger.addRowFlags(t, rowFlags[:-1])
+    t.close()
+
+
+def _match_brute_force(uv, UV, cellSize, dilateU, dilateV):
+    """Matches rows to cells one cell at a time, as flagQuartile originally did"""
+    expected = np.zeros(uv.shape[0], bool)
+    for i in range(UV.shape[1]):
+        inU = (uv[:, 0] > UV[0, i] - (1 / 2 + dilateU) * cellSize) & (uv[:, 0] <= UV[0, i] + (1 / 2 + dilateU) * cellSize)
+        inV = (uv[:, 1] > UV[1, i] - (1 / 2 + dilateV) * cellSize) & (uv[:, 1] <= UV[1, i] + (1 / 2 + dilateV) * cellSize)
+        expected |= inU & inV
+    return expected
+
+
+@pytest.mark.parametrize("dilate", [(0, 0), (1, 2)])
+def test_match_cell_rows(dilate):
+    rng = np.random.default_rng(2)
+    cellSize = 7.3
+    grid = (np.arange(-20, 20) + 0.5) * cellSize
+    cells = rng.choice(len(grid), size=(2, 30))
+    UV = np.array([grid[cells[0]], grid[cells[1]]])
+    uv = rng.uniform(-160, 160, size=(20000, 2))
+    flagger = UzeroFlagger({"flag_u_zeros": {}})
+
+    expected = _match_brute_force(uv, UV, cellSize, *dilate)
+    assert expected.any()
+    assert np.array_equal(flagger.matchCellRows(uv, UV, cellSize, *dilate, qrtdebug=True), expected)
+
+    # cells off the regular grid are matched one by one
+    UV[:, 0] += 0.3 * cellSize
+    assert np.array_equal(flagger.matchCellRows(uv, UV, cellSize, *dilate), _match_brute_force(uv, UV, cellSize, *dilate))
+
+    assert not flagger.matchCellRows(uv, np.zeros((2, 0)), cellSize, *dilate).any()
+
+
+@pytest.mark.parametrize("taper", [True, False])
+def test_save_fft_table(monkeypatch, taper):
+    rng = np.random.default_rng(3)
+    inFFT = rng.random((64, 64)).astype(np.float32)
+    inFFT[5, 7] = np.nan
+    U = np.flip((np.arange(64) - 32.0) * 3.1)
+    V = (np.arange(64) - 33.0) * 3.1
+    flagger = UzeroFlagger({"flag_u_zeros": {"taper": taper}})
+    tables = []
+
+    def flagQuartile(visName, newtab, *args, **kw):
+        tables.append(newtab)
+        return None, 0.0
+
+    monkeypatch.setattr(flagger, "flagQuartile", flagQuartile)
+
+    cutoff = flagger.saveFFTTable(inFFT, {}, "", U, V, "gal", 0, "t", 1, 0, 0, "percentile", 0, 0, 0, False)[-1]
+
+    # the table of all cells, in order of U then V, as saveFFTTable originally built it
+    u, v = np.repeat(U, len(V)), np.tile(V, len(U))
+    amp = inFFT.T.ravel().astype(np.float64)
+    assert cutoff == np.nanpercentile(amp, 99.99 if taper else 99.9999)
+    index = np.where(amp >= cutoff)[0]
+    assert len(index)
+    assert np.array_equal(tables[0]["u"], u[index])
+    assert np.array_equal(tables[0]["v"], v[index])
+    assert np.array_equal(tables[0]["amp"], amp[index])
+
+
+def test_scan_tables(tmp_path):
+    rng = np.random.default_rng(4)
+    nrow = 300
+    flags = rng.random((nrow, 16, 2)) < 0.1
+    scans = np.repeat([3, 1, 2, 3], [50, 100, 100, 50])
+    desc = tables.maketabdesc([tables.makearrcoldesc("FLAG", False, ndim=2, shape=flags.shape[1:]), tables.makescacoldesc("SCAN_NUMBER", 0)])
+    t = tables.table(str(tmp_path / "test.ms"), desc, nrow=nrow, ack=False)
+    t.putcol("FLAG", flags)
+    t.putcol("SCAN_NUMBER", scans)
+    flagger = UzeroFlagger({"flag_u_zeros": {"chunk_size": 0}})
+
+    scanRows = flagger.scanRows(t)
+    t.close()
+    assert list(scanRows) == [1, 2, 3]
+    for scan, rows in scanRows.items():
+        assert np.array_equal(rows, np.where(scans == scan)[0])
+
+    scanVisList, scanVisNames = flagger.makeScanTables(str(tmp_path / "test.ms"), scanRows)
+    assert scanVisNames == ["test_scn1.ms", "test_scn2.ms", "test_scn3.ms"]
+
+    # flags written to a scan table go to the rows of the parent MS, and can be rewound
+    rowFlags = rng.random(100) < 0.3
+    undo = []
+    st = tables.table(scanVisList[2], readonly=False, ack=False)
+    assert st.nrows() == 100
+    flagger.addRowFlags(st, rowFlags, undo=undo)
+    st.close()
+    expected = flags.copy()
+    expected[scanRows[3][rowFlags]] = True
+    assert np.array_equal(tables.table(str(tmp_path / "test.ms"), ack=False).getcol("FLAG"), expected)
+
+    flagger.rewindScan(scanVisList[2], undo)
+    assert not undo
+    assert np.array_equal(tables.table(str(tmp_path / "test.ms"), ack=False).getcol("FLAG"), flags)
+
+
+@pytest.mark.parametrize("nParallel", [1, 3])
+def test_process_scans(nParallel):
+    scanNums = [1, 2, 3, 5]
+    scanRows = {1: np.arange(0, 10), 2: np.arange(10, 30), 3: np.arange(30, 35), 5: np.arange(40, 50)}
+    flagger = UzeroFlagger({"flag_u_zeros": {}})
+    done, plotted = [], []
+
+    def processScan(kk):
+        # later scans finish first
+        time.sleep(0.01 * (len(scanNums) - kk))
+        done.append(kk)
+        rows = scanRows[scanNums[kk]]
+        return dict(statsArray=np.full((1, 7), scanNums[kk]), scanFlags=rows % 2 == 0, percent=10.0 * kk)
+
+    arr, stripeFlags, percent = flagger.processScans(processScan, scanNums, scanRows, 50, nParallel, plotScan=lambda kk, result: plotted.append(kk))
+    if nParallel > 1:
+        assert done != sorted(done)
+    # the results are merged in scan order
+    assert list(arr[:, 0]) == scanNums and percent == [0.0, 10.0, 20.0, 30.0] and plotted == [0, 1, 2, 3]
+    expected = np.zeros(50, bool)
+    for rows in scanRows.values():
+        expected[rows] = rows % 2 == 0
+    assert np.array_equal(stripeFlags, expected)
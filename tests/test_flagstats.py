@@ -0,0 +1,112 @@
+import itertools
+import json
+import os
+from types import SimpleNamespace
+
+import casacore.tables as tables
+import numpy as np
+import pytest
+
+from caracal.dispatch_crew import flagstats
+from caracal.workers.utils import manage_antennas
+
+NANT, NTIME = 5, 12
+# (nchan, corr types) of each data description
+SETUPS = [(16, [9, 10, 11, 12]), (8, [9, 12])]
+POSITIONS = [[0.0, 0.0, 0.0], [10.0, 0.0, 0.0], [0.0, 20.0, 0.0], [3.0, 4.0, 0.0], [5000.0, 0.0, 0.0]]
+
+
+def _make_ms(path):
+    baselines = list(itertools.combinations_with_replacement(range(NANT), 2))
+    tidx = np.repeat(np.arange(NTIME), len(baselines))
+    ant1, ant2 = np.array(baselines * NTIME).T
+    ddids = tidx % 2
+    t = tables.default_ms(str(path))
+    t.addrows(len(tidx))
+    t.putcol("ANTENNA1", ant1)
+    t.putcol("ANTENNA2", ant2)
+    t.putcol("SCAN_NUMBER", 1 + tidx // 4)
+    t.putcol("FIELD_ID", (tidx // 4) % 2)
+    t.putcol("DATA_DESC_ID", ddids)
+    t.close()
+    for subtable, nrow, cols in [
+        ("ANTENNA", NANT, dict(NAME=[f"m00{ii}" for ii in range(NANT)], POSITION=np.array(POSITIONS))),
+        ("FIELD", 2, dict(NAME=["cal", "target"])),
+        ("SPECTRAL_WINDOW", 2, dict(NUM_CHAN=[nchan for nchan, corrs in SETUPS])),
+        ("POLARIZATION", 2, dict(NUM_CORR=[len(corrs) for nchan, corrs in SETUPS])),
+        ("DATA_DESCRIPTION", 2, dict(SPECTRAL_WINDOW_ID=[0, 1], POLARIZATION_ID=[0, 1])),
+    ]:
+        with tables.table(f"{path}/{subtable}", readonly=False, ack=False) as st:
+            st.addrows(nrow)
+            for col, val in cols.items():
+                st.putcol(col, val)
+    with tables.table(f"{path}/SPECTRAL_WINDOW", readonly=False, ack=False) as st:
+        for ii, (nchan, corrs) in enumerate(SETUPS):
+            st.putcell("CHAN_FREQ", ii, 1.4e9 + 1e6 * ii + 1e4 * np.arange(nchan))
+    with tables.table(f"{path}/POLARIZATION", readonly=False, ack=False) as st:
+        for ii, (nchan, corrs) in enumerate(SETUPS):
+            st.putcell("CORR_TYPE", ii, corrs)
+
+    # random flags, heavier on antenna 1. Row 3 is flagged through FLAG_ROW only
+    rng = np.random.default_rng(0)
+    flags = []
+    with tables.table(str(path), readonly=False, ack=False) as t:
+        for row, ddid in enumerate(ddids):
+            nchan, corrs = SETUPS[ddid]
+            flag = rng.random((nchan, len(corrs))) < (0.6 if 1 in (ant1[row], ant2[row]) else 0.1)
+            t.putcell("FLAG", row, flag)
+            flags.append(flag)
+        t.putcell("FLAG_ROW", 3, True)
+    flags[3][...] = True
+    return flags, ant1, ant2, tidx, ddids
+
+
+def test_flagstats(tmp_path):
+    ms = str(tmp_path / "test.ms")
+    flags, ant1, ant2, tidx, ddids = _make_ms(ms)
+
+    # 1 kB chunks hold 16 rows of the larger shape, and the data descriptions alternate every row
+    stats = flagstats.compute(ms, chunkSize=2**-10)
+    flagged = np.array([ff.sum() for ff in flags])
+    total = np.array([ff.size for ff in flags])
+    for ant in range(NANT):
+        sel = (ant1 == ant) | (ant2 == ant)
+        assert stats.flagged["antenna"][ant] == flagged[sel].sum() and stats.total["antenna"][ant] == total[sel].sum()
+    sel = (ant1 == 1) & (ant2 == 3)
+    assert stats.fraction("baseline")[1, 3] == pytest.approx(flagged[sel].sum() / total[sel].sum())
+    assert np.isnan(stats.fraction("baseline")[3, 1])
+    assert list(stats.scan_numbers) == [1, 2, 3]
+    assert stats.flagged["scan"][2] == flagged[(tidx // 4) == 1].sum()
+    assert stats.total_fraction == pytest.approx(flagged.sum() / total.sum())
+    assert stats.corr_names == ["XX", "XY", "YX", "YY"]
+    xx = sum(ff[:, 0].sum() for ff in flags)
+    assert stats.flagged["correlation"][0] == xx and stats.total["correlation"][0] == sum(len(ff) for ff in flags)
+    chans = sum(ff.sum(axis=1) for ff, dd in zip(flags, ddids) if dd == 1)
+    assert (stats.flagged["channel"][1] == chans).all()
+
+    # statistics are cached until the MS changes
+    assert flagstats.get(ms) is flagstats.get(ms)
+    cached = flagstats.get(ms)
+    with tables.table(ms, readonly=False, ack=False) as t:
+        t.putcol("FLAG_ROW", np.ones(t.nrows(), bool))
+    assert flagstats.get(ms) is not cached and flagstats.get(ms).total_fraction == 1
+
+    outfile, htmlfile = str(tmp_path / "summary.json"), str(tmp_path / "summary.html")
+    flagstats.save_statistics(ms, outfile, htmlfile)
+    with open(outfile) as stdr:
+        summary = json.load(stdr)
+    antennas = summary["Flag stats"][1]["antennas"]
+    assert antennas["4"]["name"] == "m004" and antennas["4"]["frac"] == 1 and antennas["4"]["position"] == POSITIONS[4]
+    assert os.path.getsize(htmlfile) > 0
+
+
+def test_get_refant(tmp_path):
+    _make_ms(tmp_path / "test.ms")
+    pipeline = SimpleNamespace(msdir=str(tmp_path))
+    recipe = SimpleNamespace(jobs=[])
+    # antenna 4 is too far from the centre, and antenna 3 is only 5 m from antenna 0
+    assert manage_antennas.get_refant(pipeline, recipe, "prefix", "test.ms", [], 8.0, 1000.0, 0) == "m002,m001"
+    # antenna 1 has the most flags, and the others are sorted by their flagged fraction
+    fracs = flagstats.get(str(tmp_path / "test.ms")).fraction("antenna")
+    expected = ",".join(f"m00{ii}" for ii in sorted([0, 2, 3], key=lambda ii: fracs[ii]))
+    assert manage_antennas.get_refant(pipeline, recipe, "prefix", "test.ms", [], 1.0, 1000.0, 0) == expected
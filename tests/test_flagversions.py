@@ -0,0 +1,94 @@
+import casacore.tables as tables
+import numpy as np
+
+from caracal.dispatch_crew import flagversions
+
+# (nchan, ncorr) of each data description
+SHAPES = [(16, 4), (8, 2)]
+BLOCK = 25
+
+
+def _make_ms(path, nrow=300):
+    t = tables.default_ms(str(path))
+    t.addrows(nrow)
+    ddids = (np.arange(nrow) // BLOCK) % len(SHAPES)
+    t.putcol("DATA_DESC_ID", ddids)
+    t.close()
+
+    spw = tables.table(f"{path}/SPECTRAL_WINDOW", readonly=False, ack=False)
+    spw.addrows(len(SHAPES))
+    spw.putcol("NUM_CHAN", [nchan for nchan, ncorr in SHAPES])
+    spw.close()
+    pol = tables.table(f"{path}/POLARIZATION", readonly=False, ack=False)
+    pol.addrows(len(SHAPES))
+    pol.putcol("NUM_CORR", [ncorr for nchan, ncorr in SHAPES])
+    pol.close()
+    ddesc = tables.table(f"{path}/DATA_DESCRIPTION", readonly=False, ack=False)
+    ddesc.addrows(len(SHAPES))
+    ddesc.putcol("SPECTRAL_WINDOW_ID", np.arange(len(SHAPES)))
+    ddesc.putcol("POLARIZATION_ID", np.arange(len(SHAPES)))
+    ddesc.close()
+    _put_flags(str(path), np.random.default_rng(0))
+
+
+def _put_flags(ms, rng):
+    """Sets random flags, and returns them as a list of per-block arrays"""
+    blocks = []
+    with tables.table(ms, readonly=False, ack=False) as t:
+        for start in range(0, t.nrows(), BLOCK):
+            nchan, ncorr = SHAPES[(start // BLOCK) % len(SHAPES)]
+            flag = rng.random((BLOCK, nchan, ncorr)) < 0.2
+            t.putcol("FLAG", flag, start, BLOCK)
+            t.putcol("FLAG_ROW", flag.all(axis=(1, 2)), start, BLOCK)
+            blocks.append(flag)
+    return blocks
+
+
+def _get_flags(ms):
+    with tables.table(ms, ack=False) as t:
+        return [t.getcol("FLAG", start, BLOCK) for start in range(0, t.nrows(), BLOCK)]
+
+
+def test_flagversions(tmp_path):
+    ms = str(tmp_path / "test.ms")
+    _make_ms(ms)
+    before = _get_flags(ms)
+
+    # 1 kB chunks hold 16 rows of the larger shape, so chunks straddle the data descriptions
+    flagversions.save(ms, "before", chunkSize=2**-10)
+    after = _put_flags(ms, np.random.default_rng(1))
+    flagversions.save(ms, "after", comment="new flags")
+    assert flagversions.list_versions(ms) == [("before", ""), ("after", "new flags")]
+
+    counts = flagversions.diff(ms, "before", chunkSize=2**-10)
+    assert counts["version"] == sum(ff.sum() for ff in before)
+    assert counts["current"] == sum(ff.sum() for ff in after)
+    assert counts["added"] == sum((aa & ~bb).sum() for aa, bb in zip(after, before))
+    assert counts["removed"] == sum((bb & ~aa).sum() for aa, bb in zip(after, before))
+
+    flagversions.restore(ms, "before")
+    assert all((aa == bb).all() for aa, bb in zip(_get_flags(ms), before))
+    flagversions.delete(ms, "after")
+    assert flagversions.list_versions(ms) == [("before", "")]
+
+    # versions saved by CASA's flagmanager are tables of FLAG and FLAG_ROW
+    with tables.table(ms, ack=False) as t:
+        t.query(columns="FLAG,FLAG_ROW").copy(flagversions._table_dir(ms, "casa"), deep=True).close()
+    with open(flagversions._list_file(ms), "a") as stdw:
+        stdw.write("casa : saved by flagmanager\n")
+    _put_flags(ms, np.random.default_rng(2))
+    flagversions.restore(ms, "casa", chunkSize=2**-10)
+    assert all((aa == bb).all() for aa, bb in zip(_get_flags(ms), before))
+    # saving replaces the CASA version
+    flagversions.save(ms, "casa")
+    assert flagversions.list_versions(ms) == [("before", ""), ("casa", "")]
+
+
+def test_save_all(tmp_path):
+    mss = [str(tmp_path / f"test{ii}.ms") for ii in range(2)]
+    for ms in mss:
+        _make_ms(ms)
+    flagversions.save_all(mss, "version", nproc=2)
+    for ms in mss:
+        assert flagversions.list_versions(ms) == [("version", "")]
+        assert flagversions.diff(ms, "version")["added"] == 0
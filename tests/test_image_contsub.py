@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from caracal.workers.utils.image_contsub import batched_polyfit, imcontsub
+
+
+@pytest.fixture
+def cube(tmp_path):
+    rng = np.random.default_rng(3)
+    nchan, ny, nx = 40, 23, 16
+    chans = np.arange(nchan)[:, None, None]
+    data = 1e-3 * rng.standard_normal((1, nchan, ny, nx)) + 1e-2 * rng.random((ny, nx)) * (1 + 0.01 * chans)
+    data[0, 5, 3, 4] = np.nan
+    mask = np.zeros(data.shape)
+    mask[0, 15:20, 10:14, 8:12] = 1
+    header = fits.Header()
+    header["CTYPE3"] = "FREQ"
+    fits.PrimaryHDU(data.astype("float32"), header=header).writeto(tmp_path / "cube.fits")
+    fits.PrimaryHDU(mask.astype("float32")).writeto(tmp_path / "mask.fits")
+    return tmp_path
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        dict(fitmode="poly", polyorder=2, kersiz=3),
+        dict(fitmode="median", length=5),
+        dict(fitmode="savgol", length=7, polyorder=2, sgiters=2, kersiz=2, kertyp="tophat"),
+    ],
+)
+@pytest.mark.parametrize("nworkers", [1, 2])
+def test_chunked(cube, params, nworkers):
+    outputs = {}
+    for label, chunksize in ("memory", 0), ("chunked", 0.002):
+        names = {name: str(cube / f"{label}-{name}.fits") for name in ("outcubus", "fitted", "confit")}
+        imcontsub(str(cube / "cube.fits"), mask=str(cube / "mask.fits"), chunksize=chunksize, nworkers=nworkers, **names, **params)
+        outputs[label] = names
+
+    for name in "outcubus", "fitted", "confit":
+        expected = fits.open(outputs["memory"][name])[0]
+        result = fits.open(outputs["chunked"][name])[0]
+        assert np.array_equal(expected.data, result.data, equal_nan=True)
+        assert expected.header == result.header
+
+    # without a continuum-subtracted cube
+    imcontsub(str(cube / "cube.fits"), mask=str(cube / "mask.fits"), chunksize=0.002, nworkers=nworkers, fitted=str(cube / "only-fitted.fits"), **params)
+    assert np.array_equal(fits.getdata(cube / "only-fitted.fits"), fits.getdata(outputs["memory"]["fitted"]), equal_nan=True)
+
+
+def test_batched_polyfit():
+    rng = np.random.default_rng(4)
+    nchan, npix, order = 50, 300, 2
+    data = rng.standard_normal((nchan, npix))
+    mask = np.zeros(data.shape, bool)
+    # a large group sharing a mask, and pixels with masks of their own
+    mask[10:20, :100] = True
+    mask[:, 200:] = rng.random((nchan, 100)) < 0.3
+    # too few channels for a unique fit, and nothing to fit to
+    mask[2:, 298] = True
+    mask[:, 299] = True
+
+    fit = batched_polyfit(data, mask, order)
+
+    x = np.arange(nchan)
+    for pix in range(298):
+        valid = ~mask[:, pix]
+        expected = np.polyval(np.polyfit(x[valid], data[valid, pix], order), x)
+        assert np.allclose(fit[:, pix], expected)
+    assert np.allclose(fit[[0, 1], 298], data[[0, 1], 298])
+    assert np.all(fit[:, 299] == 0)
+
+
+def test_polymask_pixel(cube):
+    outputs = []
+    for chunksize in 0, 0.002:
+        outcubus = str(cube / f"out-{chunksize}.fits")
+        imcontsub(str(cube / "cube.fits"), outcubus, fitmode="poly", polyorder=1, mask=str(cube / "mask.fits"), polymask="pixel", chunksize=chunksize)
+        outputs.append(fits.getdata(outcubus))
+    assert np.allclose(outputs[0], outputs[1], equal_nan=True, atol=1e-7)
+    # an unmasked pixel is fitted to all its channels, even those masked elsewhere
+    spectrum = fits.getdata(str(cube / "cube.fits"))[0, :, 0, 0].astype(float)
+    x = np.arange(spectrum.size)
+    expected = spectrum - np.polyval(np.polyfit(x, spectrum, 1), x)
+    assert np.allclose(outputs[0][0, :, 0, 0], expected, atol=1e-6)
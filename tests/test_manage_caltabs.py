@@ -0,0 +1,93 @@
+import json
+
+import casacore.tables as tables
+import numpy as np
+
+from caracal.workers import polcal_worker
+from caracal.workers.utils import manage_caltabs
+
+NCHAN, NANT, NPOL = 32, 10, 2
+TIMES = [5e9, 5e9 + 100.0, 5e9 + 200.0]
+SCANS = [1, 2, 3]
+
+
+def _make_caltable(path, gains, flags):
+    """Writes gains and flags (time, antenna, channel, correlation) in the layout of a CASA caltable, leaving out
+    the solution of antenna 3 at the second time"""
+    rows = [(it, ant) for it in range(len(TIMES)) for ant in range(NANT) if (it, ant) != (1, 3)]
+    desc = tables.maketabdesc(
+        [tables.makescacoldesc(col, 0) for col in ("FIELD_ID", "SPECTRAL_WINDOW_ID", "SCAN_NUMBER", "ANTENNA1", "ANTENNA2")]
+        + [tables.makescacoldesc("TIME", 0.0)]
+        + [tables.makearrcoldesc("CPARAM", 0j, ndim=2), tables.makearrcoldesc("FLAG", False, ndim=2)]
+    )
+    with tables.table(str(path), desc, nrow=len(rows), ack=False) as t:
+        t.putcol("TIME", np.array([TIMES[it] for it, ant in rows]))
+        t.putcol("SCAN_NUMBER", np.array([SCANS[it] for it, ant in rows]))
+        t.putcol("ANTENNA1", np.array([ant for it, ant in rows]))
+        t.putcol("CPARAM", np.array([gains[it, ant] for it, ant in rows]))
+        t.putcol("FLAG", np.array([flags[it, ant] for it, ant in rows]))
+
+
+def _bandpass():
+    chans = np.arange(NCHAN)
+    amp = 1 + 0.1 * np.arange(NANT)[:, None] + 0.01 * chans
+    gains = amp[None, :, :, None] * np.exp(1j * 0.3 * chans)[None, None, :, None] * np.ones((len(TIMES), 1, 1, NPOL))
+    return gains
+
+
+def test_caltable(tmp_path):
+    gains, flags = _bandpass(), np.zeros((len(TIMES), NANT, NCHAN, NPOL), bool)
+    # a flagged spike, a gap of 5 channels (phases wrap across it), a gap at the band edge and an unflagged spike
+    gains[:, :, 10] *= 100
+    flags[:, :, 10] = True
+    flags[:, :, 20:25] = True
+    flags[:, 0, -2:] = True
+    gains[0, 5, 4, 1] *= 3
+    caltable = str(tmp_path / "test.B0")
+    _make_caltable(caltable, gains, flags)
+
+    with manage_caltabs.CalTable(caltable) as ct:
+        assert ct.param == "CPARAM" and list(ct.scans[0]) == SCANS
+        cube, flag = ct.read("CPARAM"), ct.read("FLAG")
+        assert cube.shape == (len(TIMES), NANT, NCHAN, NPOL)
+        # the missing solution reads as flagged
+        assert flag[1, 3].all() and (cube[1, 3] == 1).all()
+        assert np.allclose(ct.read("CPARAM", antennas=[2, 5]), gains[:, [2, 5]])
+
+    # outliers are clipped against the running median, and only the spike is
+    clipped = manage_caltabs.clip_outliers(cube, flag, nsigma=5, window=5)
+    assert (clipped & ~flag).sum() == 1 and clipped[0, 5, 4, 1]
+
+    # gaps are filled in amplitude and phase, up to maxgap channels, and not at the band edge
+    filled, newflag = manage_caltabs.interpolate(cube, flag, maxgap=5)
+    assert newflag[1, 3].all() and newflag[:, 0, -2:].all() and newflag[:, :, 10:25].sum() == newflag[1, 3, 10:25].size
+    gap, spike = ~newflag[:, :, 20:25], ~newflag[:, :, 10]
+    assert np.allclose(filled[:, :, 20:25][gap], gains[:, :, 20:25][gap]) and np.allclose(filled[:, :, 10][spike], gains[:, :, 10][spike] / 100)
+    assert manage_caltabs.interpolate(cube, flag, maxgap=4)[1][:, :, 20:25].all()
+
+    # the flagged spike keeps its value, and does not enter the smoothed values of the (linear) amplitude
+    smoothed = manage_caltabs.smooth(np.abs(cube), flag, 3)
+    assert np.allclose(smoothed[2, 1, 12:19], np.abs(gains[2, 1, 12:19]))
+    assert np.allclose(smoothed[2, 1, 10], np.abs(gains[2, 1, 10]))
+    median = manage_caltabs.smooth(np.abs(cube), flag, 3, mode="median")
+    assert np.isclose(median[0, 5, 4, 1], np.abs(gains[0, 5, 4, 1]) / 3, rtol=0.02)
+
+    # the table functions give the same results, over antenna chunks and threads
+    manage_caltabs.interpolate_table(caltable, maxgap=5, nthreads=4)
+    with manage_caltabs.CalTable(caltable) as ct:
+        assert np.allclose(ct.read("CPARAM")[~newflag], filled[~newflag]) and (ct.read("FLAG") == newflag).all()
+    with tables.table(caltable, ack=False) as t:
+        assert t.nrows() == len(TIMES) * NANT - 1
+
+
+def test_select_best_scan(tmp_path):
+    gains, flags = np.ones((len(TIMES), NANT, 1, NPOL), complex), np.zeros((len(TIMES), NANT, 1, NPOL), bool)
+    gains[:, :, :, 0] = np.array([1.2, 1.1, 1.05])[:, None, None]
+    # the best scan has a flagged outlier
+    gains[2, 4, :, 0] = 5
+    flags[2, 4] = True
+    caltable, outfile = str(tmp_path / "test.Gpol1"), str(tmp_path / "test_bestscan.json")
+    _make_caltable(caltable, gains, flags)
+    assert polcal_worker.select_best_scan(caltable, outfile) == 3
+    with open(outfile) as stdr:
+        assert json.load(stdr) == {"bestscan": 3}
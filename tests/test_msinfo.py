@@ -0,0 +1,68 @@
+import json
+import os.path
+import shutil
+
+import pytest
+
+from caracal import utils
+from caracal.dispatch_crew import msinfo
+from caracal.dispatch_crew import utils as dc_utils
+
+from . import TESTDIR
+
+SUMMARY = os.path.join(TESTDIR, "obsinfo", "ms_summary.json")
+
+
+def test_msinfo_lookups(tmp_path):
+    summary = str(tmp_path / "test-summary.json")
+    shutil.copyfile(SUMMARY, summary)
+    msdict = utils.load_yaml(SUMMARY)
+    info = msinfo.MSInfo(msdict)
+
+    assert info["FIELD"]["NAME"] == msdict["FIELD"]["NAME"] == info.field_names
+    for idx, (name, sid) in enumerate(zip(msdict["FIELD"]["NAME"], msdict["FIELD"]["SOURCE_ID"])):
+        assert info.field_index(name) == info.field_index(sid) == idx
+        scans, lengths = info.field_scans(name)
+        assert dict(zip(map(str, scans), lengths)) == msdict["SCAN"][str(sid)]
+    with pytest.raises(ValueError):
+        info.field_index("no-such-field")
+    assert info.reference_dirs.shape == (info.nfields, 2)
+    assert info.antenna_index(msdict["ANT"]["NAME"][-1]) == info.nants - 1
+    assert info.corr_types == ["XX", "XY", "YX", "YY"]
+    assert info.num_chans.tolist() == [len(info.chan_freqs[0])]
+
+    # the helpers give the same results for a summary dict, a summary file, and an MSInfo
+    for arg in msdict, summary, info:
+        intents = dc_utils.categorize_fields(arg)
+        assert intents["fcal"][1] == intents["bpcal"][1] == ["J1331+3030"]
+        assert intents["gcal"][1] == ["J1318-4620", "J1424-4913"]
+        assert intents["target"][1] == ["circinus-p3"]
+        assert dc_utils.get_field_id(arg, "circinus-p3,J1424-4913") == [2, 3]
+        assert dc_utils.select_gcal(arg, ["circinus-p3"], ["J1331+3030", "J1424-4913"]) == "J1424-4913"
+        assert dc_utils.select_gcal(arg, ["circinus-p3"], ["J1318-4620", "J1424-4913"], mode="most_scans") == "J1424-4913"
+        assert dc_utils.observed_longest(arg, msdict["FIELD"]["NAME"]) == "circinus-p3"
+    with pytest.raises(KeyError):
+        dc_utils.get_field_id(info, "no-such-field")
+
+
+def test_msinfo_index(tmp_path):
+    summary = str(tmp_path / "test-summary.json")
+    shutil.copyfile(SUMMARY, summary)
+
+    info = msinfo.load(summary)
+    assert os.path.exists(tmp_path / "test-summary.pkl")
+    assert msinfo.load(summary) is info
+
+    # a new process loads the persisted index
+    msinfo._INDEX.clear()
+    assert msinfo.load(summary).field_names == info.field_names
+
+    # the index is rebuilt when the summary changes
+    with open(summary) as stdr:
+        msdict = json.load(stdr)
+    msdict["FIELD"]["NAME"][0] = "renamed"
+    with open(summary, "w") as stdw:
+        json.dump(msdict, stdw)
+    assert msinfo.load(summary).field_names[0] == "renamed"
+    msinfo._INDEX.clear()
+    assert msinfo.load(summary).field_names[0] == "renamed"
@@ -0,0 +1,59 @@
+import casacore.tables as tables
+import numpy as np
+import pytest
+
+from caracal.dispatch_crew import noisy
+
+NCHAN = 64
+CORR_TYPE = [9, 10, 11, 12]  # XX, XY, YX, YY
+
+
+def _make_ms(path, seed, nrow=500):
+    rng = np.random.default_rng(seed)
+    t = tables.default_ms(str(path))
+    t.addrows(nrow)
+    ant1 = rng.integers(0, 4, nrow)
+    ant2 = rng.integers(0, 4, nrow)
+    fieldIDs = rng.integers(0, 2, nrow)
+    interval = rng.choice([8.0, 16.0], nrow)
+    flags = rng.random((nrow, NCHAN, len(CORR_TYPE))) < 0.3
+    t.putcol("ANTENNA1", ant1)
+    t.putcol("ANTENNA2", ant2)
+    t.putcol("FIELD_ID", fieldIDs)
+    t.putcol("INTERVAL", interval)
+    t.putcol("FLAG", flags)
+    t.close()
+
+    field = tables.table(f"{path}/FIELD", readonly=False, ack=False)
+    field.addrows(2)
+    field.putcol("NAME", ["cal", "target"])
+    field.close()
+    spw = tables.table(f"{path}/SPECTRAL_WINDOW", readonly=False, ack=False)
+    spw.addrows(1)
+    spw.putcell("CHAN_FREQ", 0, 1.4e9 + 2.0e4 * np.arange(NCHAN))
+    spw.putcell("CHAN_WIDTH", 0, np.full(NCHAN, 2.0e4))
+    spw.close()
+    pol = tables.table(f"{path}/POLARIZATION", readonly=False, ack=False)
+    pol.addrows(1)
+    pol.putcell("CORR_TYPE", 0, np.array(CORR_TYPE, dtype=np.int32))
+    pol.close()
+
+    selection = (fieldIDs == 1) & (ant1 != ant2)
+    return flags[selection][:, :, [0, 3]], interval[selection]
+
+
+def test_predict_noise(tmp_path):
+    mss = [str(tmp_path / f"test{ii}.ms") for ii in range(2)]
+    flag, interval = zip(*[_make_ms(ms, seed) for seed, ms in enumerate(mss)])
+
+    kB, Aant, tsyseff, width = 1380.6, np.pi * (13.5 / 2) ** 2, 20.5, 2.0e4
+    unflagged = np.concatenate([ii[:, None, None] * ~ff for ff, ii in zip(flag, interval)]).sum(axis=(0, 2))
+    expected = np.sqrt(2) * kB * tsyseff / Aant / np.sqrt(width * unflagged)
+    rmsEach = [np.sqrt(2) * kB * tsyseff / Aant / np.sqrt(np.full(NCHAN, width) * ii.sum() * 2) for ii in interval]
+    expectedAll = 1.0 / np.sqrt(sum(1.0 / rms**2 for rms in rmsEach))
+
+    # 1 kB chunks hold 4 rows
+    for nproc, chunkSize in [(1, 0), (1, 2**-10), (2, 2**-10)]:
+        rmsAll, rmsUnflagged = noisy.PredictNoise(mss, str(tsyseff), 13.5, "target", verbose=2, nproc=nproc, chunkSize=chunkSize)
+        assert rmsAll == pytest.approx(expectedAll)
+        assert rmsUnflagged == pytest.approx(expected)
@@ -0,0 +1,35 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+from caracal.dispatch_crew import profiler
+from caracal.dispatch_crew.profiler import Profiler
+
+
+def test_profile(tmp_path):
+    prof = Profiler(str(tmp_path / "perf"), "20240101-000000", interval=0.01)
+    with prof.profile_worker("flag"):
+        with prof.profile("child process"):
+            subprocess.check_call([sys.executable, "-c", "sum(range(10**6))"])
+        with pytest.raises(RuntimeError):
+            with prof.profile("failing step"):
+                raise RuntimeError("failed")
+
+    ok, failed = prof.steps
+    assert ok["worker"] == "flag" and ok["status"] == "completed"
+    assert ok["wall"] > 0 and ok["cpu_user"] + ok["cpu_system"] > 0 and ok["peak_rss"] > 0
+    assert failed["status"] == "failed"
+    assert prof.workers[0]["name"] == "flag"
+
+    prof.log_summary()
+    with open(prof.write_report()) as stdr:
+        report = json.load(stdr)
+    assert [step["label"] for step in report["steps"]] == ["child process", "failing step"]
+
+
+def test_profiled_disabled():
+    profiler.set_profiler(None)
+    with profiler.profiled("nothing"):
+        pass
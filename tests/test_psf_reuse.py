@@ -0,0 +1,63 @@
+import os
+
+import casacore.tables as tables
+import numpy as np
+from astropy.io import fits
+
+from caracal.workers.utils import psf_reuse
+
+NROW = 50
+
+
+def _make_ms(path):
+    """Writes a minimal MS main table, with the calibrated data in a data manager of its own"""
+    desc = tables.maketabdesc(
+        [tables.makescacoldesc("TIME", 0.0), tables.makearrcoldesc("UVW", 0.0, ndim=1, shape=[3])]
+        + [tables.makearrcoldesc(col, False, ndim=2, shape=[4, 2]) for col in ("FLAG",)]
+        + [tables.makearrcoldesc(col, 0.0, ndim=2, shape=[4, 2]) for col in ("WEIGHT_SPECTRUM",)]
+    )
+    with tables.table(str(path), desc, nrow=NROW, ack=False) as tb:
+        tb.addcols(tables.maketabdesc([tables.makearrcoldesc("CORRECTED_DATA", 0j, ndim=2, shape=[4, 2])]), {"TYPE": "TiledShapeStMan", "NAME": "cdata", "SPEC": {}})
+
+
+def _write_psf(outdir, prefix):
+    for suffix in ("-0000-psf.fits", "-0001-psf.fits", "-MFS-psf.fits"):
+        fits.PrimaryHDU(np.zeros((4, 4), np.float32)).writeto(os.path.join(outdir, prefix + suffix), overwrite=True)
+
+
+def test_psf_reuse(tmp_path):
+    ms = str(tmp_path / "test.ms")
+    _make_ms(ms)
+    outdir = str(tmp_path)
+    opts = {"weight": "briggs 0", "npix": 100, "scale": 1.3, "channelsout": 2, "column": "DATA", "niter": 100}
+    sig = psf_reuse.signature(opts, [ms])
+    _write_psf(outdir, "im_1")
+    # an iteration that ends in _10 is not mistaken for part of _1
+    _write_psf(outdir, "im_10")
+    psf_reuse.record(outdir, "im_1", sig)
+    assert len(psf_reuse.psf_products(os.path.join(outdir, "im_1"))) == 3
+
+    # the calibrated data, data column and deconvolution settings do not matter
+    with tables.table(ms, readonly=False, ack=False) as tb:
+        tb.putcol("CORRECTED_DATA", np.ones((NROW, 4, 2), complex))
+    opts.update(column="CORRECTED_DATA", niter=1000)
+    assert psf_reuse.reusable_psf(outdir, "im_1", psf_reuse.signature(opts, [ms])) == "im_1"
+
+    # an iteration that reused the PSF passes it on
+    psf_reuse.record(outdir, "im_2", sig, psf_prefix="im_1")
+    assert psf_reuse.reusable_psf(outdir, "im_2", sig) == "im_1"
+
+    # but the weighting, the flags and the PSF images themselves do
+    assert psf_reuse.reusable_psf(outdir, "im_1", psf_reuse.signature(dict(opts, weight="briggs 0.5"), [ms])) is None
+    os.utime(os.path.join(outdir, "im_1-MFS-psf.fits"), ns=(0, 0))
+    assert psf_reuse.reusable_psf(outdir, "im_1", sig) is None
+    _write_psf(outdir, "im_1")
+    psf_reuse.record(outdir, "im_1", sig)
+    assert psf_reuse.reusable_psf(outdir, "im_1", sig) == "im_1"
+    with tables.table(ms, readonly=False, ack=False) as tb:
+        tb.putcol("FLAG", np.ones((NROW, 4, 2), bool))
+    assert psf_reuse.reusable_psf(outdir, "im_1", psf_reuse.signature(opts, [ms])) is None
+
+    # nor is anything reused once a run is forgotten
+    psf_reuse.forget(outdir, "im_1")
+    assert psf_reuse.reusable_psf(outdir, "im_1", sig) is None
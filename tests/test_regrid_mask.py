@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from caracal.workers.utils import regrid_mask
+
+RA, DEC = 150.0, -30.0
+
+
+def _write_mask(path, header, data):
+    fits.PrimaryHDU(data, header).writeto(path, overwrite=True)
+
+
+def _cube_header(npix, cell, crpix, nchan):
+    header = regrid_mask.sky_header(npix, npix, RA + 0.01, DEC - 0.01, cell, crpix, crpix)
+    header.update(NAXIS=3, NAXIS3=nchan, CTYPE3="FREQ", CRPIX3=1, CRVAL3=1.4e9, CDELT3=1e5, BSCALE=1.0)
+    return header
+
+
+def test_reproject_mask(tmp_path, monkeypatch):
+    # a cube mask of 3 channels on a coarser grid, offset from the target grid, with values > 1 and NaNs
+    source = _cube_header(60, 4 / 3600, 30, 3)
+    data = np.zeros((3, 60, 60), np.float32)
+    data[0, 20:30, 25:40] = 5
+    data[1, 40:45, 10:12] = 1
+    data[2] = np.nan
+    _write_mask(tmp_path / "mask.fits", source, data)
+    target = regrid_mask.sky_header(200, 150, RA, DEC, 1.5 / 3600, 101, 76)
+
+    regrid_mask.reproject_mask(str(tmp_path / "mask.fits"), str(tmp_path / "regrid.fits"), target, cachedir=str(tmp_path / "cache"))
+    with fits.open(tmp_path / "regrid.fits") as hdul:
+        header, out = hdul[0].header, hdul[0].data
+    assert out.dtype.kind == "i" and out.dtype.itemsize == 2 and out.shape == (3, 150, 200)
+    assert header["NAXIS1"] == 200 and header["CRPIX1"] == 101 and header["CDELT2"] == pytest.approx(1.5 / 3600)
+    assert header["CTYPE3"] == "FREQ" and header["NAXIS3"] == 3 and "BSCALE" not in header
+
+    # each target pixel takes the value of the source pixel nearest to its position
+    yy, xx = np.mgrid[:150, :200]
+    ra, dec = WCS(target).all_pix2world(xx, yy, 0)
+    sx, sy = (np.round(pp).astype(int) for pp in WCS(source).celestial.all_world2pix(ra, dec, 0))
+    inside = (sx >= 0) & (sx < 60) & (sy >= 0) & (sy < 60)
+    for chan in range(3):
+        expected = np.zeros((150, 200), bool)
+        expected[inside] = np.nan_to_num(data[chan][sy[inside], sx[inside]]) > 0
+        assert (out[chan] == expected).all()
+    assert out[0].sum() > 0 and out[1].sum() > 0 and not out[2].any()
+
+    # the mapping is saved, and reused by later runs
+    assert len(os.listdir(tmp_path / "cache")) == 1
+    regrid_mask._CACHE.clear()
+
+    def _fail(*args):
+        raise AssertionError("the mapping was recomputed")
+
+    monkeypatch.setattr(regrid_mask, "compute_mapping", _fail)
+    _write_mask(tmp_path / "mask.fits", source, data[::-1])
+    regrid_mask.reproject_mask(str(tmp_path / "mask.fits"), str(tmp_path / "regrid.fits"), target, cachedir=str(tmp_path / "cache"))
+    with fits.open(tmp_path / "regrid.fits") as hdul:
+        assert (hdul[0].data == out[::-1]).all()
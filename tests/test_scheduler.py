@@ -0,0 +1,109 @@
+import threading
+import time
+
+import pytest
+
+from caracal.dispatch_crew.scheduler import WorkerScheduler, worker_io
+
+
+def test_worker_io():
+    reads, writes = worker_io("crosscal", {"label_in": "cal", "label_cal": "1gc1"})
+    assert reads == {"ms:cal"}
+    assert {"ms:cal", "callib:1gc1"}.issubset(writes)
+
+    config = {
+        "label_in": "",
+        "label_out": "corr",
+        "rewind_flags": {"enable": False},
+        "split_field": {"enable": True, "otfcal": {"enable": True, "callib": "", "label_cal": "1gc1"}},
+    }
+    reads, writes = worker_io("transform", config)
+    assert reads == {"ms:", "callib:1gc1"}
+    assert writes == {"ms:corr"}
+
+    reads, writes = worker_io("inspect", {"label_in": "cal"})
+    assert reads == {"ms:cal"} and not writes
+
+
+def test_graph():
+    scheduler = WorkerScheduler(ncpu=4)
+    scheduler.add_worker("flag", "flag", {"label_in": "cal"})
+    scheduler.add_worker("crosscal", "crosscal", {"label_in": "cal", "label_cal": "1gc1"})
+    scheduler.add_worker("inspect", "inspect", {"label_in": "cal"})
+    scheduler.add_worker("transform", "transform", {"label_in": "", "label_out": "corr", "otfcal": {"label_cal": "1gc1"}})
+    scheduler.add_worker("flag__2", "flag", {"label_in": "corr"})
+
+    deps = {node.name: node.deps for node in scheduler.nodes}
+    assert deps["crosscal"] == {"flag"}
+    assert deps["inspect"] == {"flag", "crosscal"}
+    assert deps["transform"] == {"crosscal"}
+    assert deps["flag__2"] == {"transform"}
+
+
+def test_run():
+    scheduler = WorkerScheduler(ncpu=2, mem_limit=10)
+    scheduler.add_worker("a", "flag", {"label_in": "a"})
+    scheduler.add_worker("b", "flag", {"label_in": "b"})
+    scheduler.add_worker("c", "flag", {"label_in": "c"})
+    scheduler.add_worker("a2", "crosscal", {"label_in": "a", "ncpu": 2})
+
+    lock = threading.Lock()
+    order = []
+    running = set()
+    max_running = 0
+
+    def runner(node):
+        nonlocal max_running
+        with lock:
+            running.add(node.name)
+            max_running = max(max_running, len(running))
+        time.sleep(0.05)
+        with lock:
+            running.discard(node.name)
+            order.append(node.name)
+
+    scheduler.run(runner)
+    assert sorted(order) == ["a", "a2", "b", "c"]
+    assert order.index("a2") > order.index("a")
+    assert max_running == 2
+
+
+def test_run_failure():
+    scheduler = WorkerScheduler(ncpu=1)
+    scheduler.add_worker("a", "flag", {"label_in": "a"})
+    scheduler.add_worker("b", "flag", {"label_in": "a"})
+    called = []
+
+    def runner(node):
+        called.append(node.name)
+        raise RuntimeError(node.name)
+
+    with pytest.raises(RuntimeError):
+        scheduler.run(runner)
+    assert called == ["a"]
+
+
+def test_add_task():
+    scheduler = WorkerScheduler(ncpu=3, mem_limit=10, worker_mem=4)
+    for ii in range(4):
+        scheduler.add_task(f"ms{ii}", payload=ii)
+    assert all(not node.deps for node in scheduler.nodes)
+
+    lock = threading.Lock()
+    running = set()
+    max_running = 0
+    done = []
+
+    def runner(node):
+        nonlocal max_running
+        with lock:
+            running.add(node.payload)
+            max_running = max(max_running, len(running))
+        time.sleep(0.05)
+        with lock:
+            running.discard(node.payload)
+            done.append(node.payload)
+
+    scheduler.run(runner)
+    # 3 CPUs, but only 10 GB for 4 GB tasks
+    assert sorted(done) == [0, 1, 2, 3] and max_running == 2
@@ -0,0 +1,91 @@
+import itertools
+import json
+from datetime import datetime
+
+import casacore.tables as tables
+import numpy as np
+import pytest
+
+from caracal.dispatch_crew import msinfo, static_flagger
+
+NCHAN, NANT, NTIME = 64, 4, 20
+FREQS = 1.4e9 + 1.0e4 * np.arange(NCHAN)
+CORR_TYPE = [9, 10, 11, 12]  # XX, XY, YX, YY
+DAY = (datetime(2020, 1, 1) - datetime(1858, 11, 17)).days * 86400.0
+
+
+def _make_ms(path):
+    baselines = [(a1, a2) for a1, a2 in itertools.combinations_with_replacement(range(NANT), 2)]
+    tidx = np.repeat(np.arange(NTIME), len(baselines))
+    ant1, ant2 = np.array(baselines * NTIME).T
+    t = tables.default_ms(str(path))
+    t.addrows(len(tidx))
+    t.putcol("ANTENNA1", ant1)
+    t.putcol("ANTENNA2", ant2)
+    t.putcol("TIME", DAY + 8.0 * tidx)
+    t.putcol("INTERVAL", np.full(len(tidx), 8.0))
+    t.putcol("SCAN_NUMBER", 1 + tidx // 5)
+    t.putcol("FIELD_ID", (tidx // 5) % 2)
+    t.putcol("DATA_DESC_ID", np.zeros(len(tidx), int))
+    t.putcol("FLAG", np.zeros((len(tidx), NCHAN, len(CORR_TYPE)), bool))
+    t.putcol("FLAG_ROW", np.zeros(len(tidx), bool))
+    t.close()
+    for subtable, nrow, cols in [
+        ("SPECTRAL_WINDOW", 1, dict(NUM_CHAN=[NCHAN])),
+        ("POLARIZATION", 1, dict(NUM_CORR=[len(CORR_TYPE)])),
+        ("DATA_DESCRIPTION", 1, dict(SPECTRAL_WINDOW_ID=[0], POLARIZATION_ID=[0])),
+    ]:
+        with tables.table(f"{path}/{subtable}", readonly=False, ack=False) as st:
+            st.addrows(nrow)
+            for col, val in cols.items():
+                st.putcol(col, val)
+
+    summary = {
+        "FIELD": {"NAME": ["cal", "target"], "SOURCE_ID": [0, 1], "REFERENCE_DIR": [[[0.0, 0.0]], [[1.0, -0.5]]]},
+        "SPW": {"CHAN_FREQ": [FREQS.tolist()], "NUM_CHAN": [NCHAN]},
+        "ANT": {"NAME": [f"m00{ii}" for ii in range(NANT)], "POSITION": [[0.0, 0.0, 0.0]] * NANT},
+        "CORR": {"CORR_TYPE": ["XX", "XY", "YX", "YY"]},
+    }
+    summary_file = str(path).replace(".ms", "-summary.json")
+    with open(summary_file, "w") as stdw:
+        json.dump(summary, stdw)
+    return summary_file, tidx, ant1, ant2
+
+
+def test_static_flagger(tmp_path):
+    ms = str(tmp_path / "test.ms")
+    summary, tidx, ant1, ant2 = _make_ms(ms)
+    rules = [
+        ("autocorr", dict(mode="manual", autocorr=True, field="cal,target")),
+        ("quack", dict(mode="quack", quackinterval=10.0, quackmode="beg", field="target")),
+        ("spw", dict(mode="manual", spw="*:1400.1~1400.2MHz , 0:60~63", field="*")),
+        ("time", dict(mode="manual", timerange="00:01:00~00:01:30")),
+        ("scan", dict(mode="manual", scan="3")),
+        ("antenna", dict(mode="manual", antenna="m002", correlation="XY,YX", timerange="2020/01/01/00:00:00~2020/01/01/00:00:40")),
+    ]
+    info = msinfo.load(summary)
+    assert all(static_flagger.supported(args, info) for label, args in rules)
+    for args in dict(mode="shadow"), dict(antenna="m001&m002"), dict(spw="856~880MHz"), dict(mode="manual", uvrange="<100m"):
+        assert not static_flagger.supported(args, info)
+
+    expected = np.zeros((len(tidx), NCHAN, len(CORR_TYPE)), bool)
+    expected[ant1 == ant2] = True
+    expected[((tidx // 5) % 2 == 1) & (tidx % 5 < 2)] = True
+    expected[:, (FREQS >= 1400.1e6) & (FREQS <= 1400.2e6)] = True
+    expected[:, 60:] = True
+    expected[(tidx >= 8) & (tidx <= 11)] = True
+    expected[1 + tidx // 5 == 3] = True
+    expected[((ant1 == 2) | (ant2 == 2)) & (tidx <= 5), :, 1:3] = True
+
+    # 1 kB chunks hold 4 rows
+    report = static_flagger.flag_ms(ms, rules, summary, chunkSize=2**-10)
+    with tables.table(ms, ack=False) as t:
+        flag, flagRow = t.getcol("FLAG"), t.getcol("FLAG_ROW")
+    assert (flag == expected).all()
+    assert (flagRow == expected.all(axis=(1, 2))).all()
+    assert report["autocorr"]["selected"] == report["autocorr"]["new"] == pytest.approx(4 / 10)
+    assert sum(rr["new"] for rr in report.values()) == pytest.approx(expected.mean())
+
+    # flags are only ever added
+    report = static_flagger.flag_ms(ms, rules, summary)
+    assert sum(rr["new"] for rr in report.values()) == 0
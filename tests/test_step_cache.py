@@ -0,0 +1,122 @@
+import os
+from types import SimpleNamespace
+
+from caracal.dispatch_crew.step_cache import StepCache
+
+
+def _touch(path, content):
+    with open(path, "w") as stdw:
+        stdw.write(content)
+    # make sure the mtime moves on, even on coarse-grained filesystems
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+
+def _step(msname, prefix):
+    pass
+
+
+def _job(params, label="step"):
+    return SimpleNamespace(job={"function": _step, "parameters": params}, label=label, version=None, tag=None)
+
+
+def _run(cache, recipe, steps):
+    """Runs a recipe of (job, action) steps as CaracalRecipe.run does. Returns True if it was skipped."""
+    if cache.skip([job for job, action in steps], recipe):
+        return True
+    for job, action in steps:
+        inputs = cache.fingerprints(job, recipe)
+        action()
+        cache.record(job, recipe, inputs)
+    return False
+
+
+def test_step_cache(tmp_path):
+    msname = tmp_path / "test.ms"
+    msname.mkdir()
+    _touch(msname / "table.dat", "a")
+
+    recipe = SimpleNamespace(msdir=str(tmp_path), indir=None, outdir=str(tmp_path))
+    params = {"msname": str(msname), "prefix": "image:output"}
+    job = _job(params)
+
+    def _image():
+        _touch(tmp_path / "image-MFS-image.fits", "image")
+
+    assert not _run(StepCache(str(tmp_path / "cache")), recipe, [(job, _image)])
+    # a new run finds everything as the previous one left it
+    assert _run(StepCache(str(tmp_path / "cache")), recipe, [(job, _image)])
+
+    # opening a table updates its lock file, which must not invalidate the cache
+    _touch(msname / "table.lock", "locked")
+    assert _run(StepCache(str(tmp_path / "cache")), recipe, [(job, _image)])
+
+    # products changed after the step ran, under a referenced prefix, invalidate it
+    _touch(tmp_path / "image-MFS-image.fits", "edited")
+    assert not _run(StepCache(str(tmp_path / "cache")), recipe, [(job, _image)])
+    assert _run(StepCache(str(tmp_path / "cache")), recipe, [(job, _image)])
+
+    # as do changes to the MS
+    _touch(msname / "table.dat", "b")
+    assert not _run(StepCache(str(tmp_path / "cache")), recipe, [(job, _image)])
+
+    # and different parameters make a different step
+    other = _job(dict(params, prefix="other:output"))
+    assert not _run(StepCache(str(tmp_path / "cache")), recipe, [(other, lambda: None)])
+
+
+def test_step_cache_no_files(tmp_path):
+    recipe = SimpleNamespace(msdir=str(tmp_path), indir=None, outdir=None)
+    job = _job({"msname": "missing.ms"})
+    cache = StepCache(str(tmp_path / "cache"))
+    cache.record(job, recipe, cache.fingerprints(job, recipe))
+    # steps without files are always run, and do not stop the other steps of a recipe from being skipped
+    assert cache.skip([job], recipe)
+    assert cache.job_paths(job, recipe) == set()
+
+
+def test_step_cache_in_place(tmp_path):
+    # recipes of steps that change the MS in place, one after the other, as flagging and applycal do
+    msname = tmp_path / "test.ms"
+    msname.mkdir()
+    _touch(msname / "FLAG", "raw")
+    recipe = SimpleNamespace(msdir=str(tmp_path), indir=None, outdir=str(tmp_path))
+    runs = []
+
+    def _flag(content):
+        def action():
+            runs.append(content)
+            _touch(msname / "FLAG", content)
+
+        return action
+
+    def _rewind():
+        runs.append("rewind")
+        _touch(msname / "FLAG", "raw")
+
+    def _recipe(name, flags):
+        rewind = (_job({"msname": str(msname), "rewind": name}), _rewind)
+        return [rewind, (_job({"msname": str(msname), "flags": flags}), _flag(flags))]
+
+    def _pipeline(*recipes):
+        cache = StepCache(str(tmp_path / "cache"))
+        del runs[:]
+        return [_run(cache, recipe, steps) for steps in recipes]
+
+    assert _pipeline(_recipe("w1", "p1"), _recipe("w2", "q1")) == [False, False]
+    # a rerun skips every recipe, although the later one changed the MS after the earlier one ran
+    assert _pipeline(_recipe("w1", "p1"), _recipe("w2", "q1")) == [True, True] and not runs
+    # a changed later recipe runs, and the earlier one is still skipped
+    assert _pipeline(_recipe("w1", "p1"), _recipe("w2", "q2")) == [True, False] and runs == ["rewind", "q2"]
+    assert _pipeline(_recipe("w1", "p1"), _recipe("w2", "q2")) == [True, True]
+
+    # a recipe whose flags were undone and replaced by another one's runs again
+    assert _pipeline(_recipe("w", "p1")) == [False]
+    assert _pipeline(_recipe("w", "p2")) == [False]
+    assert _pipeline(_recipe("w", "p1")) == [False] and runs == ["rewind", "p1"]
+    assert (msname / "FLAG").read_text() == "p1"
+    assert _pipeline(_recipe("w", "p1")) == [True]
+
+    # changes made outside of recorded steps invalidate them all
+    _touch(msname / "FLAG", "edited")
+    assert _pipeline(_recipe("w", "p1")) == [False]
@@ -0,0 +1,76 @@
+import logging
+import os
+
+from caracal.dispatch_crew import warm_pool
+from caracal.dispatch_crew.warm_pool import WARM_MOUNT, WarmPool
+
+MOUNT = warm_pool.MOUNT
+
+
+class FakeContainer(object):
+    def __init__(self, tmp_path, cab, msdir):
+        self.image = str(tmp_path / "casa.sif")
+        self.parameter_file_name = str(tmp_path / f"{cab}.json")
+        for path in self.image, self.parameter_file_name, tmp_path / "passwd", tmp_path / "group":
+            open(path, "w").close()
+        self.RUNSCRIPT = "/singularity"
+        self.volumes = [
+            f"{self.parameter_file_name}:{MOUNT}/configfile:ro",
+            f"/cargo/cab/{cab}/src:{MOUNT}/code:ro",
+            f"{tmp_path}/passwd:/etc/passwd:rw",
+            f"{tmp_path}/group:/etc/group:rw",
+            f"/cargo/cab/stimela_runscript:{self.RUNSCRIPT}:ro",
+            f"{msdir}:{MOUNT}/msdir:rw",
+        ]
+        self._env = {"SINGULARITYENV_CONFIG": f"{MOUNT}/configfile"}
+        self.logger = logging.getLogger("test")
+        self.time_out = -1
+        self.logfile = None
+
+
+class FakeJob(object):
+    jtype = "singularity"
+
+    def __init__(self, cont):
+        self.job = cont
+
+
+def test_warm_pool(tmp_path, monkeypatch):
+    commands = []
+
+    def fake_xrun(command, options, env=None, **kw):
+        commands.append((" ".join(command.split()[1:3]), options, env))
+
+    monkeypatch.setattr(warm_pool, "xrun", fake_xrun)
+    monkeypatch.setattr(warm_pool.singularity, "BINARY", "apptainer")
+    monkeypatch.setattr(warm_pool.singularity, "BINARY_NAME", "apptainer")
+    pool = WarmPool(str(tmp_path / "pool"), max_instances=1)
+
+    # two cabs of the same image on the same MS directory share an instance
+    starts = []
+    for cab in "casa_flagdata", "casa_listobs":
+        job = FakeJob(FakeContainer(tmp_path, cab, "/data/msdir"))
+        with pool.attach(job):
+            job.job.run(output_wrangler=None)
+        assert "run" not in vars(job.job)
+        starts.append(job.job.warm_start)
+    assert starts[0] > 0 and starts[1] == 0
+    start, run1, run2 = commands
+    assert start[0] == "instance start" and f"/cargo/cab:{WARM_MOUNT}/cabs:ro" in start[1][0]
+    assert run1[0] == run2[0] == f"exec instance://{start[1][-1]}" and run1[1] == [warm_pool.RUNSCRIPT]
+    assert run1[2]["APPTAINERENV_WARM_CODE"] == f"{WARM_MOUNT}/cabs/casa_flagdata/src"
+    assert run2[2]["APPTAINERENV_CONFIG"].endswith("casa_listobs.json")
+    assert os.listdir(pool.config_dir) == []
+
+    # a different MS directory needs a new instance, and the idle one is stopped
+    commands.clear()
+    job = FakeJob(FakeContainer(tmp_path, "casa_flagdata", "/data/other"))
+    with pool.attach(job):
+        job.job.run(output_wrangler=None)
+    stop, start, run = commands
+    assert stop[0] == "instance stop" and stop[1] == run1[0].split("//")[1:]
+    assert start[0] == "instance start" and run[0] == f"exec instance://{start[1][-1]}"
+
+    commands.clear()
+    pool.shutdown()
+    assert commands == [("instance stop", [start[1][-1]], None)] and not os.path.exists(pool.pool_dir)